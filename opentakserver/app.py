@@ -37,13 +37,20 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 import opentakserver
 from opentakserver.certificate_authority import CertificateAuthority
 from opentakserver.controllers.meshtastic_controller import MeshtasticController
+from opentakserver.cot_storage import cot_storage
 from opentakserver.defaultconfig import DefaultConfig
 from opentakserver.EmailValidator import EmailValidator
 from opentakserver.extensions import apscheduler, babel, db, ldap_manager, logger, mail, socketio
+from opentakserver.group_cache import GROUP_CHANGES_EXCHANGE, GroupChangeListener
+from opentakserver.map_state import rebuild_map_state
+from opentakserver.models.EUD import EUD
 from opentakserver.models.Group import Group, GroupTypeEnum
 from opentakserver.models.Icon import Icon
+from opentakserver.models.MapState import MapState
+from opentakserver.models.Marker import Marker
 from opentakserver.models.role import Role
 from opentakserver.models.WebAuthn import WebAuthn
+from opentakserver.partitions import maintain_partitions
 from opentakserver.PasswordValidator import PasswordValidator
 from opentakserver.plugins.Plugin import Plugin
 from opentakserver.plugins.PluginManager import PluginManager
@@ -79,6 +86,9 @@ def init_extensions(app):
                 os.path.dirname(os.path.realpath(opentakserver.__file__)), "migrations"
             )
         )
+        maintain_partitions(db.session.connection())
+        db.session.commit()
+        cot_storage.init_app(app)
         # Flask-Migrate does weird things to the logger
         logger.disabled = False
         logger.parent.handlers.pop()
@@ -171,6 +181,9 @@ def init_extensions(app):
         "firehose", durable=True, exchange_type="fanout"
     )  # A firehose of all CoT data
     channel.exchange_declare("flask-socketio", durable=False, exchange_type="fanout")
+    channel.exchange_declare(
+        GROUP_CHANGES_EXCHANGE, durable=True, exchange_type="fanout"
+    )  # Invalidates the group membership caches
     channel.close()
     rabbit_connection.close()
 
@@ -448,6 +461,18 @@ def main(app):
                 logger.error("Failed to download icons: {}".format(e))
                 logger.debug(traceback.format_exc())
 
+        # Fill the map_state table the first time the server starts after it was added
+        if (
+            db.session.query(MapState).count() == 0
+            and db.session.query(EUD).count() + db.session.query(Marker).count() > 0
+        ):
+            try:
+                rebuild_map_state()
+            except BaseException as e:
+                db.session.rollback()
+                logger.error("Failed to build the map state: {}".format(e))
+                logger.debug(traceback.format_exc())
+
         if app.config.get("DEBUG"):
             logger.debug("Starting in debug mode")
         else:
@@ -503,6 +528,10 @@ def main(app):
             logger.error(f"Failed to load plugins: {e}")
             logger.debug(traceback.format_exc())
 
+    # Group memberships changed by other processes have to be dropped from this process's cache too
+    group_change_listener = GroupChangeListener(app)
+    group_change_listener.start()
+
     app.start_time = datetime.now(timezone.utc)
 
     create_default_groups(app)
@@ -0,0 +1,206 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from flask import Response
+from flask import current_app as app
+from flask import request, send_file
+
+from opentakserver.extensions import db
+from opentakserver.models.DataPackage import DataPackage
+from opentakserver.models.MissionContent import MissionContent
+from opentakserver.uploads import SHA256_PATTERN, write_temp_file
+
+
+class FileSystemBlobStore:
+    """Files stored by the SHA256 of their contents in sharded folders, i.e. <root>/ab/cd/abcd1234...
+
+    Files saved before the blob store existed are still found in the upload folder as <hash>.zip
+    """
+
+    def __init__(self, root: str, legacy_folder: str | None = None, levels: int = 2):
+        self.root = root
+        self.legacy_folder = legacy_folder
+        self.levels = levels
+        self.temp_folder = os.path.join(root, "tmp")
+
+    def path(self, sha256: str) -> str:
+        if not SHA256_PATTERN.match(sha256):
+            raise ValueError(f"Invalid SHA256 hash: {sha256}")
+
+        sha256 = sha256.lower()
+        shards = [sha256[i * 2 : i * 2 + 2] for i in range(self.levels)]
+        return os.path.join(self.root, *shards, sha256)
+
+    def find(self, sha256: str, extension: str = ".zip") -> str | None:
+        """The path of a blob, or None if it isn't stored"""
+        path = self.path(sha256)
+        if os.path.exists(path):
+            return path
+
+        if self.legacy_folder:
+            path = os.path.join(self.legacy_folder, f"{sha256.lower()}{extension}")
+            if os.path.exists(path):
+                return path
+
+        return None
+
+    def put(self, temp_path: str, sha256: str) -> str:
+        """Moves a file written to temp_folder into the store. Renaming is atomic so a blob is never partially
+        written"""
+        path = self.path(sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return path
+
+    def store(self, stream, expected_hash: str | None = None) -> tuple[str, int]:
+        """Saves a stream without holding it in memory. Returns its hash and size.
+
+        If the client sent the hash and that blob already exists, nothing is written. Raises ValueError if
+        expected_hash isn't a SHA256 or doesn't match what was received
+        """
+        if expected_hash:
+            path = self.find(expected_hash)
+            if path:
+                return expected_hash.lower(), os.path.getsize(path)
+
+        temp_path, sha256, size = write_temp_file(stream, self.temp_folder)
+        if expected_hash and sha256 != expected_hash.lower():
+            os.remove(temp_path)
+            raise ValueError(f"Expected a file with the hash {expected_hash} but got {sha256}")
+
+        self.put(temp_path, sha256)
+        return sha256, size
+
+    def delete(self, sha256: str):
+        for path in (self.path(sha256), self.find(sha256)):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+
+blob_stores: dict[str, FileSystemBlobStore] = {}
+
+
+def get_blob_store() -> FileSystemBlobStore:
+    """The blob store for the app's OTS_BLOB_FOLDER. Must be called in an app context"""
+    root = app.config.get("OTS_BLOB_FOLDER")
+    if root not in blob_stores:
+        blob_stores[root] = FileSystemBlobStore(root, app.config.get("UPLOAD_FOLDER"))
+    return blob_stores[root]
+
+
+@dataclass
+class Blob:
+    sha256: str
+    path: str
+    filename: str
+    mime_type: str | None
+
+
+class BlobIndex:
+    """LRU of hash -> file lookups for data packages and mission content so downloads don't query the database
+    and probe the disk every time"""
+
+    def __init__(self):
+        # hash -> (blob, time it was looked up)
+        self.blobs: OrderedDict[str, tuple[Blob, float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def resolve(self, sha256: str) -> Blob | None:
+        """Finds the file with a hash. Must be called in an app context"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.blobs.get(sha256)
+            if entry is not None:
+                blob, looked_up = entry
+                # Entries expire so rows deleted by other workers stop being served
+                if now - looked_up < app.config.get("OTS_BLOB_INDEX_TTL") and os.path.exists(
+                    blob.path
+                ):
+                    self.blobs.move_to_end(sha256)
+                    return blob
+                del self.blobs[sha256]
+
+        blob = self.lookup(sha256)
+        if blob is None:
+            return None
+
+        with self.lock:
+            self.blobs[sha256] = (blob, now)
+            while len(self.blobs) > app.config.get("OTS_BLOB_INDEX_SIZE"):
+                self.blobs.popitem(last=False)
+
+        return blob
+
+    @staticmethod
+    def lookup(sha256: str) -> Blob | None:
+        if not SHA256_PATTERN.match(sha256):
+            return None
+
+        row = db.session.execute(
+            db.select(DataPackage.filename, DataPackage.mime_type).filter_by(hash=sha256)
+        ).first()
+        if not row:
+            row = db.session.execute(
+                db.select(MissionContent.filename, MissionContent.mime_type).filter_by(hash=sha256)
+            ).first()
+        if not row:
+            return None
+
+        filename, mime_type = row
+        name, extension = os.path.splitext(filename)
+        path = get_blob_store().find(sha256, extension)
+
+        # Mission content used to be saved under its file name
+        legacy_path = os.path.join(app.config.get("OTS_DATA_FOLDER"), "missions", filename)
+        if not path and os.path.exists(legacy_path):
+            path = legacy_path
+
+        if not path:
+            return None
+
+        return Blob(sha256, path, filename, mime_type)
+
+    def invalidate(self, sha256: str):
+        with self.lock:
+            self.blobs.pop(sha256, None)
+
+
+blob_index = BlobIndex()
+
+
+def send_blob(blob: Blob, as_attachment: bool = False) -> Response:
+    """Sends a blob with a strong ETag of its hash so clients can use If-None-Match and Range requests.
+
+    When OTS_BLOB_ACCEL_REDIRECT is set, nginx sends the file instead. It should be an internal location whose
+    alias is OTS_BLOB_FOLDER
+    """
+    accel_redirect = app.config.get("OTS_BLOB_ACCEL_REDIRECT")
+    store = get_blob_store()
+    if not accel_redirect or os.path.commonpath([store.root, blob.path]) != store.root:
+        return send_file(
+            blob.path,
+            mimetype=blob.mime_type,
+            as_attachment=as_attachment,
+            download_name=blob.filename,
+            etag=blob.sha256,
+            conditional=True,
+        )
+
+    response = Response(mimetype=blob.mime_type or "application/octet-stream")
+    response.set_etag(blob.sha256)
+    response.headers.set(
+        "Content-Disposition",
+        "attachment" if as_attachment else "inline",
+        filename=blob.filename,
+    )
+
+    if request.if_none_match.contains(blob.sha256):
+        response.status_code = 304
+        return response
+
+    relative_path = os.path.relpath(blob.path, store.root).replace(os.sep, "/")
+    response.headers["X-Accel-Redirect"] = f"{accel_redirect.rstrip('/')}/{relative_path}"
+    return response
@@ -7,10 +7,20 @@ import yaml
 from flask import current_app as app
 from flask import g
 from flask.cli import with_appcontext
+from sqlalchemy import select
 
 from opentakserver.certificate_authority import CertificateAuthority
+from opentakserver.cot_storage import (
+    benchmark,
+    cot_storage,
+    migrate_stored_cots,
+    train_cot_dictionary,
+    zstandard,
+)
 from opentakserver.defaultconfig import DefaultConfig
-from opentakserver.extensions import logger
+from opentakserver.extensions import db, logger
+from opentakserver.models.CoT import CoT
+from opentakserver.partitions import INTERVALS, PARTITIONED_TABLES, is_partitioned, partition_table
 
 
 @click.group()
@@ -44,6 +54,28 @@ def issue_certificate(cn):
         ca.issue_certificate(cn)
 
 
+@ots.command()
+@with_appcontext
+@click.option("--server", required=True, help="The server's address to put in the data packages")
+@click.argument("common_names", nargs=-1, required=True)
+def issue_certificates(server, common_names):
+    """Issues client certificates for several common names, generating their keys in parallel"""
+    ca = CertificateAuthority(logger, app)
+    if ca.check_if_ca_exists():
+        # The data packages get the server's address from the request
+        with app.test_request_context(base_url=f"https://{server}"):
+            ca.issue_certificates(list(common_names))
+
+
+@ots.command()
+@with_appcontext
+@click.argument("cn")
+def revoke_certificate(cn):
+    ca = CertificateAuthority(logger, app)
+    if ca.check_if_ca_exists():
+        ca.revoke_certificate(cn)
+
+
 @ots.command()
 @with_appcontext
 def issue_server_certificate():
@@ -83,6 +115,82 @@ def generate_config(overwrite):
         config.write(yaml.safe_dump(conf))
 
 
+@ots.command()
+@with_appcontext
+@click.option(
+    "--interval",
+    type=click.Choice(list(INTERVALS)),
+    help="Defaults to OTS_PARTITION_INTERVAL",
+)
+def partition_tables(interval):
+    """Partitions the cot and points tables by timestamp on PostgreSQL. Rewrites both tables"""
+    interval = interval or app.config.get("OTS_PARTITION_INTERVAL")
+    if interval not in INTERVALS:
+        logger.error(f"Please set OTS_PARTITION_INTERVAL to one of {', '.join(INTERVALS)}")
+        return
+
+    connection = db.session.connection()
+    if connection.dialect.name != "postgresql":
+        logger.error("Partitioning is only supported on PostgreSQL")
+        return
+
+    for table in PARTITIONED_TABLES:
+        if is_partitioned(connection, table):
+            logger.warning(f"The {table} table is already partitioned")
+        else:
+            partition_table(connection, table, interval, app.config.get("OTS_PARTITIONS_AHEAD"))
+    db.session.commit()
+
+
+@ots.command("train-cot-dictionary")
+@with_appcontext
+def train_dictionary():
+    """Trains a new zstd dictionary on the newest CoTs for OTS_COT_STORAGE zstd"""
+    if zstandard is None:
+        logger.error("Please install the zstandard package")
+        return
+
+    cot_storage.init_app(app)
+    train_cot_dictionary()
+
+
+@ots.command()
+@with_appcontext
+def compress_cots():
+    """Re-encodes every CoT stored as raw XML with the OTS_COT_STORAGE codec"""
+    cot_storage.init_app(app)
+    migrate_stored_cots(app.config.get("OTS_COT_MIGRATION_BATCH_SIZE"))
+
+
+@ots.command()
+@with_appcontext
+@click.option("--samples", default=10000, help="How many of the newest CoTs to encode")
+def benchmark_cot_storage(samples):
+    """Reports the size and encode and decode time of the newest CoTs with each OTS_COT_STORAGE codec"""
+    cot_storage.init_app(app)
+    cot_storage.load_dictionaries()
+    xml = [
+        cot
+        for cot in db.session.execute(select(CoT.xml).order_by(CoT.id.desc()).limit(samples))
+        .scalars()
+        .all()
+        if cot
+    ]
+    if not xml:
+        logger.error("There are no CoTs to benchmark")
+        return
+
+    click.echo(
+        f"{len(xml)} CoTs, dictionary {cot_storage.dictionary.dict_id() if cot_storage.dictionary else None}"
+    )
+    click.echo(f"{'codec':<10}{'bytes/event':>14}{'encode µs':>12}{'decode µs':>12}")
+    for result in benchmark(xml):
+        click.echo(
+            f"{result['codec']:<10}{result['bytes_per_event']:>14.1f}"
+            f"{result['encode_us']:>12.1f}{result['decode_us']:>12.1f}"
+        )
+
+
 @click.group()
 @click.option(
     "-x", "--x-arg", multiple=True, help="Additional arguments consumed by custom env.py scripts"
@@ -1,15 +1,21 @@
 import datetime
 from xml.etree.ElementTree import Element, fromstring, tostring
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 from flask_babel import gettext
+from sqlalchemy import select
 
 from opentakserver.extensions import db, logger
 from opentakserver.functions import datetime_from_iso8601_string
+from opentakserver.geo_index import bbox_filter, parse_bbox
 from opentakserver.models.CoT import CoT
+from opentakserver.models.Point import Point
 
 cot_marti_api = Blueprint("cot_api", __name__)
 
+# How many rows streamed <events> responses fetch from the DB at a time
+SA_ROWS_PER_FETCH = 500
+
 """
 Right now OpenTAKServer only uses a few of these for Data Sync. The rest were added as place holders 
 based on the API docs until I find an example of them actually being used by a TAK client 
@@ -75,14 +81,56 @@ def get_all_cot(uid):
 
 @cot_marti_api.route("/Marti/api/cot/sa")
 def get_cot_by_time_and_bbox():
+    """CoTs with a point in the bounding box, optionally between start and end, as an <events> document.
+
+    :param left: Western longitude of the box. The box crosses the antimeridian when left is greater than right
+    :param bottom: Southern latitude of the box
+    :param right: Eastern longitude of the box
+    :param top: Northern latitude of the box
+    :param start: Optional ISO8601 timestamp
+    :param end: Optional ISO8601 timestamp
+    """
     logger.debug(request.headers)
     logger.debug(request.args)
 
-    start = request.args.get("start")
-    end = request.args.get("end")
-    left = request.args.get("left")
-    bottom = request.args.get("bottom")
-    right = request.args.get("right")
-    top = request.args.get("top")
+    try:
+        bbox = parse_bbox(request.args)
+        if bbox is None:
+            raise ValueError("left, bottom, right and top are all required")
+    except ValueError as e:
+        return (
+            jsonify({"success": False, "error": gettext("Invalid bounding box: %(e)s", e=e)}),
+            400,
+        )
 
-    return "", 200
+    query = select(CoT.xml).join(Point, Point.cot_id == CoT.id).where(bbox_filter(Point, *bbox))
+
+    try:
+        if request.args.get("start"):
+            query = query.where(
+                Point.timestamp >= datetime_from_iso8601_string(request.args.get("start"))
+            )
+        if request.args.get("end"):
+            query = query.where(
+                Point.timestamp <= datetime_from_iso8601_string(request.args.get("end"))
+            )
+    except ValueError:
+        return jsonify({"success": False, "error": gettext("Invalid start or end time")}), 400
+
+    return stream_events(query.order_by(Point.timestamp))
+
+
+def stream_events(query) -> Response:
+    """Streams the XML of each row of a select(CoT.xml) query inside <events> without parsing it"""
+    query = query.execution_options(yield_per=SA_ROWS_PER_FETCH)
+
+    def generate():
+        yield "<events>"
+        for (xml,) in db.session.execute(query):
+            # Strip the XML declaration so each event can go inside <events>
+            if xml.startswith("<?xml"):
+                xml = xml[xml.index("?>") + 2 :]
+            yield xml
+        yield "</events>"
+
+    return Response(stream_with_context(generate()), mimetype="application/xml")
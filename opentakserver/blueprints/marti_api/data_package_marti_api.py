@@ -1,6 +1,6 @@
-import hashlib
 import io
 import os
+import tempfile
 import traceback
 import uuid
 import zipfile
@@ -12,43 +12,38 @@ import bleach
 import sqlalchemy
 from flask import Blueprint
 from flask import current_app as app
-from flask import jsonify, request, send_from_directory
+from flask import jsonify, request
 from flask_babel import gettext
 from flask_login import current_user
 from werkzeug.datastructures.file_storage import FileStorage
 from werkzeug.utils import secure_filename
 
+from opentakserver.blob_store import blob_index, get_blob_store, send_blob
 from opentakserver.extensions import db, logger
 from opentakserver.functions import format_bytes, iso8601_string_from_datetime
 from opentakserver.models.DataPackage import DataPackage
-from opentakserver.models.MissionContent import MissionContent
+from opentakserver.uploads import copy_stream, hash_file, hash_stream
 
 data_package_marti_api = Blueprint("data_package_marti_api", __name__)
 
 
 def save_data_package_file(file, filename: str = None, username: str = None, eud_uid: str = None):
-    file_hash = request.args.get("hash")
-    if not file_hash:
-        sha256 = hashlib.sha256()
-        if type(file) == bytes:
-            sha256.update(file)
-            file_hash = sha256.hexdigest()
-            filename, extension = os.path.splitext(secure_filename(filename))
-            with open(os.path.join(app.config.get("UPLOAD_FOLDER"), f"{file_hash}.zip"), "wb") as f:
-                f.write(file)
-        else:
-            sha256.update(file.stream.read())
-            file.stream.seek(0)
-            file_hash = sha256.hexdigest()
-            file.save(os.path.join(app.config.get("UPLOAD_FOLDER"), f"{file_hash}.zip"))
-            filename, extension = os.path.splitext(secure_filename(file.filename))
-            logger.debug("Got file: {} - {}".format(file.filename, file_hash))
+    """Saves a data package in the blob store. file can be a FileStorage, bytes or a binary stream.
+
+    Raises ValueError if the hash sent by the client is invalid or doesn't match the file
+    """
+    if isinstance(file, FileStorage):
+        filename = file.filename
+        stream = file.stream
+    elif isinstance(file, bytes):
+        stream = io.BytesIO(file)
     else:
-        file.save(os.path.join(app.config.get("UPLOAD_FOLDER"), f"{file_hash}.zip"))
-        filename, extension = os.path.splitext(secure_filename(file.filename))
-        logger.debug("Got file: {} - {}".format(file.filename, file_hash))
+        stream = file
+
+    file_hash, file_size = get_blob_store().store(stream, request.args.get("hash"))
+    filename, extension = os.path.splitext(secure_filename(filename))
+    logger.debug("Got file: {} - {}".format(filename, file_hash))
 
-    file_size = os.path.getsize(os.path.join(app.config.get("UPLOAD_FOLDER"), f"{file_hash}.zip"))
     save_data_package_to_db(
         f"{filename}.zip", file_hash, "application/x-zip-compressed", file_size, username, eud_uid
     )
@@ -103,29 +98,20 @@ def create_data_package_zip(file: FileStorage | str) -> str:
     else:
         filename, extension = os.path.splitext(secure_filename(file.filename))
 
-    zipf = zipfile.ZipFile(
-        os.path.join(app.config.get("UPLOAD_FOLDER"), f"{filename}.zip"),
-        "a",
-        zipfile.ZIP_DEFLATED,
-        False,
-    )
+    blob_store = get_blob_store()
+    os.makedirs(blob_store.temp_folder, exist_ok=True)
+    zip_file = tempfile.NamedTemporaryFile(dir=blob_store.temp_folder, suffix=".tmp", delete=False)
+    zipf = zipfile.ZipFile(zip_file, "w", zipfile.ZIP_DEFLATED, False)
 
     # Use the md5 of the uploaded file as its folder name in the data package zip
-    md5 = hashlib.md5()
-    try:
-        md5.update(file.stream.read())
-        file.stream.seek(0)
-    except AttributeError:
-        with open(file, "r") as f:
-            md5.update(f.read().encode())
-
-    md5_hash = md5.hexdigest()
-
     if isinstance(file, str):
-        with open(file, "r") as f:
-            zipf.writestr(f"{md5_hash}/{secure_filename(filename + extension)}", f.read())
+        md5_hash = hash_file(file, "md5")
+        zipf.write(file, f"{md5_hash}/{secure_filename(filename + extension)}")
     else:
-        zipf.writestr(f"{md5_hash}/{secure_filename(filename + extension)}", file.stream.read())
+        md5_hash = hash_stream(file.stream, "md5")
+        file.stream.seek(0)
+        with zipf.open(f"{md5_hash}/{secure_filename(filename + extension)}", "w") as entry:
+            copy_stream(file.stream, entry)
 
     # MANIFEST file
     manifest = Element("MissionPackageManifest", {"version": "2"})
@@ -154,23 +140,13 @@ def create_data_package_zip(file: FileStorage | str) -> str:
 
     zipf.writestr("MANIFEST/manifest.xml", tostring(manifest))
     zipf.close()
-
-    # Get the sha256 hash of the data package zip for its file name on disk and for the data_packages table
-    zip_file = open(os.path.join(app.config.get("UPLOAD_FOLDER"), f"{filename}.zip"), "rb")
-    zip_file_bytes = zip_file.read()
     zip_file.close()
 
-    sha256 = hashlib.sha256()
-    sha256.update(zip_file_bytes)
-    data_package_hash = sha256.hexdigest()
-
-    os.rename(
-        os.path.join(app.config.get("UPLOAD_FOLDER"), f"{filename}.zip"),
-        os.path.join(app.config.get("UPLOAD_FOLDER"), f"{data_package_hash}.zip"),
-    )
-    save_data_package_to_db(
-        f"{filename}.zip", data_package_hash, "application/zip", len(zip_file_bytes)
-    )
+    # Get the sha256 hash of the data package zip for the blob store and for the data_packages table
+    data_package_hash = hash_file(zip_file.name)
+    file_size = os.path.getsize(zip_file.name)
+    blob_store.put(zip_file.name, data_package_hash)
+    save_data_package_to_db(f"{filename}.zip", data_package_hash, "application/zip", file_size)
 
     return data_package_hash
 
@@ -208,7 +184,11 @@ def data_package_share():
         if extension != "zip":
             file_hash = create_data_package_zip(file)
         else:
-            file_hash = save_data_package_file(file)
+            try:
+                file_hash = save_data_package_file(file)
+            except ValueError as e:
+                logger.error(f"Failed to save data package: {e}")
+                return jsonify({"success": False, "error": str(e)}), 400
 
         url = urlparse(request.url_root)
         return (
@@ -239,14 +219,10 @@ def data_package_metadata(file_hash):
             logger.error(traceback.format_exc())
             return {"error": str(e)}, 500
     elif request.method == "GET":
-        data_package = db.session.execute(
-            db.select(DataPackage).filter_by(hash=file_hash)
-        ).scalar_one()
-        return send_from_directory(
-            app.config.get("UPLOAD_FOLDER"),
-            data_package.hash + ".zip",
-            download_name=data_package.filename,
-        )
+        blob = blob_index.resolve(file_hash)
+        if not blob:
+            return "", 404
+        return send_blob(blob)
 
 
 @data_package_marti_api.route("/Marti/api/sync/search", methods=["GET"])
@@ -351,42 +327,17 @@ def data_package_search():
 @data_package_marti_api.route("/Marti/sync/content", methods=["GET", "HEAD"])
 def download_data_package():
     file_hash = request.args.get("hash")
-    file = db.session.execute(db.select(DataPackage).filter_by(hash=file_hash)).first()
-    if not file:
-        file = db.session.execute(db.select(MissionContent).filter_by(hash=file_hash)).first()
-    if not file and request.method == "HEAD":
+    blob = blob_index.resolve(file_hash) if file_hash else None
+    if not blob and request.method == "HEAD":
         return "", 404
-    elif not file:
+    elif not blob:
         return (
             jsonify({"success": False, "error": f"No data package found with hash {file_hash}"}),
             404,
         )
-    elif file and request.method == "HEAD":
-        return "", 200
-
-    filename, extension = os.path.splitext(secure_filename(file[0].filename))
-    if os.path.exists(os.path.join(app.config.get("UPLOAD_FOLDER"), f"{file_hash}{extension}")):
-        return send_from_directory(
-            app.config.get("UPLOAD_FOLDER"),
-            f"{file_hash}{extension}",
-            download_name=file[0].filename,
-        )
-    elif os.path.exists(
-        os.path.join(app.config.get("OTS_DATA_FOLDER"), "missions", file[0].filename)
-    ):
-        return send_from_directory(
-            os.path.join(app.config.get("OTS_DATA_FOLDER"), "missions"), file[0].filename
-        )
-    else:
-        return (
-            jsonify(
-                {
-                    "success": False,
-                    "error": gettext("File not found: %(filename)s}", filename=file[0].filename),
-                }
-            ),
-            404,
-        )
+
+    # HEAD requests get the same headers as GET, including the ETag and Content-Length
+    return send_blob(blob)
 
 
 @data_package_marti_api.route("/Marti/sync/missionquery")
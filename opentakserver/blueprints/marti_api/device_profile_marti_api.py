@@ -1,26 +1,28 @@
 import datetime
-import io
+import hashlib
 import os
 import re
 import traceback
 import uuid
 import zipfile
+from typing import BinaryIO
 from urllib.parse import urlparse
 from xml.etree.ElementTree import Element, SubElement, tostring
 
-from flask import Blueprint, Response
+from flask import Blueprint
 from flask import current_app as app
-from flask import request
+from flask import request, send_file
 from sqlalchemy import or_
-from werkzeug.wsgi import FileWrapper
 
 import opentakserver
+from opentakserver.blob_store import get_blob_store
 from opentakserver.blueprints.marti_api.marti_api import verify_client_cert
 from opentakserver.extensions import db, ldap_manager, logger
 from opentakserver.models.DataPackage import DataPackage
 from opentakserver.models.DeviceProfiles import DeviceProfiles
 from opentakserver.models.Packages import Packages
 from opentakserver.models.Plugins import Plugins
+from opentakserver.profile_cache import profile_cache
 
 device_profile_marti_api_blueprint = Blueprint("device_profile_marti_api_blueprint", __name__)
 
@@ -67,7 +69,8 @@ def get_ldap_attributes(prefs: Element):
                 subelement.text = user_info[field][0]
 
 
-def create_profile_zip(enrollment=True, syncSecago=-1, clientUid: str | None = None):
+def create_profile_zip(enrollment=True, syncSecago=-1, clientUid: str | None = None) -> BinaryIO:
+    """Returns the profile zip for these arguments opened for reading, only building it if there isn't a cached copy"""
     # preference.pref
     prefs = Element("preferences")
     pref = SubElement(prefs, "preference", {"version": "1", "name": "com.atakmap.app_preferences"})
@@ -77,27 +80,6 @@ def create_profile_zip(enrollment=True, syncSecago=-1, clientUid: str | None = N
     plugins = None
     data_packages = None
     device_profiles = None
-    zip_buffer = io.BytesIO()
-    zipf = zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False)
-
-    # MANIFEST file
-    manifest = Element("MissionPackageManifest", {"version": "2"})
-    config = SubElement(manifest, "Configuration")
-    SubElement(config, "Parameter", {"name": "uid", "value": str(uuid.uuid4())})
-    SubElement(config, "Parameter", {"name": "name", "value": "Device Profile"})
-    SubElement(config, "Parameter", {"name": "onReceiveDelete", "value": "true"})
-
-    contents = SubElement(manifest, "Contents")
-    SubElement(
-        contents,
-        "Content",
-        {"ignore": "false", "zipEntry": "5c2bfcae3d98c9f4d262172df99ebac5/preference.pref"},
-    )
-    SubElement(
-        contents,
-        "Content",
-        {"ignore": "false", "zipEntry": "5c2bfcae3d98c9f4d262172df99ebac5/truststore-root.p12"},
-    )
 
     enable_update_server = SubElement(
         pref, "entry", {"key": "appMgmtEnableUpdateServer", "class": "class java.lang.Boolean"}
@@ -145,14 +127,7 @@ def create_profile_zip(enrollment=True, syncSecago=-1, clientUid: str | None = N
     enable_channels.text = "true" if app.config.get("OTS_ENABLE_CHANNELS") else "false"
 
     if enrollment:
-        # Add the maps to the zip
         if app.config.get("OTS_PROFILE_MAP_SOURCES") and enrollment:
-            maps_path = os.path.join(os.path.dirname(opentakserver.__file__), "maps")
-            for root, dirs, map_files in os.walk(maps_path):
-                for map in map_files:
-                    zipf.writestr(f"maps/{map}", open(os.path.join(maps_path, map), "r").read())
-                    SubElement(contents, "Content", {"ignore": "false", "zipEntry": f"maps/{map}"})
-
             device_profiles = db.session.execute(
                 db.session.query(DeviceProfiles).filter_by(enrollment=True, active=True)
             ).all()
@@ -198,49 +173,86 @@ def create_profile_zip(enrollment=True, syncSecago=-1, clientUid: str | None = N
         )
         p.text = profile[0].preference_value
 
-    if plugins:
-        for plugin in plugins:
-            plugin = plugin[0]
-
-            SubElement(
-                contents,
-                "Content",
-                {
-                    "ignore": "false",
-                    "zipEntry": f"5c2bfcae3d98c9f4d262172df99ebac5/{plugin.file_name}",
-                },
+    maps = []
+    if enrollment and app.config.get("OTS_PROFILE_MAP_SOURCES"):
+        maps_path = os.path.join(os.path.dirname(opentakserver.__file__), "maps")
+        for root, dirs, map_files in os.walk(maps_path):
+            maps.extend((f"maps/{map}", os.path.join(root, map)) for map in sorted(map_files))
+
+    # Plugins and data packages are already compressed so they're stored as is
+    members = [(name, path, zipfile.ZIP_DEFLATED) for name, path in maps]
+    for plugin in plugins or []:
+        members.append(
+            (
+                f"5c2bfcae3d98c9f4d262172df99ebac5/{plugin[0].file_name}",
+                os.path.join(app.config.get("OTS_DATA_FOLDER"), "packages", plugin[0].file_name),
+                zipfile.ZIP_STORED,
             )
-            zipf.write(
-                os.path.join(app.config.get("OTS_DATA_FOLDER"), "packages", plugin.file_name),
-                f"5c2bfcae3d98c9f4d262172df99ebac5/{plugin.file_name}",
+        )
+    for data_package in data_packages or []:
+        members.append(
+            (
+                f"5c2bfcae3d98c9f4d262172df99ebac5/{data_package[0].filename}",
+                get_blob_store().find(data_package[0].hash),
+                zipfile.ZIP_STORED,
             )
+        )
 
-    if data_packages:
-        for data_package in data_packages:
-            data_package = data_package[0]
-            SubElement(
-                contents,
-                "Content",
-                {
-                    "ignore": "false",
-                    "zipEntry": f"5c2bfcae3d98c9f4d262172df99ebac5/{data_package.filename}",
-                },
-            )
-            zipf.write(
-                os.path.join(app.config.get("UPLOAD_FOLDER"), f"{data_package.hash}.zip"),
-                f"5c2bfcae3d98c9f4d262172df99ebac5/{data_package.filename}",
-            )
+    truststore = os.path.join(app.config.get("OTS_CA_FOLDER"), "truststore-root.p12")
+    preferences = tostring(prefs)
+
+    # The preferences cover the hostname, LDAP attributes, settings and device profiles. The files are identified
+    # by their paths and modification times, so new or changed plugins and data packages get a new zip
+    key = hashlib.sha256(preferences)
+    for name, path, compression in members + [("truststore-root.p12", truststore, None)]:
+        key.update(f"{name}\0{path}\0{os.stat(path).st_mtime_ns}\0".encode())
+    key = key.hexdigest()
+
+    return profile_cache.get(key, lambda path: write_profile_zip(path, key, preferences, members))
 
-    zipf.writestr("MANIFEST/manifest.xml", tostring(manifest))
 
-    zipf.writestr("5c2bfcae3d98c9f4d262172df99ebac5/preference.pref", tostring(prefs))
+def write_profile_zip(path: str, key: str, preferences: bytes, members: list[tuple[str, str, int]]):
+    # MANIFEST file. The UID is derived from the contents since the same zip is sent to every EUD that asks for it
+    manifest = Element("MissionPackageManifest", {"version": "2"})
+    config = SubElement(manifest, "Configuration")
+    SubElement(
+        config, "Parameter", {"name": "uid", "value": str(uuid.uuid5(uuid.NAMESPACE_OID, key))}
+    )
+    SubElement(config, "Parameter", {"name": "name", "value": "Device Profile"})
+    SubElement(config, "Parameter", {"name": "onReceiveDelete", "value": "true"})
+
+    contents = SubElement(manifest, "Contents")
+    SubElement(
+        contents,
+        "Content",
+        {"ignore": "false", "zipEntry": "5c2bfcae3d98c9f4d262172df99ebac5/preference.pref"},
+    )
+    SubElement(
+        contents,
+        "Content",
+        {"ignore": "false", "zipEntry": "5c2bfcae3d98c9f4d262172df99ebac5/truststore-root.p12"},
+    )
 
-    with open(
-        os.path.join(app.config.get("OTS_CA_FOLDER"), "truststore-root.p12"), "rb"
-    ) as truststore:
-        zipf.writestr("5c2bfcae3d98c9f4d262172df99ebac5/truststore-root.p12", truststore.read())
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, False, strict_timestamps=False) as zipf:
+        for name, member_path, compression in members:
+            SubElement(contents, "Content", {"ignore": "false", "zipEntry": name})
+            zipf.write(member_path, name, compression)
 
-    return zip_buffer
+        zipf.writestr("MANIFEST/manifest.xml", tostring(manifest))
+        zipf.writestr("5c2bfcae3d98c9f4d262172df99ebac5/preference.pref", preferences)
+        zipf.write(
+            os.path.join(app.config.get("OTS_CA_FOLDER"), "truststore-root.p12"),
+            "5c2bfcae3d98c9f4d262172df99ebac5/truststore-root.p12",
+        )
+
+
+def send_profile_zip(profile_zip: BinaryIO):
+    return send_file(
+        profile_zip,
+        mimetype="application/zip",
+        etag=profile_cache.key(profile_zip),
+        conditional=True,
+    )
 
 
 # Authentication for /Marti endpoints handled by client cert validation
@@ -248,11 +260,7 @@ def create_profile_zip(enrollment=True, syncSecago=-1, clientUid: str | None = N
 @device_profile_marti_api_blueprint.route("/Marti/api/tls/profile/enrollment")
 def enrollment_profile():
     try:
-        profile_zip = create_profile_zip()
-        profile_zip.seek(0)
-        return Response(
-            FileWrapper(profile_zip), mimetype="application/zip", direct_passthrough=True
-        )
+        return send_profile_zip(create_profile_zip())
     except BaseException as e:
         logger.error(f"Failed to send enrollment package: {e}")
         logger.debug(traceback.format_exc())
@@ -274,11 +282,7 @@ def connection_profile():
         if "clientUid" in request.args:
             client_uid = request.args["clientUid"]
 
-        profile_zip = create_profile_zip(False, syncSecago, client_uid)
-        profile_zip.seek(0)
-        return Response(
-            FileWrapper(profile_zip), mimetype="application/zip", direct_passthrough=True
-        )
+        return send_profile_zip(create_profile_zip(False, syncSecago, client_uid))
     except BaseException as e:
         logger.error(f"Failed to send enrollment package: {e}")
         logger.debug(traceback.format_exc())
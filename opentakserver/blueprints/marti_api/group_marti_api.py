@@ -13,6 +13,7 @@ from OpenSSL.crypto import X509
 from opentakserver.blueprints.marti_api.marti_api import verify_client_cert
 from opentakserver.extensions import db, ldap_manager, logger
 from opentakserver.functions import iso8601_string_from_datetime
+from opentakserver.group_cache import notify_group_change
 from opentakserver.models.Group import Group
 from opentakserver.models.GroupUser import GroupUser
 
@@ -362,9 +363,10 @@ def put_active_groups():
             )
 
     try:
+        db.session.commit()
+        notify_group_change(user.id, channel)
         channel.close()
         rabbit_connection.close()
-        db.session.commit()
         return "", 200
     except BaseException as e:
         logger.error(f"Failed to update group subscriptions for {current_user.username}: {e}")
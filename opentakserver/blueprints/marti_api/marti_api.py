@@ -1,24 +1,29 @@
+import datetime
 import glob
 import os
 import traceback
 from urllib.parse import unquote, urlparse
 
-from flask import Blueprint
+from flask import Blueprint, Response
 from flask import current_app as app
-from flask import jsonify, request, send_from_directory
+from flask import jsonify, request, stream_with_context
 from flask_babel import gettext
-from OpenSSL import crypto
 from OpenSSL.crypto import X509
-from simplekml import Document, GxMultiTrack, GxTrack, Icon, IconStyle, Kml, Style
+from sqlalchemy import select
 
 from opentakserver import __version__ as version
 from opentakserver.extensions import db, logger
 from opentakserver.functions import datetime_from_iso8601_string, iso8601_string_from_datetime
+from opentakserver.key_cache import verified_certificates
+from opentakserver.kml_export import kmz, split_tracks, track_kml
 from opentakserver.models.EUD import EUD
 from opentakserver.models.Point import Point
 
 marti_api = Blueprint("marti_api", __name__)
 
+# How many points /Marti/ExportMissionKML fetches from the DB at a time
+KML_ROWS_PER_FETCH = 1000
+
 
 # Verifies the client cert forwarded by nginx in the X-Ssl-Cert header
 # Returns the parsed cert if valid, otherwise returns False
@@ -27,21 +32,12 @@ def verify_client_cert() -> X509 | bool:
     if cert_header not in request.headers:
         return False
 
-    cert = unquote(request.headers.get(cert_header))
-    cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert)
-    with open(os.path.join(app.config.get("OTS_CA_FOLDER"), "ca.pem"), "rb") as f:
-        ca_cert = crypto.load_certificate(crypto.FILETYPE_PEM, f.read())
-
-    store = crypto.X509Store()
-    store.add_cert(ca_cert)
-    ctx = crypto.X509StoreContext(store, cert)
-
-    try:
-        ctx.verify_certificate()
-        return cert
-    except crypto.X509StoreContextError:
+    cert = verified_certificates.verify(unquote(request.headers.get(cert_header)))
+    if cert is None:
         return False
 
+    return cert
+
 
 @marti_api.route("/Marti/api/clientEndPoints", methods=["GET"])
 def client_end_points():
@@ -93,13 +89,22 @@ def atak_track_history():
         end_time = request.args.get("endTime")
         uid = request.args.get("uid")
         file_format = request.args.get("format")
-        # Not sure what these three are supposed to do
-        multitrack_threshold = request.args.get("multiTrackThreshold")
+        # Not sure what this is supposed to do
         extended_data = request.args.get("extendedData")
-        optimize_export = request.args.get("optimizeExport")
 
-        kml = Kml()
-        doc: Document = kml.newdocument(name=uid)
+        # Minutes between two points that start a new track
+        multitrack_threshold = None
+        if request.args.get("multiTrackThreshold"):
+            try:
+                multitrack_threshold = datetime.timedelta(
+                    minutes=float(request.args.get("multiTrackThreshold"))
+                )
+            except ValueError:
+                pass
+
+        tolerance = 0
+        if request.args.get("optimizeExport", "").lower() == "true":
+            tolerance = app.config.get("OTS_KML_EXPORT_TOLERANCE")
 
         eud = db.session.execute(db.session.query(EUD).filter_by(uid=uid)).first()
         if not eud:
@@ -109,61 +114,37 @@ def atak_track_history():
             )
         eud: EUD = eud[0]
 
-        icon = Icon(href=f"files/team_{eud.team.name.lower().replace(' ', '')}.png")
-        icon_style = IconStyle(scale=1.0, heading=0.0, icon=icon)
-        style = Style(iconstyle=icon_style)
-        doc.styles.append(style)
-        kml.addfile(
-            os.path.join(
-                os.path.dirname(os.path.realpath(__file__)),
-                "icons",
-                f"team_{eud.team.name.lower().replace(' ', '')}.png",
-            )
-        )
-
-        query = db.session.query(Point)
+        icon = f"team_{eud.team.name.lower().replace(' ', '') if eud.team else 'cyan'}.png"
 
-        if uid:
-            query = query.filter(Point.device_uid == uid)
+        query = select(Point.timestamp, Point.longitude, Point.latitude).where(
+            Point.device_uid == uid
+        )
 
         if start_time:
-            query = query.filter(Point.timestamp >= datetime_from_iso8601_string(start_time))
+            query = query.where(Point.timestamp >= datetime_from_iso8601_string(start_time))
 
         if end_time:
-            query = query.filter(Point.timestamp <= datetime_from_iso8601_string(end_time))
+            query = query.where(Point.timestamp <= datetime_from_iso8601_string(end_time))
 
-        points = db.session.execute(query)
-        timestamps = []
-        coords = []
-        for point in points:
-            point = point[0]
-            timestamps.append(iso8601_string_from_datetime(point.timestamp))
-            coords.append((point.longitude, point.latitude))
-
-        multitrack: GxMultiTrack = doc.newgxmultitrack(gxinterpolate=0)
-        multitrack.style = style
-        multitrack.name = eud.callsign
-
-        track: GxTrack = multitrack.newgxtrack(name=uid, gxaltitudemode="clampToGround")
-        track.newwhen(timestamps)
-        track.newgxcoord(coords)
+        # Stream the points from the DB instead of loading the whole track
+        query = query.order_by(Point.timestamp).execution_options(yield_per=KML_ROWS_PER_FETCH)
+        points = split_tracks(db.session.execute(query), multitrack_threshold, tolerance)
+        document = track_kml(uid, eud.callsign or uid, f"files/{icon}", points)
 
         if file_format == "kmz":
-            kml.savekmz(os.path.join(app.config.get("UPLOAD_FOLDER"), f"{uid}.kmz"))
-            return send_from_directory(
-                app.config.get("UPLOAD_FOLDER"),
-                f"{uid}.kmz",
-                as_attachment=True,
-                download_name=f"{uid}.kmz",
+            icon_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "icons", icon)
+            response = Response(
+                stream_with_context(kmz(document, {f"files/{icon}": icon_path})),
+                mimetype="application/vnd.google-earth.kmz",
             )
+            response.headers.set("Content-Disposition", "attachment", filename=f"{uid}.kmz")
         else:
-            kml.save(os.path.join(app.config.get("UPLOAD_FOLDER"), f"{uid}.kml"))
-            return send_from_directory(
-                app.config.get("UPLOAD_FOLDER"),
-                f"{uid}.kml",
-                as_attachment=True,
-                download_name=f"{uid}.kml",
+            response = Response(
+                stream_with_context(document), mimetype="application/vnd.google-earth.kml+xml"
             )
+            response.headers.set("Content-Disposition", "attachment", filename=f"{uid}.kml")
+
+        return response
 
     except BaseException as e:
         logger.error(f"Failed to generate KML: {e}")
@@ -6,7 +6,7 @@ import time
 import traceback
 import uuid
 from urllib.parse import urlparse
-from xml.etree.ElementTree import Element, SubElement, fromstring, tostring
+from xml.etree.ElementTree import Element, SubElement, tostring
 
 import bleach
 import flask
@@ -16,16 +16,27 @@ import sqlalchemy.exc
 from bs4 import BeautifulSoup
 from flask import Blueprint, Response
 from flask import current_app as app
-from flask import jsonify, request
+from flask import jsonify, request, stream_with_context
 from flask_babel import gettext
 from flask_security import current_user, hash_password, verify_password
-from sqlalchemy import insert, or_, update
+from sqlalchemy import and_, func, insert, or_, select, update
+from sqlalchemy.orm import selectinload
 from werkzeug.utils import secure_filename
 
+from opentakserver.blob_store import get_blob_store
+from opentakserver.blueprints.marti_api.cot_marti_api import SA_ROWS_PER_FETCH, stream_events
 from opentakserver.blueprints.marti_api.data_package_marti_api import save_data_package_file
 from opentakserver.blueprints.marti_api.marti_api import verify_client_cert
+from opentakserver.cot_parser.cot_decoder import decode_cot
 from opentakserver.extensions import db, logger
 from opentakserver.functions import datetime_from_iso8601_string, iso8601_string_from_datetime
+from opentakserver.key_cache import jwt_private_key, jwt_public_key
+from opentakserver.mission_cache import (
+    mission_cache,
+    mission_version,
+    mission_version_columns,
+    missions_etag,
+)
 from opentakserver.models.CoT import CoT
 from opentakserver.models.EUD import EUD
 from opentakserver.models.Group import Group
@@ -41,6 +52,7 @@ from opentakserver.models.MissionRole import MissionRole
 from opentakserver.models.MissionUID import MissionUID
 from opentakserver.models.Team import Team
 from opentakserver.models.user import User
+from opentakserver.uploads import RangeError, range_headers, receive_range, write_temp_file
 
 mission_marti_api = Blueprint("mission_marti_api", __name__)
 
@@ -61,18 +73,12 @@ def verify_token() -> dict | bool:
 
     token = token.replace("Bearer ", "")
 
-    with open(
-        os.path.join(
-            app.config.get("OTS_CA_FOLDER"), "certs", "opentakserver", "opentakserver.pub"
-        ),
-        "r",
-    ) as key:
-        try:
-            return jwt.decode(token, key.read(), algorithms=["RS256"])
-        except BaseException as e:
-            logger.error("Failed to validate mission token: {}".format(e))
-            logger.debug(traceback.format_exc())
-            return False
+    try:
+        return jwt.decode(token, jwt_public_key(), algorithms=["RS256"])
+    except BaseException as e:
+        logger.error("Failed to validate mission token: {}".format(e))
+        logger.debug(traceback.format_exc())
+        return False
 
 
 # iTAK sucks and doesn't send a token for some reason...
@@ -160,17 +166,7 @@ def generate_token(mission: Mission, eud_uid: str):
         "MISSION_GUID": mission.guid,
     }
 
-    server_key = open(
-        os.path.join(
-            app.config.get("OTS_CA_FOLDER"), "certs", "opentakserver", "opentakserver.nopass.key"
-        ),
-        "r",
-    )
-
-    token = jwt.encode(payload, server_key.read(), algorithm="RS256")
-    server_key.close()
-
-    return token
+    return jwt.encode(payload, jwt_private_key(), algorithm="RS256")
 
 
 def generate_new_mission_cot(mission: Mission) -> Element:
@@ -361,6 +357,12 @@ def get_missions():
     if default_role:
         default_role = bleach.clean(default_role).lower() == "true"
 
+    # Summaries have the number of uids, contents and changes instead of the rows. Clients get the details from
+    # /Marti/api/missions/<mission_name>
+    summary = request.args.get(
+        "summary", str(app.config.get("OTS_MISSION_LIST_SUMMARY"))
+    ).lower() in ("true", "1")
+
     response = {
         "version": 3,
         "type": "Mission",
@@ -369,36 +371,93 @@ def get_missions():
     }
 
     try:
-        query = db.session.query(Mission)
+        query = select(Mission).options(selectinload(Mission.groups))
 
         # Let admins see all missions
         if not user.has_role("administrator"):
-            group_filters = []
-            groups = db.session.execute(
-                db.session.query(GroupUser).filter_by(user_id=user.id, direction=Group.IN)
-            ).scalars()
-            for group in groups:
-                group_filters.append(GroupMission.group_id == group.group.id)
-            if group_filters:
-                query = query.outerjoin(GroupMission).where(or_(*group_filters))
-            else:
-                # If a user isn't in a group, only show them __ANON__ missions
-                query.outerjoin(GroupMission).where(GroupMission.group_id == 1)
+            group_ids = (
+                db.session.execute(
+                    select(GroupUser.group_id).filter_by(user_id=user.id, direction=Group.IN)
+                )
+                .scalars()
+                .all()
+            )
+            # If a user isn't in a group, only show them __ANON__ missions
+            if not group_ids:
+                group_ids = [1]
+
+            # A subquery instead of a join so missions in several of the user's groups are only listed once
+            query = query.where(
+                Mission.name.in_(
+                    select(GroupMission.mission_name).where(GroupMission.group_id.in_(group_ids))
+                )
+            )
 
-        missions = db.session.execute(query).scalars()
-        for mission in missions:
+        missions = []
+        for mission, *version_columns in db.session.execute(
+            query.add_columns(*mission_version_columns()).order_by(Mission.name)
+        ):
             if not password_protected and mission.password_protected:
                 continue
             if tool and tool.lower() != "public" and mission.tool != tool:
                 continue
-            response["data"].append(mission.to_marti_json())
+            missions.append((mission, version_columns, mission_version(mission, *version_columns)))
+
+        etag = missions_etag(request.url_root, summary, [version for _, _, version in missions])
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+        if summary:
+            for mission, version_columns, version in missions:
+                uid_count, content_count, change_count = version_columns[:3]
+                response["data"].append(
+                    mission.to_marti_json(
+                        {
+                            "uidCount": uid_count,
+                            "contentCount": content_count,
+                            "missionChangeCount": change_count,
+                        }
+                    )
+                )
+        else:
+            cached = {
+                mission.name: mission_cache.get(mission.name, request.url_root, version)
+                for mission, _, version in missions
+            }
+
+            # Load everything the missions that aren't cached serialize in a few queries instead of lazy loading
+            # it for every mission
+            misses = [name for name, mission_json in cached.items() if mission_json is None]
+            if misses:
+                db.session.execute(
+                    select(Mission)
+                    .where(Mission.name.in_(misses))
+                    .options(
+                        selectinload(Mission.uids),
+                        selectinload(Mission.contents),
+                        selectinload(Mission.mission_changes).selectinload(
+                            MissionChange.content_resource
+                        ),
+                        selectinload(Mission.mission_changes).selectinload(MissionChange.uid),
+                        selectinload(Mission.owner),
+                    )
+                ).scalars().all()
+
+            for mission, _, version in missions:
+                mission_json = cached[mission.name]
+                if mission_json is None:
+                    mission_json = mission.to_marti_json()
+                    mission_cache.put(mission.name, request.url_root, version, mission_json)
+                response["data"].append(mission_json)
 
     except BaseException as e:
         logger.error(f"Failed to get missions: {e}")
         logger.debug(traceback.format_exc())
         return jsonify({"success": False, "error": str(e)}), 500
 
-    return jsonify(response)
+    response = jsonify(response)
+    response.set_etag(etag)
+    return response
 
 
 @mission_marti_api.route("/Marti/api/missions/guid/<mission_guid>/invitations", methods=["GET"])
@@ -1565,24 +1624,61 @@ def mission_changes(mission_name):
     if isinstance(permission_granted, flask.Response):
         return permission_granted
 
-    squashed = request.args.get("squashed")
-    if squashed:
-        squashed = bleach.clean(squashed)
+    query = (
+        select(MissionChange)
+        .where(MissionChange.mission_name == mission_name)
+        .options(selectinload(MissionChange.content_resource), selectinload(MissionChange.uid))
+    )
 
-    response = {
-        "version": "3",
-        "type": "MissionChange",
-        "data": [],
-        "nodeId": app.config.get("OTS_NODE_ID"),
-    }
+    # Only send the latest change to each piece of content or CoT. Changes to the mission itself are always sent
+    if request.args.get("squashed", "").lower() == "true":
+        latest = (
+            select(func.max(MissionChange.id))
+            .where(
+                MissionChange.mission_name == mission_name,
+                or_(MissionChange.content_uid.isnot(None), MissionChange.mission_uid.isnot(None)),
+            )
+            .group_by(MissionChange.content_uid, MissionChange.mission_uid)
+        )
+        query = query.where(
+            or_(
+                and_(MissionChange.content_uid.is_(None), MissionChange.mission_uid.is_(None)),
+                MissionChange.id.in_(latest),
+            )
+        )
 
-    changes = db.session.execute(
-        db.session.query(MissionChange).filter_by(mission_name=mission_name)
-    ).all()
-    for change in changes:
-        response["data"].append(change[0].to_json())
+    try:
+        if request.args.get("secago"):
+            query = query.where(
+                MissionChange.timestamp
+                >= datetime.datetime.now(datetime.timezone.utc)
+                - datetime.timedelta(seconds=int(request.args.get("secago")))
+            )
+        if request.args.get("start"):
+            query = query.where(
+                MissionChange.timestamp >= datetime_from_iso8601_string(request.args.get("start"))
+            )
+        if request.args.get("end"):
+            query = query.where(
+                MissionChange.timestamp <= datetime_from_iso8601_string(request.args.get("end"))
+            )
+    except ValueError:
+        return (
+            jsonify({"success": False, "error": gettext("Invalid secago, start or end time")}),
+            400,
+        )
 
-    return jsonify(response)
+    query = query.order_by(MissionChange.timestamp, MissionChange.id).execution_options(
+        yield_per=SA_ROWS_PER_FETCH
+    )
+
+    def generate():
+        yield '{"version": "3", "type": "MissionChange", "data": ['
+        for i, change in enumerate(db.session.execute(query).scalars()):
+            yield ("," if i else "") + app.json.dumps(change.to_json())
+        yield f"], \"nodeId\": {app.json.dumps(app.config.get('OTS_NODE_ID'))}}}"
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
 
 
 @mission_marti_api.route("/Marti/api/missions/logs/entries", methods=["POST"])
@@ -1711,30 +1807,16 @@ def upload_content():
 
     # When uploading data packages, iTAK doesn't include an extension. If the user agent is iTAK and
     # the content type is zip, assume that iTAK is uploading a data package
-    if (
+    itak_data_package = (
         "iTAK" in request.user_agent.string
         and request.content_type == "application/x-zip-compressed"
-    ):
-        file_hash = save_data_package_file(
-            request.data, secure_filename(file_name) + ".zip", username, creator_uid
-        )
-
-        response = {
-            "UID": str(uuid.uuid4()),
-            "SubmissionDateTime": iso8601_string_from_datetime(),
-            "MIMEType": "application/x-zip-compressed",
-            "SubmissionUser": username,
-            "PrimaryKey": 0,
-            "Hash": file_hash,
-            "CreatorUid": creator_uid,
-            "Name": file_name,
-        }
-
-        return jsonify(response)
+    )
 
     filename, extension = os.path.splitext(secure_filename(file_name))
 
-    if extension.replace(".", "").lower() not in app.config.get("ALLOWED_EXTENSIONS"):
+    if not itak_data_package and extension.replace(".", "").lower() not in app.config.get(
+        "ALLOWED_EXTENSIONS"
+    ):
         logger.error(f"{extension} is not an allowed file extension")
         return (
             jsonify(
@@ -1748,12 +1830,54 @@ def upload_content():
             400,
         )
 
-    file = request.data
-    sha256 = hashlib.sha256()
-    sha256.update(file)
+    # Large files can be sent in chunks with Content-Range headers so uploads can resume after a dropped connection
+    body = request.stream
+    partial_path = None
+    if "Content-Range" in request.headers:
+        upload_id = hashlib.sha256(f"{username}/{creator_uid}/{file_name}".encode()).hexdigest()
+        try:
+            partial_path, received = receive_range(
+                upload_id, request.stream, request.headers["Content-Range"]
+            )
+        except RangeError as e:
+            return jsonify({"success": False, "error": str(e)}), 416, range_headers(e.received)
+
+        if not partial_path:
+            return "", 308, range_headers(received)
+
+        body = open(partial_path, "rb")
+
+    try:
+        if itak_data_package:
+            try:
+                file_hash = save_data_package_file(
+                    body, secure_filename(file_name) + ".zip", username, creator_uid
+                )
+            except ValueError as e:
+                return jsonify({"success": False, "error": str(e)}), 400
+
+            response = {
+                "UID": str(uuid.uuid4()),
+                "SubmissionDateTime": iso8601_string_from_datetime(),
+                "MIMEType": "application/x-zip-compressed",
+                "SubmissionUser": username,
+                "PrimaryKey": 0,
+                "Hash": file_hash,
+                "CreatorUid": creator_uid,
+                "Name": file_name,
+            }
+
+            return jsonify(response)
+
+        blob_store = get_blob_store()
+        temp_path, content_hash, content_size = write_temp_file(body, blob_store.temp_folder)
+    finally:
+        if partial_path:
+            body.close()
+            os.remove(partial_path)
 
     content = db.session.execute(
-        db.session.query(MissionContent).filter_by(hash=sha256.hexdigest())
+        db.session.query(MissionContent).filter_by(hash=content_hash)
     ).first()
     if not content:
         content = MissionContent()
@@ -1763,10 +1887,10 @@ def upload_content():
         content.submitter = username or "anonymous"
         content.uid = str(uuid.uuid4())
         content.creator_uid = creator_uid
-        content.size = request.content_length
+        content.size = content_size
         content.expiration = -1
         content.keywords = keywords if keywords else []
-        content.hash = sha256.hexdigest()
+        content.hash = content_hash
         content_pk = db.session.execute(insert(MissionContent).values(**content.serialize()))
         content_pk = content_pk.inserted_primary_key[0]
         db.session.commit()
@@ -1783,10 +1907,7 @@ def upload_content():
             db.session.commit()
 
     # Save the content even if it exists in the database in case it was deleted from disk
-    os.makedirs(os.path.join(app.config.get("OTS_DATA_FOLDER"), "missions"), exist_ok=True)
-    with open(os.path.join(app.config.get("OTS_DATA_FOLDER"), "missions", file_name), "wb") as f:
-        f.write(file)
-        f.flush()
+    blob_store.put(temp_path, content_hash)
 
     response = {
         "UID": content.uid,
@@ -2116,7 +2237,7 @@ def delete_content(mission_name: str | None = None, mission_guid: str | None = N
             cot_event = cot_event[0]
             cot_event.mission_name = None
             db.session.add(cot_event)
-            cot_event = BeautifulSoup(cot_event.xml, "xml").find("event")
+            cot_event = decode_cot(cot_event.xml)
 
     # Files will be kept in the DB so the mission log is correct and on disk in case it gets added back to a mission
     content = None
@@ -2226,27 +2347,16 @@ def get_mission_cots(mission_name: str = None, mission_guid: str = None):
     if isinstance(permission_granted, flask.Response):
         return permission_granted
 
-    if mission_name:
-        cots = db.session.execute(db.session.query(CoT).filter_by(mission_name=mission_name)).all()
-    elif mission_guid:
-        mission = db.session.execute(db.session.query(Mission).filter_by(guid=mission_guid)).first()
-        if mission:
-            mission_name = mission[0].name
-            cots = db.session.execute(
-                db.session.query(CoT).filter_by(mission_name=mission_name)
-            ).all()
-        else:
-            cots = []
-    else:
-        cots = []
-
-    events = Element("events")
+    if mission_guid:
+        mission_name = db.session.execute(
+            select(Mission.name).where(Mission.guid == mission_guid)
+        ).scalar()
 
-    for cot in cots:
-        events.append(fromstring(cot[0].xml))
+    if not mission_name:
+        return Response("<events></events>", mimetype="application/xml")
 
-    return Response(
-        response=tostring(events).decode("utf-8"), status=200, mimetype="application/xml"
+    return stream_events(
+        select(CoT.xml).where(CoT.mission_name == mission_name).order_by(CoT.timestamp, CoT.id)
     )
 
 
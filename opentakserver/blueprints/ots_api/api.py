@@ -4,7 +4,6 @@ import json
 import os
 import platform
 import traceback
-from shutil import copyfile
 from urllib.parse import urlparse
 
 import bleach
@@ -21,24 +20,26 @@ from flask_security import auth_required, current_user, verify_password
 from sqlalchemy import select
 
 from opentakserver import __version__ as version
+from opentakserver import map_state
+from opentakserver.blob_store import get_blob_store
 from opentakserver.certificate_authority import CertificateAuthority
 from opentakserver.extensions import babel, db, ldap_manager, logger
+from opentakserver.functions import datetime_from_iso8601_string
+from opentakserver.geo_index import bbox_filter, parse_bbox
+from opentakserver.group_cache import group_cache
 from opentakserver.models.Alert import Alert
 from opentakserver.models.APSchedulerJobs import APSchedulerJobs
-from opentakserver.models.CasEvac import CasEvac
 from opentakserver.models.Certificate import Certificate
 from opentakserver.models.CoT import CoT
 from opentakserver.models.DataPackage import DataPackage
 from opentakserver.models.EUD import EUD
 from opentakserver.models.Group import Group
-from opentakserver.models.GroupUser import GroupUser
 from opentakserver.models.Icon import Icon
-from opentakserver.models.Marker import Marker
 from opentakserver.models.Point import Point
-from opentakserver.models.RBLine import RBLine
 from opentakserver.models.Token import Token
 from opentakserver.models.user import User
 from opentakserver.models.ZMIST import ZMIST
+from opentakserver.pagination import InvalidCursor, count, keyset_page
 
 api_blueprint = Blueprint("api_blueprint", __name__)
 
@@ -54,6 +55,17 @@ def search(query, model, field):
 
 
 def paginate(query: db.Query, model=None):
+    """Paginates query by page and per_page, or by cursor when the after argument is given.
+
+    :param page: The page number
+    :param per_page: The number of results per page
+    :param sort_by: The column to sort by
+    :param sort_direction: ``asc`` or ``desc``
+    :param after: The ``next`` cursor from the previous response. Pass an empty value to get the first page. Unlike
+                  page, the cost of each page doesn't grow with how deep it is and the total isn't counted unless
+                  requested with count
+    :param count: With after, ``exact`` to count the total or ``estimate`` to get PostgreSQL's estimate of it
+    """
     try:
         page = int(request.args.get("page")) if "page" in request.args else 1
         per_page = int(request.args.get("per_page")) if "per_page" in request.args else 10
@@ -64,6 +76,9 @@ def paginate(query: db.Query, model=None):
             {"Content-Type": "application/json"},
         )
 
+    if "after" in request.args:
+        return keyset_paginate(query, model or query.column_descriptions[0]["entity"], per_page)
+
     try:
         if model:
             sort_by = request.args.get("sort_by")
@@ -86,23 +101,61 @@ def paginate(query: db.Query, model=None):
         )
 
     pagination = db.paginate(query, page=page, per_page=per_page)
-    rows = pagination.items
 
+    # Queries must not return duplicate rows, i.e. filter on groups with a subquery instead of joining them
     results = {
-        "results": [],
+        "results": [row.to_json() for row in pagination.items],
         "total_pages": pagination.pages,
         "current_page": page,
         "per_page": per_page,
-        "total": 0,
+        "total": pagination.total,
     }
 
-    for row in rows:
-        mission = row.to_json()
-        # Filter out duplicate results caused by missions belonging to multiple groups
-        if mission not in results["results"]:
-            results["results"].append(row.to_json())
+    return jsonify(results)
+
 
-    results["total"] = pagination.total
+def keyset_paginate(query: db.Query, model, per_page: int):
+    count_mode = request.args.get("count")
+    if count_mode not in (None, "exact", "estimate") or per_page < 1:
+        return (
+            jsonify({"success": False, "error": gettext("Invalid count or per_page")}),
+            400,
+        )
+
+    sort_direction = request.args.get("sort_direction") or "asc"
+    if sort_direction not in ("asc", "desc"):
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": gettext(
+                        "Invalid sort direction: %(sort_direction)s", sort_direction=sort_direction
+                    ),
+                }
+            ),
+            400,
+        )
+
+    try:
+        rows, next_cursor = keyset_page(
+            query,
+            model,
+            request.args.get("sort_by"),
+            sort_direction,
+            request.args.get("after"),
+            per_page,
+        )
+    except InvalidCursor as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    results = {
+        "results": [row.to_json() for row in rows],
+        "per_page": per_page,
+        "next": next_cursor,
+    }
+
+    if count_mode:
+        results["total"] = count(query, count_mode == "estimate")
 
     return jsonify(results)
 
@@ -143,24 +196,23 @@ def route_cot(event: str, user: User):
     )
     channel = rabbit_connection.channel()
 
-    group_memberships = db.session.execute(
-        db.session.query(GroupUser).filter_by(user_id=user.id, direction=Group.IN, enabled=True)
-    ).all()
-    if not group_memberships:
+    body = json.dumps({"uid": app.config["OTS_NODE_ID"], "cot": str(event)})
+
+    group_names = group_cache.group_names(user.id, Group.IN)
+    if not group_names:
         # Default to the __ANON__ group if the user doesn't belong to any IN groups
         channel.basic_publish(
             exchange="groups",
             routing_key="__ANON__.OUT",
-            body=json.dumps({"uid": app.config["OTS_NODE_ID"], "cot": str(event)}),
+            body=body,
             properties=pika.BasicProperties(expiration=app.config.get("OTS_RABBITMQ_TTL")),
         )
 
-    for membership in group_memberships:
-        membership = membership[0]
+    for group_name in group_names:
         channel.basic_publish(
             exchange="groups",
-            routing_key=f"{membership.group.name}.{Group.OUT}",
-            body=json.dumps({"uid": app.config["OTS_NODE_ID"], "cot": str(event)}),
+            routing_key=f"{group_name}.{Group.OUT}",
+            body=body,
             properties=pika.BasicProperties(expiration=app.config.get("OTS_RABBITMQ_TTL")),
         )
     channel.close()
@@ -328,12 +380,10 @@ def certificate():
                         400,
                     )
 
-                copyfile(
-                    os.path.join(
-                        app.config.get("OTS_CA_FOLDER"), "certs", username, "{}".format(filename)
-                    ),
-                    os.path.join(app.config.get("UPLOAD_FOLDER"), "{}.zip".format(file_hash)),
-                )
+                with open(
+                    os.path.join(app.config.get("OTS_CA_FOLDER"), "certs", username, filename), "rb"
+                ) as f:
+                    get_blob_store().store(f, file_hash)
 
                 cert = Certificate()
                 cert.common_name = username
@@ -362,7 +412,7 @@ def certificate():
         query = search(query, Certificate, "callsign")
         query = search(query, Certificate, "username")
 
-        return paginate(query)
+        return paginate(query, Certificate)
 
 
 @api_blueprint.route("/api/me")
@@ -422,14 +472,31 @@ def query_points():
 
     :param uid: The point's UID
     :param callsign: The point's callsign
+    :param left: Western longitude of the map's viewport. left, bottom, right and top must be used together
+    :param bottom: Southern latitude of the map's viewport
+    :param right: Eastern longitude of the map's viewport
+    :param top: Northern latitude of the map's viewport
     :param page: The page number
     :param per_page: The number of results per page
     """
     query = db.session.query(Point)
 
+    if "uid" in request.args or "callsign" in request.args:
+        query = query.join(EUD, EUD.uid == Point.device_uid)
     query = search(query, EUD, "uid")
     query = search(query, EUD, "callsign")
 
+    try:
+        bbox = parse_bbox(request.args)
+    except ValueError as e:
+        return (
+            jsonify({"success": False, "error": gettext("Invalid bounding box: %(e)s", e=e)}),
+            400,
+        )
+
+    if bbox:
+        query = query.where(bbox_filter(Point, *bbox))
+
     return paginate(query, Point)
 
 
@@ -529,38 +596,30 @@ def get_truststore():
 @api_blueprint.route("/api/map_state")
 @auth_required()
 def get_map_state():
-    """Gets the latest data to be displayed on the web UI's map"""
-    try:
-        results = {"euds": [], "markers": [], "rb_lines": [], "casevacs": []}
+    """Gets the latest data to be displayed on the web UI's map
 
-        euds = db.session.execute(db.session.query(EUD)).all()
-        for eud in euds:
-            results["euds"].append(eud[0].to_json())
-
-        markers = db.session.execute(
-            db.session.query(Marker)
-            .join(CoT)
-            .filter(CoT.stale >= datetime.datetime.now(datetime.timezone.utc))
-        ).all()
-        for marker in markers:
-            results["markers"].append(marker[0].to_json())
-
-        rb_lines = db.session.execute(
-            db.session.query(RBLine)
-            .join(CoT)
-            .filter(CoT.stale >= datetime.datetime.now(datetime.timezone.utc))
-        ).all()
-        for rb_line in rb_lines:
-            results["rb_lines"].append(rb_line[0].to_json())
-
-        casevacs = db.session.execute(
-            db.session.query(CasEvac)
-            .join(CoT)
-            .filter(CoT.stale >= datetime.datetime.now(datetime.timezone.utc))
-        ).all()
-        for casevac in casevacs:
-            results["casevacs"].append(casevac[0].to_json())
+    :param since: Optional ISO8601 timestamp. Only returns what changed since then, including the UIDs of deleted
+                  items. Use the timestamp from the previous response
+    """
+    since = None
+    if request.args.get("since"):
+        try:
+            since = datetime_from_iso8601_string(request.args.get("since"))
+        except ValueError:
+            return (
+                jsonify(
+                    {
+                        "success": False,
+                        "error": gettext(
+                            "Invalid since timestamp: %(since)s", since=request.args.get("since")
+                        ),
+                    }
+                ),
+                400,
+            )
 
+    try:
+        results = map_state.get_map_state(since)
     except BaseException as e:
         logger.error(traceback.format_exc())
         return jsonify({"success": False, "error": str(e)}), 500
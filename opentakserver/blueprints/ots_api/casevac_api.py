@@ -15,6 +15,7 @@ from opentakserver.extensions import db, logger, socketio
 from opentakserver.forms.casevac_form import CasEvacForm
 from opentakserver.forms.zmist_form import ZmistForm
 from opentakserver.functions import *
+from opentakserver.map_state import delete_map_state
 from opentakserver.models.CasEvac import CasEvac
 from opentakserver.models.CoT import CoT
 from opentakserver.models.EUD import EUD
@@ -30,6 +31,8 @@ casevac_api_blueprint = Blueprint("casevac_api_blueprint", __name__)
 def query_casevac():
     query = db.session.query(CasEvac)
 
+    if "callsign" in request.args:
+        query = query.join(EUD, EUD.uid == CasEvac.sender_uid)
     query = search(query, EUD, "callsign")
     query = search(query, CasEvac, "sender_uid")
     query = search(query, CasEvac, "uid")
@@ -162,6 +165,7 @@ def delete_casevac():
     route_cot(tostring(event).decode("utf-8"), current_user)
 
     db.session.delete(casevac)
+    delete_map_state("casevacs", [casevac.uid])
     db.session.commit()
 
     return jsonify({"success": True})
@@ -5,18 +5,20 @@ from datetime import datetime, timezone
 
 from flask import Blueprint
 from flask import current_app as app
-from flask import jsonify, request, send_from_directory
+from flask import jsonify, request
 from flask_babel import gettext
 from flask_security import auth_required
 from sqlalchemy import update
 from werkzeug.datastructures import ImmutableMultiDict
 
+from opentakserver.blob_store import blob_index, get_blob_store, send_blob
 from opentakserver.blueprints.marti_api.data_package_marti_api import data_package_share
 from opentakserver.blueprints.ots_api.api import paginate, search
 from opentakserver.extensions import db, logger
 from opentakserver.forms.data_package_form import DataPackageUpdateForm
 from opentakserver.models.Certificate import Certificate
 from opentakserver.models.DataPackage import DataPackage
+from opentakserver.models.MissionContent import MissionContent
 
 data_package_api = Blueprint("data_package_api", __name__)
 
@@ -88,9 +90,13 @@ def delete_data_package():
         )
         db.session.delete(data_package[0])
         db.session.commit()
-        os.remove(
-            os.path.join(app.config.get("UPLOAD_FOLDER"), "{}.zip".format(data_package[0].hash))
-        )
+        blob_index.invalidate(data_package[0].hash)
+
+        # Mission content with the same hash shares the file
+        if not db.session.execute(
+            db.select(MissionContent.id).filter_by(hash=data_package[0].hash)
+        ).first():
+            get_blob_store().delete(data_package[0].hash)
 
         if data_package[0].certificate:
             Certificate.query.filter_by(id=data_package[0].certificate.id).delete()
@@ -153,15 +159,19 @@ def data_package_download():
             404,
         )
 
-    download_name = data_package[0].filename
-    name, extension = os.path.splitext(download_name)
+    blob = blob_index.resolve(data_package[0].hash)
+    if not blob:
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": gettext("Data package with hash '%(hash)s' not found", hash=file_hash),
+                }
+            ),
+            404,
+        )
 
-    return send_from_directory(
-        app.config.get("UPLOAD_FOLDER"),
-        f"{file_hash}{extension}",
-        as_attachment=True,
-        download_name=download_name,
-    )
+    return send_blob(blob, as_attachment=True)
 
 
 @data_package_api.route("/api/data_packages", methods=["POST"])
@@ -21,7 +21,7 @@ def get_device_profiles():
     query = search(query, DeviceProfiles, "preference_key")
     query = search(query, DeviceProfiles, "preference_value")
     query = search(query, DeviceProfiles, "tool")
-    return paginate(query)
+    return paginate(query, DeviceProfiles)
 
 
 @device_profile_api_blueprint.route("/api/profiles", methods=["POST"])
@@ -12,6 +12,7 @@ from flask_security import auth_required, roles_required
 
 from opentakserver.blueprints.ots_api.api import paginate, search
 from opentakserver.extensions import db, ldap_manager, logger
+from opentakserver.group_cache import notify_group_change
 from opentakserver.models.Group import Group
 from opentakserver.models.GroupUser import GroupUser
 
@@ -235,6 +236,7 @@ def remove_user_from_group():
                 exchange="groups", queue=eud.uid, routing_key=f"{group_name}.{direction}"
             )
 
+        notify_group_change(user.id, channel)
         channel.close()
         rabbit_connection.close()
 
@@ -399,6 +401,7 @@ def add_user_to_group():
         try:
             db.session.add(membership)
             db.session.commit()
+            notify_group_change(user.id)
         except sqlalchemy.exc.IntegrityError:
             db.session.rollback()
 
@@ -452,6 +455,7 @@ def delete_group():
         GroupUser.query.filter_by(group_id=group.id).delete()
         db.session.delete(group)
         db.session.commit()
+        notify_group_change()
     except BaseException as e:
         logger.error(f"Failed to delete {request.args.get('group_name')}: {e}")
         logger.debug(traceback.format_exc())
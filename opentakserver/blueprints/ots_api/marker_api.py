@@ -17,6 +17,7 @@ from sqlalchemy.exc import IntegrityError
 from opentakserver.blueprints.ots_api.api import paginate, route_cot, search
 from opentakserver.extensions import db, logger, socketio
 from opentakserver.functions import *
+from opentakserver.map_state import delete_map_state
 from opentakserver.models.CoT import CoT
 from opentakserver.models.Marker import Marker
 from opentakserver.models.Point import Point
@@ -32,7 +33,7 @@ def get_markers():
     query = search(query, Marker, "affiliation")
     query = search(query, Marker, "callsign")
 
-    return paginate(query)
+    return paginate(query, Marker)
 
 
 @marker_api_blueprint.route("/api/markers", methods=["POST"])
@@ -349,6 +350,7 @@ def delete_marker():
         rabbit_connection.close()
 
         db.session.delete(marker)
+        delete_map_state("markers", [marker.uid])
         db.session.commit()
 
         return jsonify({"success": True})
@@ -18,7 +18,7 @@ from flask_security import (
     roles_required,
     verify_password,
 )
-from sqlalchemy import or_
+from sqlalchemy import select
 
 from opentakserver.blueprints.marti_api.mission_marti_api import (
     generate_invitation_cot,
@@ -43,6 +43,7 @@ from opentakserver.models.MissionInvitation import MissionInvitation
 from opentakserver.models.MissionLogEntry import MissionLogEntry
 from opentakserver.models.MissionRole import MissionRole
 from opentakserver.models.MissionUID import MissionUID
+from opentakserver.partitions import delete_references
 
 data_sync_api = Blueprint("data_sync_api", __name__)
 
@@ -55,16 +56,24 @@ def get_missions():
     query = search(query, Mission, "guid")
     query = search(query, Mission, "tool")
 
-    # Only show users missions that belong to the same groups they belong to
+    # Only show users missions that belong to the same groups they belong to. A subquery instead of a join so
+    # missions in several of the user's groups are only listed once
     if not current_user.has_role("administrator"):
-        group_filters = []
-        groups = db.session.execute(
-            db.session.query(GroupUser).filter_by(user_id=current_user.id, direction=Group.IN)
-        ).scalars()
-        for group in groups:
-            group_filters.append(GroupMission.group_id == group.group_id)
-        if group_filters:
-            query = query.outerjoin(GroupMission).where(or_(*group_filters)).distinct(Mission.name)
+        group_ids = (
+            db.session.execute(
+                select(GroupUser.group_id).where(
+                    GroupUser.user_id == current_user.id, GroupUser.direction == Group.IN
+                )
+            )
+            .scalars()
+            .all()
+        )
+        if group_ids:
+            query = query.where(
+                Mission.name.in_(
+                    select(GroupMission.mission_name).where(GroupMission.group_id.in_(group_ids))
+                )
+            )
 
     return paginate(query, Mission)
 
@@ -338,6 +347,12 @@ def delete_mission():
         db.session.execute(sqlalchemy.delete(GeoChat).where(GeoChat.chatroom_id == chatroom.id))
         db.session.delete(chatroom)
 
+    delete_references(
+        db.session.connection(),
+        "cot",
+        "SELECT id FROM cot WHERE mission_name = :mission_name",
+        {"mission_name": mission_name},
+    )
     db.session.execute(sqlalchemy.delete(CoT).where(CoT.mission_name == mission_name))
     db.session.execute(
         sqlalchemy.delete(MissionInvitation).where(MissionInvitation.mission_name == mission_name)
@@ -1,13 +1,16 @@
 import csv
 import datetime
+import hashlib
+import io
 import os
+import tempfile
 import zipfile
 
 import bleach
 import sqlalchemy.exc
 from flask import Blueprint
 from flask import current_app as app
-from flask import jsonify, request, send_from_directory
+from flask import jsonify, request, send_file, send_from_directory
 from flask_security import auth_required, roles_accepted
 from werkzeug.datastructures import ImmutableMultiDict
 from werkzeug.utils import secure_filename
@@ -17,6 +20,7 @@ from opentakserver.blueprints.marti_api.marti_api import verify_client_cert
 from opentakserver.blueprints.ots_api.api import paginate, search
 from opentakserver.extensions import db, logger
 from opentakserver.forms.package_form import PackageForm, PackageUpdateForm
+from opentakserver.key_cache import CachedFile
 from opentakserver.models.Packages import Packages
 
 packages_blueprint = Blueprint("packages_api_blueprint", __name__)
@@ -50,109 +54,112 @@ def get_packages():
     query = search(query, Packages, "file_size")
     query = search(query, Packages, "atak_version")
 
-    return paginate(query)
+    return paginate(query, Packages)
 
 
-@packages_blueprint.route("/api/packages/product.infz", methods=["HEAD"])
-def head_product_infz():
-    cert = verify_client_cert()
-    if not cert:
-        return "", 401
+def product_infz_path(atak_version: str | None = None) -> str:
+    if atak_version:
+        return os.path.join(
+            app.config.get("OTS_DATA_FOLDER"),
+            "packages",
+            secure_filename(bleach.clean(atak_version)),
+            "product.infz",
+        )
+    return os.path.join(app.config.get("OTS_DATA_FOLDER"), "packages", "product.infz")
 
-    if os.path.exists(os.path.join(app.config.get("OTS_DATA_FOLDER"), "packages", "product.infz")):
-        return jsonify({"success": True})
 
-    return jsonify({"success": False}), 404
+# The SHA256 of each product.infz, only read again when the file changes
+product_infz_hashes = CachedFile(lambda data: hashlib.sha256(data).hexdigest())
 
 
-@packages_blueprint.route("/api/packages/<atak_version>/product.infz", methods=["HEAD"])
-def head_product_infz_with_version(atak_version: str):
-    cert = verify_client_cert()
-    if not cert:
-        return "", 401
-
-    if os.path.exists(
-        os.path.join(app.config.get("OTS_DATA_FOLDER"), "packages", atak_version, "product.infz")
-    ):
-        return jsonify({"success": True})
+def send_product_infz(atak_version: str | None = None):
+    path = product_infz_path(atak_version)
+    if not os.path.exists(path):
+        return jsonify({"success": False}), 404
 
-    return jsonify({"success": False}), 404
+    # ATAK checks for updates every time it starts. The ETag and Last-Modified headers let it get a 304 when
+    # nothing changed
+    return send_file(path, etag=product_infz_hashes.get(path), conditional=True)
 
 
-@packages_blueprint.route("/api/packages/product.infz", methods=["GET"])
+@packages_blueprint.route("/api/packages/product.infz", methods=["GET", "HEAD"])
 def get_product_infz():
     cert = verify_client_cert()
     if not cert:
         return "", 401
-    return send_from_directory(
-        os.path.join(app.config.get("OTS_DATA_FOLDER"), "packages"), "product.infz"
-    )
+    return send_product_infz()
 
 
-@packages_blueprint.route("/api/packages/<atak_version>/product.infz", methods=["GET"])
+@packages_blueprint.route("/api/packages/<atak_version>/product.infz", methods=["GET", "HEAD"])
 def get_product_infz_with_version(atak_version: str):
     cert = verify_client_cert()
     if not cert:
         return "", 401
-    return send_from_directory(
-        os.path.join(app.config.get("OTS_DATA_FOLDER"), "packages", atak_version), "product.infz"
-    )
+    return send_product_infz(atak_version)
 
 
 def create_product_infz(atak_version: str | None):
-    product_infz_file = os.path.join(app.config.get("OTS_DATA_FOLDER"), "packages", "product.infz")
-    product_inf_file = os.path.join(app.config.get("OTS_DATA_FOLDER"), "packages", "product.inf")
-
+    """Rebuilds the product.infz for an ATAK version and the one for all packages. Called when packages change"""
     if atak_version:
-        atak_version = bleach.clean(atak_version)
-        product_infz_file = os.path.join(
-            app.config.get("OTS_DATA_FOLDER"), "packages", atak_version, "product.infz"
-        )
-        product_inf_file = os.path.join(
-            app.config.get("OTS_DATA_FOLDER"), "packages", atak_version, "product.inf"
-        )
-        os.makedirs(
-            os.path.join(app.config.get("OTS_DATA_FOLDER"), "packages", atak_version), exist_ok=True
-        )
+        write_product_infz(bleach.clean(atak_version))
+    write_product_infz(None)
 
-    if os.path.exists(product_infz_file):
-        os.remove(product_infz_file)
 
+def write_product_infz(atak_version: str | None):
     query = db.session.query(Packages)
     if atak_version:
         query = query.where(Packages.atak_version == atak_version)
-    packages = db.session.execute(query).all()
-
-    with zipfile.ZipFile(product_infz_file, mode="a", compression=zipfile.ZIP_DEFLATED) as zipf:
-
-        with open(product_inf_file, "w") as inf:
-            csv_writer = csv.writer(inf)
-
-            for package in packages:
-                package = package[0]
-                csv_writer.writerow(
-                    [
-                        package.platform,
-                        package.plugin_type,
-                        package.package_name,
-                        package.name,
-                        package.version,
-                        package.revision_code,
-                        package.file_name,
-                        package.icon_filename,
-                        package.description,
-                        package.apk_hash,
-                        package.os_requirement,
-                        package.tak_prereq,
-                        package.file_size,
-                    ]
-                )
+    packages = db.session.execute(query.order_by(Packages.package_name)).scalars()
+
+    inf = io.StringIO()
+    csv_writer = csv.writer(inf)
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as zipf:
+        for package in packages:
+            csv_writer.writerow(
+                [
+                    package.platform,
+                    package.plugin_type,
+                    package.package_name,
+                    package.name,
+                    package.version,
+                    package.revision_code,
+                    package.file_name,
+                    package.icon_filename,
+                    package.description,
+                    package.apk_hash,
+                    package.os_requirement,
+                    package.tak_prereq,
+                    package.file_size,
+                ]
+            )
+
+            if package.icon:
+                zipf.writestr(infz_entry(package.icon_filename), package.icon)
+
+        zipf.writestr(infz_entry("product.inf"), inf.getvalue())
+
+    # The entries have fixed timestamps so an unchanged index is byte for byte the same and keeps its ETag and
+    # Last-Modified time
+    path = product_infz_path(atak_version)
+    product_infz = zip_buffer.getvalue()
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            if f.read() == product_infz:
+                return
+
+    # Written to a temporary file and renamed so EUDs downloading the index at the same time never get a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+        f.write(product_infz)
+    os.replace(f.name, path)
+    product_infz_hashes.invalidate(path)
 
-                if package.icon:
-                    zipf.writestr(package.icon_filename, package.icon)
 
-        zipf.write(product_inf_file, arcname="product.inf")
-        os.remove(product_inf_file)
+def infz_entry(name: str) -> zipfile.ZipInfo:
+    entry = zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0))
+    entry.compress_type = zipfile.ZIP_DEFLATED
+    return entry
 
 
 @packages_blueprint.route("/api/packages/repositories.inf")
@@ -295,6 +302,7 @@ def delete_package():
         return jsonify({"success": False, "error": f"Unknown package name: {package_name}"}), 404
 
     package = package[0]
+    atak_version = package.atak_version
     if os.path.exists(
         os.path.join(app.config.get("OTS_DATA_FOLDER"), "packages", package.file_name)
     ):
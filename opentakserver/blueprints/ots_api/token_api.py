@@ -1,5 +1,4 @@
 import datetime
-import os
 import time
 import traceback
 from urllib.parse import urlparse
@@ -16,6 +15,7 @@ from flask_security import auth_required, verify_password
 from sqlalchemy import delete
 
 from opentakserver.extensions import db, ldap_manager, logger
+from opentakserver.key_cache import jwt_private_key
 from opentakserver.models.Token import Token
 from opentakserver.models.user import User
 
@@ -56,28 +56,22 @@ def cloudtak_oauth_token():
         if not user or not verify_password(password, user.password):
             return jsonify({"success": False, "error": "Invalid username or password"}), 400
 
-    with open(
-        os.path.join(
-            app.config.get("OTS_CA_FOLDER"), "certs", "opentakserver", "opentakserver.nopass.key"
-        ),
-        "rb",
-    ) as key:
-        token = jwt.encode(
-            {
-                "exp": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=365),
-                "nbf": datetime.datetime.now(datetime.timezone.utc),
-                "iss": "OpenTAKServer",
-                "aud": "OpenTAKServer",
-                "iat": datetime.datetime.now(datetime.timezone.utc),
-                "sub": user.username,
-            },
-            key.read(),
-            algorithm="RS256",
-        )
-
-        return jsonify(
-            {"access_token": token, "token_type": "Bearer", "expires_in": 365 * 24 * 60 * 60}
-        )
+    token = jwt.encode(
+        {
+            "exp": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=365),
+            "nbf": datetime.datetime.now(datetime.timezone.utc),
+            "iss": "OpenTAKServer",
+            "aud": "OpenTAKServer",
+            "iat": datetime.datetime.now(datetime.timezone.utc),
+            "sub": user.username,
+        },
+        jwt_private_key(),
+        algorithm="RS256",
+    )
+
+    return jsonify(
+        {"access_token": token, "token_type": "Bearer", "expires_in": 365 * 24 * 60 * 60}
+    )
 
 
 @token_api_blueprint.route("/api/atak_qr_string", methods=["POST"])
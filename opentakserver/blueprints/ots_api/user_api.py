@@ -16,6 +16,7 @@ from flask_security import (
 
 from opentakserver.blueprints.ots_api.api import paginate, search
 from opentakserver.extensions import db, ldap_manager, logger
+from opentakserver.group_cache import notify_group_change
 from opentakserver.models.EUD import EUD
 from opentakserver.models.Group import Group
 from opentakserver.models.GroupUser import GroupUser
@@ -133,6 +134,7 @@ def delete_user():
 
     try:
         user = app.security.datastore.find_user(username=username)
+        user_id = user.id
         db.session.execute(sqlalchemy.delete(GroupUser).where(GroupUser.user_id == user.id))
         app.security.datastore.delete_user(user)
     except BaseException as e:
@@ -143,6 +145,7 @@ def delete_user():
         )
 
     db.session.commit()
+    notify_group_change(user_id)
     return jsonify({"success": True}), 200
 
 
@@ -627,4 +630,5 @@ def add_user_to_groups():
         except sqlalchemy.exc.IntegrityError:
             db.session.rollback()
 
+    notify_group_change(user.id)
     return jsonify({"success": True})
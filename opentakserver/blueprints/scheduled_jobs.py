@@ -1,7 +1,6 @@
 import datetime
 import json
 import traceback
-from xml.etree.ElementTree import tostring
 
 import adsbxcot
 import aiscot
@@ -10,14 +9,11 @@ import requests
 from bs4 import BeautifulSoup
 from flask import Blueprint
 from flask import current_app as app
-from sqlalchemy import delete
+from sqlalchemy import select
 
+from opentakserver.cot_storage import migrate_stored_cots
 from opentakserver.extensions import apscheduler, db, logger
-from opentakserver.functions import (
-    datetime_from_iso8601_string,
-    generate_delete_cot,
-    iso8601_string_from_datetime,
-)
+from opentakserver.map_state import KINDS, delete_map_state
 from opentakserver.models.Alert import Alert
 from opentakserver.models.CasEvac import CasEvac
 from opentakserver.models.Certificate import Certificate
@@ -27,7 +23,6 @@ from opentakserver.models.CoT import CoT
 from opentakserver.models.DataPackage import DataPackage
 from opentakserver.models.EUD import EUD
 from opentakserver.models.GeoChat import GeoChat
-from opentakserver.models.Group import Group
 from opentakserver.models.Marker import Marker
 from opentakserver.models.Mission import Mission
 from opentakserver.models.MissionChange import MissionChange
@@ -41,6 +36,9 @@ from opentakserver.models.Team import Team
 from opentakserver.models.VideoRecording import VideoRecording
 from opentakserver.models.VideoStream import VideoStream
 from opentakserver.models.ZMIST import ZMIST
+from opentakserver.partitions import maintain_partitions
+from opentakserver.retention import DeleteCoTPublisher, RetentionRun
+from opentakserver.uploads import delete_stale_partial_uploads
 
 scheduler_blueprint = Blueprint("scheduler_blueprint", __name__)
 
@@ -189,6 +187,8 @@ def purge_data():
     Mission.query.delete()
     EUD.query.delete()
     Team.query.delete()
+    for kind in KINDS:
+        delete_map_state(kind)
     db.session.commit()
     logger.info("Purged all data")
 
@@ -291,87 +291,11 @@ def delete_old_data():
         )
         channel = rabbit_connection.channel()
 
-        # I wish I hadn't made the marker's timestamp field a string...
-        markers = db.session.execute(db.session.query(Marker)).all()
-        groups = db.session.execute(db.session.query(Group)).scalars()
-        for marker in markers:
-            marker = marker[0]
-            if datetime_from_iso8601_string(marker.production_time) <= timestamp:
-                cot = generate_delete_cot(marker.uid, marker.cot.type)
-                for group in groups:
-                    channel.basic_publish(
-                        exchange="groups",
-                        routing_key=f"{group.name}.{Group.OUT}",
-                        body=json.dumps(
-                            {"cot": tostring(cot).decode("utf-8"), "uid": app.config["OTS_NODE_ID"]}
-                        ),
-                        properties=pika.BasicProperties(
-                            expiration=app.config.get("OTS_RABBITMQ_TTL")
-                        ),
-                    )
-                    channel.basic_publish(
-                        exchange="firehose",
-                        routing_key="",
-                        body=json.dumps(
-                            {"cot": tostring(cot).decode("utf-8"), "uid": app.config["OTS_NODE_ID"]}
-                        ),
-                        properties=pika.BasicProperties(
-                            expiration=app.config.get("OTS_RABBITMQ_TTL")
-                        ),
-                    )
-                db.session.delete(marker)
-
-        alerts = db.session.execute(
-            db.session.query(Alert).where(Alert.start_time <= timestamp)
-        ).all()
-        for alert in alerts:
-            alert = alert[0]
-            cot = generate_delete_cot(alert.uid, alert.cot.type)
-            for group in groups:
-                channel.basic_publish(
-                    exchange="groups",
-                    routing_key=f"{group.name}.{Group.OUT}",
-                    body=json.dumps(
-                        {"cot": tostring(cot).decode("utf-8"), "uid": app.config["OTS_NODE_ID"]}
-                    ),
-                    properties=pika.BasicProperties(expiration=app.config.get("OTS_RABBITMQ_TTL")),
-                )
-                channel.basic_publish(
-                    exchange="firehose",
-                    routing_key="",
-                    body=json.dumps(
-                        {"cot": tostring(cot).decode("utf-8"), "uid": app.config["OTS_NODE_ID"]}
-                    ),
-                    properties=pika.BasicProperties(expiration=app.config.get("OTS_RABBITMQ_TTL")),
-                )
-            db.session.delete(alert)
-
-        rb_lines = db.session.execute(
-            db.session.query(RBLine).where(RBLine.timestamp <= timestamp)
-        ).all()
-        for rb_line in rb_lines:
-            rb_line = rb_line[0]
-            cot = generate_delete_cot(rb_line.uid, rb_line.cot.type)
-            for group in groups:
-                channel.basic_publish(
-                    exchange="groups",
-                    routing_key=f"{group.name}.{Group.OUT}",
-                    body=json.dumps(
-                        {"cot": tostring(cot).decode("utf-8"), "uid": app.config["OTS_NODE_ID"]}
-                    ),
-                    properties=pika.BasicProperties(expiration=app.config.get("OTS_RABBITMQ_TTL")),
-                )
-                channel.basic_publish(
-                    exchange="firehose",
-                    routing_key="",
-                    body=json.dumps(
-                        {"cot": tostring(cot).decode("utf-8"), "uid": app.config["OTS_NODE_ID"]}
-                    ),
-                    properties=pika.BasicProperties(expiration=app.config.get("OTS_RABBITMQ_TTL")),
-                )
-            db.session.delete(rb_line)
-
-        db.session.execute(delete(GeoChat).where(GeoChat.timestamp <= timestamp))
+        retention = RetentionRun(DeleteCoTPublisher(channel))
+        retention.delete_with_cots(Marker, "markers", Marker.production_time <= timestamp)
+        retention.delete_with_cots(Alert, None, Alert.start_time <= timestamp)
+        retention.delete_with_cots(RBLine, "rb_lines", RBLine.timestamp <= timestamp)
+        retention.delete(GeoChat, GeoChat.timestamp <= timestamp)
 
         timestamp = datetime.datetime.now() - datetime.timedelta(
             seconds=app.config.get("OTS_DELETE_OLD_DATA_SECONDS"),
@@ -381,18 +305,37 @@ def delete_old_data():
             weeks=app.config.get("OTS_DELETE_OLD_DATA_WEEKS"),
         )
 
-        db.session.execute(delete(MissionRole).where(MissionRole.createTime <= timestamp))
-        db.session.execute(delete(MissionUID).where(MissionUID.timestamp <= timestamp))
-        db.session.execute(delete(MissionChange).where(MissionChange.timestamp <= timestamp))
-        db.session.execute(delete(EUD).where(EUD.last_event_time <= timestamp))
-        db.session.execute(delete(Point).where(Point.timestamp <= timestamp))
-        db.session.execute(delete(CoT).where(CoT.timestamp <= timestamp))
+        retention.delete(MissionRole, MissionRole.createTime <= timestamp)
+        retention.delete(MissionUID, MissionUID.timestamp <= timestamp)
+        retention.delete(MissionChange, MissionChange.timestamp <= timestamp)
+        delete_map_state("euds", select(EUD.uid).where(EUD.last_event_time <= timestamp))
         db.session.commit()
+        retention.delete(EUD, EUD.last_event_time <= timestamp)
+
+        # Drop whole partitions of the cot and points tables when they're partitioned, then delete what's left
+        maintain_partitions(db.session.connection(), timestamp)
+        db.session.commit()
+        retention.delete(Point, Point.timestamp <= timestamp)
+        retention.delete(CoT, CoT.timestamp <= timestamp)
+
+        delete_stale_partial_uploads()
 
         channel.close()
         rabbit_connection.close()
 
-        logger.info(f"Deleted data older than {iso8601_string_from_datetime(timestamp)}")
+        logger.info(retention.summary(timestamp))
+
+
+def create_partitions():
+    with apscheduler.app.app_context():
+        maintain_partitions(db.session.connection())
+        db.session.commit()
+
+
+def compress_cots():
+    with apscheduler.app.app_context():
+        # Stop before the next run starts
+        migrate_stored_cots(app.config.get("OTS_COT_MIGRATION_BATCH_SIZE"), 240)
 
 
 # This function is to prevent errors caused by changing get_airplanes_live_data() to get_adsb_data
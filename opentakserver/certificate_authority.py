@@ -1,20 +1,48 @@
+import datetime
 import io
+import ipaddress
+import multiprocessing
 import os
-import random
 import re
 import shutil
-import subprocess
 import traceback
 import uuid
 import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from shutil import copyfile, rmtree
 from urllib.parse import urlparse
 
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
 from flask import request
 from jinja2 import Template
 
-from .ca_config import ca_config, server_config
+from .ca_config import ca_config
+
+# How long before the next CRL, the same as default_crl_days in ca_config.cfg
+CRL_DAYS = 730
+
+# Maps the keys in OTS_CA_SUBJECT to their OIDs
+SUBJECT_OIDS = {
+    "C": NameOID.COUNTRY_NAME,
+    "ST": NameOID.STATE_OR_PROVINCE_NAME,
+    "L": NameOID.LOCALITY_NAME,
+    "O": NameOID.ORGANIZATION_NAME,
+    "OU": NameOID.ORGANIZATIONAL_UNIT_NAME,
+    "CN": NameOID.COMMON_NAME,
+}
+
+
+def generate_private_key(key_size: int = 2048) -> bytes:
+    """Generates an RSA key and returns it as unencrypted PEM so it can be sent back from a worker process"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    return key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
 
 
 class CertificateAuthority:
@@ -23,92 +51,117 @@ class CertificateAuthority:
         self.logger = logger
         self.app = app
 
+    def path(self, *parts) -> str:
+        return os.path.join(self.app.config.get("OTS_CA_FOLDER"), *parts)
+
+    def subject(self, common_name: str) -> x509.Name:
+        """Builds a subject from OTS_CA_SUBJECT, i.e. /C=WW/ST=XX/L=YY/O=ZZ/OU=OpenTAKServer, and a common name"""
+        attributes = []
+        for part in self.app.config.get("OTS_CA_SUBJECT").strip("/").split("/"):
+            key, _, value = part.partition("=")
+            if key in SUBJECT_OIDS and value:
+                attributes.append(x509.NameAttribute(SUBJECT_OIDS[key], value))
+        attributes.append(x509.NameAttribute(NameOID.COMMON_NAME, common_name))
+        return x509.Name(attributes)
+
+    def pkcs12_encryption(self):
+        # The same algorithms as openssl pkcs12 -legacy, which ATAK and iTAK can read
+        return (
+            serialization.PrivateFormat.PKCS12.encryption_builder()
+            .kdf_rounds(2048)
+            .key_cert_algorithm(pkcs12.PBES.PBESv1SHA1And3KeyTripleDESCBC)
+            .hmac_hash(hashes.SHA1())
+            .build(self.app.config.get("OTS_CA_PASSWORD").encode())
+        )
+
+    def load_ca(self) -> tuple[x509.Certificate, rsa.RSAPrivateKey]:
+        with open(self.path("ca.pem"), "rb") as f:
+            ca_cert = x509.load_pem_x509_certificate(f.read())
+        with open(self.path("ca-do-not-share.key"), "rb") as f:
+            ca_key = serialization.load_pem_private_key(
+                f.read(), password=self.app.config.get("OTS_CA_PASSWORD").encode()
+            )
+        return ca_cert, ca_key
+
     def create_ca(self):
         if not self.check_if_ca_exists():
             self.logger.info("Creating CA...")
             os.makedirs(self.app.config.get("OTS_CA_FOLDER"), exist_ok=True)
 
-            f = open(os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca_config.cfg"), "w")
-            f.write(ca_config)
-            f.close()
-
-            subject = self.app.config.get("OTS_CA_SUBJECT") + "/CN={}".format(
-                self.app.config.get("OTS_CA_NAME")
-            )
-
-            command = "openssl req -new -sha256 -x509 -days {} -extensions v3_ca -keyout {} -out {} -passout pass:{} -config {} -subj {}".format(
-                self.app.config.get("OTS_CA_EXPIRATION_TIME"),
-                os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca-do-not-share.key"),
-                os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca.pem"),
-                self.app.config.get("OTS_CA_PASSWORD"),
-                os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca_config.cfg"),
-                subject,
-            )
-
-            self.logger.debug(command)
-
-            exit_code = subprocess.call(command, shell=True)
-
-            if exit_code:
-                raise Exception("Failed to create ca.pem. Exit code {}".format(exit_code))
-
-            command = "openssl x509 -in {} -addtrust clientAuth -addtrust serverAuth -setalias {} -out {}".format(
-                os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca.pem"),
-                self.app.config.get("OTS_CA_NAME"),
-                os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca-trusted.pem"),
-            )
-
-            self.logger.debug(command)
-
-            exit_code = subprocess.call(command, shell=True)
-
-            if exit_code:
-                raise Exception("Failed to add trust to CA. Exit code {}".format(exit_code))
-
-            use_legacy = not subprocess.call("openssl list -providers", shell=True)
-
-            if use_legacy:
-                command = "openssl pkcs12 -legacy -export -in {} -out {} -passout pass:{} -nokeys -caname {}".format(
-                    os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca-trusted.pem"),
-                    os.path.join(self.app.config.get("OTS_CA_FOLDER"), "truststore-root.p12"),
-                    self.app.config.get("OTS_CA_PASSWORD"),
-                    self.app.config.get("OTS_CA_NAME"),
+            # Kept so the CA can still be managed with the openssl ca command
+            with open(self.path("ca_config.cfg"), "w") as f:
+                f.write(ca_config)
+
+            ca_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            subject = self.subject(self.app.config.get("OTS_CA_NAME"))
+            now = datetime.datetime.now(datetime.timezone.utc)
+
+            ca_cert = (
+                x509.CertificateBuilder()
+                .subject_name(subject)
+                .issuer_name(subject)
+                .public_key(ca_key.public_key())
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(now)
+                .not_valid_after(
+                    now + datetime.timedelta(days=self.app.config.get("OTS_CA_EXPIRATION_TIME"))
                 )
-            else:
-                command = "openssl pkcs12 -export -in {} -out {} -passout pass:{} -nokeys -caname {}".format(
-                    os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca-trusted.pem"),
-                    os.path.join(self.app.config.get("OTS_CA_FOLDER"), "truststore-root.p12"),
-                    self.app.config.get("OTS_CA_PASSWORD"),
-                    self.app.config.get("OTS_CA_NAME"),
+                .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                .add_extension(
+                    x509.KeyUsage(
+                        digital_signature=False,
+                        content_commitment=False,
+                        key_encipherment=False,
+                        data_encipherment=False,
+                        key_agreement=False,
+                        key_cert_sign=True,
+                        crl_sign=True,
+                        encipher_only=False,
+                        decipher_only=False,
+                    ),
+                    critical=True,
                 )
-
-            self.logger.debug(command)
-
-            exit_code = subprocess.call(command, shell=True)
-
-            if exit_code:
-                raise Exception("Failed to export truststore. Exit code {}".format(exit_code))
-
-            Path(os.path.join(self.app.config.get("OTS_CA_FOLDER"), "crl_index.txt")).touch()
-            f = open(os.path.join(self.app.config.get("OTS_CA_FOLDER"), "crl_index.txt.attr"), "w")
-            f.write("unique_subject = no")
-            f.close()
-
-            command = "cd {} && openssl ca -config {} -gencrl -keyfile {} -passin pass:{} -cert {} -out {}".format(
-                self.app.config.get("OTS_CA_FOLDER"),
-                os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca_config.cfg"),
-                os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca-do-not-share.key"),
-                self.app.config.get("OTS_CA_PASSWORD"),
-                os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca.pem"),
-                os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca.crl"),
+                .add_extension(
+                    x509.SubjectKeyIdentifier.from_public_key(ca_key.public_key()), critical=False
+                )
+                .sign(ca_key, hashes.SHA256())
             )
 
-            self.logger.debug(command)
+            with open(self.path("ca-do-not-share.key"), "wb") as f:
+                f.write(
+                    ca_key.private_bytes(
+                        serialization.Encoding.PEM,
+                        serialization.PrivateFormat.PKCS8,
+                        serialization.BestAvailableEncryption(
+                            self.app.config.get("OTS_CA_PASSWORD").encode()
+                        ),
+                    )
+                )
+            os.chmod(self.path("ca-do-not-share.key"), 0o600)
+
+            with open(self.path("ca.pem"), "wb") as f:
+                f.write(ca_cert.public_bytes(serialization.Encoding.PEM))
+
+            with open(self.path("truststore-root.p12"), "wb") as f:
+                f.write(
+                    pkcs12.serialize_key_and_certificates(
+                        None,
+                        None,
+                        None,
+                        [
+                            pkcs12.PKCS12Certificate(
+                                ca_cert, self.app.config.get("OTS_CA_NAME").encode()
+                            )
+                        ],
+                        self.pkcs12_encryption(),
+                    )
+                )
 
-            exit_code = subprocess.call(command, shell=True)
+            Path(self.path("crl_index.txt")).touch()
+            with open(self.path("crl_index.txt.attr"), "w") as f:
+                f.write("unique_subject = no")
 
-            if exit_code:
-                raise Exception("Failed to create crl. Exit code {}".format(exit_code))
+            self.generate_crl(ca_cert, ca_key)
 
             self.logger.debug("Creating server cert...")
             self.issue_certificate("opentakserver", True)
@@ -119,224 +172,212 @@ class CertificateAuthority:
         else:
             self.logger.debug("CA already exists")
 
-    def issue_certificate(self, common_name, server=False):
-        if not os.path.exists(os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca.pem")):
-            raise FileNotFoundError("ca.pem not found")
-
-        if os.path.exists(os.path.join(self.app.config.get("OTS_CA_FOLDER"), "certs", common_name)):
-            shutil.rmtree(os.path.join(self.app.config.get("OTS_CA_FOLDER"), "certs", common_name))
-
-        os.makedirs(os.path.join(self.app.config.get("OTS_CA_FOLDER"), "certs", common_name))
-
-        subject = self.app.config.get("OTS_CA_SUBJECT") + "/CN={}".format(common_name)
-
-        command = "openssl req -new -newkey rsa:2048 -sha256 -keyout {} -passout pass:{} -out {} -subj {} -config {}".format(
-            os.path.join(
-                self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name + ".key"
-            ),
-            self.app.config.get("OTS_CA_PASSWORD"),
-            os.path.join(
-                self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name + ".csr"
-            ),
-            subject,
-            os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca_config.cfg"),
+    def generate_crl(self, ca_cert: x509.Certificate = None, ca_key: rsa.RSAPrivateKey = None):
+        """Writes ca.crl from the revoked certificates in crl_index.txt, which uses the openssl ca index format"""
+        if ca_cert is None or ca_key is None:
+            ca_cert, ca_key = self.load_ca()
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        builder = (
+            x509.CertificateRevocationListBuilder()
+            .issuer_name(ca_cert.subject)
+            .last_update(now)
+            .next_update(now + datetime.timedelta(days=CRL_DAYS))
         )
 
-        self.logger.debug(command)
+        with open(self.path("crl_index.txt"), "r") as index:
+            for line in index:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 4 or fields[0] != "R":
+                    continue
+
+                revocation_date = datetime.datetime.strptime(
+                    fields[2].split(",")[0], "%y%m%d%H%M%SZ"
+                ).replace(tzinfo=datetime.timezone.utc)
+                builder = builder.add_revoked_certificate(
+                    x509.RevokedCertificateBuilder()
+                    .serial_number(int(fields[3], 16))
+                    .revocation_date(revocation_date)
+                    .build()
+                )
+
+        crl = builder.sign(ca_key, hashes.SHA256())
+        with open(self.path("ca.crl"), "wb") as f:
+            f.write(crl.public_bytes(serialization.Encoding.PEM))
 
-        exit_code = subprocess.call(command, shell=True)
-        if exit_code:
-            raise Exception("Failed to create csr. Exit code {}".format(exit_code))
+    def revoke_certificate(self, common_name: str):
+        """Adds a certificate to crl_index.txt and regenerates ca.crl. nginx must be reloaded to use the new CRL"""
+        with open(self.path("certs", common_name, common_name + ".pem"), "rb") as f:
+            cert = x509.load_pem_x509_certificate(f.read())
 
-        csr = open(
-            os.path.join(
-                self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name + ".csr"
-            ),
-            "r",
+        now = datetime.datetime.now(datetime.timezone.utc)
+        subject = "".join(
+            "/{}={}".format(
+                next(key for key, oid in SUBJECT_OIDS.items() if oid == attribute.oid),
+                attribute.value,
+            )
+            for attribute in cert.subject
+            if attribute.oid in SUBJECT_OIDS.values()
         )
-        csr_bytes = csr.read().encode()
-        csr.close()
+        with open(self.path("crl_index.txt"), "a") as index:
+            index.write(
+                "R\t{}\t{}\t{:X}\tunknown\t{}\n".format(
+                    cert.not_valid_after_utc.strftime("%y%m%d%H%M%SZ"),
+                    now.strftime("%y%m%d%H%M%SZ"),
+                    cert.serial_number,
+                    subject,
+                )
+            )
 
-        self.sign_csr(csr_bytes, common_name, server)
+        self.generate_crl()
+        self.logger.info("Revoked the certificate for {}".format(common_name))
 
-        use_legacy = not subprocess.call("openssl list -providers", shell=True)
+    def issue_certificate(self, common_name, server=False, private_key: bytes = None):
+        if not os.path.exists(self.path("ca.pem")):
+            raise FileNotFoundError("ca.pem not found")
 
-        if use_legacy:
-            command = "openssl pkcs12 -legacy -export -in {}.pem -inkey {}.key -out {}.p12 -name {} -CAfile {} -passin pass:{} -passout pass:{}".format(
-                os.path.join(
-                    self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name
-                ),
-                os.path.join(
-                    self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name
-                ),
-                os.path.join(
-                    self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name
-                ),
-                common_name,
-                os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca.pem"),
-                self.app.config.get("OTS_CA_PASSWORD"),
-                self.app.config.get("OTS_CA_PASSWORD"),
-            )
-        else:
-            command = "openssl pkcs12 -export -in {}.pem -inkey {}.key -out {}.p12 -name {} -CAfile {} -passin pass:{} -passout pass:{}".format(
-                os.path.join(
-                    self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name
-                ),
-                os.path.join(
-                    self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name
-                ),
-                os.path.join(
-                    self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name
-                ),
-                common_name,
-                os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca.pem"),
-                self.app.config.get("OTS_CA_PASSWORD"),
-                self.app.config.get("OTS_CA_PASSWORD"),
-            )
+        if os.path.exists(self.path("certs", common_name)):
+            shutil.rmtree(self.path("certs", common_name))
 
-        self.logger.debug(command)
+        os.makedirs(self.path("certs", common_name))
 
-        exit_code = subprocess.call(command, shell=True)
-        if exit_code:
-            raise Exception("Failed to export p12 key. Exit code {}".format(exit_code))
+        if private_key is None:
+            private_key = generate_private_key()
+        key = serialization.load_pem_private_key(private_key, password=None)
 
-        os.chmod(
-            os.path.join(
-                self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name + ".key"
-            ),
-            0o620,
+        cert = self.sign(
+            self.subject(common_name), key.public_key(), common_name, server, *self.load_ca()
         )
 
-        command = "openssl rsa -in {} -passin pass:{} -out {}".format(
-            os.path.join(
-                self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name + ".key"
-            ),
-            os.path.join(self.app.config.get("OTS_CA_PASSWORD")),
-            os.path.join(
-                self.app.config.get("OTS_CA_FOLDER"),
-                "certs",
-                common_name,
-                common_name + ".nopass.key",
-            ),
+        p12 = pkcs12.serialize_key_and_certificates(
+            common_name.encode(), key, cert, None, self.pkcs12_encryption()
         )
+        with open(self.path("certs", common_name, common_name + ".p12"), "wb") as f:
+            f.write(p12)
+
+        with open(self.path("certs", common_name, common_name + ".key"), "wb") as f:
+            f.write(
+                key.private_bytes(
+                    serialization.Encoding.PEM,
+                    serialization.PrivateFormat.PKCS8,
+                    serialization.BestAvailableEncryption(
+                        self.app.config.get("OTS_CA_PASSWORD").encode()
+                    ),
+                )
+            )
+        os.chmod(self.path("certs", common_name, common_name + ".key"), 0o620)
 
-        self.logger.debug(command)
-
-        exit_code = subprocess.call(command, shell=True)
-        if exit_code:
-            raise Exception("Failed to remove server key password. Exit code {}".format(exit_code))
+        with open(self.path("certs", common_name, common_name + ".nopass.key"), "wb") as f:
+            f.write(private_key)
 
         if not server:
             return self.generate_zip(common_name)
         else:
             # Generate public key for PyJWT to validate tokens
-            command = "openssl x509 -pubkey -in {} -out {}".format(
-                os.path.join(
-                    self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name + ".pem"
-                ),
-                os.path.join(
-                    self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name + ".pub"
-                ),
-            )
-
-            self.logger.debug(command)
-
-            exit_code = subprocess.call(command, shell=True)
-            if exit_code:
-                raise Exception(
-                    "Failed to generate server's public key. Exit code {}".format(exit_code)
+            with open(self.path("certs", common_name, common_name + ".pub"), "wb") as f:
+                f.write(
+                    key.public_key().public_bytes(
+                        serialization.Encoding.PEM,
+                        serialization.PublicFormat.SubjectPublicKeyInfo,
+                    )
                 )
 
-    def sign_csr(self, csr_bytes, common_name, server=False):
-        os.makedirs(
-            os.path.join(self.app.config.get("OTS_CA_FOLDER"), "certs", common_name), exist_ok=True
-        )
-        f = open(
-            os.path.join(
-                self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name + ".csr"
-            ),
-            "wb",
+    def issue_certificates(self, common_names: list[str], server=False) -> dict[str, list[str]]:
+        """Issues certificates for many common names at once. The RSA keys are generated in parallel in
+        OTS_CA_KEYGEN_PROCESSES worker processes. Returns the filenames of each common name's data packages
+        """
+        processes = min(len(common_names), self.app.config.get("OTS_CA_KEYGEN_PROCESSES") or 1)
+        if processes > 1:
+            # Spawn instead of fork because the web server's threads are monkey patched by gevent
+            with ProcessPoolExecutor(
+                max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                private_keys = list(executor.map(generate_private_key, [2048] * len(common_names)))
+        else:
+            private_keys = [generate_private_key() for _ in common_names]
+
+        results = {}
+        for common_name, private_key in zip(common_names, private_keys):
+            results[common_name] = self.issue_certificate(common_name, server, private_key)
+
+        return results
+
+    def sign(
+        self,
+        subject: x509.Name,
+        public_key,
+        common_name: str,
+        server: bool,
+        ca_cert: x509.Certificate,
+        ca_key: rsa.RSAPrivateKey,
+    ) -> x509.Certificate:
+        """Signs a certificate with the same extensions as the client and server sections of ca_config.cfg"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        extended_key_usage = [ExtendedKeyUsageOID.CLIENT_AUTH]
+        if server:
+            extended_key_usage.append(ExtendedKeyUsageOID.SERVER_AUTH)
+
+        builder = (
+            x509.CertificateBuilder()
+            .subject_name(subject)
+            .issuer_name(ca_cert.subject)
+            .public_key(public_key)
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now)
+            .not_valid_after(
+                now + datetime.timedelta(days=self.app.config.get("OTS_CA_EXPIRATION_TIME"))
+            )
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True)
+            .add_extension(
+                x509.KeyUsage(
+                    digital_signature=True,
+                    content_commitment=False,
+                    key_encipherment=True,
+                    data_encipherment=False,
+                    key_agreement=False,
+                    key_cert_sign=False,
+                    crl_sign=False,
+                    encipher_only=False,
+                    decipher_only=False,
+                ),
+                critical=True,
+            )
+            .add_extension(x509.ExtendedKeyUsage(extended_key_usage), critical=True)
         )
-        f.write(csr_bytes)
-        f.close()
 
         if server:
             if re.match("^[0-9]{1,3}.[0-9]{1,3}.[0-9]{1,3}.[0-9]{1,3}$", common_name):
-                alt_name_field = "IP.1"
+                alt_name = x509.IPAddress(ipaddress.ip_address(common_name))
             else:
-                alt_name_field = "DNS.1"
-
-            f = open(
-                os.path.join(
-                    self.app.config.get("OTS_CA_FOLDER"),
-                    "certs",
-                    common_name,
-                    "{}_config.cfg".format(common_name),
-                ),
-                "w",
-            )
-
-            f.write(server_config.render(alt_name_field=alt_name_field, common_name=common_name))
+                alt_name = x509.DNSName(common_name)
+            builder = builder.add_extension(x509.SubjectAlternativeName([alt_name]), critical=False)
 
-            f.close()
+        cert = builder.sign(ca_key, hashes.SHA256())
 
-            config_file = os.path.join(
-                self.app.config.get("OTS_CA_FOLDER"),
-                "certs",
-                common_name,
-                "{}_config.cfg".format(common_name),
-            )
-            extensions = "server"
-        else:
-            config_file = os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca_config.cfg")
-            extensions = "client"
-
-        command = "openssl x509 -sha256 -req -days {} -in {} -CA {} -CAkey {} -out {} -set_serial {} -passin pass:{} -extensions {} -extfile {}".format(
-            self.app.config.get("OTS_CA_EXPIRATION_TIME"),
-            os.path.join(
-                self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name + ".csr"
-            ),
-            os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca.pem"),
-            os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca-do-not-share.key"),
-            os.path.join(
-                self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name + ".pem"
-            ),
-            random.randint(10000, 100000),
-            self.app.config.get("OTS_CA_PASSWORD"),
-            extensions,
-            config_file,
-        )
+        with open(self.path("certs", common_name, common_name + ".pem"), "wb") as f:
+            f.write(cert.public_bytes(serialization.Encoding.PEM))
+            # Server certs include the CA
+            if server:
+                f.write(ca_cert.public_bytes(serialization.Encoding.PEM))
 
-        self.logger.debug(command)
+        return cert
 
-        exit_code = subprocess.call(command, shell=True)
-        if exit_code:
-            raise Exception("Failed to sign csr. Exit code {}".format(exit_code))
+    def sign_csr(self, csr_bytes, common_name, server=False):
+        os.makedirs(self.path("certs", common_name), exist_ok=True)
+        with open(self.path("certs", common_name, common_name + ".csr"), "wb") as f:
+            f.write(csr_bytes)
+
+        csr = x509.load_pem_x509_csr(csr_bytes)
+        if not csr.is_signature_valid:
+            raise Exception(
+                "Failed to sign csr for {}, its signature is invalid".format(common_name)
+            )
 
-        if server:
-            with open(os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca.pem"), "r") as ca_file:
-                f = open(
-                    os.path.join(
-                        self.app.config.get("OTS_CA_FOLDER"),
-                        "certs",
-                        common_name,
-                        common_name + ".pem",
-                    ),
-                    "a",
-                )
-                f.write(ca_file.read())
-                f.close()
-
-        f = open(
-            os.path.join(
-                self.app.config.get("OTS_CA_FOLDER"), "certs", common_name, common_name + ".pem"
-            ),
-            "r",
-        )
-        cert_bytes = f.read().encode()
-        f.close()
+        ca_cert, ca_key = self.load_ca()
+        self.sign(csr.subject, csr.public_key(), common_name, server, ca_cert, ca_key)
 
-        return cert_bytes
+        with open(self.path("certs", common_name, common_name + ".pem"), "rb") as f:
+            return f.read()
 
     def check_if_ca_exists(self):
         return os.path.exists(os.path.join(self.app.config.get("OTS_CA_FOLDER"), "ca.pem"))
@@ -17,6 +17,7 @@ from pika.spec import Basic, BasicProperties, Channel
 
 from opentakserver.controllers.rabbitmq_client import RabbitMQClient
 from opentakserver.extensions import db, logger, socketio
+from opentakserver.map_state import save_map_state
 from opentakserver.models.EUD import EUD
 from opentakserver.models.Meshtastic import MeshtasticChannel
 from opentakserver.models.Point import Point
@@ -342,6 +343,11 @@ class MeshtasticController(RabbitMQClient):
                         sqlalchemy.update(EUD).where(EUD.uid == uid).values(**eud.serialize())
                     )
                     db.session.commit()
+                else:
+                    return
+
+            save_map_state("euds", uid, eud.to_json())
+            db.session.commit()
 
     def position(self, pb, from_id, to_id, portnum):
         try:
@@ -0,0 +1,142 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+
+from lxml import etree
+
+from opentakserver.functions import datetime_from_iso8601_string
+
+xml_parser = etree.XMLParser(
+    resolve_entities=False, no_network=True, remove_comments=True, remove_pis=True
+)
+
+# Elements whose attributes are saved by decode_cot(). Only the first occurrence of each is kept,
+# which is the same element that BeautifulSoup's find() returned
+ELEMENT_FIELDS = {
+    "point": "point",
+    "track": "track",
+    "sensor": "sensor",
+    "precisionlocation": "precision_location",
+    "status": "status",
+    "usericon": "usericon",
+    "color": "color",
+    "contact": "contact",
+    "takv": "takv",
+    "__video": "video",
+    "ConnectionEntry": "connection_entry",
+    "__chat": "chat",
+    "chatgrp": "chat_group",
+    "emergency": "emergency",
+    "_medevac_": "medevac",
+    "zMist": "zmist",
+    "link": "link",
+    "stats": "stats",
+}
+
+
+@dataclass(slots=True)
+class DecodedCoT:
+    """Everything cot_parser needs from a CoT event, extracted in a single pass over the XML"""
+
+    xml: str
+    uid: str | None
+    type: str
+    how: str | None
+    time: datetime
+    start: datetime
+    stale: datetime
+
+    # Attributes of the first element with each tag in ELEMENT_FIELDS
+    point: dict | None = None
+    track: dict | None = None
+    sensor: dict | None = None
+    precision_location: dict | None = None
+    status: dict | None = None
+    usericon: dict | None = None
+    color: dict | None = None
+    contact: dict | None = None
+    takv: dict | None = None
+    video: dict | None = None
+    connection_entry: dict | None = None
+    chat: dict | None = None
+    chat_group: dict | None = None
+    emergency: dict | None = None
+    medevac: dict | None = None
+    zmist: dict | None = None
+    link: dict | None = None
+    stats: dict | None = None
+
+    remarks: dict | None = None
+    remarks_text: str = ""
+    destinations: list[dict] = field(default_factory=list)
+
+    has_detail: bool = False
+    # (tag, attributes) of the <detail> element's children, only decoded for R&B lines
+    detail_children: list[tuple[str, dict]] = field(default_factory=list)
+
+    # The last value of these attributes on any element in <detail>, used for markers
+    readiness: str | None = None
+    argb: str | None = None
+    iconset_path: str | None = None
+    altsrc: str | None = None
+
+
+def decode_cot(xml: str | bytes) -> DecodedCoT | None:
+    """Parses a CoT message. Returns None if it doesn't contain an <event>"""
+    if isinstance(xml, str):
+        root = etree.fromstring(xml.encode(), parser=xml_parser)
+    else:
+        root = etree.fromstring(xml, parser=xml_parser)
+        xml = xml.decode("utf-8")
+
+    event = root if root.tag == "event" else root.find(".//event")
+    if event is None:
+        return None
+
+    cot = DecodedCoT(
+        xml=xml,
+        uid=event.get("uid"),
+        type=event.get("type", ""),
+        how=event.get("how"),
+        time=datetime_from_iso8601_string(event.get("time")),
+        start=datetime_from_iso8601_string(event.get("start")),
+        stale=datetime_from_iso8601_string(event.get("stale")),
+    )
+
+    detail = None
+    for element in event.iter():
+        tag = element.tag
+        attributes = element.attrib
+
+        field_name = ELEMENT_FIELDS.get(tag)
+        if field_name is not None:
+            if getattr(cot, field_name) is None:
+                setattr(cot, field_name, dict(attributes))
+        elif tag == "dest":
+            cot.destinations.append(dict(attributes))
+        elif tag == "remarks":
+            if cot.remarks is None:
+                cot.remarks = dict(attributes)
+                cot.remarks_text = "".join(element.itertext())
+        elif tag == "detail":
+            if detail is None:
+                detail = element
+            continue
+        elif tag == "event":
+            continue
+
+        if tag != "point" and attributes:
+            if "readiness" in attributes:
+                cot.readiness = attributes["readiness"]
+            if "argb" in attributes:
+                cot.argb = attributes["argb"]
+            if "iconsetpath" in attributes:
+                cot.iconset_path = attributes["iconsetpath"]
+            if "altsrc" in attributes:
+                cot.altsrc = attributes["altsrc"]
+
+    if detail is not None:
+        cot.has_detail = True
+        if cot.type.startswith("u-rb"):
+            cot.detail_children = [(child.tag, dict(child.attrib)) for child in detail]
+
+    return cot
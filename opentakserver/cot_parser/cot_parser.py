@@ -1,6 +1,6 @@
 import base64
 import datetime
-from datetime import timedelta, timezone
+import functools
 import logging
 import os
 import platform
@@ -9,6 +9,8 @@ import sys
 import time
 import traceback
 import uuid
+from dataclasses import dataclass, field
+from datetime import timedelta, timezone
 from logging.handlers import TimedRotatingFileHandler
 
 import bleach
@@ -18,20 +20,25 @@ import pika
 import sqlalchemy.exc
 import unishox2
 import yaml
-from bs4 import BeautifulSoup
 from flask import Flask, jsonify
 from flask_security import SQLAlchemyUserDatastore
 from flask_security.models import fsqla
 from flask_socketio import SocketIO
 from meshtastic import BROADCAST_NUM, mesh_pb2, mqtt_pb2, portnums_pb2
-from opentakserver.models.GroupUser import GroupUser
 from pika.channel import Channel
-from sqlalchemy import exc, insert, select, update
+from sqlalchemy import bindparam, exc, insert, select, update
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 
+from opentakserver.cot_parser.cot_decoder import DecodedCoT, decode_cot
+from opentakserver.cot_parser.pli_filter import PLIFilter
+from opentakserver.cot_storage import cot_storage
 from opentakserver.defaultconfig import DefaultConfig
 from opentakserver.extensions import db, logger
 from opentakserver.functions import *
 from opentakserver.functions import datetime_from_iso8601_string
+from opentakserver.group_cache import group_cache
+from opentakserver.map_state import save_map_state
 from opentakserver.models.Alert import Alert
 from opentakserver.models.CasEvac import CasEvac
 from opentakserver.models.Certificate import Certificate
@@ -46,6 +53,7 @@ from opentakserver.models.GeoChat import GeoChat
 from opentakserver.models.Group import Group
 from opentakserver.models.GroupMission import GroupMission
 from opentakserver.models.Icon import Icon
+from opentakserver.models.MapState import MapState
 from opentakserver.models.Marker import Marker
 from opentakserver.models.Meshtastic import MeshtasticChannel
 from opentakserver.models.Mission import Mission
@@ -64,6 +72,35 @@ from opentakserver.models.ZMIST import ZMIST
 from opentakserver.proto import atak_pb2
 
 
+def connect_to_rabbitmq() -> pika.BlockingConnection:
+    rabbit_credentials = pika.PlainCredentials(
+        app.config.get("OTS_RABBITMQ_USERNAME"), app.config.get("OTS_RABBITMQ_PASSWORD")
+    )
+    rabbit_host = app.config.get("OTS_RABBITMQ_SERVER_ADDRESS")
+    return pika.BlockingConnection(
+        pika.ConnectionParameters(host=rabbit_host, credentials=rabbit_credentials)
+    )
+
+
+@dataclass(slots=True)
+class QueuedMessage:
+    """A message from the cot_parser queue waiting to be saved with the rest of its batch"""
+
+    delivery_tag: int
+    body: dict | None = None
+    uid: str | None = None
+    cot: DecodedCoT | None = None
+    cot_pk: int | None = None
+    point_pk: int | None = None
+    point: Point | None = None
+    # socketio, Meshtastic and RabbitMQ messages to send once the batch is committed
+    after_commit: list = field(default_factory=list)
+    failed: bool = False
+    # Position reports are only stored when they're outside the PLI dead-bands
+    pli: bool = False
+    moved: bool = True
+
+
 class CoTController:
 
     def __init__(self, context, log, database, socket_io):
@@ -77,14 +114,17 @@ class CoTController:
         self.rabbit_connection: pika.BlockingConnection = None
         self.rabbit_channel = None
 
+        self.batch: list[QueuedMessage] = []
+        self.flush_timer = None
+
+        self.pli_filter = PLIFilter.from_config(context.app.config)
+        self.pli_stats_logged = time.monotonic()
+        # Sends the rate limited PLIs once their group's interval passes
+        self.pli_timer = None
+        self.pli_timer_due = None
+
     def run(self):
-        rabbit_credentials = pika.PlainCredentials(
-            app.config.get("OTS_RABBITMQ_USERNAME"), app.config.get("OTS_RABBITMQ_PASSWORD")
-        )
-        rabbit_host = app.config.get("OTS_RABBITMQ_SERVER_ADDRESS")
-        self.rabbit_connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=rabbit_host, credentials=rabbit_credentials)
-        )
+        self.rabbit_connection = connect_to_rabbitmq()
         self.rabbit_channel = self.rabbit_connection.channel()
         self.rabbit_channel.queue_declare(queue="cot_parser")
         self.rabbit_channel.queue_bind(
@@ -96,282 +136,293 @@ class CoTController:
         self.rabbit_channel.basic_consume(
             queue="cot_parser", on_message_callback=self.on_message, auto_ack=False
         )
+        group_cache.subscribe(self.rabbit_channel)
         self.rabbit_channel.start_consuming()
 
-    def insert_cot(self, soup, event, uid):
-        start = datetime_from_iso8601_string(event.attrs["start"])
-        stale = datetime_from_iso8601_string(event.attrs["stale"])
-        timestamp = datetime_from_iso8601_string(event.attrs["time"])
+    def insert_rows(self, model, rows: list[dict]) -> list[int]:
+        """Inserts rows with as few statements as the database allows and returns their primary keys in order"""
+        if not rows:
+            return []
 
-        # Assign CoT to a data sync mission
-        dest = event.find("dest")
-        mission_name = None
-        if dest and "mission" in dest.attrs:
-            mission_name = dest.attrs["mission"]
-
-        with self.context:
-            res = self.db.session.execute(
-                insert(CoT).values(
-                    how=event.attrs["how"],
-                    type=event.attrs["type"],
-                    sender_uid=uid,
-                    timestamp=timestamp,
-                    xml=str(soup),
-                    start=start,
-                    stale=stale,
-                    mission_name=mission_name,
-                    uid=event.attrs["uid"],
+        if self.db.engine.dialect.insert_executemany_returning_sort_by_parameter_order:
+            return list(
+                self.db.session.scalars(
+                    insert(model).returning(model.id, sort_by_parameter_order=True), rows
                 )
             )
 
-            try:
-                self.db.session.commit()
-                return res.inserted_primary_key[0]
-            except sqlalchemy.exc.IntegrityError:
-                # When using MySQL it will raise IntegrityError when a new EUD connects and it doesn't exist yet in the EUDs table
-                # We'll ignore this error and not insert this CoT so the EUD table can be populated
-                return None
+        # MySQL doesn't support INSERT ... RETURNING
+        return [
+            self.db.session.execute(insert(model).values(**row)).inserted_primary_key[0]
+            for row in rows
+        ]
+
+    def insert_row(self, model, values: dict) -> bool:
+        """Inserts a row in a savepoint so a duplicate only undoes this insert instead of the whole batch.
+        Returns False if the row already exists"""
+        try:
+            with self.db.session.begin_nested():
+                self.db.session.execute(insert(model).values(**values))
+            return True
+        except exc.IntegrityError:
+            return False
+
+    def add_row(self, row) -> bool:
+        """Like insert_row() for a new model instance"""
+        try:
+            with self.db.session.begin_nested():
+                self.db.session.add(row)
+            return True
+        except exc.IntegrityError:
+            return False
+
+    def insert_cots(self, messages: list[QueuedMessage]) -> list[int | None]:
+        rows = []
+        for message in messages:
+            cot = message.cot
+
+            # Assign CoT to a data sync mission
+            mission_name = None
+            if cot.destinations and "mission" in cot.destinations[0]:
+                mission_name = cot.destinations[0]["mission"]
+
+            rows.append(
+                {
+                    "how": cot.how,
+                    "type": cot.type,
+                    "sender_uid": message.uid,
+                    "timestamp": cot.time,
+                    "xml": cot.xml,
+                    "start": cot.start,
+                    "stale": cot.stale,
+                    "mission_name": mission_name,
+                    "uid": cot.uid,
+                }
+            )
 
-    def parse_point(self, event, uid, cot_id):
+        try:
+            return self.insert_rows(CoT, rows)
+        except sqlalchemy.exc.IntegrityError:
+            if len(rows) > 1:
+                # save_batch() will retry each message on its own
+                raise
+
+            # When using MySQL it will raise IntegrityError when a new EUD connects and it doesn't exist yet in the EUDs table
+            # We'll ignore this error and not insert this CoT so the EUD table can be populated
+            self.db.session.rollback()
+            return [None]
+
+    def build_point(self, cot: DecodedCoT, uid, cot_id) -> Point | None:
         # hae = Height above the WGS ellipsoid in meters
         # ce = Circular 1-sigma or a circular area about the location in meters
         # le = Linear 1-sigma error or an altitude range about the location in meters
-        point = event.find("point")
-        if point and not point.attrs["lat"].startswith("999"):
+        point = cot.point
+        if point and not point["lat"].startswith("999"):
             p = Point()
-            p.uid = event.attrs["uid"]
+            p.uid = cot.uid
             p.device_uid = uid
-            p.ce = point.attrs["ce"]
-            p.hae = point.attrs["hae"]
-            p.le = point.attrs["le"]
-            p.latitude = float(point.attrs["lat"])
-            p.longitude = float(point.attrs["lon"])
-            p.timestamp = datetime_from_iso8601_string(event.attrs["time"])
+            p.ce = point["ce"]
+            p.hae = point["hae"]
+            p.le = point["le"]
+            p.latitude = float(point["lat"])
+            p.longitude = float(point["lon"])
+            p.timestamp = cot.time
             p.cot_id = cot_id
 
             # We only really care about the rest of the data if there's a valid lat/lon
             if p.latitude == 0 and p.longitude == 0:
                 return None
 
-            track = event.find("track")
-            if track:
-                if "course" in track.attrs and track.attrs["course"] != "9999999.0":
-                    p.course = track.attrs["course"]
+            track = cot.track
+            if track is not None:
+                if "course" in track and track["course"] != "9999999.0":
+                    p.course = track["course"]
                 else:
                     p.course = 0
 
-                if "speed" in track.attrs and track.attrs["speed"] != "9999999.0":
-                    p.speed = track.attrs["speed"]
+                if "speed" in track and track["speed"] != "9999999.0":
+                    p.speed = track["speed"]
                 else:
                     p.speed = 0
 
             # For TAK ICU and OpenTAK ICU CoT's with bearing from the compass
-            sensor = event.find("sensor")
-            if sensor:
-                if "azimuth" in sensor.attrs:
-                    p.azimuth = sensor.attrs["azimuth"]
+            sensor = cot.sensor
+            if sensor is not None:
+                if "azimuth" in sensor:
+                    p.azimuth = sensor["azimuth"]
                 # Camera's field of view
-                if "fov" in sensor.attrs:
-                    p.fov = sensor.attrs["fov"]
-
-            precision_location = event.find("precisionlocation")
-            if precision_location and "geolocationsrc" in precision_location.attrs:
-                p.location_source = precision_location.attrs["geolocationsrc"]
-            elif precision_location and "altsrc" in precision_location.attrs:
-                p.location_source = precision_location.attrs["altsrc"]
-            elif event.attrs["how"] == "m-g":
+                if "fov" in sensor:
+                    p.fov = sensor["fov"]
+
+            precision_location = cot.precision_location
+            if precision_location and "geolocationsrc" in precision_location:
+                p.location_source = precision_location["geolocationsrc"]
+            elif precision_location and "altsrc" in precision_location:
+                p.location_source = precision_location["altsrc"]
+            elif cot.how == "m-g":
                 p.location_source = "GPS"
 
-            status = event.find("status")
-            if status:
-                if "battery" in status.attrs:
-                    p.battery = status.attrs["battery"]
+            status = cot.status
+            if status is not None:
+                if "battery" in status:
+                    p.battery = status["battery"]
+
+            return p
+
+        return None
+
+    def mission_uid_values(self, cot: DecodedCoT, p: Point) -> dict:
+        # iTAK sucks. Instead of sending mission CoTs with a <dest mission="mission_name"> tag, it sends a normal CoT and
+        # makes a POST to /Marti/api/missions/mission_name/contents. The POST happens faster than the CoT can be received and parsed,
+        # so we're left with a row in the mission_uids table without most of the details that come from the CoT. Fortunately
+        # the mission_uids.uid field corresponds to the CoT's event UID, so the row in mission_uids can be updated here.
+        usericon = cot.usericon
+        color = cot.color
+        contact = cot.contact
+
+        iconset_path = None
+        if usericon and "iconsetpath" in usericon:
+            iconset_path = usericon["iconsetpath"]
+        elif usericon and "iconsetPath" in usericon:
+            iconset_path = usericon["iconsetPath"]
+
+        cot_color = None
+        if color and "argb" in color:
+            cot_color = color["argb"]
+        if color and "value" in color:
+            cot_color = color["value"]
+
+        callsign = None
+        if contact and "callsign" in contact:
+            callsign = contact["callsign"]
+
+        return {
+            "b_uid": cot.uid,
+            "cot_type": cot.type,
+            "latitude": p.latitude,
+            "longitude": p.longitude,
+            "iconset_path": iconset_path,
+            "color": cot_color,
+            "callsign": callsign,
+        }
+
+    def publish_point(self, cot: DecodedCoT, uid, p: Point):
+        # This CoT is a position update for an EUD. Send it to socketio clients so it can be seen on the UI map
+        # OpenTAK ICU position updates don't include the <takv> tag, but we still want to send the updated position
+        # to the UI's map
+        if cot.takv is not None or cot.video is not None:
+            self.socketio.emit("point", p.to_json(), namespace="/socket.io")
 
-            with self.context:
-                res = self.db.session.execute(
-                    insert(Point).values(
-                        uid=p.uid,
-                        device_uid=p.device_uid,
-                        ce=p.ce,
-                        hae=p.hae,
-                        le=p.le,
-                        latitude=p.latitude,
-                        longitude=p.longitude,
-                        timestamp=p.timestamp,
-                        cot_id=cot_id,
-                        location_source=p.location_source,
-                        course=p.course,
-                        speed=p.speed,
-                        battery=p.battery,
-                        fov=p.fov,
-                        azimuth=p.azimuth,
-                    )
-                )
-
-                # iTAK sucks. Instead of sending mission CoTs with a <dest mission="mission_name"> tag, it sends a normal CoT and
-                # makes a POST to /Marti/api/missions/mission_name/contents. The POST happens faster than the CoT can be received and parsed,
-                # so we're left with a row in the mission_uids table without most of the details that come from the CoT. Fortunately
-                # the mission_uids.uid field corresponds to the CoT's event UID, so the row in mission_uids can be updated here.
-                usericon = event.find("usericon")
-                color = event.find("color")
-                contact = event.find("contact")
-
-                iconset_path = None
-                if usericon and "iconsetpath" in usericon.attrs:
-                    iconset_path = usericon.attrs["iconsetpath"]
-                elif usericon and "iconsetPath" in usericon.attrs:
-                    iconset_path = usericon.attrs["iconsetPath"]
-
-                cot_color = None
-                if color and "argb" in color.attrs:
-                    cot_color = color.attrs["argb"]
-                if color and "value" in color.attrs:
-                    cot_color = color.attrs["value"]
-
-                callsign = None
-                if contact and "callsign" in contact.attrs:
-                    callsign = contact.attrs["callsign"]
-
-                self.db.session.execute(
-                    update(MissionUID)
-                    .where(MissionUID.uid == event.attrs["uid"])
-                    .values(
-                        cot_type=event.attrs["type"],
-                        latitude=p.latitude,
-                        longitude=p.longitude,
-                        iconset_path=iconset_path,
-                        color=cot_color,
-                        callsign=callsign,
-                    )
-                )
-
-                self.db.session.commit()
-                # Get the point from the DB with its related CoT
-                p = self.db.session.execute(
-                    select(Point).filter(Point.id == res.inserted_primary_key[0])
-                ).first()[0]
-
-                # This CoT is a position update for an EUD. Send it to socketio clients so it can be seen on the UI map
-                # OpenTAK ICU position updates don't include the <takv> tag, but we still want to send the updated position
-                # to the UI's map
-                if event.find("takv") or event.find("__video"):
-                    self.socketio.emit("point", p.to_json(), namespace="/socket.io")
-
-                if self.context.app.config.get("OTS_ENABLE_MESHTASTIC"):
-                    try:
-                        eud = self.db.session.execute(select(EUD).filter_by(uid=uid)).first()
-
-                        if not eud:
-                            return res.inserted_primary_key[0]
+        with self.context:
+            if self.context.app.config.get("OTS_ENABLE_MESHTASTIC"):
+                try:
+                    eud = self.db.session.execute(select(EUD).filter_by(uid=uid)).first()
 
-                        eud = eud[0]
+                    if not eud:
+                        return
 
-                        now = datetime.now(timezone.utc)
-                        if eud.last_meshtastic_publish is None or (
-                            now - eud.last_meshtastic_publish.replace(tzinfo=timezone.utc)
-                        ).total_seconds() >= self.context.app.config.get(
-                            "OTS_MESHTASTIC_PUBLISH_INTERVAL"
-                        ):
+                    eud = eud[0]
 
-                            self.logger.debug("publishing position to mesh")
-                            try:
-                                eud.last_meshtastic_publish = now
-                                self.db.session.execute(
-                                    update(EUD)
-                                    .filter_by(uid=eud.uid)
-                                    .values(last_meshtastic_publish=now)
-                                )
-                                self.db.session.commit()
-
-                                if eud.platform != "Meshtastic":
-                                    mesh_user = mesh_pb2.User()
-                                    setattr(mesh_user, "id", "!{:x}".format(eud.meshtastic_id))
-                                    mesh_user.hw_model = mesh_pb2.HardwareModel.PRIVATE_HW
-                                    mesh_user.short_name = p.device_uid[-4:]
-
-                                    contact = event.find("contact")
-                                    if contact:
-                                        mesh_user.long_name = contact.attrs["callsign"]
-
-                                    # Rate limits how often to send NodeInfo messages
-                                    if (
-                                        now
-                                        - eud.last_meshtastic_publish.replace(tzinfo=timezone.utc)
-                                    ).total_seconds() >= self.context.app.config.get(
-                                        "OTS_MESHTASTIC_NODEINFO_INTERVAL"
-                                    ) * self.context.app.config.get(
-                                        "OTS_MESHTASTIC_PUBLISH_INTERVAL"
-                                    ):
-
-                                        # Note to future self: The Meshtastic firmware expects a User payload when the Portnum is NodeInfo
-                                        # DO NOT SEND A NODEINFO PAYLOAD!
-                                        encoded_message = mesh_pb2.Data()
-                                        encoded_message.portnum = portnums_pb2.NODEINFO_APP
-                                        encoded_message.payload = mesh_user.SerializeToString()
-                                        self.publish_to_meshtastic(
-                                            self.get_protobuf(encoded_message, uid=p.device_uid)
-                                        )
+                    now = datetime.now(timezone.utc)
+                    if eud.last_meshtastic_publish is None or (
+                        now - eud.last_meshtastic_publish.replace(tzinfo=timezone.utc)
+                    ).total_seconds() >= self.context.app.config.get(
+                        "OTS_MESHTASTIC_PUBLISH_INTERVAL"
+                    ):
 
-                                    position = mesh_pb2.Position()
-                                    position.latitude_i = int(p.latitude / 0.0000001)
-                                    position.longitude_i = int(p.longitude / 0.0000001)
-                                    position.altitude = int(p.hae)
-                                    position.timestamp = int(time.mktime(p.timestamp.timetuple()))
-                                    position.ground_track = int(p.course) if p.course else 0
-                                    position.ground_speed = (
-                                        int(p.speed) if p.speed and p.speed >= 0 else 0
-                                    )
-                                    position.seq_number = 1
-                                    position.precision_bits = 32
+                        self.logger.debug("publishing position to mesh")
+                        try:
+                            eud.last_meshtastic_publish = now
+                            self.db.session.execute(
+                                update(EUD)
+                                .filter_by(uid=eud.uid)
+                                .values(last_meshtastic_publish=now)
+                            )
+                            self.db.session.commit()
 
+                            if eud.platform != "Meshtastic":
+                                mesh_user = mesh_pb2.User()
+                                setattr(mesh_user, "id", "!{:x}".format(eud.meshtastic_id))
+                                mesh_user.hw_model = mesh_pb2.HardwareModel.PRIVATE_HW
+                                mesh_user.short_name = p.device_uid[-4:]
+
+                                if cot.contact is not None:
+                                    mesh_user.long_name = cot.contact["callsign"]
+
+                                # Rate limits how often to send NodeInfo messages
+                                if (
+                                    now - eud.last_meshtastic_publish.replace(tzinfo=timezone.utc)
+                                ).total_seconds() >= self.context.app.config.get(
+                                    "OTS_MESHTASTIC_NODEINFO_INTERVAL"
+                                ) * self.context.app.config.get(
+                                    "OTS_MESHTASTIC_PUBLISH_INTERVAL"
+                                ):
+
+                                    # Note to future self: The Meshtastic firmware expects a User payload when the Portnum is NodeInfo
+                                    # DO NOT SEND A NODEINFO PAYLOAD!
                                     encoded_message = mesh_pb2.Data()
-                                    encoded_message.portnum = portnums_pb2.POSITION_APP
-                                    encoded_message.payload = position.SerializeToString()
+                                    encoded_message.portnum = portnums_pb2.NODEINFO_APP
+                                    encoded_message.payload = mesh_user.SerializeToString()
                                     self.publish_to_meshtastic(
                                         self.get_protobuf(encoded_message, uid=p.device_uid)
                                     )
 
-                                    tak_packet = atak_pb2.TAKPacket()
-                                    tak_packet.is_compressed = True
-                                    tak_packet.contact.device_callsign, size = unishox2.compress(
-                                        eud.uid
-                                    )
-                                    tak_packet.contact.callsign, size = unishox2.compress(
-                                        eud.callsign
-                                    )
-                                    tak_packet.group.team = (
-                                        eud.team.name.replace(" ", "_") if eud.team else "Cyan"
-                                    )
-                                    tak_packet.group.role = (
-                                        eud.team_role.replace(" ", "")
-                                        if eud.team_role
-                                        else "TeamMember"
-                                    )
-                                    tak_packet.status.battery = int(p.battery) if p.battery else 0
-                                    tak_packet.pli.latitude_i = int(p.latitude / 0.0000001)
-                                    tak_packet.pli.longitude_i = int(p.longitude / 0.0000001)
-                                    tak_packet.pli.altitude = int(p.hae) if p.hae else 0
-                                    tak_packet.pli.speed = int(p.speed) if p.speed else 0
-                                    tak_packet.pli.course = int(p.course) if p.course else 0
-
-                                    encoded_message = mesh_pb2.Data()
-                                    encoded_message.portnum = portnums_pb2.ATAK_PLUGIN
-                                    encoded_message.payload = tak_packet.SerializeToString()
+                                position = mesh_pb2.Position()
+                                position.latitude_i = int(p.latitude / 0.0000001)
+                                position.longitude_i = int(p.longitude / 0.0000001)
+                                position.altitude = int(p.hae)
+                                position.timestamp = int(time.mktime(p.timestamp.timetuple()))
+                                position.ground_track = int(p.course) if p.course else 0
+                                position.ground_speed = (
+                                    int(p.speed) if p.speed and p.speed >= 0 else 0
+                                )
+                                position.seq_number = 1
+                                position.precision_bits = 32
+
+                                encoded_message = mesh_pb2.Data()
+                                encoded_message.portnum = portnums_pb2.POSITION_APP
+                                encoded_message.payload = position.SerializeToString()
+                                self.publish_to_meshtastic(
+                                    self.get_protobuf(encoded_message, uid=p.device_uid)
+                                )
 
-                                    self.publish_to_meshtastic(
-                                        self.get_protobuf(
-                                            encoded_message, uid=eud.uid, from_id=eud.meshtastic_id
-                                        )
+                                tak_packet = atak_pb2.TAKPacket()
+                                tak_packet.is_compressed = True
+                                tak_packet.contact.device_callsign, size = unishox2.compress(
+                                    eud.uid
+                                )
+                                tak_packet.contact.callsign, size = unishox2.compress(eud.callsign)
+                                tak_packet.group.team = (
+                                    eud.team.name.replace(" ", "_") if eud.team else "Cyan"
+                                )
+                                tak_packet.group.role = (
+                                    eud.team_role.replace(" ", "")
+                                    if eud.team_role
+                                    else "TeamMember"
+                                )
+                                tak_packet.status.battery = int(p.battery) if p.battery else 0
+                                tak_packet.pli.latitude_i = int(p.latitude / 0.0000001)
+                                tak_packet.pli.longitude_i = int(p.longitude / 0.0000001)
+                                tak_packet.pli.altitude = int(p.hae) if p.hae else 0
+                                tak_packet.pli.speed = int(p.speed) if p.speed else 0
+                                tak_packet.pli.course = int(p.course) if p.course else 0
+
+                                encoded_message = mesh_pb2.Data()
+                                encoded_message.portnum = portnums_pb2.ATAK_PLUGIN
+                                encoded_message.payload = tak_packet.SerializeToString()
+
+                                self.publish_to_meshtastic(
+                                    self.get_protobuf(
+                                        encoded_message, uid=eud.uid, from_id=eud.meshtastic_id
                                     )
-                            except BaseException as e:
-                                self.logger.error(f"Failed to send publish message to mesh: {e}")
-                                self.logger.debug(traceback.format_exc())
-
-                    except BaseException as e:
-                        logger.warning(f"Failed to publish Meshtastic message: {e}")
-                        logger.debug(traceback.format_exc())
+                                )
+                        except BaseException as e:
+                            self.logger.error(f"Failed to send publish message to mesh: {e}")
+                            self.logger.debug(traceback.format_exc())
 
-                return res.inserted_primary_key[0]
+                except BaseException as e:
+                    logger.warning(f"Failed to publish Meshtastic message: {e}")
+                    logger.debug(traceback.format_exc())
 
     def get_protobuf(
         self, payload, uid=None, from_id=None, to_id=BROADCAST_NUM, channel_id="LongFast"
@@ -407,223 +458,207 @@ class CoTController:
 
         return service_envelope
 
-    def parse_geochat(self, event, cot_id, point_pk):
-        chat = event.find("__chat")
-        if chat:
-            chat_group = event.find("chatgrp")
-            remarks = event.find("remarks")
+    def parse_geochat(self, cot: DecodedCoT, cot_id, point_pk, after_commit: list):
+        chat = cot.chat
+        if chat is not None:
+            chat_group = cot.chat_group
+            remarks = cot.remarks
 
             # Sometimes WinTAK seems to send GeoChat CoTs without remarks
-            if not remarks:
+            if remarks is None:
                 return
 
-            chatroom = Chatroom()
-
-            chatroom.name = chat.attrs["chatroom"]
-            chatroom.id = chat.attrs["id"]
-            chatroom.parent = chat.attrs["parent"] if "parent" in chat.attrs else None
-
             with self.context:
-                try:
-                    self.db.session.add(chatroom)
-                    self.db.session.commit()
-                except exc.IntegrityError:
-                    self.db.session.rollback()
-
-            geochat = GeoChat()
-
-            geochat.uid = event.attrs["uid"]
-            geochat.chatroom_id = chat.attrs["id"]
-            geochat.sender_uid = chat_group.attrs["uid0"]
-            geochat.remarks = remarks.text
-            geochat.timestamp = datetime_from_iso8601_string(remarks.attrs["time"])
-            geochat.point_id = point_pk
-            geochat.cot_id = cot_id
+                self.insert_row(
+                    Chatroom,
+                    {
+                        "id": chat["id"],
+                        "name": chat["chatroom"],
+                        "parent": chat["parent"] if "parent" in chat else None,
+                    },
+                )
 
-            with self.context:
-                try:
-                    self.db.session.add(geochat)
-                    self.db.session.commit()
-                except exc.IntegrityError:
-                    # TODO: Check if remarks can be edited and if so do an update here
-                    self.db.session.rollback()
+                # TODO: Check if remarks can be edited and if so do an update when the GeoChat already exists
+                self.insert_row(
+                    GeoChat,
+                    {
+                        "uid": cot.uid,
+                        "chatroom_id": chat["id"],
+                        "sender_uid": chat_group["uid0"],
+                        "remarks": cot.remarks_text,
+                        "timestamp": datetime_from_iso8601_string(remarks["time"]),
+                        "point_id": point_pk,
+                        "cot_id": cot_id,
+                    },
+                )
 
             if self.context.app.config.get("OTS_ENABLE_MESHTASTIC"):
-                try:
-                    with self.context:
-                        from_eud = self.db.session.execute(
-                            self.db.session.query(EUD).filter_by(uid=chat_group.attrs["uid0"])
-                        ).first()[0]
-
-                        tak_packet = atak_pb2.TAKPacket()
-                        tak_packet.contact.device_callsign, size = unishox2.compress(
-                            chat_group.attrs["uid0"]
-                        )
-                        tak_packet.contact.callsign, size = unishox2.compress(from_eud.callsign)
-                        tak_packet.chat.message, size = unishox2.compress(remarks.text)
-                        tak_packet.group.team = from_eud.team.name.replace(" ", "_")
-                        tak_packet.group.role = from_eud.team_role.replace(" ", "")
-                        tak_packet.is_compressed = True
-
-                        send_meshtastic_text = False
-                        dest = event.find("dest")
-                        if (
-                            dest
-                            and "callsign" in dest.attrs
-                            and dest.attrs["callsign"] == chat.attrs["chatroom"]
-                        ):
-                            # This is a DM
-                            to = chat.attrs["id"]
-                            try:
-                                # DM to a Meshtastic device
-                                to_id = int(to, 16)
-                                send_meshtastic_text = True
-                            except:
-                                # DM to an EUD running the Meshtastic ATAK Plugin
-                                to_id = BROADCAST_NUM
-
-                            tak_packet.chat.to, size = unishox2.compress(to)
-                        else:
-                            # This goes to a chat room
-                            to = chat.attrs["chatroom"]
-                            to_id = BROADCAST_NUM
-                            tak_packet.chat.to, size = unishox2.compress(to)
-
-                            # By only sending a Meshtastic Data packet and not a TAK Packet, both the Meshtastic app
-                            # and the Meshtastic ATAK plugin will receive the message
-                            send_meshtastic_text = to == "All Chat Rooms"
-
-                        if send_meshtastic_text:
-                            self.logger.debug("Publishing text to Meshtastic devices")
-                            # Publish again for Meshtastic devices without the ATAK Plugin
-                            encoded_message = mesh_pb2.Data()
-                            encoded_message.portnum = portnums_pb2.TEXT_MESSAGE_APP
-                            encoded_message.payload = remarks.text.encode("utf-8")
-                            self.publish_to_meshtastic(
-                                self.get_protobuf(
-                                    encoded_message, to_id=to_id, from_id=from_eud.meshtastic_id
-                                )
-                            )
-                        else:
-                            # Publish once for EUDs using the Meshtastic ATAK Plugin
-                            encoded_message = mesh_pb2.Data()
-                            encoded_message.portnum = portnums_pb2.ATAK_PLUGIN
-                            encoded_message.payload = tak_packet.SerializeToString()
-
-                            self.publish_to_meshtastic(
-                                self.get_protobuf(
-                                    encoded_message, from_id=from_eud.meshtastic_id, to_id=to_id
-                                )
-                            )
-
-                except BaseException as e:
-                    self.logger.error("Failed to publish MQTT message: {}".format(e))
-                    self.logger.debug(traceback.format_exc())
+                after_commit.append(
+                    functools.partial(self.publish_geochat_to_meshtastic, cot, chat, chat_group)
+                )
 
-            for attr in chat_group.attrs:
+            for attr in chat_group:
                 if attr.startswith("uid") and attr != "uid":
 
                     if (
-                        "groupOwner" in chat.attrs
-                        and chat.attrs["groupOwner"].lower() == "true"
+                        "groupOwner" in chat
+                        and chat["groupOwner"].lower() == "true"
                         and attr == "uid0"
                     ):
                         with self.context:
                             self.db.session.execute(
                                 update(Chatroom)
-                                .where(Chatroom.id == chat.attrs["id"])
-                                .values(group_owner=chat_group.attrs[attr])
+                                .where(Chatroom.id == chat["id"])
+                                .values(group_owner=chat_group[attr])
                             )
-                            self.db.session.commit()
-
-                    chatroom_uid = ChatroomsUids()
-                    chatroom_uid.chatroom_id = chat.attrs["id"]
-                    chatroom_uid.uid = chat_group.attrs[attr]
 
                     with self.context:
-                        try:
-                            self.db.session.add(chatroom_uid)
-                            self.db.session.commit()
+                        if self.insert_row(
+                            ChatroomsUids, {"chatroom_id": chat["id"], "uid": chat_group[attr]}
+                        ):
                             self.logger.debug(
-                                "add {} to chatroom {}".format(
-                                    chatroom_uid.uid, chatroom_uid.chatroom_id
-                                )
+                                "add {} to chatroom {}".format(chat_group[attr], chat["id"])
                             )
-                        except exc.IntegrityError:
-                            self.db.session.rollback()
 
-    def parse_video(self, event, cot_pk):
-        video = event.find("__video")
-        if video:
+    def publish_geochat_to_meshtastic(self, cot: DecodedCoT, chat: dict, chat_group: dict):
+        try:
+            with self.context:
+                from_eud = self.db.session.execute(
+                    self.db.session.query(EUD).filter_by(uid=chat_group["uid0"])
+                ).first()[0]
+
+                tak_packet = atak_pb2.TAKPacket()
+                tak_packet.contact.device_callsign, size = unishox2.compress(chat_group["uid0"])
+                tak_packet.contact.callsign, size = unishox2.compress(from_eud.callsign)
+                tak_packet.chat.message, size = unishox2.compress(cot.remarks_text)
+                tak_packet.group.team = from_eud.team.name.replace(" ", "_")
+                tak_packet.group.role = from_eud.team_role.replace(" ", "")
+                tak_packet.is_compressed = True
+
+                send_meshtastic_text = False
+                dest = cot.destinations[0] if cot.destinations else None
+                if dest and "callsign" in dest and dest["callsign"] == chat["chatroom"]:
+                    # This is a DM
+                    to = chat["id"]
+                    try:
+                        # DM to a Meshtastic device
+                        to_id = int(to, 16)
+                        send_meshtastic_text = True
+                    except:
+                        # DM to an EUD running the Meshtastic ATAK Plugin
+                        to_id = BROADCAST_NUM
+
+                    tak_packet.chat.to, size = unishox2.compress(to)
+                else:
+                    # This goes to a chat room
+                    to = chat["chatroom"]
+                    to_id = BROADCAST_NUM
+                    tak_packet.chat.to, size = unishox2.compress(to)
+
+                    # By only sending a Meshtastic Data packet and not a TAK Packet, both the Meshtastic app
+                    # and the Meshtastic ATAK plugin will receive the message
+                    send_meshtastic_text = to == "All Chat Rooms"
+
+                if send_meshtastic_text:
+                    self.logger.debug("Publishing text to Meshtastic devices")
+                    # Publish again for Meshtastic devices without the ATAK Plugin
+                    encoded_message = mesh_pb2.Data()
+                    encoded_message.portnum = portnums_pb2.TEXT_MESSAGE_APP
+                    encoded_message.payload = cot.remarks_text.encode("utf-8")
+                    self.publish_to_meshtastic(
+                        self.get_protobuf(
+                            encoded_message, to_id=to_id, from_id=from_eud.meshtastic_id
+                        )
+                    )
+                else:
+                    # Publish once for EUDs using the Meshtastic ATAK Plugin
+                    encoded_message = mesh_pb2.Data()
+                    encoded_message.portnum = portnums_pb2.ATAK_PLUGIN
+                    encoded_message.payload = tak_packet.SerializeToString()
+
+                    self.publish_to_meshtastic(
+                        self.get_protobuf(
+                            encoded_message, from_id=from_eud.meshtastic_id, to_id=to_id
+                        )
+                    )
+
+        except BaseException as e:
+            self.logger.error("Failed to publish MQTT message: {}".format(e))
+            self.logger.debug(traceback.format_exc())
+
+    def parse_video(self, cot: DecodedCoT, cot_pk):
+        if cot.video is not None:
             self.logger.debug("Got video stream")
-            connection_entry = video.find("ConnectionEntry")
-            if not connection_entry:
+            connection_entry = cot.connection_entry
+            if connection_entry is None:
                 return
 
-            path = connection_entry.attrs["path"]
+            path = connection_entry["path"]
             if path.startswith("/"):
                 path = path[1:]
 
             v = VideoStream()
-            v.network_timeout = connection_entry.attrs["networkTimeout"]
-            v.uid = connection_entry.attrs["uid"]
+            v.network_timeout = connection_entry["networkTimeout"]
+            v.uid = connection_entry["uid"]
             v.path = path
-            v.protocol = connection_entry.attrs["protocol"]
-            v.buffer_time = connection_entry.attrs["bufferTime"]
-            v.port = connection_entry.attrs["port"]
-            v.rover_port = connection_entry.attrs["roverPort"]
-            v.rtsp_reliable = connection_entry.attrs["rtspReliable"]
-            v.ignore_embedded_klv = connection_entry.attrs["ignoreEmbeddedKLV"].lower() == "true"
-            v.alias = connection_entry.attrs["alias"]
-            v.cot_id = cot_pk
-            v.generate_xml(connection_entry.attrs["address"])
+            v.protocol = connection_entry["protocol"]
+            v.buffer_time = connection_entry["bufferTime"]
+            v.port = connection_entry["port"]
+            v.rover_port = connection_entry["roverPort"]
+            v.rtsp_reliable = connection_entry["rtspReliable"]
+            v.ignore_embedded_klv = connection_entry["ignoreEmbeddedKLV"].lower() == "true"
+            v.alias = connection_entry["alias"]
+            v.generate_xml(connection_entry["address"])
+
+            values = {
+                "network_timeout": connection_entry["networkTimeout"],
+                "protocol": connection_entry["protocol"],
+                "buffer_time": connection_entry["bufferTime"],
+                # "address": connection_entry["address"],
+                "port": connection_entry["port"],
+                "rover_port": connection_entry["roverPort"],
+                "rtsp_reliable": connection_entry["rtspReliable"],
+                "ignore_embedded_klv": connection_entry["ignoreEmbeddedKLV"].lower() == "true",
+                "alias": connection_entry["alias"],
+                "xml": v.xml,
+            }
 
             with self.context:
-                try:
-                    self.db.session.add(v)
-                    self.db.session.commit()
+                if self.insert_row(
+                    VideoStream,
+                    dict(values, uid=connection_entry["uid"], path=path, cot_id=cot_pk),
+                ):
                     self.logger.debug("Added video")
-                except exc.IntegrityError as e:
-                    self.db.session.rollback()
+                else:
                     self.db.session.execute(
                         update(VideoStream)
-                        .where(VideoStream.uid == connection_entry.attrs["uid"])
-                        .values(
-                            network_timeout=connection_entry.attrs["networkTimeout"],
-                            protocol=connection_entry.attrs["protocol"],
-                            buffer_time=connection_entry.attrs["bufferTime"],
-                            # address=connection_entry.attrs['address'],
-                            port=connection_entry.attrs["port"],
-                            rover_port=connection_entry.attrs["roverPort"],
-                            rtsp_reliable=connection_entry.attrs["rtspReliable"],
-                            ignore_embedded_klv=(
-                                connection_entry.attrs["ignoreEmbeddedKLV"].lower() == "true"
-                            ),
-                            alias=connection_entry.attrs["alias"],
-                            xml=v.xml,
-                        )
+                        .where(VideoStream.uid == connection_entry["uid"])
+                        .values(**values)
                     )
 
-                    self.db.session.commit()
+    def emit_after_commit(self, after_commit: list, event: str, data: dict):
+        after_commit.append(
+            functools.partial(self.socketio.emit, event, data, namespace="/socket.io")
+        )
 
-    def parse_alert(self, event, uid, point_pk, cot_pk):
-        emergency = event.find("emergency")
-        if emergency:
-            if "type" in emergency.attrs:
-                emergency_type = emergency.attrs["type"]
+    def parse_alert(self, cot: DecodedCoT, uid, point_pk, cot_pk, after_commit: list):
+        emergency = cot.emergency
+        if emergency is not None:
+            if "type" in emergency:
+                emergency_type = emergency["type"]
                 alert = Alert()
                 alert.sender_uid = uid
-                alert.uid = event.attrs["uid"]
-                alert.start_time = datetime_from_iso8601_string(event.attrs["start"])
+                alert.uid = cot.uid
+                alert.start_time = cot.start
                 alert.point_id = point_pk
                 alert.alert_type = emergency_type
                 alert.cot_id = cot_pk
 
                 with self.context:
                     self.db.session.add(alert)
-                    self.db.session.commit()
-                    self.socketio.emit("alert", alert.to_json(), namespace="/socket.io")
-            elif "cancel" in emergency.attrs:
+                    self.db.session.flush()
+                    self.emit_after_commit(after_commit, "alert", alert.to_json())
+            elif "cancel" in emergency:
                 with self.context:
                     try:
                         alert = self.db.session.execute(
@@ -631,166 +666,153 @@ class CoTController:
                                 Alert.cancel_time == None, Alert.sender_uid == uid
                             ).order_by(Alert.start_time.desc())
                         ).first()[0]
-                        alert.cancel_time = datetime_from_iso8601_string(event.attrs["start"])
-                        self.db.session.commit()
-                        self.socketio.emit("alert", alert.to_json(), namespace="/socket.io")
+                        alert.cancel_time = cot.start
+                        self.db.session.flush()
+                        self.emit_after_commit(after_commit, "alert", alert.to_json())
                     except BaseException as e:
                         self.logger.error("Failed to set alert cancel time: {}".format(e))
                         self.logger.debug(traceback.format_exc())
 
-    def parse_casevac(self, event, uid, point_pk, cot_pk):
-        medevac = event.find("_medevac_")
-        if medevac:
-            zmist = medevac.find("zMist")
+    def parse_casevac(self, cot: DecodedCoT, uid, point_pk, cot_pk, after_commit: list):
+        medevac = cot.medevac
+        if medevac is not None:
+            zmist = cot.zmist
             with self.context:
-                for a in medevac.attrs:
-                    if medevac.attrs[a].lower() == "true":
-                        medevac.attrs[a] = True
-                    elif medevac.attrs[a].lower() == "false":
-                        medevac.attrs[a] = False
+                for a in medevac:
+                    if medevac[a].lower() == "true":
+                        medevac[a] = True
+                    elif medevac[a].lower() == "false":
+                        medevac[a] = False
 
                 try:
-                    self.db.session.execute(
-                        insert(CasEvac).values(
-                            timestamp=datetime_from_iso8601_string(event.attrs["start"]),
-                            sender_uid=uid,
-                            uid=event.attrs["uid"],
-                            point_id=point_pk,
-                            cot_id=cot_pk,
-                            **medevac.attrs,
-                        )
-                    )
-
-                    if zmist:
+                    with self.db.session.begin_nested():
                         self.db.session.execute(
-                            insert(ZMIST).values(casevac_uid=event.attrs["uid"], **zmist.attrs)
+                            insert(CasEvac).values(
+                                timestamp=cot.start,
+                                sender_uid=uid,
+                                uid=cot.uid,
+                                point_id=point_pk,
+                                cot_id=cot_pk,
+                                **medevac,
+                            )
                         )
+
+                        if zmist is not None:
+                            self.db.session.execute(
+                                insert(ZMIST).values(casevac_uid=cot.uid, **zmist)
+                            )
                 except exc.IntegrityError as e:
-                    self.db.session.rollback()
                     self.db.session.execute(
-                        update(CasEvac)
-                        .where(CasEvac.uid == event.attrs["uid"])
-                        .values(**medevac.attrs)
+                        update(CasEvac).where(CasEvac.uid == cot.uid).values(**medevac)
                     )
 
-                    if zmist:
+                    if zmist is not None:
                         self.db.session.execute(
-                            update(ZMIST)
-                            .where(CasEvac.uid == event.attrs["uid"])
-                            .values(**zmist.attrs)
+                            update(ZMIST).where(CasEvac.uid == cot.uid).values(**zmist)
                         )
-                self.db.session.commit()
 
                 try:
                     casevac: CasEvac = self.db.session.execute(
-                        self.db.session.query(CasEvac).filter_by(uid=event.attrs["uid"])
+                        self.db.session.query(CasEvac).filter_by(uid=cot.uid)
                     ).first()[0]
-                    self.socketio.emit("casevac", casevac.to_json(), namespace="/socket.io")
+                    casevac_json = casevac.to_json()
+                    save_map_state("casevacs", casevac.uid, casevac_json, cot.stale)
+                    self.emit_after_commit(after_commit, "casevac", casevac_json)
                 except BaseException as e:
                     self.logger.error(f"Failed to emit CasEvac: {e}")
                     self.logger.debug(traceback.format_exc())
 
-    def parse_marker(self, event, uid, point_pk, cot_pk):
+    def parse_marker(self, cot: DecodedCoT, uid, point_pk, cot_pk, after_commit: list):
         if (
             (
-                re.match("^a-[fhupansjk]-[ZPAGSUF]", event.attrs["type"])
+                re.match("^a-[fhupansjk]-[ZPAGSUF]", cot.type)
                 or
                 # Spot map
-                re.match("^b-m-p", event.attrs["type"])
+                re.match("^b-m-p", cot.type)
             )
             and
             # Don't worry about EUD location updates
-            not event.find("takv")
-            and (not event.find("contact") or "endpoint" not in event.find("contact").attrs)
+            cot.takv is None
+            and (cot.contact is None or "endpoint" not in cot.contact)
             and
             # Ignore video streams from sources like OpenTAK ICU
-            event.attrs["type"] != "b-m-p-s-p-loc"
+            cot.type != "b-m-p-s-p-loc"
         ):
 
             try:
                 marker = Marker()
-                marker.uid = event.attrs["uid"]
-                marker.affiliation = get_affiliation(event.attrs["type"])
-                marker.battle_dimension = get_battle_dimension(event.attrs["type"])
-                marker.mil_std_2525c = cot_type_to_2525c(event.attrs["type"])
+                marker.uid = cot.uid
+                marker.affiliation = get_affiliation(cot.type)
+                marker.battle_dimension = get_battle_dimension(cot.type)
+                marker.mil_std_2525c = cot_type_to_2525c(cot.type)
 
-                detail = event.find("detail")
                 icon = None
 
-                if detail:
-                    for tag in detail.find_all():
-                        if "readiness" in tag.attrs:
-                            marker.readiness = tag.attrs["readiness"] == "true"
-                        if "argb" in tag.attrs:
-                            marker.argb = tag.attrs["argb"]
-                            marker.color_hex = marker.color_to_hex()
-                        if tag.name == "contact":
-                            marker.callsign = tag.attrs["callsign"]
-                        if "iconsetpath" in tag.attrs:
-                            marker.iconset_path = tag.attrs["iconsetpath"]
-                            if marker.iconset_path.lower().endswith(".png"):
-                                with self.context:
-                                    filename = marker.iconset_path.split("/")[-1]
-
-                                    try:
-                                        icon = self.db.session.execute(
-                                            self.db.session.query(Icon).filter(
-                                                Icon.filename == filename
-                                            )
-                                        ).first()[0]
-                                        marker.icon_id = icon.id
-                                    except:
-                                        icon = self.db.session.execute(
-                                            self.db.session.query(Icon).filter(
-                                                Icon.filename == "marker-icon.png"
-                                            )
-                                        ).first()
-                                        if icon is None:
-                                            marker.icon_id = None
-                                        else:
-                                            marker.icon_id = icon.id
-                            elif not marker.mil_std_2525c:
-                                with self.context:
+                if cot.has_detail:
+                    if cot.readiness is not None:
+                        marker.readiness = cot.readiness == "true"
+                    if cot.argb is not None:
+                        marker.argb = cot.argb
+                        marker.color_hex = marker.color_to_hex()
+                    if cot.contact is not None:
+                        marker.callsign = cot.contact["callsign"]
+                    if cot.iconset_path is not None:
+                        marker.iconset_path = cot.iconset_path
+                        if marker.iconset_path.lower().endswith(".png"):
+                            with self.context:
+                                filename = marker.iconset_path.split("/")[-1]
+
+                                try:
                                     icon = self.db.session.execute(
                                         self.db.session.query(Icon).filter(
-                                            Icon.filename == "marker-icon.png"
+                                            Icon.filename == filename
                                         )
                                     ).first()[0]
                                     marker.icon_id = icon.id
+                                except:
+                                    icon = self.db.session.execute(
+                                        self.db.session.query(Icon).filter(
+                                            Icon.filename == "marker-icon.png"
+                                        )
+                                    ).first()
+                                    if icon is None:
+                                        marker.icon_id = None
+                                    else:
+                                        marker.icon_id = icon.id
+                        elif not marker.mil_std_2525c:
+                            with self.context:
+                                icon = self.db.session.execute(
+                                    self.db.session.query(Icon).filter(
+                                        Icon.filename == "marker-icon.png"
+                                    )
+                                ).first()[0]
+                                marker.icon_id = icon.id
 
-                        if "altsrc" in tag.attrs:
-                            marker.location_source = tag.attrs["altsrc"]
+                    if cot.altsrc is not None:
+                        marker.location_source = cot.altsrc
 
-                link = event.find("link")
-                if link:
-                    marker.parent_callsign = (
-                        link.attrs["parent_callsign"] if "parent_callsign" in link.attrs else None
-                    )
-                    marker.production_time = (
-                        link.attrs["production_time"]
-                        if "production_time" in link.attrs
-                        else iso8601_string_from_datetime(datetime.now(timezone.utc))
-                    )
-                    marker.relation = link.attrs["relation"] if "relation" in link.attrs else None
-                    marker.relation_type = (
-                        link.attrs["relation_type"] if "relation_type" in link.attrs else None
-                    )
-                    marker.parent_uid = link.attrs["uid"] if "uid" in link.attrs else None
+                link = cot.link
+                if link is not None:
+                    marker.parent_callsign = link.get("parent_callsign")
+                    try:
+                        marker.production_time = datetime_from_iso8601_string(
+                            link.get("production_time")
+                        )
+                    except ValueError:
+                        marker.production_time = datetime.now(timezone.utc)
+                    marker.relation = link.get("relation")
+                    marker.relation_type = link.get("relation_type")
+                    marker.parent_uid = link.get("uid")
                 else:
-                    marker.production_time = iso8601_string_from_datetime(
-                        datetime.now(timezone.utc)
-                    )
+                    marker.production_time = datetime.now(timezone.utc)
 
                 marker.point_id = point_pk
                 marker.cot_id = cot_pk
 
                 with self.context:
-                    try:
-                        self.db.session.add(marker)
-                        self.db.session.commit()
+                    if self.add_row(marker):
                         self.logger.debug("added marker")
-                    except exc.IntegrityError:
-                        self.db.session.rollback()
+                    else:
                         self.db.session.execute(
                             update(Marker)
                             .where(Marker.uid == marker.uid)
@@ -800,58 +822,58 @@ class CoTController:
                                 **marker.serialize(),
                             )
                         )
-                        self.db.session.commit()
                         self.logger.debug("updated marker")
                         marker = self.db.session.execute(
                             self.db.session.query(Marker).filter(Marker.uid == marker.uid)
                         ).first()[0]
 
-                    self.socketio.emit("marker", marker.to_json(), namespace="/socket.io")
+                    marker_json = marker.to_json()
+                    save_map_state("markers", marker.uid, marker_json, cot.stale)
+                    self.emit_after_commit(after_commit, "marker", marker_json)
 
             except BaseException as e:
                 self.logger.error("Failed to parse marker: {}".format(e))
                 self.logger.debug(traceback.format_exc())
 
-    def parse_rbline(self, event, uid, point_pk, cot_pk):
-        if re.match("^u-rb", event.attrs["type"]):
+    def parse_rbline(self, cot: DecodedCoT, uid, point_pk, cot_pk, after_commit: list):
+        if re.match("^u-rb", cot.type):
             self.logger.debug("Got an R&B line")
             rb_line = RBLine()
 
-            detail = event.find("detail")
-            if detail:
-                rb_line.uid = event.attrs["uid"]
+            if cot.has_detail:
+                rb_line.uid = cot.uid
                 rb_line.sender_uid = uid
-                rb_line.timestamp = datetime_from_iso8601_string(event.attrs["start"])
+                rb_line.timestamp = cot.start
                 rb_line.point_id = point_pk
                 rb_line.cot_id = cot_pk
 
-                for tag in detail:
-                    if tag.name == "range":
-                        rb_line.range = tag.attrs["value"]
-                    if tag.name == "bearing":
-                        rb_line.bearing = tag.attrs["value"]
+                for name, attributes in cot.detail_children:
+                    if name == "range":
+                        rb_line.range = attributes["value"]
+                    if name == "bearing":
+                        rb_line.bearing = attributes["value"]
                     # Sometimes ATAK sends NaN for the inclination which causes issues in the DB
-                    if tag.name == "inclination" and tag.attrs["value"].isnumeric():
-                        rb_line.inclination = tag.attrs["value"]
-                    if tag.name == "anchorUID":
-                        rb_line.anchor_uid = tag.attrs["value"]
-                    if tag.name == "rangeUnits":
-                        rb_line.range_units = tag.attrs["value"]
-                    if tag.name == "bearingUnits":
-                        rb_line.bearing_units = tag.attrs["value"]
-                    if tag.name == "northRef":
-                        rb_line.north_ref = tag.attrs["value"]
-                    if tag.name == "color":
-                        rb_line.color = tag.attrs["value"]
+                    if name == "inclination" and attributes["value"].isnumeric():
+                        rb_line.inclination = attributes["value"]
+                    if name == "anchorUID":
+                        rb_line.anchor_uid = attributes["value"]
+                    if name == "rangeUnits":
+                        rb_line.range_units = attributes["value"]
+                    if name == "bearingUnits":
+                        rb_line.bearing_units = attributes["value"]
+                    if name == "northRef":
+                        rb_line.north_ref = attributes["value"]
+                    if name == "color":
+                        rb_line.color = attributes["value"]
                         rb_line.color_hex = rb_line.color_to_hex()
-                    if tag.name == "contact":
-                        rb_line.callsign = tag.attrs["callsign"]
-                    if tag.name == "strokeColor":
-                        rb_line.stroke_color = tag.attrs["value"]
-                    if tag.name == "strokeWeight":
-                        rb_line.stroke_weight = tag.attrs["value"]
-                    if tag.name == "labels_on":
-                        rb_line.labels_on = tag.attrs["value"] == "true"
+                    if name == "contact":
+                        rb_line.callsign = attributes["callsign"]
+                    if name == "strokeColor":
+                        rb_line.stroke_color = attributes["value"]
+                    if name == "strokeWeight":
+                        rb_line.stroke_weight = attributes["value"]
+                    if name == "labels_on":
+                        rb_line.labels_on = attributes["value"] == "true"
 
                 with self.context:
 
@@ -862,55 +884,53 @@ class CoTController:
                     rb_line.end_latitude = end_point["latitude"]
                     rb_line.end_longitude = end_point["longitude"]
 
-                    try:
-                        self.db.session.add(rb_line)
-                        self.db.session.commit()
+                    if self.add_row(rb_line):
                         self.logger.debug("Inserted new R&B line: {}".format(rb_line.uid))
-                    except exc.IntegrityError:
-                        self.db.session.rollback()
+                    else:
                         self.db.session.execute(
                             update(RBLine)
                             .where(RBLine.uid == rb_line.uid)
                             .values(**rb_line.serialize())
                         )
-                        self.db.session.commit()
                         self.logger.debug("Updated R&B line: {}".format(rb_line.uid))
 
-                    rb_line.point = start_point
-                    self.socketio.emit("rb_line", rb_line.to_json(), namespace="/socket.io")
+                    # Only for to_json(), without the backref adding rb_line to the session again
+                    set_committed_value(rb_line, "point", start_point)
+                    rb_line_json = rb_line.to_json()
+                    save_map_state("rb_lines", rb_line.uid, rb_line_json, cot.stale)
+                    self.emit_after_commit(after_commit, "rb_line", rb_line_json)
 
-    def parse_stats(self, event, uid):
-        stats = event.find("stats")
+    def parse_stats(self, cot: DecodedCoT, uid):
+        stats = cot.stats
         eud_stats = EUDStats()
-        if stats:
-            eud_stats.timestamp = datetime_from_iso8601_string(event.attrs.get("time"))
+        if stats is not None:
+            eud_stats.timestamp = cot.time
             eud_stats.eud_uid = uid
-            eud_stats.battery_status = stats.attrs.get("battery_status")
-            eud_stats.ip_address = stats.attrs.get("ip_address")
-            if stats.attrs.get("app_framerate"):
-                eud_stats.app_framerate = int(stats.attrs.get("app_framerate"))
-            if stats.attrs.get("deviceDataRx"):
-                eud_stats.deviceDataRx = int(stats.attrs.get("deviceDataRx"))
-            if stats.attrs.get("deviceDataTx"):
-                eud_stats.deviceDataTx = int(stats.attrs.get("deviceDataTx"))
-            if stats.attrs.get("heap_current_size"):
-                eud_stats.heap_current_size = int(stats.attrs.get("heap_current_size"))
-            if stats.attrs.get("heap_free_size"):
-                eud_stats.heap_free_size = int(stats.attrs.get("heap_free_size"))
-            if stats.attrs.get("heap_max_size"):
-                eud_stats.heap_max_size = int(stats.attrs.get("heap_max_size"))
-            if stats.attrs.get("storage_available"):
-                eud_stats.storage_available = int(stats.attrs.get("storage_available"))
-            if stats.attrs.get("storage_total"):
-                eud_stats.storage_total = int(stats.attrs.get("storage_total"))
-            if stats.attrs.get("battery_temp"):
-                eud_stats.battery_temp = int(stats.attrs.get("battery_temp"))
-            if stats.attrs.get("battery"):
-                eud_stats.battery = int(stats.attrs.get("battery").replace("%", ""))
+            eud_stats.battery_status = stats.get("battery_status")
+            eud_stats.ip_address = stats.get("ip_address")
+            if stats.get("app_framerate"):
+                eud_stats.app_framerate = int(stats.get("app_framerate"))
+            if stats.get("deviceDataRx"):
+                eud_stats.deviceDataRx = int(stats.get("deviceDataRx"))
+            if stats.get("deviceDataTx"):
+                eud_stats.deviceDataTx = int(stats.get("deviceDataTx"))
+            if stats.get("heap_current_size"):
+                eud_stats.heap_current_size = int(stats.get("heap_current_size"))
+            if stats.get("heap_free_size"):
+                eud_stats.heap_free_size = int(stats.get("heap_free_size"))
+            if stats.get("heap_max_size"):
+                eud_stats.heap_max_size = int(stats.get("heap_max_size"))
+            if stats.get("storage_available"):
+                eud_stats.storage_available = int(stats.get("storage_available"))
+            if stats.get("storage_total"):
+                eud_stats.storage_total = int(stats.get("storage_total"))
+            if stats.get("battery_temp"):
+                eud_stats.battery_temp = int(stats.get("battery_temp"))
+            if stats.get("battery"):
+                eud_stats.battery = int(stats.get("battery").replace("%", ""))
 
             with self.context:
                 self.db.session.add(eud_stats)
-                self.db.session.commit()
 
     def publish_to_meshtastic(self, body):
         for channel in self.get_meshtastic_channels():
@@ -971,30 +991,25 @@ class CoTController:
             message = json.dumps({"uid": uid, "cot": tostring(event).decode("utf-8")})
             if self.rabbit_channel and not self.rabbit_channel.is_closed and user_id:
                 with self.context:
-                    group_query = db.session.query(GroupUser).filter_by(
-                        user_id=user_id, direction=Group.OUT, enabled=True
+                    group_names = group_cache.group_names(user_id, Group.OUT)
+
+                for group_name in group_names:
+                    self.rabbit_channel.basic_publish(
+                        exchange="groups",
+                        routing_key=f"{group_name}.{Group.OUT}",
+                        body=message,
+                        properties=pika.BasicProperties(
+                            expiration=app.config.get("OTS_RABBITMQ_TTL")
+                        ),
                     )
-                    groups = db.session.execute(group_query).all()
-                    for group in groups:
-                        group = group[0]
-                        self.rabbit_channel.basic_publish(
-                            exchange="groups",
-                            routing_key=f"{group.group.name}.{group.direction}",
-                            body=message,
-                            properties=pika.BasicProperties(
-                                expiration=app.config.get("OTS_RABBITMQ_TTL")
-                            ),
-                        )
 
-                        self.rabbit_channel.queue_bind(
-                            queue=uid,
-                            exchange="groups",
-                            routing_key=f"{group.group.name}.{group.direction}",
-                        )
+                    self.rabbit_channel.queue_bind(
+                        queue=uid,
+                        exchange="groups",
+                        routing_key=f"{group_name}.{Group.OUT}",
+                    )
 
-                        self.logger.debug(
-                            f"Unbound {uid} from {group.group.name}.{group.direction}"
-                        )
+                    self.logger.debug(f"Unbound {uid} from {group_name}.{Group.OUT}")
             elif (
                 self.rabbit_channel
                 and not self.rabbit_channel.is_closing
@@ -1026,103 +1041,121 @@ class CoTController:
                     .filter(EUD.uid == uid)
                     .values(last_status="Disconnected", last_event_time=now)
                 )
+                eud = db.session.execute(select(EUD).filter_by(uid=uid)).scalar()
+                if eud:
+                    save_map_state("euds", uid, eud.to_json())
                 db.session.commit()
 
-    def generate_mission_change(self, uid: str, event: BeautifulSoup):
-        destinations = event.find_all("dest")
+    def publish_after_commit(
+        self, after_commit: list, exchange: str, routing_key: str, body: str, **kwargs
+    ):
+        after_commit.append(
+            functools.partial(
+                self.rabbit_channel.basic_publish,
+                exchange,
+                routing_key=routing_key,
+                body=body,
+                **kwargs,
+            )
+        )
+
+    def generate_mission_change(
+        self, uid: str, cot: DecodedCoT, takproto: str | None, after_commit: list
+    ):
+        destinations = cot.destinations
         mission_changes = []
 
         if not destinations:
             return
 
         for destination in destinations:
-            if "mission" in destination.attrs:
+            if "mission" in destination:
                 with self.context:
                     mission = db.session.execute(
-                        db.session.query(Mission).filter_by(name=destination.attrs["mission"])
+                        db.session.query(Mission).filter_by(name=destination["mission"])
                     ).first()
 
                     if not mission:
-                        self.logger.error(f"No such mission found: {destination.attrs['mission']}")
+                        self.logger.error(f"No such mission found: {destination['mission']}")
                         return
 
                     mission = mission[0]
-                    self.rabbit_channel.basic_publish(
+                    self.publish_after_commit(
+                        after_commit,
                         "missions",
-                        routing_key=f"missions.{destination.attrs['mission']}",
-                        body=json.dumps({"uid": uid, "cot": str(event)}),
+                        routing_key=f"missions.{destination['mission']}",
+                        body=self.routed_message(uid, cot, takproto),
                         properties=pika.BasicProperties(
                             expiration=app.config.get("OTS_RABBITMQ_TTL")
                         ),
                     )
 
                     mission_uid = db.session.execute(
-                        db.session.query(MissionUID).filter_by(uid=event.attrs["uid"])
+                        db.session.query(MissionUID).filter_by(uid=cot.uid)
                     ).first()
 
                     if not mission_uid:
                         mission_uid = MissionUID()
-                        mission_uid.uid = event.attrs["uid"]
-                        mission_uid.mission_name = destination.attrs["mission"]
-                        mission_uid.timestamp = datetime_from_iso8601_string(event.attrs["start"])
+                        mission_uid.uid = cot.uid
+                        mission_uid.mission_name = destination["mission"]
+                        mission_uid.timestamp = cot.start
                         mission_uid.creator_uid = uid
-                        mission_uid.cot_type = event.attrs["type"]
-
-                        color = event.find("color")
-                        icon = event.find("usericon")
-                        point = event.find("point")
-                        contact = event.find("contact")
-
-                        if color and "argb" in color.attrs:
-                            mission_uid.color = color.attrs["argb"]
-                        elif color and "value" in color.attrs:
-                            mission_uid.color = color.attrs["value"]
-                        if icon:
+                        mission_uid.cot_type = cot.type
+
+                        color = cot.color
+                        icon = cot.usericon
+                        point = cot.point
+                        contact = cot.contact
+
+                        if color is not None and "argb" in color:
+                            mission_uid.color = color["argb"]
+                        elif color is not None and "value" in color:
+                            mission_uid.color = color["value"]
+                        if icon is not None:
                             mission_uid.iconset_path = icon["iconsetpath"]
-                        if point:
-                            mission_uid.latitude = float(point.attrs["lat"])
-                            mission_uid.longitude = float(point.attrs["lon"])
-                        if contact:
-                            mission_uid.callsign = contact.attrs["callsign"]
-
-                        try:
-                            db.session.add(mission_uid)
-                            db.session.commit()
-                        except sqlalchemy.exc.IntegrityError:
-                            db.session.rollback()
+                        if point is not None:
+                            mission_uid.latitude = float(point["lat"])
+                            mission_uid.longitude = float(point["lon"])
+                        if contact is not None:
+                            mission_uid.callsign = contact["callsign"]
+
+                        if not self.insert_row(
+                            MissionUID,
+                            dict(
+                                mission_uid.serialize(),
+                                uid=mission_uid.uid,
+                                mission_name=mission_uid.mission_name,
+                            ),
+                        ):
                             db.session.execute(update(MissionUID).values(**mission_uid.serialize()))
 
                         mission_change = MissionChange()
                         mission_change.isFederatedChange = False
                         mission_change.change_type = MissionChange.ADD_CONTENT
-                        mission_change.mission_name = destination.attrs["mission"]
-                        mission_change.timestamp = datetime_from_iso8601_string(
-                            event.attrs["start"]
-                        )
+                        mission_change.mission_name = destination["mission"]
+                        mission_change.timestamp = cot.start
                         mission_change.creator_uid = uid
-                        mission_change.server_time = datetime_from_iso8601_string(
-                            event.attrs["start"]
-                        )
-                        mission_change.mission_uid = event.attrs["uid"]
+                        mission_change.server_time = cot.start
+                        mission_change.mission_uid = cot.uid
 
                         change_pk = db.session.execute(
                             insert(MissionChange).values(**mission_change.serialize())
                         )
-                        db.session.commit()
 
                         body = {
                             "uid": self.context.app.config.get("OTS_NODE_ID"),
                             "cot": tostring(
                                 generate_mission_change_cot(
-                                    mission_name=str(destination.attrs["mission"]),
+                                    mission_name=str(destination["mission"]),
                                     mission=mission,
                                     mission_change=mission_change,
-                                    cot_event=event,
+                                    cot_event=cot,
                                 )
                             ).decode("utf-8"),
                         }
                         mission_changes.append({"mission": mission.name, "message": body})
-                        self.rabbit_channel.basic_publish(
+                        self.publish_after_commit(
+                            after_commit,
                             "missions",
                             routing_key=f"missions.{mission.name}",
                             body=json.dumps(body),
@@ -1130,7 +1163,8 @@ class CoTController:
 
         if mission_changes:
             for change in mission_changes:
-                self.rabbit_channel.basic_publish(
+                self.publish_after_commit(
+                    after_commit,
                     "missions",
                     routing_key=f"missions.{change['mission']}",
                     body=json.dumps(change["message"]),
@@ -1139,32 +1173,49 @@ class CoTController:
                     ),
                 )
 
-    def route_cot(self, event, uid: str, user_id: int):
+    def routed_message(self, uid: str, cot: DecodedCoT, takproto: str | None = None) -> str:
+        message = {"uid": uid, "cot": cot.xml}
+        if takproto:
+            # EUDs using TAK protocol version 1 can forward the original protobuf message without converting the XML
+            message["takproto"] = takproto
+        return json.dumps(message)
+
+    def route_cot(
+        self,
+        cot: DecodedCoT,
+        uid: str,
+        user_id: int,
+        takproto: str | None = None,
+        pli_moved: bool | None = None,
+    ):
+        """pli_moved is None unless the CoT is a PLI, in which case each group's PLI rate limit applies"""
         if not uid or uid == self.context.app.config.get("OTS_NODE_ID"):
             # This is a server generated CoT (i.e. ADS-B scheduled job) which was already properly routed
             return
 
-        destinations = event.find_all("dest")
+        body = self.routed_message(uid, cot, takproto)
+
+        destinations = cot.destinations
         if destinations:
 
             for destination in destinations:
                 # ATAK and WinTAK use callsign, iTAK uses uid
-                if "callsign" in destination.attrs and destination.attrs["callsign"]:
+                if destination.get("callsign"):
                     self.rabbit_channel.basic_publish(
                         exchange="dms",
-                        routing_key=destination.attrs["callsign"],
-                        body=json.dumps({"uid": uid, "cot": str(event)}),
+                        routing_key=destination["callsign"],
+                        body=body,
                         properties=pika.BasicProperties(
                             expiration=self.context.app.config.get("OTS_RABBITMQ_TTL")
                         ),
                     )
 
                 # iTAK uses its own UID in the <dest> tag when sending CoTs to a mission so we don't send those to the dms exchange
-                elif "uid" in destination.attrs and destination["uid"] != uid:
+                elif "uid" in destination and destination["uid"] != uid:
                     self.rabbit_channel.basic_publish(
                         exchange="dms",
-                        routing_key=destination.attrs["uid"],
-                        body=json.dumps({"uid": uid, "cot": str(event)}),
+                        routing_key=destination["uid"],
+                        body=body,
                         properties=pika.BasicProperties(
                             expiration=self.context.app.config.get("OTS_RABBITMQ_TTL")
                         ),
@@ -1173,43 +1224,53 @@ class CoTController:
                 # CoT messages belonging to Data Sync missions (i.e. <dest mission="mission name" /> are handled by cot_parser
 
         if not destinations and not user_id:
+            if pli_moved is not None and not self.pli_filter.forward(
+                uid, "__ANON__", pli_moved, body
+            ):
+                return
+
             # Publish all CoT messages received by TCP and that have no destination to the __ANON__ group
             self.rabbit_channel.basic_publish(
                 exchange="groups",
                 routing_key="__ANON__.OUT",
-                body=json.dumps({"uid": uid, "cot": str(event)}),
+                body=body,
                 properties=pika.BasicProperties(expiration=app.config.get("OTS_RABBITMQ_TTL")),
             )
             return
 
         if not destinations:
             with self.context:
-                group_memberships = db.session.execute(
-                    db.session.query(GroupUser).filter_by(
-                        user_id=user_id, direction=Group.IN, enabled=True
-                    )
-                ).all()
-                if not group_memberships:
-                    # Default to the __ANON__ group if the user doesn't belong to any IN groups
-                    self.rabbit_channel.basic_publish(
-                        exchange="groups",
-                        routing_key="__ANON__.OUT",
-                        body=json.dumps({"uid": uid, "cot": str(event)}),
-                        properties=pika.BasicProperties(
-                            expiration=self.context.app.config.get("OTS_RABBITMQ_TTL")
-                        ),
-                    )
+                group_names = group_cache.group_names(user_id, Group.IN)
+
+            if pli_moved is not None:
+                group_names = [
+                    group_name
+                    for group_name in group_names or ["__ANON__"]
+                    if self.pli_filter.forward(uid, group_name, pli_moved, body)
+                ]
+                if not group_names:
+                    return
+
+            if not group_names:
+                # Default to the __ANON__ group if the user doesn't belong to any IN groups
+                self.rabbit_channel.basic_publish(
+                    exchange="groups",
+                    routing_key="__ANON__.OUT",
+                    body=body,
+                    properties=pika.BasicProperties(
+                        expiration=self.context.app.config.get("OTS_RABBITMQ_TTL")
+                    ),
+                )
 
-                for membership in group_memberships:
-                    membership = membership[0]
-                    self.rabbit_channel.basic_publish(
-                        exchange="groups",
-                        routing_key=f"{membership.group.name}.{Group.OUT}",
-                        body=json.dumps({"uid": uid, "cot": str(event)}),
-                        properties=pika.BasicProperties(
-                            expiration=self.context.app.config.get("OTS_RABBITMQ_TTL")
-                        ),
-                    )
+            for group_name in group_names:
+                self.rabbit_channel.basic_publish(
+                    exchange="groups",
+                    routing_key=f"{group_name}.{Group.OUT}",
+                    body=body,
+                    properties=pika.BasicProperties(
+                        expiration=self.context.app.config.get("OTS_RABBITMQ_TTL")
+                    ),
+                )
 
     def on_message(
         self,
@@ -1218,70 +1279,333 @@ class CoTController:
         properties: pika.spec.BasicProperties,
         body: bytes,
     ):
+        self.batch.append(self.decode_message(basic_deliver.delivery_tag, body))
+        if len(self.batch) >= self.context.app.config.get("OTS_COT_PARSER_BATCH_SIZE"):
+            self.flush()
+        elif self.flush_timer is None:
+            self.flush_timer = self.rabbit_connection.call_later(
+                self.context.app.config.get("OTS_COT_PARSER_BATCH_WINDOW") / 1000, self.flush
+            )
+
+    def decode_message(self, delivery_tag: int, body: bytes | dict) -> QueuedMessage:
+        message = QueuedMessage(delivery_tag)
         try:
-            start = time.time()
-            body = json.loads(body)
+            message.body = body if isinstance(body, dict) else json.loads(body)
+
+            if not message.body.get("disconnected"):
+                message.cot = decode_cot(message.body["cot"])
 
-            if body.get("disconnected"):
-                self.send_disconnect_cot(body.get("uid"), body.get("user_id"))
-                self.rabbit_channel.basic_ack(delivery_tag=basic_deliver.delivery_tag)
+                if message.cot is not None:
+                    message.uid = message.body["uid"] or message.cot.uid
+                    if message.uid == self.context.app.config["OTS_NODE_ID"]:
+                        message.uid = None
+        except BaseException as e:
+            self.logger.error(f"Failed to parse CoT: {e}")
+            self.logger.debug(traceback.format_exc())
+            message.failed = True
+
+        return message
+
+    def flush(self):
+        if self.flush_timer is not None:
+            self.rabbit_connection.remove_timeout(self.flush_timer)
+            self.flush_timer = None
+
+        batch, self.batch = self.batch, []
+        if batch:
+            self.handle_batch(batch)
+            self.acknowledge(batch)
+
+        if self.pli_filter:
+            self.send_delayed_plis()
+
+    def send_delayed_plis(self):
+        """Sends each group the newest PLI it didn't get because of its rate limit once its interval passed, then
+        schedules the next check"""
+        for group_name, body in self.pli_filter.due():
+            self.rabbit_channel.basic_publish(
+                exchange="groups",
+                routing_key=f"{group_name}.{Group.OUT}",
+                body=body,
+                properties=pika.BasicProperties(
+                    expiration=self.context.app.config.get("OTS_RABBITMQ_TTL")
+                ),
+            )
+
+        due = self.pli_filter.next_due()
+        if due is None or (self.pli_timer is not None and self.pli_timer_due <= due):
+            return
+
+        if self.pli_timer is not None:
+            self.rabbit_connection.remove_timeout(self.pli_timer)
+        self.pli_timer_due = due
+        self.pli_timer = self.rabbit_connection.call_later(
+            max(due - time.monotonic(), 0), self.on_pli_timer
+        )
+
+    def on_pli_timer(self):
+        self.pli_timer = None
+        self.send_delayed_plis()
+
+    def coalesce_plis(self, messages: list[QueuedMessage]):
+        """Marks the PLIs inside the dead-bands so they're neither stored nor sent to the UI"""
+        for message in messages:
+            if self.pli_filter.is_pli(message.cot, message.uid):
+                message.pli = True
+                message.moved = self.pli_filter.store(message.cot)
+
+        if time.monotonic() - self.pli_stats_logged >= self.context.app.config.get(
+            "OTS_PLI_STATS_INTERVAL"
+        ):
+            self.pli_stats_logged = time.monotonic()
+            self.logger.info(self.pli_filter.summary())
+
+    def save_last_positions(self, plis: list[QueuedMessage]):
+        """Keeps each EUD's newest position in its map state, and in its mission_uids row for PLIs inside the
+        dead-bands. Those PLIs aren't stored in the points table, which only holds the EUDs' real history
+        """
+        newest = {}
+        for message in plis:
+            if not message.failed:
+                newest[message.uid] = message
+
+        points = []
+        for uid, message in newest.items():
+            point = self.build_point(message.cot, uid, None)
+            if point is not None:
+                points.append((message, point))
+        if not points:
+            return
+
+        with self.context:
+            try:
+                states = dict(
+                    self.db.session.execute(
+                        select(MapState.uid, MapState.data).where(
+                            MapState.kind == "euds",
+                            MapState.uid.in_([message.uid for message, point in points]),
+                            MapState.deleted.is_(False),
+                        )
+                    ).all()
+                )
+                for message, point in points:
+                    eud_json = states.get(message.uid)
+                    if eud_json is not None:
+                        last_point = point.to_json()
+                        last_point.update(
+                            how=message.cot.how,
+                            type=message.cot.type,
+                            callsign=eud_json.get("callsign"),
+                        )
+                        save_map_state("euds", message.uid, {**eud_json, "last_point": last_point})
+
+                suppressed = [(message, point) for message, point in points if not message.moved]
+                if suppressed:
+                    mission_uids = MissionUID.__table__
+                    self.db.session.execute(
+                        update(mission_uids).where(mission_uids.c.uid == bindparam("b_uid")),
+                        [
+                            self.mission_uid_values(message.cot, point)
+                            for message, point in suppressed
+                        ],
+                    )
+                self.db.session.commit()
+            except BaseException as e:
+                self.db.session.rollback()
+                self.logger.error(f"Failed to save the last positions of {len(points)} EUDs: {e}")
+                self.logger.debug(traceback.format_exc())
+
+    def handle_batch(self, batch: list[QueuedMessage]):
+        messages = [message for message in batch if message.cot is not None and not message.failed]
+        plis = []
+        if self.pli_filter:
+            self.coalesce_plis(messages)
+            plis = [message for message in messages if message.pli]
+            messages = [message for message in messages if message.moved]
+
+        try:
+            self.save_batch(messages)
+        except BaseException as e:
+            # Nothing in the batch was saved, so find the messages that can't be
+            self.logger.warning(
+                f"Failed to save {len(messages)} CoTs in one transaction, saving them one at a time: {e}"
+            )
+            self.logger.debug(traceback.format_exc())
+
+            for message in messages:
+                try:
+                    self.save_batch([message])
+                except BaseException as e:
+                    self.logger.error(f"Failed to parse CoT: {e}")
+                    self.logger.debug(traceback.format_exc())
+                    message.failed = True
+
+        try:
+            self.load_points([message for message in messages if not message.failed])
+        except BaseException as e:
+            self.logger.error(f"Failed to get the saved points: {e}")
+            self.logger.debug(traceback.format_exc())
+
+        if plis:
+            self.save_last_positions(plis)
+
+        for message in batch:
+            self.process(message)
+
+    def acknowledge(self, batch: list[QueuedMessage]):
+        # Messages are only acked once they've been committed to the DB
+        if not any(message.failed for message in batch):
+            self.rabbit_channel.basic_ack(delivery_tag=batch[-1].delivery_tag, multiple=True)
+            return
+
+        for message in batch:
+            if message.failed:
+                self.rabbit_channel.basic_nack(delivery_tag=message.delivery_tag, requeue=False)
+            else:
+                self.rabbit_channel.basic_ack(delivery_tag=message.delivery_tag)
+
+    def save_batch(self, messages: list[QueuedMessage]):
+        """Saves the CoTs and points of a batch of messages and everything parsed from them in a single
+        transaction. It's rolled back if anything fails"""
+        if not messages:
+            return
+
+        with self.context:
+            try:
+                cot_pks = self.insert_cots(messages)
+                points = [
+                    self.build_point(message.cot, message.uid, cot_pk)
+                    for message, cot_pk in zip(messages, cot_pks)
+                ]
+
+                new_points = [point for point in points if point is not None]
+                point_pks = self.insert_rows(
+                    Point, [dict(point.serialize(), cot_id=point.cot_id) for point in new_points]
+                )
+
+                if new_points:
+                    mission_uids = MissionUID.__table__
+                    self.db.session.execute(
+                        update(mission_uids).where(mission_uids.c.uid == bindparam("b_uid")),
+                        [
+                            self.mission_uid_values(message.cot, point)
+                            for message, point in zip(messages, points)
+                            if point is not None
+                        ],
+                    )
+
+                point_pks = iter(point_pks)
+                for message, cot_pk, point in zip(messages, cot_pks, points):
+                    message.cot_pk = cot_pk
+                    message.point_pk = next(point_pks) if point is not None else None
+                    message.after_commit = []
+                    self.save_details(message)
+
+                self.db.session.commit()
+            except BaseException:
+                self.db.session.rollback()
+                raise
+
+    def save_details(self, message: QueuedMessage):
+        """Saves what's parsed from a CoT, like chats, markers and mission changes, without committing. Messages
+        to socketio and RabbitMQ are added to message.after_commit"""
+        cot, uid = message.cot, message.uid
+        cot_pk, point_pk, after_commit = message.cot_pk, message.point_pk, message.after_commit
+
+        self.parse_geochat(cot, cot_pk, point_pk, after_commit)
+        self.parse_video(cot, cot_pk)
+        self.parse_alert(cot, uid, point_pk, cot_pk, after_commit)
+        self.parse_casevac(cot, uid, point_pk, cot_pk, after_commit)
+        self.parse_marker(cot, uid, point_pk, cot_pk, after_commit)
+        self.parse_rbline(cot, uid, point_pk, cot_pk, after_commit)
+        self.parse_stats(cot, uid)
+        self.generate_mission_change(uid, cot, message.body.get("takproto"), after_commit)
+
+        # EUD went offline
+        if cot.type == "t-x-d-d":
+            try:
+                eud = self.db.session.execute(self.db.session.query(EUD).filter_by(uid=uid)).first()
+                if eud:
+                    eud = eud[0]
+                    eud.last_event_time = cot.start
+                    eud.last_status = "Disconnected"
+                    eud_json = eud.to_json()
+                    save_map_state("euds", uid, eud_json)
+                    self.logger.debug("Updated {}".format(uid))
+                    # The first time an EUD connects but doesn't have a location.
+                    # Tells the UI what kind of EUD this is, ie ATAK/WinTAK/iTAK or OpenTAK ICU
+                    if not eud_json["last_point"]:
+                        eud_json["type"] = cot.type
+                    self.emit_after_commit(after_commit, "eud", eud.to_json())
+            except BaseException as e:
+                self.logger.error("Failed to update EUD: {}".format(e))
+                self.logger.debug(traceback.format_exc())
+
+    def load_points(self, messages: list[QueuedMessage]):
+        """Gets the saved points from the DB with their related CoT and EUD for the socketio messages"""
+        point_pks = [message.point_pk for message in messages if message.point_pk is not None]
+        if not point_pks:
+            return
+
+        with self.context:
+            saved_points = {
+                point.id: point
+                for point in self.db.session.scalars(
+                    select(Point)
+                    .filter(Point.id.in_(point_pks))
+                    .options(
+                        selectinload(Point.cot).load_only(CoT.how, CoT.type),
+                        selectinload(Point.eud),
+                    )
+                )
+            }
+
+        for message in messages:
+            if message.point_pk is not None:
+                message.point = saved_points.get(message.point_pk)
+
+    def process(self, message: QueuedMessage):
+        """Everything that happens to a message after it's committed to the DB"""
+        if message.failed:
+            return
+
+        try:
+            if message.body.get("disconnected"):
+                self.send_disconnect_cot(message.body.get("uid"), message.body.get("user_id"))
                 return
 
-            soup = BeautifulSoup(body["cot"], "xml")
-            event: BeautifulSoup | None = soup.find("event")
+            cot = message.cot
+            if cot is None:
+                return
 
-            if not event:
-                self.rabbit_channel.basic_ack(delivery_tag=basic_deliver.delivery_tag)
+            uid = message.uid
+            if not message.moved:
+                self.route_cot(
+                    cot,
+                    uid,
+                    message.body.get("user_id"),
+                    message.body.get("takproto"),
+                    pli_moved=False,
+                )
                 return
 
-            uid = body["uid"] or event.attrs["uid"]
-            if uid == self.context.app.config["OTS_NODE_ID"]:
-                uid = None
-
-            if event:
-                cot_pk = self.insert_cot(soup, event, uid)
-                point_pk = self.parse_point(event, uid, cot_pk)
-                self.parse_geochat(event, cot_pk, point_pk)
-                self.parse_video(event, cot_pk)
-                self.parse_alert(event, uid, point_pk, cot_pk)
-                self.parse_casevac(event, uid, point_pk, cot_pk)
-                self.parse_marker(event, uid, point_pk, cot_pk)
-                self.parse_rbline(event, uid, point_pk, cot_pk)
-                self.parse_stats(event, uid)
-                self.generate_mission_change(uid, event)
-                self.route_cot(event, uid, body.get("user_id"))
-                self.rabbit_channel.basic_ack(delivery_tag=basic_deliver.delivery_tag)
-
-                # EUD went offline
-                if event.attrs["type"] == "t-x-d-d":
+            if message.point is not None:
+                self.publish_point(cot, uid, message.point)
 
-                    try:
-                        with self.context:
-                            eud = self.db.session.execute(
-                                self.db.session.query(EUD).filter_by(uid=uid)
-                            ).first()
-                            if eud:
-                                eud = eud[0]
-                                eud.last_event_time = datetime_from_iso8601_string(
-                                    event.attrs["start"]
-                                )
-                                eud.last_status = "Disconnected"
-                                self.db.session.commit()
-                                self.logger.debug("Updated {}".format(uid))
-                                eud_json = eud.to_json()
-                                # The first time an EUD connects but doesn't have a location.
-                                # Tells the UI what kind of EUD this is, ie ATAK/WinTAK/iTAK or OpenTAK ICU
-                                if not eud_json["last_point"]:
-                                    eud_json["type"] = event.attrs["type"]
-                                self.socketio.emit("eud", eud.to_json(), namespace="/socket.io")
-                    except BaseException as e:
-                        self.logger.error("Failed to update EUD: {}".format(e))
-                        self.logger.debug(traceback.format_exc())
+            for send in message.after_commit:
+                send()
 
+            self.route_cot(
+                cot,
+                uid,
+                message.body.get("user_id"),
+                message.body.get("takproto"),
+                pli_moved=True if message.pli else None,
+            )
         except BaseException as e:
             self.logger.error(f"Failed to parse CoT: {e}")
             self.logger.debug(traceback.format_exc())
-            self.rabbit_channel.basic_nack(delivery_tag=basic_deliver.delivery_tag, requeue=False)
+            message.failed = True
 
 
 def setup_logging(app):
@@ -1345,6 +1669,7 @@ def create_app():
 
     setup_logging(app)
     db.init_app(app)
+    cot_storage.init_app(app)
 
     try:
         fsqla.FsModels.set_db_info(db)
@@ -1369,6 +1694,12 @@ def status():
 
 
 def main():
+    if app.config.get("OTS_COT_PARSER_THREADS"):
+        from opentakserver.cot_parser.worker_pool import supervise
+
+        supervise(app, logger, db)
+        return
+
     sio = SocketIO(message_queue="amqp://" + app.config.get("OTS_RABBITMQ_SERVER_ADDRESS"))
 
     processes = 0
@@ -0,0 +1,215 @@
+import math
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any
+
+from opentakserver.cot_parser.cot_decoder import DecodedCoT
+
+EARTH_RADIUS = 6371008.8
+
+
+def distance(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Meters between two points. An equirectangular approximation, which is accurate over the short distances
+    dead-bands are measured in"""
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * EARTH_RADIUS
+
+
+def course_change(course1: float | None, course2: float | None) -> float:
+    if course1 is None or course2 is None:
+        return 0
+    change = abs(course1 - course2) % 360
+    return min(change, 360 - change)
+
+
+@dataclass(slots=True)
+class Track:
+    """What was last stored for an EUD and when it was last forwarded to each group"""
+
+    latitude: float
+    longitude: float
+    course: float | None
+    stored: float
+    forwarded: dict[str, float] = field(default_factory=dict)
+    # Group -> (when its interval passes, the newest PLI it didn't get yet)
+    pending: dict[str, tuple[float, Any]] = field(default_factory=dict)
+
+
+class PLIFilter:
+    """Coalesces the position reports (PLI) EUDs send every few seconds, even when they aren't moving.
+
+    A PLI is only stored once the EUD moved further than the distance dead-band or turned more than the course
+    dead-band from its last stored PLI, or once the time dead-band passed. Each group gets an EUD's PLIs at most
+    once per its interval, and PLIs inside the dead-bands are only forwarded once per time dead-band so the EUD
+    doesn't go stale. The newest PLI a group didn't get is kept and sent once its interval passes, so every group
+    ends up with an EUD's latest position even if it stops reporting.
+
+    Not thread safe. Each cot_parser shard has its own filter for the UIDs it handles
+    """
+
+    def __init__(
+        self,
+        distance_deadband: float,
+        course_deadband: float,
+        time_deadband: float,
+        group_interval: float,
+        group_intervals: dict[str, float] | None = None,
+        max_tracks: int = 100000,
+    ):
+        self.distance_deadband = distance_deadband
+        self.course_deadband = course_deadband
+        self.time_deadband = time_deadband
+        self.group_interval = group_interval
+        self.group_intervals = group_intervals or {}
+        self.max_tracks = max_tracks
+        self.tracks: OrderedDict[str, Track] = OrderedDict()
+        # UIDs with PLIs that are waiting for a group's interval to pass
+        self.pending: set[str] = set()
+        self.counters = {
+            "stored": 0,
+            "suppressed": 0,
+            "forwarded": 0,
+            "rate_limited": 0,
+            "delayed": 0,
+        }
+
+    @classmethod
+    def from_config(cls, config) -> "PLIFilter | None":
+        if not config.get("OTS_PLI_COALESCING"):
+            return None
+
+        return cls(
+            config.get("OTS_PLI_DISTANCE_DEADBAND"),
+            config.get("OTS_PLI_COURSE_DEADBAND"),
+            config.get("OTS_PLI_TIME_DEADBAND"),
+            config.get("OTS_PLI_GROUP_INTERVAL"),
+            config.get("OTS_PLI_GROUP_INTERVALS"),
+            config.get("OTS_PLI_MAX_TRACKED_UIDS"),
+        )
+
+    @staticmethod
+    def is_pli(cot: DecodedCoT, uid: str | None) -> bool:
+        """An EUD reporting its own position to its groups. Markers, direct messages and mission CoTs aren't"""
+        return (
+            uid is not None
+            and cot.uid == uid
+            and cot.type.startswith("a-")
+            and cot.point is not None
+            and not cot.destinations
+        )
+
+    def store(self, cot: DecodedCoT, now: float | None = None) -> bool:
+        """Whether a PLI moved far enough from the last stored one, or enough time passed, to be stored"""
+        now = time.monotonic() if now is None else now
+        try:
+            latitude = float(cot.point["lat"])
+            longitude = float(cot.point["lon"])
+        except (KeyError, TypeError, ValueError):
+            return True
+
+        course = None
+        if cot.track is not None:
+            try:
+                course = float(cot.track["course"])
+            except (KeyError, TypeError, ValueError):
+                pass
+            if course is not None and not 0 <= course <= 360:
+                course = None
+
+        track = self.tracks.get(cot.uid)
+        if track is not None:
+            self.tracks.move_to_end(cot.uid)
+            if (
+                now - track.stored < self.time_deadband
+                and distance(track.latitude, track.longitude, latitude, longitude)
+                < self.distance_deadband
+                and course_change(track.course, course) < self.course_deadband
+            ):
+                self.counters["suppressed"] += 1
+                return False
+
+            track.latitude, track.longitude, track.course, track.stored = (
+                latitude,
+                longitude,
+                course,
+                now,
+            )
+        else:
+            self.tracks[cot.uid] = Track(latitude, longitude, course, now)
+            while len(self.tracks) > self.max_tracks:
+                self.tracks.popitem(last=False)
+
+        self.counters["stored"] += 1
+        return True
+
+    def forward(
+        self, uid: str, group: str, moved: bool, pli: Any = None, now: float | None = None
+    ) -> bool:
+        """Whether to forward a PLI to a group. moved is what store() returned for it. A PLI that isn't forwarded
+        is kept until the group's interval passes, unless a newer one replaces it"""
+        now = time.monotonic() if now is None else now
+        track = self.tracks.get(uid)
+        if track is None:
+            return True
+
+        interval = self.group_intervals.get(group, self.group_interval)
+        if not moved:
+            interval = max(interval, self.time_deadband)
+
+        last = track.forwarded.get(group)
+        if last is not None and now - last < interval:
+            self.counters["rate_limited"] += 1
+            if pli is not None:
+                due = last + interval
+                if group in track.pending:
+                    due = min(due, track.pending[group][0])
+                track.pending[group] = (due, pli)
+                self.pending.add(uid)
+            return False
+
+        track.forwarded[group] = now
+        track.pending.pop(group, None)
+        self.counters["forwarded"] += 1
+        return True
+
+    def due(self, now: float | None = None) -> list[tuple[str, Any]]:
+        """Takes the kept PLIs whose group's interval passed, as (group, PLI)"""
+        now = time.monotonic() if now is None else now
+        due = []
+        for uid in list(self.pending):
+            track = self.tracks.get(uid)
+            for group, (when, pli) in list(track.pending.items()) if track else []:
+                if when <= now:
+                    del track.pending[group]
+                    track.forwarded[group] = now
+                    self.counters["delayed"] += 1
+                    due.append((group, pli))
+
+            if not track or not track.pending:
+                self.pending.discard(uid)
+
+        return due
+
+    def next_due(self) -> float | None:
+        """When the next kept PLI has to be sent"""
+        return min(
+            (
+                when
+                for uid in self.pending
+                if uid in self.tracks
+                for when, pli in self.tracks[uid].pending.values()
+            ),
+            default=None,
+        )
+
+    def summary(self) -> str:
+        received = self.counters["stored"] + self.counters["suppressed"]
+        sent = self.counters["forwarded"] + self.counters["rate_limited"]
+        return (
+            f"PLI coalescing: stored {self.counters['stored']} of {received} PLIs "
+            f"({self.counters['suppressed']} suppressed), forwarded {self.counters['forwarded']} of {sent} "
+            f"({self.counters['rate_limited']} rate limited, {self.counters['delayed']} sent when their interval "
+            f"passed), tracking {len(self.tracks)} EUDs"
+        )
@@ -0,0 +1,294 @@
+import hashlib
+import json
+import os
+import queue
+import re
+import threading
+import time
+import traceback
+from functools import partial
+
+import pika
+from flask_socketio import SocketIO
+
+from opentakserver.cot_parser.cot_parser import CoTController, QueuedMessage, connect_to_rabbitmq
+from opentakserver.group_cache import group_cache
+
+# Finds the uid attribute of the <event> element without parsing the whole message
+EVENT_UID = re.compile(r"<event\s(?:[^>]*?\s)?uid\s*=\s*[\"']([^\"']*)[\"']")
+
+# How often in seconds the worker threads are checked and the shard queue depths are logged
+WATCHDOG_INTERVAL = 5
+# How often in seconds idle worker threads service their RabbitMQ connection's heartbeats
+IDLE_POLL_INTERVAL = 1
+
+
+def jump_consistent_hash(key: int, buckets: int) -> int:
+    """Lamping and Veach's jump consistent hash. Going from n to n + 1 buckets only moves 1/(n + 1) of the keys"""
+    bucket = -1
+    j = 0
+    while j < buckets:
+        bucket = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_index(uid: str, shards: int, level: int = 0) -> int:
+    """Maps a UID to one of the shards. Level 0 picks the process and level 1 picks the thread in that process.
+    Each level uses different bits of the hash so every thread gets a share of its process's UIDs"""
+    digest = hashlib.blake2b(uid.encode(), digest_size=16).digest()
+    key = int.from_bytes(digest[level * 8 : (level + 1) * 8], "little")
+    return jump_consistent_hash(key, shards)
+
+
+def message_uid(body: dict) -> str:
+    """The UID a message is sharded by. Disconnect messages don't have a CoT so they use the EUD's UID"""
+    match = EVENT_UID.search(body.get("cot") or "")
+    if match:
+        return match.group(1)
+    return body.get("uid") or ""
+
+
+class ShardWorker(CoTController):
+    """Parses the messages of one shard in order on its own thread"""
+
+    def __init__(self, pool, index: int, context, log, database, socket_io):
+        super().__init__(context, log, database, socket_io)
+        self.pool = pool
+        self.index = index
+        self.queue: queue.Queue[tuple[int, dict | bytes]] = queue.Queue()
+        self.thread = threading.Thread(
+            target=self.run, name=f"cot_parser-shard-{index}", daemon=True
+        )
+
+    def run(self):
+        try:
+            # pika connections aren't thread safe so every worker has its own for publishing. Acks go through the pool
+            self.rabbit_connection = connect_to_rabbitmq()
+            self.rabbit_channel = self.rabbit_connection.channel()
+
+            batch_size = self.context.app.config.get("OTS_COT_PARSER_BATCH_SIZE")
+            batch_window = self.context.app.config.get("OTS_COT_PARSER_BATCH_WINDOW") / 1000
+            deadline = None
+
+            while True:
+                if deadline is None:
+                    timeout = IDLE_POLL_INTERVAL
+                else:
+                    timeout = max(deadline - time.monotonic(), 0)
+
+                try:
+                    delivery_tag, body = self.queue.get(timeout=timeout)
+                    self.batch.append(self.decode_message(delivery_tag, body))
+                    if deadline is None:
+                        deadline = time.monotonic() + batch_window
+                except queue.Empty:
+                    self.rabbit_connection.process_data_events(time_limit=0)
+
+                if self.batch and (len(self.batch) >= batch_size or time.monotonic() >= deadline):
+                    self.flush()
+                    deadline = None
+        except BaseException as e:
+            self.logger.error(f"cot_parser shard {self.index} stopped: {e}")
+            self.logger.debug(traceback.format_exc())
+
+    def acknowledge(self, batch: list[QueuedMessage]):
+        self.pool.rabbit_connection.add_callback_threadsafe(partial(self.pool.acknowledge, batch))
+
+
+class WorkerPool:
+    """Consumes a cot_parser queue and spreads its messages over ShardWorker threads by event UID"""
+
+    def __init__(self, app, log, database, queue_name: str = "cot_parser"):
+        self.app = app
+        self.logger = log
+        self.queue_name = queue_name
+
+        self.rabbit_connection: pika.BlockingConnection = None
+        self.rabbit_channel = None
+
+        self.workers = [
+            ShardWorker(
+                self,
+                i,
+                app.app_context(),
+                log,
+                database,
+                SocketIO(message_queue="amqp://" + app.config.get("OTS_RABBITMQ_SERVER_ADDRESS")),
+            )
+            for i in range(app.config.get("OTS_COT_PARSER_THREADS"))
+        ]
+
+    def run(self):
+        self.rabbit_connection = connect_to_rabbitmq()
+        self.rabbit_channel = self.rabbit_connection.channel()
+        self.rabbit_channel.queue_declare(queue=self.queue_name)
+        self.rabbit_channel.queue_bind(
+            exchange="cot_parser", queue=self.queue_name, routing_key=self.queue_name
+        )
+        # RabbitMQ stops delivering once this many messages are unacked, which limits how much the shard queues can hold
+        self.rabbit_channel.basic_qos(prefetch_count=self.app.config.get("OTS_RABBITMQ_PREFETCH"))
+        self.rabbit_channel.basic_consume(
+            queue=self.queue_name, on_message_callback=self.on_message, auto_ack=False
+        )
+
+        group_cache.subscribe(self.rabbit_channel)
+
+        for worker in self.workers:
+            worker.thread.start()
+
+        self.rabbit_connection.call_later(WATCHDOG_INTERVAL, self.watchdog)
+        self.rabbit_channel.start_consuming()
+
+    def on_message(
+        self,
+        channel: pika.channel.Channel,
+        basic_deliver: pika.spec.Basic.Deliver,
+        properties: pika.spec.BasicProperties,
+        body: bytes,
+    ):
+        try:
+            body = json.loads(body)
+            uid = message_uid(body)
+        except BaseException:
+            # The worker will log the error and nack the message
+            uid = ""
+
+        worker = self.workers[shard_index(uid, len(self.workers), level=1)]
+        worker.queue.put((basic_deliver.delivery_tag, body))
+
+    def acknowledge(self, batch: list[QueuedMessage]):
+        # Other shards may still be working on earlier delivery tags so each message is acked on its own
+        for message in batch:
+            if message.failed:
+                self.rabbit_channel.basic_nack(delivery_tag=message.delivery_tag, requeue=False)
+            else:
+                self.rabbit_channel.basic_ack(delivery_tag=message.delivery_tag)
+
+    def queue_depths(self) -> list[int]:
+        return [worker.queue.qsize() for worker in self.workers]
+
+    def watchdog(self):
+        depths = self.queue_depths()
+        self.logger.debug(f"{self.queue_name} shard queue depths: {depths}")
+
+        prefetch = self.app.config.get("OTS_RABBITMQ_PREFETCH")
+        for i, depth in enumerate(depths):
+            if depth >= prefetch:
+                self.logger.warning(
+                    f"{self.queue_name} shard {i} is holding the whole prefetch window ({depth} messages)"
+                )
+
+        if not all(worker.thread.is_alive() for worker in self.workers):
+            # Stopping makes the process exit. Its unacked messages are redelivered to the process that replaces it
+            self.logger.error(f"A {self.queue_name} worker thread stopped, restarting the process")
+            self.rabbit_channel.stop_consuming()
+            return
+
+        self.rabbit_connection.call_later(WATCHDOG_INTERVAL, self.watchdog)
+
+
+class Dispatcher:
+    """Forwards messages from the cot_parser queue to the queue of the process that owns their event UID"""
+
+    def __init__(self, app, log, queues: list[str], on_idle):
+        self.app = app
+        self.logger = log
+        self.queues = queues
+        self.on_idle = on_idle
+
+        self.rabbit_connection: pika.BlockingConnection = None
+        self.rabbit_channel = None
+
+    def run(self):
+        self.rabbit_connection = connect_to_rabbitmq()
+        self.rabbit_channel = self.rabbit_connection.channel()
+
+        # Declare the shard queues here too so nothing is dropped while a worker process is (re)starting
+        for queue_name in self.queues + ["cot_parser"]:
+            self.rabbit_channel.queue_declare(queue=queue_name)
+            self.rabbit_channel.queue_bind(
+                exchange="cot_parser", queue=queue_name, routing_key=queue_name
+            )
+
+        self.rabbit_channel.basic_qos(prefetch_count=self.app.config.get("OTS_RABBITMQ_PREFETCH"))
+        self.rabbit_channel.basic_consume(
+            queue="cot_parser", on_message_callback=self.on_message, auto_ack=False
+        )
+        self.rabbit_connection.call_later(1, self.idle)
+        self.rabbit_channel.start_consuming()
+
+    def on_message(
+        self,
+        channel: pika.channel.Channel,
+        basic_deliver: pika.spec.Basic.Deliver,
+        properties: pika.spec.BasicProperties,
+        body: bytes,
+    ):
+        try:
+            uid = message_uid(json.loads(body))
+        except BaseException:
+            uid = ""
+
+        self.rabbit_channel.basic_publish(
+            exchange="cot_parser",
+            routing_key=self.queues[shard_index(uid, len(self.queues))],
+            body=body,
+            properties=properties,
+        )
+        self.rabbit_channel.basic_ack(delivery_tag=basic_deliver.delivery_tag)
+
+    def idle(self):
+        self.on_idle()
+        self.rabbit_connection.call_later(1, self.idle)
+
+
+def start_worker_process(app, log, database, queue_name: str) -> int:
+    pid = os.fork()
+    if pid == 0:
+        try:
+            WorkerPool(app, log, database, queue_name).run()
+        except BaseException as e:
+            log.error(f"cot_parser worker error: {e}")
+            log.debug(traceback.format_exc())
+        finally:
+            os._exit(1)
+
+    return pid
+
+
+def supervise(app, log, database):
+    """Runs cot_parser as OTS_COT_PARSER_PROCESSES processes with OTS_COT_PARSER_THREADS threads each and restarts
+    any process that exits. With more than one process, this process shards the cot_parser queue between them
+    """
+    processes = app.config.get("OTS_COT_PARSER_PROCESSES")
+    if processes > 1:
+        queues = [f"cot_parser.{i}" for i in range(processes)]
+    else:
+        queues = ["cot_parser"]
+
+    children = {
+        start_worker_process(app, log, database, queue_name): queue_name for queue_name in queues
+    }
+
+    def restart_exited_workers(block: bool = False):
+        while children:
+            pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            if pid == 0:
+                return
+
+            queue_name = children.pop(pid)
+            log.warning(
+                f"cot_parser worker for {queue_name} exited with status {status}, restarting it"
+            )
+            if block:
+                # Don't fork in a tight loop if the workers can't start, i.e. when RabbitMQ is down
+                time.sleep(1)
+            children[start_worker_process(app, log, database, queue_name)] = queue_name
+
+    if processes > 1:
+        Dispatcher(app, log, queues, restart_exited_workers).run()
+    else:
+        while True:
+            restart_exited_workers(block=True)
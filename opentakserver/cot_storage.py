@@ -0,0 +1,285 @@
+import datetime
+import threading
+import time
+import zlib
+
+from lxml import etree
+from sqlalchemy import LargeBinary, TypeDecorator, bindparam, exc, func, insert, select, update
+
+from opentakserver.eud_handler.TakProtocol import (
+    MAGIC,
+    TakProtocolFramer,
+    frame,
+    proto_to_xml,
+    xml_to_proto,
+)
+from opentakserver.extensions import db, logger
+from opentakserver.models.CoTDictionary import CoTDictionary
+from opentakserver.proto.takmessage_pb2 import TakMessage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Stored payloads describe their own format so rows written with different codecs can be read side by side:
+# raw XML starts with <, zstd frames with their magic number (which includes the dictionary ID), protobuf with
+# the TAK protocol magic byte and zlib streams with their deflate header
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+CODECS = ("xml", "zlib", "zstd", "protobuf")
+
+xml_parser = etree.XMLParser(resolve_entities=False, no_network=True)
+
+
+class CoTStorage:
+    """Encodes the XML of CoTs for the cot table with the codec in OTS_COT_STORAGE and decodes every format.
+
+    zstd uses the newest dictionary trained on stored CoTs, which compresses a single event far better than
+    zstd alone. The dictionaries are stored in the cot_dictionaries table, which every process reads them from.
+    Falls back to zlib when the zstandard package isn't installed
+    """
+
+    def __init__(self):
+        self.codec = "xml"
+        self.level = 3
+        self.dictionary_samples = 2000
+        self.dictionary_size = 32 * 1024
+        self.dictionaries: dict[int, "zstandard.ZstdCompressionDict"] = {}
+        self.dictionary = None
+        self.checked_dictionaries = 0.0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # The highest ID checked by migrate_stored_cots()
+        self.migrated_id = 0
+
+    def init_app(self, app):
+        codec = app.config.get("OTS_COT_STORAGE")
+        if codec not in CODECS:
+            logger.error(f"Invalid OTS_COT_STORAGE {codec}, must be one of {', '.join(CODECS)}")
+            codec = "xml"
+        elif codec == "zstd" and zstandard is None:
+            logger.warning("The zstandard package isn't installed, compressing CoTs with zlib")
+            codec = "zlib"
+
+        self.codec = codec
+        self.level = app.config.get("OTS_COT_COMPRESSION_LEVEL")
+        self.dictionary_samples = app.config.get("OTS_COT_DICTIONARY_SAMPLES")
+        self.dictionary_size = app.config.get("OTS_COT_DICTIONARY_SIZE")
+        # The dictionaries are loaded from the database when compressing or decompressing needs them
+        self.checked_dictionaries = 0.0
+
+    def load_dictionaries(self):
+        """Loads the dictionaries that aren't loaded yet from the cot_dictionaries table and compresses with the
+        newest one. Picks up dictionaries trained by other processes at most once a minute"""
+        self.checked_dictionaries = time.monotonic()
+        if zstandard is None:
+            return
+
+        # A connection of its own so a failure doesn't abort the caller's transaction
+        try:
+            with db.engine.connect() as connection:
+                rows = connection.execute(
+                    select(CoTDictionary.id, CoTDictionary.data).where(
+                        CoTDictionary.id.not_in(list(self.dictionaries))
+                    )
+                ).all()
+                newest = connection.execute(
+                    select(CoTDictionary.id).order_by(CoTDictionary.created.desc()).limit(1)
+                ).scalar()
+        except exc.SQLAlchemyError as e:
+            logger.warning(f"Failed to load the zstd dictionaries: {e}")
+            return
+
+        with self.lock:
+            for dictionary_id, data in rows:
+                self.dictionaries[dictionary_id] = zstandard.ZstdCompressionDict(bytes(data))
+            self.dictionary = self.dictionaries.get(newest)
+
+    def save_dictionary(self, data: bytes) -> int:
+        dictionary = zstandard.ZstdCompressionDict(data)
+        with db.engine.begin() as connection:
+            connection.execute(
+                insert(CoTDictionary).values(
+                    id=dictionary.dict_id(),
+                    data=data,
+                    created=datetime.datetime.now(datetime.timezone.utc),
+                )
+            )
+
+        with self.lock:
+            self.dictionaries[dictionary.dict_id()] = dictionary
+            self.dictionary = dictionary
+        return dictionary.dict_id()
+
+    def compressor(self):
+        # zstandard's compressors and decompressors can't be shared between threads
+        if time.monotonic() - self.checked_dictionaries > 60:
+            self.load_dictionaries()
+
+        dictionary_id = self.dictionary.dict_id() if self.dictionary else 0
+        compressors = self.local.__dict__.setdefault("compressors", {})
+        if (dictionary_id, self.level) not in compressors:
+            compressors[(dictionary_id, self.level)] = zstandard.ZstdCompressor(
+                level=self.level, dict_data=self.dictionary
+            )
+        return compressors[(dictionary_id, self.level)]
+
+    def decompressor(self, dictionary_id: int):
+        decompressors = self.local.__dict__.setdefault("decompressors", {})
+        if dictionary_id not in decompressors:
+            if dictionary_id and dictionary_id not in self.dictionaries:
+                self.load_dictionaries()
+            dictionary = self.dictionaries.get(dictionary_id) if dictionary_id else None
+            if dictionary_id and dictionary is None:
+                raise ValueError(f"The zstd dictionary {dictionary_id} is missing")
+            decompressors[dictionary_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+        return decompressors[dictionary_id]
+
+    def encode(self, xml: str, codec: str | None = None) -> bytes:
+        codec = codec or self.codec
+        data = xml.encode("utf-8")
+        if codec == "zstd":
+            return self.compressor().compress(data)
+        elif codec == "zlib":
+            return zlib.compress(data, min(self.level, 9))
+        elif codec == "protobuf":
+            try:
+                event = etree.fromstring(data, parser=xml_parser)
+                return frame(xml_to_proto(event).SerializeToString())
+            except (etree.XMLSyntaxError, ValueError, TypeError):
+                # Not every event can be converted, i.e. ones without a time
+                return data
+        return data
+
+    def decode(self, payload: bytes | str | None) -> str | None:
+        if payload is None or isinstance(payload, str):
+            return payload
+
+        payload = bytes(payload)
+        if payload.startswith(ZSTD_MAGIC):
+            if zstandard is None:
+                raise ValueError("Install the zstandard package to read compressed CoTs")
+            dictionary_id = zstandard.get_frame_parameters(payload).dict_id
+            return self.decompressor(dictionary_id).decompress(payload).decode("utf-8")
+        elif payload[:1] == bytes([MAGIC]):
+            message = TakMessage()
+            message.ParseFromString(TakProtocolFramer().feed(payload)[0])
+            return etree.tostring(proto_to_xml(message.cotEvent), encoding="unicode")
+        elif payload[:1] == b"\x78":
+            return zlib.decompress(payload).decode("utf-8")
+        return payload.decode("utf-8")
+
+    def train_dictionary(self, samples: list[str]) -> int:
+        """Trains a zstd dictionary on the XML of some CoTs and uses it from now on. Returns its ID"""
+        dictionary = zstandard.train_dictionary(
+            self.dictionary_size, [sample.encode("utf-8") for sample in samples], level=self.level
+        )
+        return self.save_dictionary(dictionary.as_bytes())
+
+
+cot_storage = CoTStorage()
+
+
+class CoTPayload(TypeDecorator):
+    """The XML of a CoT, stored as bytes encoded by cot_storage and read back as a string"""
+
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, str):
+            return cot_storage.encode(value)
+        return value
+
+    def process_result_value(self, value, dialect):
+        return cot_storage.decode(value)
+
+
+def train_cot_dictionary() -> int | None:
+    """Trains a zstd dictionary on the newest OTS_COT_DICTIONARY_SAMPLES CoTs. Returns its ID, or None if there
+    aren't enough CoTs yet"""
+    # Keep this import here to avoid a circular import
+    from opentakserver.models.CoT import CoT
+
+    xml = (
+        db.session.execute(
+            select(CoT.xml).order_by(CoT.id.desc()).limit(cot_storage.dictionary_samples)
+        )
+        .scalars()
+        .all()
+    )
+    try:
+        dictionary_id = cot_storage.train_dictionary([cot for cot in xml if cot])
+    except zstandard.ZstdError as e:
+        logger.warning(f"Not enough CoTs to train a zstd dictionary yet: {e}")
+        return None
+
+    logger.info(f"Trained the zstd dictionary {dictionary_id} on {len(xml)} CoTs")
+    return dictionary_id
+
+
+def migrate_stored_cots(batch_size: int, max_seconds: float | None = None) -> int:
+    """Re-encodes CoTs stored as raw XML with the OTS_COT_STORAGE codec, batch_size rows per transaction, until
+    there are none left or max_seconds have passed. Returns how many were re-encoded"""
+    # Keep this import here to avoid a circular import
+    from opentakserver.models.CoT import CoT
+
+    if cot_storage.codec == "xml":
+        return 0
+
+    if cot_storage.codec == "zstd":
+        cot_storage.load_dictionaries()
+        if cot_storage.dictionary is None:
+            train_cot_dictionary()
+
+    started = time.monotonic()
+    migrated = 0
+    raw_xml = bindparam("raw_xml", b"<", type_=LargeBinary)
+    while max_seconds is None or time.monotonic() - started < max_seconds:
+        rows = db.session.execute(
+            select(CoT.id, CoT.xml)
+            .where(CoT.id > cot_storage.migrated_id, func.substr(CoT.xml, 1, 1) == raw_xml)
+            .order_by(CoT.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+
+        db.session.execute(update(CoT), [{"id": cot_id, "xml": xml} for cot_id, xml in rows])
+        db.session.commit()
+        cot_storage.migrated_id = rows[-1][0]
+        migrated += len(rows)
+
+    if migrated:
+        elapsed = time.monotonic() - started
+        logger.info(
+            f"Re-encoded {migrated} CoTs with {cot_storage.codec} in {elapsed:.2f}s "
+            f"({migrated / max(elapsed, 0.001):.0f} rows/s)"
+        )
+    return migrated
+
+
+def benchmark(samples: list[str]) -> list[dict]:
+    """Bytes per event and microseconds per encode and decode of each codec for some CoTs"""
+    results = []
+    for codec in CODECS:
+        if codec == "zstd" and zstandard is None:
+            continue
+
+        started = time.perf_counter()
+        payloads = [cot_storage.encode(sample, codec) for sample in samples]
+        encoded = time.perf_counter()
+        for payload in payloads:
+            cot_storage.decode(payload)
+        decoded = time.perf_counter()
+
+        results.append(
+            {
+                "codec": codec,
+                "bytes_per_event": sum(len(payload) for payload in payloads) / len(samples),
+                "encode_us": (encoded - started) / len(samples) * 1e6,
+                "decode_us": (decoded - encoded) / len(samples) * 1e6,
+            }
+        )
+
+    return results
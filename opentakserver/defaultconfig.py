@@ -45,6 +45,29 @@ class DefaultConfig:
     OTS_SSL_STREAMING_PORT = int(os.getenv("OTS_SSL_STREAMING_PORT", 8089))
     OTS_STREAMING_INTERFACE = os.getenv("OTS_STREAMING_INTERFACE", "0.0.0.0")
     OTS_BACKUP_COUNT = int(os.getenv("OTS_BACKUP_COUNT", 7))
+    # EUDs that send a single CoT or auth message larger than this are disconnected
+    OTS_EUD_MAX_FRAME_SIZE = int(os.getenv("OTS_EUD_MAX_FRAME_SIZE", 4 * 1024 * 1024))
+    # Lets EUDs negotiate TAK protocol version 1 (protobuf) on the streaming ports
+    OTS_ENABLE_TAK_PROTOCOL = os.getenv("OTS_ENABLE_TAK_PROTOCOL", "True").lower() in [
+        "true",
+        "1",
+        "yes",
+    ]
+    # Settings for eud_handler --asyncio. 0 workers starts one event loop per CPU core
+    OTS_EUD_ASYNC_WORKERS = int(os.getenv("OTS_EUD_ASYNC_WORKERS", 0))
+    # Threads per worker for DB queries while EUDs authenticate and send their device info
+    OTS_EUD_ASYNC_DB_THREADS = int(os.getenv("OTS_EUD_ASYNC_DB_THREADS", 8))
+    # EUDs that fall this many bytes behind are disconnected
+    OTS_EUD_ASYNC_WRITE_BUFFER_LIMIT = int(
+        os.getenv("OTS_EUD_ASYNC_WRITE_BUFFER_LIMIT", 4 * 1024 * 1024)
+    )
+    # CoTs from EUDs are published in batches when either limit is reached
+    OTS_EUD_PUBLISH_BATCH_SIZE = int(os.getenv("OTS_EUD_PUBLISH_BATCH_SIZE", 100))
+    OTS_EUD_PUBLISH_BATCH_MS = int(os.getenv("OTS_EUD_PUBLISH_BATCH_MS", 5))
+    # Publishing pauses when this many messages haven't been confirmed by RabbitMQ
+    OTS_EUD_PUBLISH_MAX_UNCONFIRMED = int(os.getenv("OTS_EUD_PUBLISH_MAX_UNCONFIRMED", 1000))
+    # Max messages to hold while RabbitMQ is unavailable, the oldest are dropped first
+    OTS_EUD_PUBLISH_BUFFER = int(os.getenv("OTS_EUD_PUBLISH_BUFFER", 10000))
     OTS_ENABLE_CHANNELS = os.getenv("OTS_ENABLE_CHANNELS", "True").lower() in ["true", "1", "yes"]
 
     # RabbitMQ Settings
@@ -55,7 +78,7 @@ class DefaultConfig:
     # Set to '0' to disable auto-deletion
     OTS_RABBITMQ_TTL = "86400000"
     # How many CoT messages that cot_parser processes should prefetch. https://www.rabbitmq.com/docs/consumer-prefetch
-    OTS_RABBITMQ_PREFETCH = 2
+    OTS_RABBITMQ_PREFETCH = int(os.getenv("OTS_RABBITMQ_PREFETCH", 200))
 
     # TAK.gov account link settings
     OTS_TAK_GOV_LINKED = False
@@ -67,6 +90,8 @@ class DefaultConfig:
     OTS_MEDIAMTX_TOKEN = os.getenv("OTS_MEDIAMTX_TOKEN", secrets.token_urlsafe(30 * 3 // 4))
     OTS_SSL_VERIFICATION_MODE = int(os.getenv("OTS_SSL_VERIFICATION_MODE", 2))
     OTS_SSL_CERT_HEADER = os.getenv("OTS_SSL_CERT_HEADER", "X-Ssl-Cert")
+    # How many verified client certificates to remember so they aren't verified against the CA on every request
+    OTS_VERIFIED_CERT_CACHE_SIZE = int(os.getenv("OTS_VERIFIED_CERT_CACHE_SIZE", 1024))
     OTS_NODE_ID = os.getenv(
         "OTS_NODE_ID", "".join(random.choices(string.ascii_lowercase + string.digits, k=32))
     )
@@ -85,8 +110,31 @@ class DefaultConfig:
         "OTS_CA_SUBJECT",
         f"/C={OTS_CA_COUNTRY}/ST={OTS_CA_STATE}/L={OTS_CA_CITY}/O={OTS_CA_ORGANIZATION}/OU={OTS_CA_ORGANIZATIONAL_UNIT}",
     )
+    # How many processes generate RSA keys when issuing many certificates at once
+    OTS_CA_KEYGEN_PROCESSES = int(os.getenv("OTS_CA_KEYGEN_PROCESSES", os.cpu_count() or 1))
 
     OTS_COT_PARSER_PROCESSES = int(os.getenv("OTS_COT_PARSER_PROCESSES", 1))
+    # Set above 0 to run cot_parser as a supervised pool of OTS_COT_PARSER_PROCESSES processes with this many threads
+    # each. Messages are sharded by event UID so updates to the same marker or EUD are parsed in order
+    OTS_COT_PARSER_THREADS = int(os.getenv("OTS_COT_PARSER_THREADS", 0))
+    # cot_parser saves up to this many messages in one database transaction before acking them.
+    # Should be no larger than OTS_RABBITMQ_PREFETCH
+    OTS_COT_PARSER_BATCH_SIZE = int(os.getenv("OTS_COT_PARSER_BATCH_SIZE", 200))
+    # Maximum time in milliseconds to wait for a batch to fill up before saving it
+    OTS_COT_PARSER_BATCH_WINDOW = int(os.getenv("OTS_COT_PARSER_BATCH_WINDOW", 50))
+    # Only store an EUD's position reports (PLI) when it moved or turned past these dead-bands, or at least every
+    # OTS_PLI_TIME_DEADBAND seconds. Works best with OTS_COT_PARSER_THREADS so each EUD is handled by one thread
+    OTS_PLI_COALESCING = os.getenv("OTS_PLI_COALESCING", "False").lower() in ["true", "1", "yes"]
+    OTS_PLI_DISTANCE_DEADBAND = float(os.getenv("OTS_PLI_DISTANCE_DEADBAND", 5))  # Meters
+    OTS_PLI_COURSE_DEADBAND = float(os.getenv("OTS_PLI_COURSE_DEADBAND", 15))  # Degrees
+    OTS_PLI_TIME_DEADBAND = float(os.getenv("OTS_PLI_TIME_DEADBAND", 30))  # Seconds
+    # Each group gets at most one PLI from an EUD per this many seconds, and the newest one it didn't get once they
+    # pass. Set per group in config.yml, i.e. {"Cyan": 5}
+    OTS_PLI_GROUP_INTERVAL = float(os.getenv("OTS_PLI_GROUP_INTERVAL", 1))
+    OTS_PLI_GROUP_INTERVALS = {}
+    OTS_PLI_MAX_TRACKED_UIDS = int(os.getenv("OTS_PLI_MAX_TRACKED_UIDS", 100000))
+    # How often in seconds cot_parser logs how many PLIs were stored, suppressed, forwarded and rate limited
+    OTS_PLI_STATS_INTERVAL = int(os.getenv("OTS_PLI_STATS_INTERVAL", 60))
 
     OTS_ENABLE_LDAP = False
     # LDAP users in this group will be considered OTS administrators
@@ -137,6 +185,10 @@ class DefaultConfig:
     OTS_AISHUB_IMO_LIST = ""
 
     OTS_PROFILE_MAP_SOURCES = True
+    # Track points within this many meters of the simplified line are dropped from KML exports with optimizeExport
+    OTS_KML_EXPORT_TOLERANCE = float(os.getenv("OTS_KML_EXPORT_TOLERANCE", 5))
+    # How many enrollment and connection profile zips to keep on disk for EUDs that ask for the same profile
+    OTS_PROFILE_CACHE_SIZE = int(os.getenv("OTS_PROFILE_CACHE_SIZE", 64))
 
     OTS_ENABLE_MUMBLE_AUTHENTICATION = False
 
@@ -173,6 +225,23 @@ class DefaultConfig:
     OTS_DELETE_OLD_DATA_HOURS = int(os.getenv("OTS_DELETE_OLD_DATA_HOURS", 0))
     OTS_DELETE_OLD_DATA_DAYS = int(os.getenv("OTS_DELETE_OLD_DATA_DAYS", 0))
     OTS_DELETE_OLD_DATA_WEEKS = int(os.getenv("OTS_DELETE_OLD_DATA_WEEKS", 1))
+    # How many rows delete_old_data deletes per transaction
+    OTS_DELETE_OLD_DATA_BATCH_SIZE = int(os.getenv("OTS_DELETE_OLD_DATA_BATCH_SIZE", 5000))
+    # Partition the cot and points tables by "day" or "week" on PostgreSQL so old data is deleted by dropping
+    # whole partitions. Takes effect when migrating the database or running "flask ots partition-tables"
+    OTS_PARTITION_INTERVAL = os.getenv("OTS_PARTITION_INTERVAL", None)
+    # How many partitions to create ahead of time
+    OTS_PARTITIONS_AHEAD = int(os.getenv("OTS_PARTITIONS_AHEAD", 7))
+    # How the XML of each CoT is stored in the cot table: "xml" (uncompressed), "zstd" (with a dictionary trained on
+    # stored CoTs and kept in the cot_dictionaries table), "zlib" or "protobuf" (TAK protocol, doesn't keep the exact
+    # formatting of the XML). CoTs stored before it was changed are re-encoded in the background
+    OTS_COT_STORAGE = os.getenv("OTS_COT_STORAGE", "xml")
+    OTS_COT_COMPRESSION_LEVEL = int(os.getenv("OTS_COT_COMPRESSION_LEVEL", 3))
+    # The zstd dictionary is trained on this many of the newest CoTs and is at most this many bytes
+    OTS_COT_DICTIONARY_SAMPLES = int(os.getenv("OTS_COT_DICTIONARY_SAMPLES", 2000))
+    OTS_COT_DICTIONARY_SIZE = int(os.getenv("OTS_COT_DICTIONARY_SIZE", 32 * 1024))
+    # How many CoTs stored before OTS_COT_STORAGE was set are re-encoded per transaction in the background
+    OTS_COT_MIGRATION_BATCH_SIZE = int(os.getenv("OTS_COT_MIGRATION_BATCH_SIZE", 1000))
 
     # flask-sqlalchemy
     SQLALCHEMY_DATABASE_URI = os.getenv(
@@ -190,6 +259,28 @@ class DefaultConfig:
     UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", os.path.join(OTS_DATA_FOLDER, "uploads"))
     if not os.path.exists(UPLOAD_FOLDER):
         os.makedirs(UPLOAD_FOLDER)
+    # Uploads are hashed and written to disk in chunks of this many bytes instead of being read into memory
+    OTS_UPLOAD_CHUNK_SIZE = int(os.getenv("OTS_UPLOAD_CHUNK_SIZE", 1024 * 1024))
+    # Uploads split across requests with Content-Range headers are deleted if they're not finished in this many hours
+    OTS_PARTIAL_UPLOAD_EXPIRATION_HOURS = int(os.getenv("OTS_PARTIAL_UPLOAD_EXPIRATION_HOURS", 24))
+    # Data packages and mission content are stored here by the SHA256 of their contents
+    OTS_BLOB_FOLDER = os.getenv("OTS_BLOB_FOLDER", os.path.join(OTS_DATA_FOLDER, "blobs"))
+    # How many hash to file lookups to keep in memory and for how many seconds
+    OTS_BLOB_INDEX_SIZE = int(os.getenv("OTS_BLOB_INDEX_SIZE", 4096))
+    OTS_BLOB_INDEX_TTL = int(os.getenv("OTS_BLOB_INDEX_TTL", 60))
+
+    # GET /Marti/api/missions returns mission summaries with counts instead of every uid, content and change.
+    # Clients can override this with ?summary=true or ?summary=false
+    OTS_MISSION_LIST_SUMMARY = os.getenv("OTS_MISSION_LIST_SUMMARY", "False").lower() in [
+        "true",
+        "1",
+        "yes",
+    ]
+    # How many missions' JSON to cache for GET /Marti/api/missions and for how many seconds
+    OTS_MISSION_CACHE_SIZE = int(os.getenv("OTS_MISSION_CACHE_SIZE", 1024))
+    OTS_MISSION_CACHE_TTL = int(os.getenv("OTS_MISSION_CACHE_TTL", 60))
+    # Set to an internal nginx location aliased to OTS_BLOB_FOLDER, i.e. /blobs/, to have nginx send the files
+    OTS_BLOB_ACCEL_REDIRECT = os.getenv("OTS_BLOB_ACCEL_REDIRECT", None)
 
     # Flask-Security-Too
     SECURITY_PASSWORD_SALT = os.getenv(
@@ -274,4 +365,16 @@ class DefaultConfig:
             "minutes": 1,
             "next_run_time": None,
         },
+        {
+            "id": "create_partitions",
+            "func": "opentakserver.blueprints.scheduled_jobs:create_partitions",
+            "trigger": "interval",
+            "hours": 1,
+        },
+        {
+            "id": "compress_cots",
+            "func": "opentakserver.blueprints.scheduled_jobs:compress_cots",
+            "trigger": "interval",
+            "minutes": 5,
+        },
     ]
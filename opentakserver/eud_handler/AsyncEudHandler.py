@@ -0,0 +1,155 @@
+import asyncio
+from socket import SHUT_RDWR
+
+from lxml import etree
+
+from opentakserver.eud_handler import TakProtocol
+from opentakserver.eud_handler.CoTFramer import CoTFramer, FrameTooLarge
+from opentakserver.eud_handler.EudHandler import EudHandler
+from opentakserver.eud_handler.RabbitMQGateway import GatewayChannel, run_on_loop
+from opentakserver.extensions import db
+from opentakserver.extensions import logger as ots_logger
+
+
+class StreamSocket:
+    """Exposes the parts of the socket API that EudHandler uses on top of an asyncio StreamWriter"""
+
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop, write_limit):
+        self.writer = writer
+        self.loop = loop
+        self.write_limit = write_limit
+
+    def send(self, data: bytes):
+        # Disconnect EUDs that can't keep up instead of buffering messages for them forever
+        if self.write_limit and self.writer.transport.get_write_buffer_size() > self.write_limit:
+            raise BufferError("Write buffer is full")
+
+        run_on_loop(self.loop, self.writer.write, data)
+        return len(data)
+
+    def shutdown(self, how=SHUT_RDWR):
+        run_on_loop(self.loop, self.writer.close)
+
+    def close(self):
+        run_on_loop(self.loop, self.writer.close)
+
+
+class AsyncEudHandler(EudHandler):
+    """Runs EudHandler's auth, ping/pong and device info logic on an asyncio stream.
+
+    All of the handlers in a worker process share one Flask app, one RabbitMQGateway, and one thread pool
+    for the blocking database work that happens while an EUD is authenticating and identifying itself.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server):
+        # Don't call BaseRequestHandler.__init__(), it runs setup(), handle() and finish() synchronously
+        self.reader = reader
+        self.writer = writer
+        self.server = server
+        self.loop = asyncio.get_running_loop()
+        self.logger = ots_logger
+        self.app = server.app_context
+        self.client_address = writer.get_extra_info("peername")
+        self.request = StreamSocket(
+            writer, self.loop, self.app.config.get("OTS_EUD_ASYNC_WRITE_BUFFER_LIMIT")
+        )
+        self.socket = self.request
+        self.is_ssl = server.ssl_context is not None
+        self.closed = False
+
+        # These are class attributes in EudHandler which would be shared by every connection in this process
+        self.cached_messages = []
+        self.bound_queues = []
+        self.group_memberships = []
+
+    async def run(self):
+        try:
+            await self.setup()
+            await self.handle()
+        except BaseException as e:
+            self.logger.error(f"{self.callsign or self.client_address[0]}: {e}")
+        finally:
+            self.close_connection()
+
+    async def setup(self):
+        self.server.gateway.open_channel(self)
+
+        if self.is_ssl:
+            peer_cert = self.writer.get_extra_info("peercert") or {}
+            for c in peer_cert.get("subject", ()):
+                if c[0][0] == "commonName":
+                    self.common_name = c[0][1]
+                    self.logger.debug("Got common name {}".format(self.common_name))
+                    await self.run_blocking(self.authenticate_common_name)
+
+    def authenticate_common_name(self):
+        with self.app.app_context():
+            self.user = self.app.security.datastore.find_user(username=self.common_name)
+            self.handle_auth()
+
+    async def run_blocking(self, function, *args):
+        return await self.loop.run_in_executor(self.server.executor, function, *args)
+
+    async def handle(self):
+        self.framer = CoTFramer(self.app.config.get("OTS_EUD_MAX_FRAME_SIZE"))
+        self.advertise_tak_protocol()
+
+        while not self.shutdown:
+            data = await self.reader.read(65536)
+            if not data:
+                self.logger.debug("no data")
+                break
+
+            disconnect = False
+            try:
+                frames = self.framer.feed(data)
+            except etree.XMLSyntaxError as e:
+                self.logger.error(f"Failed to parse: {e}")
+                frames = e.frames
+            except (FrameTooLarge, TakProtocol.TakProtocolError) as e:
+                self.logger.error(f"{self.callsign or self.client_address[0]}: {e}, disconnecting")
+                # The messages before the bad one are still handled
+                frames = e.frames
+                disconnect = True
+
+            for frame in frames:
+                if isinstance(frame, bytes):
+                    handler = self.handle_takproto
+                elif frame.tag == "auth":
+                    handler = self.handle_auth
+                else:
+                    handler = self.handle_cot
+
+                if handler == self.handle_auth or not self.uid:
+                    # Until the EUD has been identified handle_cot() queries the DB
+                    await self.run_blocking(handler, frame)
+                else:
+                    handler(frame)
+
+            if disconnect:
+                break
+
+    def release_database(self):
+        # The engine is shared with every other EUD in this process so don't dispose of it
+        with self.app.app_context():
+            db.session.remove()
+
+    def on_channel_open(self, channel: GatewayChannel):
+        if self.closed:
+            channel.close()
+            return
+
+        super().on_channel_open(channel)
+
+    def on_channel_close(self, channel: GatewayChannel, error):
+        # Unlike EudHandler, don't close the RabbitMQ connection since it's shared with the other EUDs
+        self.logger.error(f"RabbitMQ channel closed for {self.callsign}, shut it down")
+        self.shutdown = True
+        self.request.close()
+
+    def close_connection(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        super().close_connection()
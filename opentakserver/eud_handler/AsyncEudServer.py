@@ -0,0 +1,113 @@
+import asyncio
+import os
+import socket
+import ssl
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from opentakserver.eud_handler.RabbitMQGateway import RabbitMQGateway
+from opentakserver.extensions import db
+
+
+class AsyncEudServer:
+    """Streaming server that multiplexes EUD connections on one asyncio event loop per worker process.
+
+    The listening socket is bound once and shared by every worker, so the kernel spreads new connections
+    across them. Each worker shares one RabbitMQGateway between all of its EUDs.
+    """
+
+    def __init__(self, server_address, eud_handler, logger, app_context, ssl_context=None):
+        self.server_address = server_address
+        self.eud_handler = eud_handler
+        self.logger = logger
+        self.app_context = app_context
+        self.ssl_context: ssl.SSLContext | None = ssl_context
+
+        self.workers = app_context.config.get("OTS_EUD_ASYNC_WORKERS") or os.cpu_count() or 1
+        self.child_processes = []
+
+        self.socket: socket.socket | None = None
+        self.executor: ThreadPoolExecutor | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.gateway = RabbitMQGateway(app_context, logger)
+
+    def server_bind(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.server_address)
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(False)
+        self.server_address = self.socket.getsockname()
+        self.logger.debug(f"listening on {self.server_address}")
+
+    def serve_forever(self):
+        self.server_bind()
+
+        if self.workers == 1:
+            self.run_worker()
+            return
+
+        for i in range(self.workers):
+            self.start_worker()
+
+        # Replace workers that crash so their share of the connections can be accepted again
+        while self.child_processes:
+            pid, status = os.wait()
+            if pid in self.child_processes:
+                self.child_processes.remove(pid)
+                self.logger.error(
+                    f"EUD handler worker {pid} exited with status {status}, restarting"
+                )
+                self.start_worker()
+
+    def start_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.run_worker()
+            finally:
+                os._exit(0)
+        else:
+            self.child_processes.append(pid)
+
+    def run_worker(self):
+        # Connections in the DB pool were opened by the parent process and can't be shared with the workers
+        with self.app_context.app_context():
+            db.engine.dispose(close=False)
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.app_context.config.get("OTS_EUD_ASYNC_DB_THREADS"),
+            thread_name_prefix="eud_handler_db",
+        )
+
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.gateway.connect(self.loop)
+
+        server = await asyncio.start_server(
+            self.handle_connection,
+            sock=self.socket,
+            ssl=self.ssl_context,
+            ssl_handshake_timeout=10 if self.ssl_context else None,
+        )
+        self.logger.info(f"EUD handler worker {os.getpid()} accepting connections")
+
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.logger.debug(f"processing request from {writer.get_extra_info('peername')}")
+        try:
+            await self.eud_handler(reader, writer, self).run()
+        except BaseException as e:
+            self.logger.error(f"EUD handler error: {e}")
+            self.logger.debug(traceback.format_exc())
+        finally:
+            writer.close()
@@ -0,0 +1,121 @@
+from lxml import etree
+
+
+class FrameTooLarge(ValueError):
+    def __init__(self, message: str, frames: list | None = None):
+        super().__init__(message)
+        # The messages that were completed before the one that's too large
+        self.frames = frames or []
+
+
+class CoTFramer:
+    """Incrementally splits a TCP stream into <event> and <auth> elements.
+
+    EUDs send a stream of XML documents, each usually with its own XML declaration. The declarations are
+    removed and everything else is fed into a single pull parser inside a synthetic root element, so each
+    byte is only parsed once no matter how the messages are split across recv() calls.
+    """
+
+    FRAME_TAGS = ("event", "auth")
+
+    def __init__(self, max_frame_size: int = 4 * 1024 * 1024):
+        self.max_frame_size = max_frame_size
+        self.parser: etree.XMLPullParser | None = None
+        self.pending = b""
+        self.frame_size = 0
+        self.resync = False
+        self.reset()
+
+    def reset(self):
+        self.parser = etree.XMLPullParser(
+            events=("end",), resolve_entities=False, no_network=True, huge_tree=False
+        )
+        self.parser.feed(b"<stream>")
+        self.frame_size = 0
+
+    def feed(self, data: bytes) -> list:
+        """Returns the <event> and <auth> elements completed by this chunk of data.
+
+        Raises etree.XMLSyntaxError if the stream is malformed and FrameTooLarge if a message is bigger than
+        max_frame_size. The framer discards data until the start of the next message after either error. The
+        messages completed by this chunk before the error are in the exception's frames attribute.
+        """
+        data = self.strip_declarations(data)
+
+        if self.resync:
+            start = min(
+                (i for i in (data.find(b"<event"), data.find(b"<auth")) if i != -1), default=-1
+            )
+            if start == -1:
+                return []
+            data = data[start:]
+            self.resync = False
+
+        try:
+            self.parser.feed(data)
+        except etree.XMLSyntaxError as e:
+            # The parser still has the events from before the malformed XML
+            e.frames = self.read_frames()[0]
+            self.discard()
+            raise
+        frames, completed = self.read_frames()
+
+        # Count the bytes received since the last complete message
+        if completed:
+            self.frame_size = 0
+        else:
+            self.frame_size += len(data)
+        if self.frame_size + len(self.pending) > self.max_frame_size:
+            self.discard()
+            raise FrameTooLarge(f"Message is larger than {self.max_frame_size} bytes", frames)
+
+        return frames
+
+    def read_frames(self) -> tuple[list, bool]:
+        frames = []
+        completed = False
+        for action, element in self.parser.read_events():
+            parent = element.getparent()
+            if parent is None or parent.getparent() is not None:
+                # Not a direct child of the synthetic root
+                continue
+
+            parent.remove(element)
+            element.tail = None
+            completed = True
+            if element.tag in self.FRAME_TAGS:
+                frames.append(element)
+
+        return frames, completed
+
+    def discard(self):
+        self.pending = b""
+        self.resync = True
+        self.reset()
+
+    def strip_declarations(self, data: bytes) -> bytes:
+        # XML declarations and processing instructions aren't allowed in the middle of a document
+        data = self.pending + data
+        self.pending = b""
+        output = bytearray()
+        position = 0
+
+        while True:
+            start = data.find(b"<?", position)
+            if start == -1:
+                # A declaration might start at the end of this chunk
+                if data.endswith(b"<"):
+                    output += data[position:-1]
+                    self.pending = b"<"
+                else:
+                    output += data[position:]
+                break
+
+            output += data[position:start]
+            end = data.find(b"?>", start)
+            if end == -1:
+                self.pending = data[start:]
+                break
+            position = end + 2
+
+        return bytes(output)
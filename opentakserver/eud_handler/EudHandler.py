@@ -5,7 +5,6 @@ import logging
 import os
 import platform
 import random
-import re
 import socketserver
 import sys
 import traceback
@@ -13,7 +12,7 @@ import uuid
 from logging.handlers import TimedRotatingFileHandler
 from socket import socket, SHUT_RDWR
 from threading import Thread
-from xml.etree.ElementTree import Element, SubElement, tostring, fromstring, ParseError
+from xml.etree.ElementTree import Element, SubElement
 
 import bleach
 import colorlog
@@ -21,19 +20,23 @@ import flask_wtf
 import pika
 import sqlalchemy
 import yaml
-from bs4 import BeautifulSoup
 from flask import Flask
 from flask_ldap3_login import AuthenticationResponseStatus
 from flask_security import SQLAlchemyUserDatastore, Security, verify_password
 from flask_security.models import fsqla
+from google.protobuf.message import DecodeError
+from lxml import etree
 from pika.channel import Channel
 from sqlalchemy import insert, update, select
 
 from opentakserver.EmailValidator import EmailValidator
 from opentakserver.PasswordValidator import PasswordValidator
 from opentakserver.defaultconfig import DefaultConfig
+from opentakserver.eud_handler import TakProtocol
+from opentakserver.eud_handler.CoTFramer import CoTFramer, FrameTooLarge
 from opentakserver.extensions import logger as ots_logger, db, ldap_manager
 from opentakserver.functions import iso8601_string_from_datetime, datetime_from_iso8601_string
+from opentakserver.map_state import save_map_state
 
 # These unused imports are required by SQLAlchemy, don't remove them
 from opentakserver.models.Alert import Alert
@@ -86,6 +89,8 @@ class EudHandler(socketserver.BaseRequestHandler):
     bound_queues = []
     phone_number = None
     group_memberships = []
+    framer = None
+    tak_protocol_version = 0
 
     def __init__(self, request: socket, client_address, server):
         super().__init__(request, client_address, server)
@@ -93,7 +98,8 @@ class EudHandler(socketserver.BaseRequestHandler):
         self.socket: socket = request
 
     def handle(self):
-        cot = ""
+        self.framer = CoTFramer(self.app.config.get("OTS_EUD_MAX_FRAME_SIZE"))
+        self.advertise_tak_protocol()
 
         while not self.shutdown:
             try:
@@ -105,31 +111,77 @@ class EudHandler(socketserver.BaseRequestHandler):
                 self.logger.debug("no data")
                 break
 
-            cot += data.decode("utf-8")
-            cot_list = re.split("</event>|</auth>", cot)
-
-            if len(cot_list) < 2:
-                continue
+            disconnect = False
+            try:
+                frames = self.framer.feed(data)
+            except etree.XMLSyntaxError as e:
+                self.logger.error(f"Failed to parse: {e}")
+                frames = e.frames
+            except (FrameTooLarge, TakProtocol.TakProtocolError) as e:
+                self.logger.error(f"{self.callsign or self.client_address[0]}: {e}, disconnecting")
+                # The messages before the bad one are still handled
+                frames = e.frames
+                disconnect = True
+
+            for frame in frames:
+                if isinstance(frame, bytes):
+                    self.handle_takproto(frame)
+                elif frame.tag == "auth":
+                    self.handle_auth(frame)
+                else:
+                    self.handle_cot(frame)
 
-            for c in cot_list:
-                try:
-                    if "<event" in c:
-                        fromstring(c + "</event>")
-                        self.handle_cot(c + "</event>")
-                    elif "<auth>" in c:
-                        fromstring(c + "</auth>")
-                        self.handle_auth(c + "</auth>")
-                except ParseError as e:
-                    self.logger.error(f"Failed to parse: {e}")
-                    cot = c
-                    break
-
-            cot = ""
+            if disconnect:
+                break
 
         self.close_connection()
 
-    def pong(self, event):
-        if event.attrs.get("type") == "t-x-c-t":
+    def advertise_tak_protocol(self):
+        if not self.app.config.get("OTS_ENABLE_TAK_PROTOCOL"):
+            return
+
+        try:
+            self.send_event(TakProtocol.protocol_support_event())
+        except BaseException as e:
+            self.logger.error(f"Failed to send TAK protocol support: {e}")
+
+    def negotiate_tak_protocol(self, event: etree._Element) -> bool:
+        if event.get("type") != "t-x-takp-q":
+            return False
+
+        version = TakProtocol.requested_version(event)
+        accepted = bool(self.app.config.get("OTS_ENABLE_TAK_PROTOCOL")) and (
+            version == TakProtocol.VERSION
+        )
+
+        try:
+            self.send_event(TakProtocol.protocol_response_event(accepted))
+        except BaseException as e:
+            self.logger.error(f"Failed to send TAK protocol response: {e}")
+            return True
+
+        # Both sides switch to protobuf right after the response
+        if accepted:
+            self.tak_protocol_version = version
+            self.framer = TakProtocol.TakProtocolFramer(
+                self.app.config.get("OTS_EUD_MAX_FRAME_SIZE")
+            )
+            self.logger.info(
+                f"{self.callsign or self.client_address[0]} is using TAK protocol version {version}"
+            )
+
+        return True
+
+    def send_event(self, event: etree._Element, takproto: bytes | None = None):
+        if self.tak_protocol_version:
+            if takproto is None:
+                takproto = TakProtocol.xml_to_proto(event).SerializeToString()
+            self.request.send(TakProtocol.frame(takproto))
+        else:
+            self.request.send(etree.tostring(event))
+
+    def pong(self, event: etree._Element, takproto: bytes | None = None):
+        if event.get("type") == "t-x-c-t":
             now = datetime.datetime.now(datetime.timezone.utc)
             stale = now + datetime.timedelta(seconds=10)
 
@@ -139,7 +191,7 @@ class EudHandler(socketserver.BaseRequestHandler):
                     "how": "h-g-i-g-o",
                     "type": "t-x-c-t-r",
                     "version": "2.0",
-                    "uid": "{}-pong".format(event.attrs.get("uid")),
+                    "uid": "{}-pong".format(event.get("uid")),
                     "start": iso8601_string_from_datetime(now),
                     "time": iso8601_string_from_datetime(now),
                     "stale": iso8601_string_from_datetime(stale),
@@ -150,7 +202,7 @@ class EudHandler(socketserver.BaseRequestHandler):
             )
 
             try:
-                self.request.send(event.encode())
+                self.send_event(event, takproto)
                 return True
             except BaseException as e:
                 self.logger.error(f"Pong error: {e}")
@@ -190,19 +242,20 @@ class EudHandler(socketserver.BaseRequestHandler):
     def close_connection(self):
         self.logger.info("{} disconnected".format(self.client_address[0]))
 
-        self.rabbit_channel.basic_publish(
-            exchange="cot_parser",
-            body=json.dumps(
-                {
-                    "uid": self.uid,
-                    "cot": None,
-                    "disconnected": True,
-                    "user_id": self.user.id if self.user else None,
-                }
-            ),
-            routing_key="cot_parser",
-            properties=pika.BasicProperties(expiration=self.app.config.get("OTS_RABBITMQ_TTL")),
-        )
+        if self.rabbit_channel and self.rabbit_channel.is_open:
+            self.rabbit_channel.basic_publish(
+                exchange="cot_parser",
+                body=json.dumps(
+                    {
+                        "uid": self.uid,
+                        "cot": None,
+                        "disconnected": True,
+                        "user_id": self.user.id if self.user else None,
+                    }
+                ),
+                routing_key="cot_parser",
+                properties=pika.BasicProperties(expiration=self.app.config.get("OTS_RABBITMQ_TTL")),
+            )
 
         self.unbind_rabbitmq_queues()
 
@@ -283,8 +336,8 @@ class EudHandler(socketserver.BaseRequestHandler):
             "flask-socketio", durable=False, exchange_type="fanout"
         )
 
-        for message in self.cached_messages:
-            self.publish_cot(message)
+        for event, takproto in self.cached_messages:
+            self.publish_cot(event, takproto)
 
         self.cached_messages.clear()
 
@@ -329,26 +382,39 @@ class EudHandler(socketserver.BaseRequestHandler):
     def on_message(self, unused_channel, basic_deliver, properties, body):
         try:
             body = json.loads(body)
-            if body["uid"] != self.uid:
-                self.request.send(body["cot"].encode())
+            if body["uid"] == self.uid:
+                return
+
+            if not self.tak_protocol_version:
+                data = body["cot"].encode()
+            elif body.get("takproto"):
+                # The CoT was sent to OTS as protobuf so it can be forwarded without converting it
+                data = TakProtocol.frame(base64.b64decode(body["takproto"]))
+            else:
+                event = etree.fromstring(body["cot"].encode(), TakProtocol.xml_parser)
+                data = TakProtocol.frame(TakProtocol.xml_to_proto(event).SerializeToString())
+        except (ValueError, TypeError, KeyError, etree.XMLSyntaxError) as e:
+            # Only this message is bad, i.e. a CoT with a time that can't be converted to protobuf
+            self.logger.error(f"{self.callsign}: Dropping a message that can't be sent: {e}")
+            return
+
+        try:
+            self.request.send(data)
         except BaseException as e:
             self.logger.error(f"{self.callsign}: {e}, closing socket")
             self.close_connection()
             self.logger.error(traceback.format_exc())
 
-    def handle_auth(self, auth: str):
-        self.logger.debug(auth)
-        if auth:
-            auth = BeautifulSoup(auth, "xml")
-        if self.is_ssl and not self.is_authenticated and (auth or self.common_name):
+    def handle_auth(self, auth: etree._Element | None = None):
+        if self.is_ssl and not self.is_authenticated and (auth is not None or self.common_name):
             user = None
             with self.app.app_context():
-                if auth:
+                if auth is not None:
                     cot = auth.find("cot")
-                    if cot:
-                        username = cot.attrs["username"]
-                        password = cot.attrs["password"]
-                        uid = cot.attrs["uid"]
+                    if cot is not None:
+                        username = cot.get("username")
+                        password = cot.get("password")
+                        uid = cot.get("uid")
 
                         if self.app.config.get("OTS_ENABLE_LDAP"):
                             result = ldap_manager.authenticate(username, password)
@@ -386,6 +452,9 @@ class EudHandler(socketserver.BaseRequestHandler):
                                     db.session.add(eud)
                                     db.session.commit()
 
+                                # The user is used after this app context's session is gone
+                                db.session.refresh(self.user)
+
                             else:
                                 self.close_connection()
                                 return
@@ -428,14 +497,32 @@ class EudHandler(socketserver.BaseRequestHandler):
                         db.session.add(eud)
                         db.session.commit()
 
+                    # The user is used after this app context's session is gone
+                    db.session.refresh(user)
+
                 else:
                     self.logger.warning("Wrong password for user {}".format(username))
                     self.close_connection()
                     return
 
-    def handle_cot(self, cot):
-        self.logger.debug(cot)
-        event = BeautifulSoup(cot, "xml").find("event")
+    def handle_takproto(self, takproto: bytes):
+        try:
+            message = TakProtocol.TakMessage()
+            message.ParseFromString(takproto)
+            if not message.HasField("cotEvent"):
+                return
+
+            # XML is still needed to store the CoT and for the firehose exchange
+            event = TakProtocol.proto_to_xml(message.cotEvent)
+        except (DecodeError, etree.XMLSyntaxError) as e:
+            self.logger.error(f"Failed to parse TAK protocol message: {e}")
+            return
+
+        self.handle_cot(event, takproto)
+
+    def handle_cot(self, event: etree._Element, takproto: bytes | None = None):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(etree.tostring(event, encoding="unicode"))
 
         # If this client is connected via ssl, make sure they're authenticated
         # before accepting any data from them
@@ -443,31 +530,42 @@ class EudHandler(socketserver.BaseRequestHandler):
             self.logger.warning("EUD isn't authenticated, ignoring")
             return
 
-        if self.pong(event):
+        if self.negotiate_tak_protocol(event):
+            return
+
+        if self.pong(event, takproto):
             return
 
-        if event and not self.uid:
+        if not self.uid:
             self.parse_device_info(event)
-            # Close the DB connection once the EUD is authenticated and identified
-            with self.app.app_context():
-                db.session.close()
-                db.engine.dispose()
+            self.release_database()
+
+        self.publish_cot(event, takproto)
 
-        self.publish_cot(event)
+    def release_database(self):
+        # Close the DB connection once the EUD is authenticated and identified
+        with self.app.app_context():
+            db.session.close()
+            db.engine.dispose()
 
-    def publish_cot(self, event):
-        if not event:
+    def publish_cot(self, event: etree._Element, takproto: bytes | None = None):
+        if event is None:
             return
 
         if not self.rabbit_channel or not self.rabbit_channel.is_open:
-            self.cached_messages.append(event)
+            self.cached_messages.append((event, takproto))
             self.logger.error("RabbitMQ channel is closed, not publishing cot")
             return
 
+        message = {"uid": self.uid, "cot": etree.tostring(event, encoding="unicode")}
+        if takproto:
+            # Lets cot_parser and the EUD handlers forward the CoT to protobuf clients without converting it
+            message["takproto"] = base64.b64encode(takproto).decode("ascii")
+
         # Route all CoTs to the firehose exchange for plugins and users that connect directly to RabbitMQ
         self.rabbit_channel.basic_publish(
             exchange="firehose",
-            body=json.dumps({"uid": self.uid, "cot": str(event)}),
+            body=json.dumps(message),
             routing_key="",
             properties=pika.BasicProperties(expiration=self.app.config.get("OTS_RABBITMQ_TTL")),
         )
@@ -475,40 +573,38 @@ class EudHandler(socketserver.BaseRequestHandler):
         # Route all cots to the cot_parser direct exchange to be processed by a pool of cot_parser processes
         self.rabbit_channel.basic_publish(
             exchange="cot_parser",
-            body=json.dumps(
-                {"uid": self.uid, "cot": str(event), "user_id": self.user.id if self.user else None}
-            ),
+            body=json.dumps({**message, "user_id": self.user.id if self.user else None}),
             routing_key="cot_parser",
             properties=pika.BasicProperties(expiration=self.app.config.get("OTS_RABBITMQ_TTL")),
         )
 
-    def parse_device_info(self, event):
-        link = event.find("link")
-        fileshare = event.find("fileshare")
-
+    def parse_device_info(self, event: etree._Element):
         # EUDs running the Meshtastic and dmrcot plugins can relay messages from their RF networks to the server
         # so we want to use the UID of the "off grid" EUD, not the relay EUD
-        contact = event.find("contact")
-        takv = event.find("takv")
-        if takv or contact:
-            uid = event.attrs.get("uid")
+        contact = event.find(".//contact")
+        takv = event.find(".//takv")
+        if takv is not None or contact is not None:
+            uid = event.get("uid")
         else:
             return
 
-        contact = event.find("contact")
-
         # Only assume it's an EUD if it's got a <contact> tag
-        if contact and uid and not uid.endswith("ping") and (self.user or not self.is_ssl):
+        if (
+            contact is not None
+            and uid
+            and not uid.endswith("ping")
+            and (self.user or not self.is_ssl)
+        ):
             self.uid = uid
             device = operating_system = platform = version = None
-            if takv:
-                device = takv.attrs["device"] if "device" in takv.attrs else None
-                operating_system = takv.attrs["os"] if "os" in takv.attrs else None
-                platform = takv.attrs["platform"] if "platform" in takv.attrs else None
-                version = takv.attrs["version"] if "version" in takv.attrs else None
+            if takv is not None:
+                device = takv.get("device")
+                operating_system = takv.get("os")
+                platform = takv.get("platform")
+                version = takv.get("version")
 
-            if "callsign" in contact.attrs:
-                self.callsign = contact.attrs["callsign"]
+            if "callsign" in contact.attrib:
+                self.callsign = contact.get("callsign")
 
                 # Declare a RabbitMQ Queue for this uid and join the 'dms' and 'cot' exchanges
                 if (
@@ -643,15 +739,15 @@ class EudHandler(socketserver.BaseRequestHandler):
                             queue=self.uid, on_message_callback=self.on_message, auto_ack=True
                         )
 
-            if "phone" in contact.attrs and contact.attrs["phone"]:
-                self.phone_number = contact.attrs["phone"]
+            if contact.get("phone"):
+                self.phone_number = contact.get("phone")
 
             with self.app.app_context():
-                __group = event.find("__group")
+                __group = event.find(".//__group")
                 team = Team()
 
-                if __group:
-                    team.name = bleach.clean(__group.attrs["name"])
+                if __group is not None:
+                    team.name = bleach.clean(__group.get("name"))
 
                     try:
                         chatroom = db.session.execute(
@@ -667,7 +763,7 @@ class EudHandler(socketserver.BaseRequestHandler):
                     except sqlalchemy.exc.IntegrityError:
                         db.session.rollback()
                         team = db.session.execute(
-                            select(Team).filter(Team.name == __group.attrs["name"])
+                            select(Team).filter(Team.name == __group.get("name"))
                         ).first()[0]
                         if not team.chatroom_id and chatroom:
                             team.chatroom_id = chatroom.id
@@ -692,7 +788,7 @@ class EudHandler(socketserver.BaseRequestHandler):
                 eud.platform = platform
                 eud.version = version
                 eud.phone_number = self.phone_number
-                eud.last_event_time = datetime_from_iso8601_string(event.attrs["start"])
+                eud.last_event_time = datetime_from_iso8601_string(event.get("start"))
                 eud.last_status = "Connected"
                 eud.user_id = self.user.id if self.user else None
 
@@ -704,7 +800,7 @@ class EudHandler(socketserver.BaseRequestHandler):
                     eud.meshtastic_id = int(meshtastic_id, 16)
                 elif not eud.meshtastic_id and eud.platform == "Meshtastic":
                     try:
-                        eud.meshtastic_id = int(takv.attrs["meshtastic_id"], 16)
+                        eud.meshtastic_id = int(takv.get("meshtastic_id"), 16)
                     except:
                         meshtastic_id = "{:x}".format(int.from_bytes(os.urandom(4), "big"))
                         while len(meshtastic_id) < 8:
@@ -712,14 +808,14 @@ class EudHandler(socketserver.BaseRequestHandler):
                         eud.meshtastic_id = int(meshtastic_id, 16)
 
                 # Get the Meshtastic device's mac address or generate a random one for TAK EUDs
-                if takv and "macaddr" in takv.attrs:
-                    eud.meshtastic_macaddr = takv.attrs["macaddr"]
+                if takv is not None and "macaddr" in takv.attrib:
+                    eud.meshtastic_macaddr = takv.get("macaddr")
                 else:
                     eud.meshtastic_macaddr = base64.b64encode(os.urandom(6)).decode("ascii")
 
-                if __group:
+                if __group is not None:
                     eud.team_id = team.id
-                    eud.team_role = bleach.clean(__group.attrs["role"])
+                    eud.team_role = bleach.clean(__group.get("role"))
 
                 try:
                     db.session.add(eud)
@@ -731,6 +827,10 @@ class EudHandler(socketserver.BaseRequestHandler):
                     )
                     db.session.commit()
 
+                eud_json = eud.to_json()
+                save_map_state("euds", eud.uid, eud_json)
+                db.session.commit()
+
                 # If the RabbitMQ channel is open, publish the EUD info to socketio to be displayed on the web UI map.
                 # Also save the EUD's info for on_channel_open to publish
                 self.eud = eud
@@ -738,7 +838,7 @@ class EudHandler(socketserver.BaseRequestHandler):
                     message = {
                         "method": "emit",
                         "event": "eud",
-                        "data": eud.to_json(),
+                        "data": eud_json,
                         "namespace": "/socket.io",
                         "room": None,
                         "skip_sid": None,
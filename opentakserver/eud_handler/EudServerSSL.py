@@ -6,6 +6,29 @@ import ssl
 from opentakserver.eud_handler.EudServer import EudServer
 
 
+def create_ssl_context(app) -> ssl.SSLContext:
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.verify_mode = ssl.CERT_REQUIRED
+    ssl_context.load_cert_chain(
+        os.path.join(
+            app.config.get("OTS_CA_FOLDER"),
+            "certs",
+            "opentakserver",
+            "opentakserver.pem",
+        ),
+        os.path.join(
+            app.config.get("OTS_CA_FOLDER"),
+            "certs",
+            "opentakserver",
+            "opentakserver.nopass.key",
+        ),
+    )
+    ssl_context.load_verify_locations(
+        cafile=os.path.join(app.config.get("OTS_CA_FOLDER"), "ca.pem")
+    )
+    return ssl_context
+
+
 class EudServerSSL(EudServer):
     allow_reuse_address = True
     daemon_threads = True
@@ -16,25 +39,7 @@ class EudServerSSL(EudServer):
     def server_bind(self):
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        ssl_context.verify_mode = ssl.CERT_REQUIRED
-        ssl_context.load_cert_chain(
-            os.path.join(
-                self.app_context.config.get("OTS_CA_FOLDER"),
-                "certs",
-                "opentakserver",
-                "opentakserver.pem",
-            ),
-            os.path.join(
-                self.app_context.config.get("OTS_CA_FOLDER"),
-                "certs",
-                "opentakserver",
-                "opentakserver.nopass.key",
-            ),
-        )
-        ssl_context.load_verify_locations(
-            cafile=os.path.join(self.app_context.config.get("OTS_CA_FOLDER"), "ca.pem")
-        )
+        ssl_context = create_ssl_context(self.app_context)
         self.socket = ssl_context.wrap_socket(
             self.socket, server_side=True, do_handshake_on_connect=False
         )
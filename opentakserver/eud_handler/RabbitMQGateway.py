@@ -0,0 +1,424 @@
+import asyncio
+import functools
+from collections import deque
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.channel import Channel
+
+
+def run_on_loop(loop: asyncio.AbstractEventLoop, function, *args, **kwargs):
+    # Blocking work like authentication and DB queries runs in the worker's thread pool, but pika and asyncio
+    # transports are not thread safe so calls from those threads are scheduled on the event loop instead
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+
+    if running_loop is loop:
+        return function(*args, **kwargs)
+
+    loop.call_soon_threadsafe(functools.partial(function, *args, **kwargs))
+
+
+class RabbitMQGateway:
+    """One RabbitMQ connection shared by every EUD in an eud_handler worker.
+
+    Outgoing messages are batched onto a single publisher channel in confirm mode. Every EUD's queue is consumed
+    on a single consumer channel and deliveries are dispatched to the right EUD by consumer tag.
+    """
+
+    def __init__(self, app, logger):
+        self.app = app
+        self.logger = logger
+        self.loop: asyncio.AbstractEventLoop | None = None
+
+        self.rabbit_connection: AsyncioConnection | None = None
+        self.publish_channel: Channel | None = None
+        self.consume_channel: Channel | None = None
+
+        self.batch_size = app.config.get("OTS_EUD_PUBLISH_BATCH_SIZE")
+        self.batch_interval = app.config.get("OTS_EUD_PUBLISH_BATCH_MS") / 1000
+        self.max_unconfirmed = app.config.get("OTS_EUD_PUBLISH_MAX_UNCONFIRMED")
+        self.buffer_size = app.config.get("OTS_EUD_PUBLISH_BUFFER")
+        self.outgoing = deque()
+        # How many messages were dropped because the buffer was full
+        self.dropped = 0
+        self.flush_handle: asyncio.TimerHandle | None = None
+
+        # Delivery tag -> (exchange, routing key, body, properties, attempts) for messages RabbitMQ hasn't confirmed
+        self.unconfirmed = {}
+        self.delivery_tag = 0
+
+        # Consumer tag -> on_message callback of the EUD that owns the queue
+        self.consumers = {}
+        self.pending_channels = []
+        self.channels = set()
+
+    @property
+    def is_open(self) -> bool:
+        return bool(
+            self.publish_channel
+            and self.publish_channel.is_open
+            and self.consume_channel
+            and self.consume_channel.is_open
+        )
+
+    def connect(self, loop: asyncio.AbstractEventLoop = None):
+        if loop:
+            self.loop = loop
+
+        rabbit_credentials = pika.PlainCredentials(
+            self.app.config.get("OTS_RABBITMQ_USERNAME"),
+            self.app.config.get("OTS_RABBITMQ_PASSWORD"),
+        )
+        rabbit_host = self.app.config.get("OTS_RABBITMQ_SERVER_ADDRESS")
+        self.rabbit_connection = AsyncioConnection(
+            pika.ConnectionParameters(host=rabbit_host, credentials=rabbit_credentials),
+            on_open_callback=self.on_connection_open,
+            on_open_error_callback=self.on_connection_error,
+            on_close_callback=self.on_connection_close,
+            custom_ioloop=self.loop,
+        )
+
+    def on_connection_open(self, connection: AsyncioConnection):
+        self.logger.debug("Connected to RabbitMQ")
+        connection.channel(on_open_callback=self.on_publish_channel_open)
+        connection.channel(on_open_callback=self.on_consume_channel_open)
+
+    def on_connection_error(self, connection: AsyncioConnection, error):
+        self.logger.error(f"Failed to connect to RabbitMQ: {error}, retrying in 5 seconds")
+        self.loop.call_later(5, self.connect)
+
+    def on_connection_close(self, connection: AsyncioConnection, error):
+        # Every EUD's queue was being consumed on this connection, so disconnect them. They'll reconnect
+        # and subscribe again once the new connection is open
+        self.logger.error(f"RabbitMQ connection closed: {error}, reconnecting in 5 seconds")
+        self.publish_channel = None
+        self.consume_channel = None
+        self.consumers.clear()
+
+        # Messages that were never confirmed are published again on the new connection
+        self.outgoing.extendleft(reversed(list(self.unconfirmed.values())))
+        self.unconfirmed.clear()
+        self.drop_oldest()
+
+        for channel in list(self.channels):
+            channel.on_close(error)
+
+        self.loop.call_later(5, self.connect)
+
+    def on_publish_channel_open(self, channel: Channel):
+        self.publish_channel = channel
+        channel.add_on_close_callback(self.on_publish_channel_close)
+        channel.exchange_declare("flask-socketio", durable=False, exchange_type="fanout")
+        channel.confirm_delivery(ack_nack_callback=self.on_delivery_confirmation)
+        self.delivery_tag = 0
+        self.on_channels_open()
+
+    def on_consume_channel_open(self, channel: Channel):
+        self.consume_channel = channel
+        channel.add_on_close_callback(self.on_consume_channel_close)
+
+        # Subscribe the EUDs again if this channel replaced one that RabbitMQ closed
+        for gateway_channel in list(self.channels):
+            gateway_channel.reattach()
+
+        self.on_channels_open()
+
+    def channel_closed_by_broker(self, channel: Channel) -> bool:
+        # The channels also close when the connection does, which on_connection_close() handles
+        connection = self.rabbit_connection
+        return bool(connection and connection.is_open and channel.connection is connection)
+
+    def on_publish_channel_close(self, channel: Channel, error):
+        if channel is not self.publish_channel or not self.channel_closed_by_broker(channel):
+            return
+
+        self.publish_channel = None
+
+        # Publish the unconfirmed messages again on the new channel, unless they already were. A message to an
+        # exchange that doesn't exist closes the channel every time
+        for exchange, routing_key, body, properties, attempts in reversed(
+            list(self.unconfirmed.values())
+        ):
+            if attempts < 1:
+                self.outgoing.appendleft((exchange, routing_key, body, properties, attempts + 1))
+            else:
+                self.logger.error(f"Dropping a message to {exchange} {routing_key}")
+        self.unconfirmed.clear()
+        self.drop_oldest()
+
+        self.reopen_channel(self.on_publish_channel_open, error)
+
+    def on_consume_channel_close(self, channel: Channel, error):
+        if channel is not self.consume_channel or not self.channel_closed_by_broker(channel):
+            return
+
+        # The EUDs' queues outlive the channel but their consumers don't
+        self.consume_channel = None
+        self.consumers.clear()
+        for gateway_channel in self.channels:
+            gateway_channel.consumer_tags.clear()
+
+        self.reopen_channel(self.on_consume_channel_open, error)
+
+    def reopen_channel(self, on_open_callback, error):
+        connection = self.rabbit_connection
+        self.logger.error(f"RabbitMQ channel closed: {error}, reopening it in 5 seconds")
+
+        def reopen():
+            if connection is self.rabbit_connection and connection.is_open:
+                connection.channel(on_open_callback=on_open_callback)
+
+        self.loop.call_later(5, reopen)
+
+    def queue_channel(self) -> Channel | None:
+        """The consumer channel, or None while it's being reopened"""
+        if self.consume_channel and self.consume_channel.is_open:
+            return self.consume_channel
+        return None
+
+    def on_channels_open(self):
+        if not self.is_open:
+            return
+
+        self.flush()
+
+        for handler in self.pending_channels:
+            self.open_channel(handler)
+        self.pending_channels.clear()
+
+    def open_channel(self, handler):
+        """Calls handler.on_channel_open() with a GatewayChannel once the gateway is connected"""
+        if not self.is_open:
+            self.pending_channels.append(handler)
+            return
+
+        channel = GatewayChannel(self, handler)
+        self.channels.add(channel)
+        handler.on_channel_open(channel)
+
+    def drop_oldest(self):
+        """Drops the oldest messages while more than OTS_EUD_PUBLISH_BUFFER are waiting to be published"""
+        while len(self.outgoing) > self.buffer_size:
+            exchange, routing_key, body, properties, attempts = self.outgoing.popleft()
+            self.dropped += 1
+            # RabbitMQ can be down for a while, so don't log every message
+            if self.dropped % 1000 == 1:
+                self.logger.warning(
+                    f"The publish buffer is full, dropped a message to {exchange} {routing_key}. "
+                    f"{self.dropped} messages dropped so far"
+                )
+
+    def publish(self, exchange: str, routing_key: str, body, properties=None):
+        self.outgoing.append((exchange, routing_key, body, properties, 0))
+        self.drop_oldest()
+
+        if len(self.outgoing) >= self.batch_size:
+            self.flush()
+        elif not self.flush_handle:
+            self.flush_handle = self.loop.call_later(self.batch_interval, self.flush)
+
+    def flush(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        if not self.publish_channel or not self.publish_channel.is_open:
+            return
+
+        # Stop publishing once too many messages are waiting to be confirmed.
+        # The rest are sent when RabbitMQ catches up and acks them
+        while self.outgoing and len(self.unconfirmed) < self.max_unconfirmed:
+            exchange, routing_key, body, properties, attempts = self.outgoing.popleft()
+            self.publish_channel.basic_publish(
+                exchange=exchange, routing_key=routing_key, body=body, properties=properties
+            )
+            self.delivery_tag += 1
+            self.unconfirmed[self.delivery_tag] = (
+                exchange,
+                routing_key,
+                body,
+                properties,
+                attempts,
+            )
+
+    def on_delivery_confirmation(self, method_frame):
+        confirmation = method_frame.method
+        if confirmation.multiple:
+            delivery_tags = [tag for tag in self.unconfirmed if tag <= confirmation.delivery_tag]
+        else:
+            delivery_tags = [confirmation.delivery_tag]
+
+        for delivery_tag in delivery_tags:
+            message = self.unconfirmed.pop(delivery_tag, None)
+            if message and isinstance(confirmation, pika.spec.Basic.Nack):
+                exchange, routing_key, body, properties, attempts = message
+                if attempts < 1:
+                    self.outgoing.append((exchange, routing_key, body, properties, attempts + 1))
+                else:
+                    self.logger.error(f"RabbitMQ rejected a message to {exchange} {routing_key}")
+        self.drop_oldest()
+
+        if self.outgoing:
+            self.flush()
+
+    def consume(self, queue: str, on_message_callback) -> str:
+        consumer_tag = self.consume_channel.basic_consume(
+            queue=queue, on_message_callback=self.on_message, auto_ack=True
+        )
+        self.consumers[consumer_tag] = on_message_callback
+        return consumer_tag
+
+    def cancel(self, consumer_tag: str):
+        if self.consumers.pop(consumer_tag, None) and self.queue_channel():
+            self.consume_channel.basic_cancel(consumer_tag)
+
+    def on_message(self, channel: Channel, basic_deliver, properties, body):
+        on_message_callback = self.consumers.get(basic_deliver.consumer_tag)
+        if on_message_callback:
+            on_message_callback(channel, basic_deliver, properties, body)
+
+
+class GatewayChannel:
+    """Stands in for the per-EUD pika channel used by EudHandler.
+
+    Publishes go through the gateway's batched publisher and the EUD's queues are consumed on the gateway's
+    shared consumer channel. Direct messages addressed to the EUD's callsign are bound to its UID queue, so
+    each EUD only needs one queue and one consumer.
+
+    Queue declarations, bindings and consumers are remembered so they can be made again if RabbitMQ closes the
+    consumer channel. Ones made while it's being reopened are made once it's open.
+    """
+
+    def __init__(self, gateway: RabbitMQGateway, handler):
+        self.gateway = gateway
+        self.handler = handler
+        # Queue -> queue_declare() arguments
+        self.declarations = {}
+        # (queue, exchange, routing key) -> queue_bind() arguments
+        self.bindings = {}
+        # Bindings removed while the consumer channel was closed
+        self.unbindings = {}
+        # Queue -> on_message callback and queue -> consumer tag
+        self.consumers = {}
+        self.consumer_tags = {}
+        self.close_callbacks = []
+        self.closed = False
+
+    @property
+    def is_open(self) -> bool:
+        # Stays open while the gateway reopens one of its channels. on_close() is called if the connection closes
+        return not self.closed
+
+    @property
+    def is_closing(self) -> bool:
+        return False
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    def queue_name(self, queue: str) -> str:
+        if self.handler.callsign and queue == self.handler.callsign and self.handler.uid:
+            return self.handler.uid
+        return queue
+
+    def add_on_close_callback(self, callback):
+        self.close_callbacks.append(callback)
+
+    def on_close(self, error):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.gateway.channels.discard(self)
+        for callback in self.close_callbacks:
+            callback(self, error)
+
+    def exchange_declare(self, exchange, **kwargs):
+        # The gateway declares the exchanges it publishes to when its channel opens
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        run_on_loop(
+            self.gateway.loop, self.gateway.publish, exchange, routing_key, body, properties
+        )
+
+    def queue_declare(self, queue, **kwargs):
+        if self.queue_name(queue) != queue:
+            return
+        run_on_loop(self.gateway.loop, self.declare, queue, kwargs)
+
+    def declare(self, queue, arguments: dict):
+        self.declarations[queue] = arguments
+        channel = self.gateway.queue_channel()
+        if channel:
+            channel.queue_declare(queue=queue, **arguments)
+
+    def queue_bind(self, queue, exchange, routing_key=None, **kwargs):
+        run_on_loop(
+            self.gateway.loop, self.bind, self.queue_name(queue), exchange, routing_key, kwargs
+        )
+
+    def bind(self, queue, exchange, routing_key, arguments: dict):
+        self.bindings[(queue, exchange, routing_key)] = arguments
+        self.unbindings.pop((queue, exchange, routing_key), None)
+        channel = self.gateway.queue_channel()
+        if channel:
+            channel.queue_bind(queue=queue, exchange=exchange, routing_key=routing_key, **arguments)
+
+    def queue_unbind(self, queue, exchange=None, routing_key=None, **kwargs):
+        run_on_loop(
+            self.gateway.loop, self.unbind, self.queue_name(queue), exchange, routing_key, kwargs
+        )
+
+    def unbind(self, queue, exchange, routing_key, arguments: dict):
+        self.bindings.pop((queue, exchange, routing_key), None)
+        channel = self.gateway.queue_channel()
+        if channel:
+            channel.queue_unbind(
+                queue=queue, exchange=exchange, routing_key=routing_key, **arguments
+            )
+        else:
+            self.unbindings[(queue, exchange, routing_key)] = arguments
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, **kwargs):
+        if self.queue_name(queue) != queue:
+            return
+        run_on_loop(self.gateway.loop, self.consume, queue, on_message_callback)
+
+    def consume(self, queue, on_message_callback):
+        if self.closed or queue in self.consumers:
+            return
+
+        self.consumers[queue] = on_message_callback
+        if self.gateway.queue_channel():
+            self.consumer_tags[queue] = self.gateway.consume(queue, on_message_callback)
+
+    def reattach(self):
+        """Makes the declarations, bindings and consumers again on a new consumer channel"""
+        channel = self.gateway.consume_channel
+        for queue, arguments in self.declarations.items():
+            channel.queue_declare(queue=queue, **arguments)
+        for (queue, exchange, routing_key), arguments in self.unbindings.items():
+            channel.queue_unbind(
+                queue=queue, exchange=exchange, routing_key=routing_key, **arguments
+            )
+        self.unbindings.clear()
+        for (queue, exchange, routing_key), arguments in self.bindings.items():
+            channel.queue_bind(queue=queue, exchange=exchange, routing_key=routing_key, **arguments)
+        for queue, on_message_callback in self.consumers.items():
+            self.consumer_tags[queue] = self.gateway.consume(queue, on_message_callback)
+
+    def close(self):
+        run_on_loop(self.gateway.loop, self.cancel)
+
+    def cancel(self):
+        self.closed = True
+        self.gateway.channels.discard(self)
+        for consumer_tag in self.consumer_tags.values():
+            self.gateway.cancel(consumer_tag)
+        self.consumer_tags.clear()
+        self.consumers.clear()
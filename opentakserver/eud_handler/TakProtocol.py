@@ -0,0 +1,312 @@
+from datetime import datetime, timedelta, timezone
+
+from lxml import etree
+
+from opentakserver.eud_handler.CoTFramer import FrameTooLarge
+from opentakserver.functions import datetime_from_iso8601_string
+from opentakserver.proto.takmessage_pb2 import CotEvent, TakMessage
+
+MAGIC = 0xBF
+VERSION = 1
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+xml_parser = etree.XMLParser(resolve_entities=False, no_network=True)
+
+# <detail> children which have their own protobuf message, along with the attributes that message can hold
+DETAIL_ATTRIBUTES = {
+    "contact": {"endpoint", "callsign"},
+    "__group": {"name", "role"},
+    "precisionlocation": {"geopointsrc", "altsrc"},
+    "status": {"battery"},
+    "takv": {"device", "platform", "os", "version"},
+    "track": {"speed", "course"},
+}
+REQUIRED_ATTRIBUTES = {
+    "contact": {"callsign"},
+    "__group": {"name", "role"},
+    "status": {"battery"},
+    "track": {"speed", "course"},
+}
+
+
+class TakProtocolError(ValueError):
+    def __init__(self, message: str, frames: list | None = None):
+        super().__init__(message)
+        # The messages that were completed before the invalid one
+        self.frames = frames or []
+
+
+def encode_varint(value: int) -> bytes:
+    output = bytearray()
+    while value > 0x7F:
+        output.append((value & 0x7F) | 0x80)
+        value >>= 7
+    output.append(value)
+    return bytes(output)
+
+
+def frame(payload: bytes) -> bytes:
+    """Adds the TAK protocol streaming header to a serialized TakMessage"""
+    return bytes([MAGIC]) + encode_varint(len(payload)) + payload
+
+
+class TakProtocolFramer:
+    """Splits a TAK protocol version 1 stream into serialized TakMessages.
+
+    Has the same feed() interface as CoTFramer so EudHandler can switch framers once the protocol is negotiated.
+    """
+
+    def __init__(self, max_frame_size: int = 4 * 1024 * 1024):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list[bytes]:
+        """Returns the TakMessages completed by this chunk of data.
+
+        Raises TakProtocolError or FrameTooLarge with the messages completed before the bad one in the
+        exception's frames attribute. There's no way to find the next message after an error, so the
+        connection has to be closed.
+        """
+        self.buffer += data
+        frames = []
+        position = 0
+
+        while position < len(self.buffer):
+            if self.buffer[position] != MAGIC:
+                raise TakProtocolError(
+                    f"Invalid TAK protocol header {self.buffer[position]:#x}", frames
+                )
+
+            length = 0
+            shift = 0
+            start = position + 1
+            while start < len(self.buffer):
+                byte = self.buffer[start]
+                length |= (byte & 0x7F) << shift
+                shift += 7
+                start += 1
+                if not byte & 0x80:
+                    break
+                if shift > 63:
+                    raise TakProtocolError("Invalid TAK protocol message length", frames)
+            else:
+                # The length hasn't been completely received yet
+                break
+
+            if length > self.max_frame_size:
+                raise FrameTooLarge(f"Message is larger than {self.max_frame_size} bytes", frames)
+
+            end = start + length
+            if end > len(self.buffer):
+                break
+
+            frames.append(bytes(self.buffer[start:end]))
+            position = end
+
+        del self.buffer[:position]
+        return frames
+
+
+def milliseconds_from_iso8601(value: str | None) -> int:
+    return (datetime_from_iso8601_string(value) - EPOCH) // timedelta(milliseconds=1)
+
+
+def iso8601_from_milliseconds(milliseconds: int) -> str:
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    timestamp = EPOCH + timedelta(seconds=seconds)
+    return f"{timestamp.strftime('%Y-%m-%dT%H:%M:%S')}.{milliseconds:03d}Z"
+
+
+def can_use_detail_message(element: etree._Element) -> bool:
+    if element.tag not in DETAIL_ATTRIBUTES or len(element) or (element.text or "").strip():
+        return False
+
+    attributes = set(element.attrib.keys())
+    if not attributes <= DETAIL_ATTRIBUTES[element.tag]:
+        return False
+    if not REQUIRED_ATTRIBUTES.get(element.tag, set()) <= attributes:
+        return False
+
+    try:
+        if element.tag == "status":
+            int(element.get("battery"))
+        elif element.tag == "track":
+            float(element.get("speed"))
+            float(element.get("course"))
+    except ValueError:
+        return False
+
+    return True
+
+
+def xml_to_proto(event: etree._Element) -> TakMessage:
+    message = TakMessage()
+    cot_event = message.cotEvent
+
+    for attribute in ("type", "access", "qos", "opex", "uid", "how"):
+        value = event.get(attribute)
+        if value:
+            setattr(cot_event, attribute, value)
+
+    cot_event.sendTime = milliseconds_from_iso8601(event.get("time"))
+    cot_event.startTime = milliseconds_from_iso8601(event.get("start"))
+    cot_event.staleTime = milliseconds_from_iso8601(event.get("stale"))
+
+    point = event.find("point")
+    if point is not None:
+        cot_event.lat = float(point.get("lat", 0))
+        cot_event.lon = float(point.get("lon", 0))
+        cot_event.hae = float(point.get("hae", 9999999))
+        cot_event.ce = float(point.get("ce", 9999999))
+        cot_event.le = float(point.get("le", 9999999))
+
+    detail = event.find("detail")
+    if detail is None:
+        return message
+
+    proto_detail = cot_event.detail
+    xml_detail = []
+    for child in detail:
+        if can_use_detail_message(child):
+            if child.tag == "contact" and not proto_detail.HasField("contact"):
+                proto_detail.contact.callsign = child.get("callsign")
+                proto_detail.contact.endpoint = child.get("endpoint", "")
+                continue
+            elif child.tag == "__group" and not proto_detail.HasField("group"):
+                proto_detail.group.name = child.get("name")
+                proto_detail.group.role = child.get("role")
+                continue
+            elif child.tag == "precisionlocation" and not proto_detail.HasField(
+                "precisionLocation"
+            ):
+                proto_detail.precisionLocation.geopointsrc = child.get("geopointsrc", "")
+                proto_detail.precisionLocation.altsrc = child.get("altsrc", "")
+                continue
+            elif child.tag == "status" and not proto_detail.HasField("status"):
+                proto_detail.status.battery = int(child.get("battery"))
+                continue
+            elif child.tag == "takv" and not proto_detail.HasField("takv"):
+                proto_detail.takv.device = child.get("device", "")
+                proto_detail.takv.platform = child.get("platform", "")
+                proto_detail.takv.os = child.get("os", "")
+                proto_detail.takv.version = child.get("version", "")
+                continue
+            elif child.tag == "track" and not proto_detail.HasField("track"):
+                proto_detail.track.speed = float(child.get("speed"))
+                proto_detail.track.course = float(child.get("course"))
+                continue
+
+        xml_detail.append(etree.tostring(child, encoding="unicode", with_tail=False))
+
+    proto_detail.xmlDetail = "".join(xml_detail)
+    return message
+
+
+def proto_to_xml(cot_event: CotEvent) -> etree._Element:
+    event = etree.Element("event", version="2.0", uid=cot_event.uid, type=cot_event.type)
+    for attribute in ("access", "qos", "opex"):
+        value = getattr(cot_event, attribute)
+        if value:
+            event.set(attribute, value)
+
+    event.set("time", iso8601_from_milliseconds(cot_event.sendTime))
+    event.set("start", iso8601_from_milliseconds(cot_event.startTime))
+    event.set("stale", iso8601_from_milliseconds(cot_event.staleTime))
+    event.set("how", cot_event.how)
+
+    etree.SubElement(
+        event,
+        "point",
+        lat=str(cot_event.lat),
+        lon=str(cot_event.lon),
+        hae=str(cot_event.hae),
+        ce=str(cot_event.ce),
+        le=str(cot_event.le),
+    )
+
+    if not cot_event.HasField("detail"):
+        return event
+
+    proto_detail = cot_event.detail
+    if proto_detail.xmlDetail:
+        detail = etree.fromstring(
+            f"<detail>{proto_detail.xmlDetail}</detail>".encode(), parser=xml_parser
+        )
+        event.append(detail)
+    else:
+        detail = etree.SubElement(event, "detail")
+
+    if proto_detail.HasField("contact"):
+        contact = etree.SubElement(detail, "contact")
+        if proto_detail.contact.endpoint:
+            contact.set("endpoint", proto_detail.contact.endpoint)
+        contact.set("callsign", proto_detail.contact.callsign)
+    if proto_detail.HasField("group"):
+        etree.SubElement(
+            detail, "__group", name=proto_detail.group.name, role=proto_detail.group.role
+        )
+    if proto_detail.HasField("precisionLocation"):
+        precision_location = etree.SubElement(detail, "precisionlocation")
+        if proto_detail.precisionLocation.geopointsrc:
+            precision_location.set("geopointsrc", proto_detail.precisionLocation.geopointsrc)
+        if proto_detail.precisionLocation.altsrc:
+            precision_location.set("altsrc", proto_detail.precisionLocation.altsrc)
+    if proto_detail.HasField("status"):
+        etree.SubElement(detail, "status", battery=str(proto_detail.status.battery))
+    if proto_detail.HasField("takv"):
+        takv = etree.SubElement(detail, "takv")
+        for attribute in ("device", "platform", "os", "version"):
+            value = getattr(proto_detail.takv, attribute)
+            if value:
+                takv.set(attribute, value)
+    if proto_detail.HasField("track"):
+        etree.SubElement(
+            detail,
+            "track",
+            speed=str(proto_detail.track.speed),
+            course=str(proto_detail.track.course),
+        )
+
+    return event
+
+
+def tak_control_event(cot_type: str) -> tuple[etree._Element, etree._Element]:
+    now = datetime.now(timezone.utc)
+    now_milliseconds = (now - EPOCH) // timedelta(milliseconds=1)
+
+    event = etree.Element(
+        "event",
+        version="2.0",
+        uid="protouid",
+        type=cot_type,
+        time=iso8601_from_milliseconds(now_milliseconds),
+        start=iso8601_from_milliseconds(now_milliseconds),
+        stale=iso8601_from_milliseconds(now_milliseconds + 60000),
+        how="m-g",
+    )
+    etree.SubElement(event, "point", lat="0.0", lon="0.0", hae="0.0", ce="999999", le="999999")
+    detail = etree.SubElement(event, "detail")
+    return event, etree.SubElement(detail, "TakControl")
+
+
+def protocol_support_event() -> etree._Element:
+    """Tells EUDs which TAK protocol versions the server supports, sent as soon as they connect"""
+    event, tak_control = tak_control_event("t-x-takp-v")
+    etree.SubElement(tak_control, "TakProtocolSupport", version=str(VERSION))
+    return event
+
+
+def protocol_response_event(accepted: bool) -> etree._Element:
+    event, tak_control = tak_control_event("t-x-takp-r")
+    etree.SubElement(tak_control, "TakResponse", status="true" if accepted else "false")
+    return event
+
+
+def requested_version(event: etree._Element) -> int | None:
+    """Returns the protocol version requested by a t-x-takp-q message"""
+    request = event.find("detail/TakControl/TakRequest")
+    try:
+        return int(request.get("version"))
+    except (AttributeError, TypeError, ValueError):
+        return None
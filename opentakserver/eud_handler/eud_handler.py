@@ -18,9 +18,11 @@ from opentakserver.EmailValidator import EmailValidator
 from opentakserver.PasswordValidator import PasswordValidator
 from opentakserver.defaultconfig import DefaultConfig
 from opentakserver.eud_handler import EudHandler
+from opentakserver.eud_handler.AsyncEudHandler import AsyncEudHandler
+from opentakserver.eud_handler.AsyncEudServer import AsyncEudServer
 from opentakserver.eud_handler.EudHandlerSSL import EudHandlerSSL
 from opentakserver.eud_handler.EudServer import EudServer
-from opentakserver.eud_handler.EudServerSSL import EudServerSSL
+from opentakserver.eud_handler.EudServerSSL import EudServerSSL, create_ssl_context
 from opentakserver.eud_handler.EudServerUdp import EudServerUdp
 from opentakserver.extensions import logger, db, ldap_manager
 
@@ -33,6 +35,12 @@ def args():
     parser.add_argument(
         "--udp", help=gettext("UDP Server"), default=False, action=argparse.BooleanOptionalAction
     )
+    parser.add_argument(
+        "--asyncio",
+        help="Serve all EUDs from one asyncio event loop per CPU core instead of a process per EUD",
+        default=False,
+        action=argparse.BooleanOptionalAction,
+    )
     return parser.parse_args()
 
 
@@ -141,8 +149,21 @@ def main():
     if opts.ssl and opts.udp:
         logger.error("Cannot use --ssl and --udp at the same time")
         return
+    elif opts.asyncio and opts.udp:
+        logger.error("Cannot use --asyncio and --udp at the same time")
+        return
 
-    if opts.ssl:
+    if opts.asyncio:
+        port = app.config.get("OTS_SSL_STREAMING_PORT" if opts.ssl else "OTS_TCP_STREAMING_PORT")
+        socket_server = AsyncEudServer(
+            (app.config.get("OTS_STREAMING_INTERFACE"), port),
+            AsyncEudHandler,
+            logger,
+            app,
+            ssl_context=create_ssl_context(app) if opts.ssl else None,
+        )
+        logger.info(f"Started asyncio {'SSL' if opts.ssl else 'TCP'} server on port {port}")
+    elif opts.ssl:
         socket_server = EudServerSSL(
             (app.config.get("OTS_STREAMING_INTERFACE"), app.config.get("OTS_SSL_STREAMING_PORT")),
             EudHandlerSSL,
@@ -0,0 +1,89 @@
+import math
+
+from sqlalchemy import and_, or_
+
+# The world is split into a grid of cells this many degrees wide and high. Cells are numbered row by row from
+# the south west corner so every latitude band is one contiguous range of cell numbers
+CELLS_PER_DEGREE = 10
+GRID_ROWS = 180 * CELLS_PER_DEGREE
+GRID_COLUMNS = 360 * CELLS_PER_DEGREE
+
+# Bounding boxes spanning more rows than this are matched by latitude band instead of one range per row
+MAX_GRID_RANGES = 64
+
+
+def grid_row(latitude: float) -> int:
+    return min(max(math.floor((latitude + 90) * CELLS_PER_DEGREE), 0), GRID_ROWS - 1)
+
+
+def grid_column(longitude: float) -> int:
+    return min(max(math.floor((longitude + 180) * CELLS_PER_DEGREE), 0), GRID_COLUMNS - 1)
+
+
+def grid_cell(latitude: float | None, longitude: float | None) -> int | None:
+    if latitude is None or longitude is None:
+        return None
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        return None
+
+    return grid_row(latitude) * GRID_COLUMNS + grid_column(longitude)
+
+
+def default_grid_cell(context) -> int | None:
+    """Column default that fills in the grid cell of a row from its latitude and longitude"""
+    parameters = context.get_current_parameters()
+    try:
+        return grid_cell(float(parameters["latitude"]), float(parameters["longitude"]))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def parse_bbox(args) -> tuple[float, float, float, float] | None:
+    """Gets left, bottom, right and top from request arguments.
+
+    Returns None if none of them are set and raises ValueError if they're incomplete or out of range
+    """
+    names = ("left", "bottom", "right", "top")
+    if not any(args.get(name) for name in names):
+        return None
+
+    if not all(args.get(name) for name in names):
+        raise ValueError("left, bottom, right and top are all required")
+
+    left, bottom, right, top = (float(args.get(name)) for name in names)
+    if not -180 <= left <= 180 or not -180 <= right <= 180:
+        raise ValueError("left and right must be between -180 and 180")
+    if not -90 <= bottom <= top <= 90:
+        raise ValueError("bottom and top must be between -90 and 90 and bottom can't be above top")
+
+    return left, bottom, right, top
+
+
+def bbox_filter(model, left: float, bottom: float, right: float, top: float):
+    """Filter for the rows of a model with latitude, longitude and grid_cell columns that are in a bounding box.
+
+    When left is greater than right the box crosses the antimeridian. The grid cell ranges let the database use
+    the grid_cell index, the latitude and longitude comparisons drop the rows at the edges of the box
+    """
+    first_row, last_row = grid_row(bottom), grid_row(top)
+    first_column, last_column = grid_column(left), grid_column(right)
+
+    if first_column <= last_column:
+        column_ranges = [(first_column, last_column)]
+        longitude = model.longitude.between(left, right)
+    else:
+        column_ranges = [(first_column, GRID_COLUMNS - 1), (0, last_column)]
+        longitude = or_(model.longitude >= left, model.longitude <= right)
+
+    if (last_row - first_row + 1) * len(column_ranges) > MAX_GRID_RANGES:
+        cells = model.grid_cell.between(first_row * GRID_COLUMNS, (last_row + 1) * GRID_COLUMNS - 1)
+    else:
+        cells = or_(
+            *(
+                model.grid_cell.between(row * GRID_COLUMNS + start, row * GRID_COLUMNS + end)
+                for row in range(first_row, last_row + 1)
+                for start, end in column_ranges
+            )
+        )
+
+    return and_(cells, model.latitude.between(bottom, top), longitude)
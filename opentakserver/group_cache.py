@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+
+import pika
+from flask import current_app as app
+from sqlalchemy import select, true
+
+from opentakserver.extensions import db, logger
+from opentakserver.models.Group import Group
+from opentakserver.models.GroupUser import GroupUser
+
+# Fanout exchange that tells every process to drop cached group memberships
+GROUP_CHANGES_EXCHANGE = "group_changes"
+
+
+class GroupCache:
+    """Process local cache of the names of the groups each user is enabled in, keyed by user ID and direction.
+
+    Lets cot_parser and the API route CoTs to groups without querying the DB for every message. Entries are dropped
+    when a message arrives on the group_changes exchange, which notify_group_change() publishes to.
+    """
+
+    def __init__(self):
+        self.groups: dict[int, dict[str, list[str]]] = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def group_names(self, user_id: int, direction: str) -> list[str]:
+        """Must be called in an app context"""
+        groups = self.groups.get(user_id)
+        if groups is not None:
+            return groups[direction]
+
+        generation = self.generation
+        groups = {Group.IN: [], Group.OUT: []}
+        memberships = db.session.execute(
+            select(Group.name, GroupUser.direction)
+            .join(GroupUser.group)
+            .where(GroupUser.user_id == user_id, GroupUser.enabled == true())
+        ).all()
+        for name, membership_direction in memberships:
+            groups.setdefault(membership_direction, []).append(name)
+
+        with self.lock:
+            # Don't cache memberships that changed while they were being loaded
+            if generation == self.generation:
+                self.groups[user_id] = groups
+
+        return groups[direction]
+
+    def invalidate(self, user_id: int | None = None):
+        """Drops the cached groups of one user, or of every user when user_id is None"""
+        with self.lock:
+            self.generation += 1
+            if user_id is None:
+                self.groups.clear()
+            else:
+                self.groups.pop(user_id, None)
+
+    def subscribe(self, channel: pika.channel.Channel):
+        """Consumes the group_changes exchange on a channel so this process's cache stays up to date"""
+        channel.exchange_declare(GROUP_CHANGES_EXCHANGE, durable=True, exchange_type="fanout")
+        queue = channel.queue_declare(queue="", exclusive=True).method.queue
+        channel.queue_bind(exchange=GROUP_CHANGES_EXCHANGE, queue=queue)
+        channel.basic_consume(queue=queue, on_message_callback=self.on_message, auto_ack=True)
+
+        # Changes made before the queue was bound were missed
+        self.invalidate()
+
+    def on_message(
+        self,
+        channel: pika.channel.Channel,
+        basic_deliver: pika.spec.Basic.Deliver,
+        properties: pika.spec.BasicProperties,
+        body: bytes,
+    ):
+        try:
+            self.invalidate(json.loads(body).get("user_id"))
+        except BaseException as e:
+            logger.error(f"Failed to parse group change: {e}")
+            self.invalidate()
+
+
+group_cache = GroupCache()
+
+
+class GroupChangeListener(threading.Thread):
+    """Consumes the group_changes exchange in the API process, which has no other RabbitMQ consumer,
+    and reconnects if the connection is lost"""
+
+    def __init__(self, app):
+        super().__init__()
+        self.app = app
+        self.daemon = True
+
+    def run(self):
+        while True:
+            connection = None
+            try:
+                rabbit_credentials = pika.PlainCredentials(
+                    self.app.config.get("OTS_RABBITMQ_USERNAME"),
+                    self.app.config.get("OTS_RABBITMQ_PASSWORD"),
+                )
+                rabbit_host = self.app.config.get("OTS_RABBITMQ_SERVER_ADDRESS")
+                connection = pika.BlockingConnection(
+                    pika.ConnectionParameters(host=rabbit_host, credentials=rabbit_credentials)
+                )
+                channel = connection.channel()
+                group_cache.subscribe(channel)
+                channel.start_consuming()
+            except BaseException as e:
+                logger.error(f"Lost the group_changes subscription: {e}")
+            finally:
+                if connection and connection.is_open:
+                    connection.close()
+
+            # Changes published while disconnected are missed
+            group_cache.invalidate()
+            time.sleep(5)
+
+
+def notify_group_change(user_id: int | None = None, channel: pika.channel.Channel | None = None):
+    """Call after committing a change to group memberships. Pass None when more than one user is affected.
+
+    Uses the channel if one is given, otherwise opens a new RabbitMQ connection
+    """
+    group_cache.invalidate(user_id)
+
+    connection = None
+    try:
+        if channel is None:
+            rabbit_credentials = pika.PlainCredentials(
+                app.config.get("OTS_RABBITMQ_USERNAME"), app.config.get("OTS_RABBITMQ_PASSWORD")
+            )
+            rabbit_host = app.config.get("OTS_RABBITMQ_SERVER_ADDRESS")
+            connection = pika.BlockingConnection(
+                pika.ConnectionParameters(host=rabbit_host, credentials=rabbit_credentials)
+            )
+            channel = connection.channel()
+
+        channel.basic_publish(
+            exchange=GROUP_CHANGES_EXCHANGE, routing_key="", body=json.dumps({"user_id": user_id})
+        )
+    except BaseException as e:
+        logger.error(f"Failed to publish group change for user {user_id}: {e}")
+    finally:
+        if connection:
+            connection.close()
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from cryptography.hazmat.primitives import serialization
+from flask import current_app as app
+from OpenSSL import crypto
+from OpenSSL.crypto import X509
+
+# How often in seconds the files are checked for changes
+RECHECK_INTERVAL = 5
+
+
+class CachedFile:
+    """A file that's only read and parsed again when its modification time changes"""
+
+    def __init__(self, loader):
+        self.loader = loader
+        # path -> (modification time, time it was last checked, parsed value)
+        self.values: dict[str, tuple[int, float, object]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, path: str):
+        now = time.monotonic()
+        entry = self.values.get(path)
+        if entry is not None and now - entry[1] < RECHECK_INTERVAL:
+            return entry[2]
+
+        with self.lock:
+            modified = os.stat(path).st_mtime_ns
+            if entry is not None and entry[0] == modified:
+                value = entry[2]
+            else:
+                with open(path, "rb") as f:
+                    value = self.loader(f.read())
+
+            self.values[path] = (modified, now, value)
+            return value
+
+    def invalidate(self, path: str):
+        with self.lock:
+            self.values.pop(path, None)
+
+
+def load_ca_store(pem: bytes) -> crypto.X509Store:
+    store = crypto.X509Store()
+    store.add_cert(crypto.load_certificate(crypto.FILETYPE_PEM, pem))
+    return store
+
+
+ca_stores = CachedFile(load_ca_store)
+public_keys = CachedFile(serialization.load_pem_public_key)
+private_keys = CachedFile(lambda pem: serialization.load_pem_private_key(pem, password=None))
+
+
+def ca_store() -> crypto.X509Store:
+    return ca_stores.get(os.path.join(app.config.get("OTS_CA_FOLDER"), "ca.pem"))
+
+
+def jwt_public_key():
+    """The server's public key for verifying JWTs. Must be called in an app context"""
+    return public_keys.get(
+        os.path.join(app.config.get("OTS_CA_FOLDER"), "certs", "opentakserver", "opentakserver.pub")
+    )
+
+
+def jwt_private_key():
+    """The server's private key for signing JWTs. Must be called in an app context"""
+    return private_keys.get(
+        os.path.join(
+            app.config.get("OTS_CA_FOLDER"), "certs", "opentakserver", "opentakserver.nopass.key"
+        )
+    )
+
+
+class VerifiedCertificates:
+    """LRU of client certificates that were verified against the CA, keyed by the SHA256 of their PEM"""
+
+    def __init__(self):
+        # fingerprint -> (certificate, expiration, the CA store it was verified with)
+        self.certificates: OrderedDict[str, tuple[X509, datetime, crypto.X509Store]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def verify(self, pem: str) -> X509 | None:
+        """Returns the parsed certificate if it was signed by the CA and hasn't expired. Must be called in an app
+        context"""
+        store = ca_store()
+        fingerprint = hashlib.sha256(pem.encode()).hexdigest()
+
+        with self.lock:
+            entry = self.certificates.get(fingerprint)
+            if entry is not None:
+                certificate, expiration, verified_with = entry
+                # Certificates verified with a CA that has since been replaced are checked again
+                if verified_with is store and datetime.now(timezone.utc) < expiration:
+                    self.certificates.move_to_end(fingerprint)
+                    return certificate
+                del self.certificates[fingerprint]
+
+        certificate = crypto.load_certificate(crypto.FILETYPE_PEM, pem)
+        try:
+            crypto.X509StoreContext(store, certificate).verify_certificate()
+        except crypto.X509StoreContextError:
+            return None
+
+        expiration = datetime.strptime(
+            certificate.get_notAfter().decode("ascii"), "%Y%m%d%H%M%SZ"
+        ).replace(tzinfo=timezone.utc)
+
+        with self.lock:
+            self.certificates[fingerprint] = (certificate, expiration, store)
+            while len(self.certificates) > app.config.get("OTS_VERIFIED_CERT_CACHE_SIZE"):
+                self.certificates.popitem(last=False)
+
+        return certificate
+
+
+verified_certificates = VerifiedCertificates()
@@ -0,0 +1,178 @@
+import datetime
+import math
+import os
+import tempfile
+import zipfile
+from xml.sax.saxutils import escape
+
+from opentakserver.functions import iso8601_string_from_datetime
+
+# How many points Douglas-Peucker simplification looks at together. The first and last points of every window
+# are kept so memory doesn't grow with the length of the track
+SIMPLIFY_WINDOW = 5000
+
+# Approximate length of a degree of latitude in meters
+METERS_PER_DEGREE = 111320
+
+KML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">'
+)
+
+
+def douglas_peucker(points: list, tolerance: float) -> list:
+    """Drops the points of a (timestamp, longitude, latitude) list that are within tolerance meters of the line
+    between the points that are kept"""
+    if len(points) < 3 or tolerance <= 0:
+        return points
+
+    # Project to meters around the first point. Good enough over the few kilometers a window covers
+    scale_x = METERS_PER_DEGREE * math.cos(math.radians(points[0][2]))
+    xy = [(p[1] * scale_x, p[2] * METERS_PER_DEGREE) for p in points]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = xy[first], xy[last]
+        dx, dy = x2 - x1, y2 - y1
+        length = math.hypot(dx, dy)
+
+        farthest, max_distance = 0, 0.0
+        for i in range(first + 1, last):
+            x, y = xy[i]
+            if length:
+                distance = abs(dy * x - dx * y + x2 * y1 - y2 * x1) / length
+            else:
+                distance = math.hypot(x - x1, y - y1)
+            if distance > max_distance:
+                farthest, max_distance = i, distance
+
+        if max_distance > tolerance:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def split_tracks(points, gap: datetime.timedelta | None = None, tolerance: float = 0):
+    """Yields (timestamp, longitude, latitude, starts_new_track) for time ordered points.
+
+    A new track starts whenever two points are more than gap apart. Each track is simplified with a tolerance in
+    meters when tolerance is above 0
+    """
+    window = []
+    new_track = True
+
+    def flush(final: bool):
+        nonlocal new_track
+        kept = douglas_peucker(window, tolerance)
+        # The last point of a window is the first point of the next one
+        for point in kept if final else kept[:-1]:
+            yield *point, new_track
+            new_track = False
+
+    for point in points:
+        if window and gap is not None and point[0] - window[-1][0] > gap:
+            yield from flush(True)
+            window = []
+            new_track = True
+
+        window.append(point)
+        if len(window) >= SIMPLIFY_WINDOW:
+            yield from flush(False)
+            window = [window[-1]]
+
+    if window:
+        yield from flush(True)
+
+
+def track_kml(name: str, callsign: str, icon_href: str, points):
+    """Yields a KML document with a gx:MultiTrack of the points in chunks.
+
+    The <when>s of a gx:Track have to come before its <gx:coord>s so the coordinates are spooled to a temporary
+    file, which stays in memory unless the track is large
+    """
+    yield KML_HEADER
+    yield (
+        f"<Document><name>{escape(name)}</name>"
+        f'<Style id="track"><IconStyle><scale>1.0</scale><heading>0.0</heading>'
+        f"<Icon><href>{escape(icon_href)}</href></Icon></IconStyle></Style>"
+        f"<Placemark><name>{escape(callsign)}</name><styleUrl>#track</styleUrl>"
+        f"<gx:MultiTrack><gx:interpolate>0</gx:interpolate>"
+    )
+
+    with tempfile.SpooledTemporaryFile(max_size=1024 * 1024, mode="w+") as coords:
+
+        def end_track():
+            coords.seek(0)
+            while chunk := coords.read(64 * 1024):
+                yield chunk
+            coords.seek(0)
+            coords.truncate()
+            yield "<gx:altitudeMode>clampToGround</gx:altitudeMode></gx:Track>"
+
+        in_track = False
+        whens = []
+        for timestamp, longitude, latitude, new_track in points:
+            if new_track:
+                if in_track:
+                    yield "".join(whens)
+                    whens = []
+                    yield from end_track()
+                yield "<gx:Track>"
+                in_track = True
+
+            whens.append(f"<when>{iso8601_string_from_datetime(timestamp)}</when>")
+            coords.write(f"<gx:coord>{longitude} {latitude} 0</gx:coord>")
+            if len(whens) >= 1000:
+                yield "".join(whens)
+                whens = []
+
+        if in_track:
+            yield "".join(whens)
+            yield from end_track()
+
+    yield "</gx:MultiTrack></Placemark></Document></kml>"
+
+
+class ChunkWriter:
+    """File-like object that collects what zipfile writes to it so it can be yielded to the client.
+
+    It has no tell() so zipfile writes the zip without seeking back to the local headers
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def kmz(kml_chunks, files: dict[str, str]):
+    """Yields a KMZ containing doc.kml, written from kml_chunks, and files, a dict of zip entry name -> path"""
+    writer = ChunkWriter()
+    with zipfile.ZipFile(writer, "w", zipfile.ZIP_DEFLATED) as zipf:
+        with zipf.open("doc.kml", "w") as doc:
+            for chunk in kml_chunks:
+                doc.write(chunk.encode())
+                if writer.chunks:
+                    yield writer.take()
+
+        for name, path in files.items():
+            if os.path.exists(path):
+                zipf.write(path, name)
+            yield writer.take()
+
+    yield writer.take()
@@ -0,0 +1,118 @@
+import datetime
+
+from sqlalchemy import Select, insert, or_, select, update
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+
+from opentakserver.extensions import db, logger
+from opentakserver.functions import iso8601_string_from_datetime
+from opentakserver.models.CasEvac import CasEvac
+from opentakserver.models.CoT import CoT
+from opentakserver.models.EUD import EUD
+from opentakserver.models.MapState import MapState
+from opentakserver.models.Marker import Marker
+from opentakserver.models.RBLine import RBLine
+
+KINDS = ("euds", "markers", "rb_lines", "casevacs")
+
+# The timestamp returned for the next ?since= request is this far in the past so changes that were being committed
+# while the map state was read aren't missed. Clients may get some items twice
+SINCE_OVERLAP = datetime.timedelta(seconds=5)
+
+
+def upsert(values: dict):
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        statement = postgresql.insert(MapState).values(**values)
+        return statement.on_conflict_do_update(index_elements=["kind", "uid"], set_=values)
+    elif dialect == "sqlite":
+        statement = sqlite.insert(MapState).values(**values)
+        return statement.on_conflict_do_update(index_elements=["kind", "uid"], set_=values)
+    elif dialect in ("mysql", "mariadb"):
+        return mysql.insert(MapState).values(**values).on_duplicate_key_update(**values)
+
+    return None
+
+
+def save_map_state(kind: str, uid: str, data: dict, stale: datetime.datetime | None = None):
+    """Saves the JSON the web UI's map shows for an EUD, marker, R&B line or CasEvac.
+
+    Must be called in an app context and doesn't commit
+    """
+    values = {
+        "kind": kind,
+        "uid": uid,
+        "stale": stale,
+        "updated": datetime.datetime.now(datetime.timezone.utc),
+        "deleted": False,
+        "data": data,
+    }
+
+    statement = upsert(values)
+    if statement is not None:
+        db.session.execute(statement)
+    elif (
+        db.session.execute(
+            update(MapState)
+            .where(MapState.kind == kind, MapState.uid == uid)
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        == 0
+    ):
+        db.session.execute(insert(MapState).values(**values))
+
+
+def delete_map_state(kind: str, uids: list[str] | Select | None = None):
+    """Marks items, or every item of a kind when uids is None, as deleted so clients polling with ?since= remove
+    them. Doesn't commit"""
+    query = update(MapState).where(MapState.kind == kind, MapState.deleted.is_(False))
+    if uids is not None:
+        query = query.where(MapState.uid.in_(uids))
+
+    db.session.execute(
+        query.values(
+            deleted=True, data=None, updated=datetime.datetime.now(datetime.timezone.utc)
+        ).execution_options(synchronize_session=False)
+    )
+
+
+def get_map_state(since: datetime.datetime | None = None) -> dict:
+    """Everything currently on the map. With since, only what changed after it, plus the UIDs of deleted items"""
+    now = datetime.datetime.now(datetime.timezone.utc)
+    results = {kind: [] for kind in KINDS}
+    results["timestamp"] = iso8601_string_from_datetime(now - SINCE_OVERLAP)
+
+    query = select(MapState.kind, MapState.uid, MapState.deleted, MapState.data)
+    if since is None:
+        query = query.where(
+            MapState.deleted.is_(False), or_(MapState.stale.is_(None), MapState.stale >= now)
+        )
+    else:
+        results["deleted"] = {kind: [] for kind in KINDS}
+        query = query.where(MapState.updated >= since)
+
+    for kind, uid, deleted, data in db.session.execute(query):
+        if deleted:
+            results["deleted"][kind].append(uid)
+        else:
+            results[kind].append(data)
+
+    return results
+
+
+def rebuild_map_state():
+    """Fills the map_state table from the EUD, marker, R&B line and CasEvac tables"""
+    logger.info("Building the map state...")
+    now = datetime.datetime.now(datetime.timezone.utc)
+
+    for eud in db.session.execute(select(EUD)).scalars():
+        save_map_state("euds", eud.uid, eud.to_json())
+
+    for model, kind in ((Marker, "markers"), (RBLine, "rb_lines"), (CasEvac, "casevacs")):
+        items = db.session.execute(
+            select(model, CoT.stale).join(CoT, model.cot_id == CoT.id).where(CoT.stale >= now)
+        ).all()
+        for item, stale in items:
+            save_map_state(kind, item.uid, item.to_json(), stale)
+
+    db.session.commit()
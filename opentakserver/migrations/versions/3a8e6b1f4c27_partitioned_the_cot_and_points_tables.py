@@ -0,0 +1,44 @@
+"""Partitioned the cot and points tables by timestamp when OTS_PARTITION_INTERVAL is set
+
+Revision ID: 3a8e6b1f4c27
+Revises: 7d3f0c5a9e21
+Create Date: 2026-10-18 18:26:54.710934
+
+"""
+
+from alembic import op
+from flask import current_app
+
+from opentakserver.partitions import (
+    PARTITIONED_TABLES,
+    is_partitioned,
+    partition_table,
+    unpartition_table,
+)
+
+# revision identifiers, used by Alembic.
+revision = "3a8e6b1f4c27"
+down_revision = "7d3f0c5a9e21"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Partitioning is PostgreSQL only, other databases keep the regular tables
+    connection = op.get_bind()
+    interval = current_app.config.get("OTS_PARTITION_INTERVAL")
+    if connection.dialect.name != "postgresql" or not interval:
+        return
+
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(connection, table):
+            partition_table(
+                connection, table, interval, current_app.config.get("OTS_PARTITIONS_AHEAD")
+            )
+
+
+def downgrade():
+    connection = op.get_bind()
+    for table in reversed(PARTITIONED_TABLES):
+        if is_partitioned(connection, table):
+            unpartition_table(connection, table)
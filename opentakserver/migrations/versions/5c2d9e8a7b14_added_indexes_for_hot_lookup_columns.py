@@ -0,0 +1,56 @@
+"""Added indexes for the columns hot queries filter and join on
+
+Revision ID: 5c2d9e8a7b14
+Revises: 3a8e6b1f4c27
+Create Date: 2026-10-18 19:48:12.305617
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5c2d9e8a7b14"
+down_revision = "3a8e6b1f4c27"
+branch_labels = None
+depends_on = None
+
+# table -> [(index name, columns)]
+INDEXES = {
+    "cot": [
+        # /Marti/api/cot/xml/<uid>
+        ("ix_cot_uid_timestamp", ["uid", "timestamp"]),
+        ("ix_cot_sender_uid_timestamp", ["sender_uid", "timestamp"]),
+        # Rebuilding the map state
+        ("ix_cot_stale", ["stale"]),
+    ],
+    "points": [
+        # Track history and KML exports
+        ("ix_points_device_uid_timestamp", ["device_uid", "timestamp"]),
+        # Cascading deletes from the cot table
+        ("ix_points_cot_id", ["cot_id"]),
+    ],
+    "markers": [("ix_markers_point_id", ["point_id"]), ("ix_markers_cot_id", ["cot_id"])],
+    "mission_uids": [("ix_mission_uids_mission_name", ["mission_name"])],
+    "mission_content_mission": [("ix_mission_content_mission_mission_name", ["mission_name"])],
+    # group_cache's membership lookups
+    "groups_users": [
+        ("ix_groups_users_user_id_direction_enabled", ["user_id", "direction", "enabled"])
+    ],
+    # The EUD stats API lists the latest stats of an EUD
+    "eud_stats": [("ix_eud_stats_eud_uid_id", ["eud_uid", "id"])],
+    "icons": [("ix_icons_filename", ["filename"])],
+}
+
+
+def upgrade():
+    for table, indexes in INDEXES.items():
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for name, columns in indexes:
+                batch_op.create_index(name, columns, unique=False)
+
+
+def downgrade():
+    for table, indexes in reversed(INDEXES.items()):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            for name, columns in reversed(indexes):
+                batch_op.drop_index(name)
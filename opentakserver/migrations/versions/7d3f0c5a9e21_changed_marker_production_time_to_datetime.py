@@ -0,0 +1,106 @@
+"""Changed markers.production_time to a DateTime and indexed the columns delete_old_data filters on
+
+Revision ID: 7d3f0c5a9e21
+Revises: b9fc2d692fc2
+Create Date: 2026-10-18 17:02:31.418230
+
+"""
+
+from datetime import datetime, timezone
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7d3f0c5a9e21"
+down_revision = "b9fc2d692fc2"
+branch_labels = None
+depends_on = None
+
+# (table, column) pairs used by delete_old_data
+RETENTION_COLUMNS = [
+    ("alerts", "start_time"),
+    ("rb_lines", "timestamp"),
+    ("geochat", "timestamp"),
+    ("mission_roles", "createTime"),
+    ("mission_uids", "timestamp"),
+    ("mission_changes", "timestamp"),
+    ("euds", "last_event_time"),
+    ("points", "timestamp"),
+    ("cot", "timestamp"),
+]
+
+
+def parse_production_time(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    for datetime_format in ("%Y-%m-%dT%H:%M:%S.%fZ", "%Y-%m-%dT%H:%M:%SZ"):
+        try:
+            return datetime.strptime(value, datetime_format)
+        except ValueError:
+            pass
+    try:
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+    except ValueError:
+        return None
+
+
+def upgrade():
+    with op.batch_alter_table("markers", schema=None) as batch_op:
+        batch_op.add_column(sa.Column("production_timestamp", sa.DateTime(), nullable=True))
+
+    # Parse the strings in Python since ATAK's ISO 8601 strings don't cast cleanly in every database
+    connection = op.get_bind()
+    markers = sa.table(
+        "markers",
+        sa.column("id", sa.Integer),
+        sa.column("production_time", sa.String),
+        sa.column("production_timestamp", sa.DateTime),
+    )
+    rows = connection.execute(
+        sa.select(markers.c.id, markers.c.production_time).where(
+            markers.c.production_time.is_not(None)
+        )
+    ).all()
+    updates = [
+        {"marker_id": marker_id, "production_timestamp": parse_production_time(production_time)}
+        for marker_id, production_time in rows
+    ]
+    if updates:
+        connection.execute(
+            markers.update()
+            .where(markers.c.id == sa.bindparam("marker_id"))
+            .values(production_timestamp=sa.bindparam("production_timestamp")),
+            updates,
+        )
+
+    with op.batch_alter_table("markers", schema=None) as batch_op:
+        batch_op.drop_column("production_time")
+        batch_op.alter_column(
+            "production_timestamp",
+            new_column_name="production_time",
+            existing_type=sa.DateTime(),
+            existing_nullable=True,
+        )
+
+    for table, column in [("markers", "production_time")] + RETENTION_COLUMNS:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.create_index(f"ix_{table}_{column}", [column], unique=False)
+
+
+def downgrade():
+    for table, column in reversed([("markers", "production_time")] + RETENTION_COLUMNS):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_index(f"ix_{table}_{column}")
+
+    with op.batch_alter_table("markers", schema=None) as batch_op:
+        batch_op.alter_column(
+            "production_time",
+            existing_type=sa.DateTime(),
+            type_=sa.String(length=255),
+            existing_nullable=True,
+            postgresql_using='to_char(production_time, \'YYYY-MM-DD"T"HH24:MI:SS.US"Z"\')',
+        )
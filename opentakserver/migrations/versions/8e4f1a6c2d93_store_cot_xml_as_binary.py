@@ -0,0 +1,113 @@
+"""Store the XML of CoTs as binary so it can be compressed, and the zstd dictionaries it's compressed with
+
+Revision ID: 8e4f1a6c2d93
+Revises: 5c2d9e8a7b14
+Create Date: 2026-10-18 21:02:41.118305
+
+"""
+
+import zlib
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8e4f1a6c2d93"
+down_revision = "5c2d9e8a7b14"
+branch_labels = None
+depends_on = None
+
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+TAK_PROTOCOL_MAGIC = b"\xbf"
+
+
+def upgrade():
+    # Existing rows keep their XML as UTF-8 bytes and are compressed in the background by the compress_cots job
+    with op.batch_alter_table("cot", schema=None) as batch_op:
+        batch_op.alter_column(
+            "xml",
+            existing_type=sa.TEXT(),
+            type_=sa.LargeBinary(),
+            postgresql_using="convert_to(xml, 'UTF8')",
+        )
+
+    # The zstd dictionaries trained on stored CoTs, which every process reads the compressed CoTs with
+    op.create_table(
+        "cot_dictionaries",
+        sa.Column("id", sa.BigInteger(), autoincrement=False, nullable=False),
+        sa.Column("data", sa.LargeBinary(), nullable=False),
+        sa.Column("created", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    with op.batch_alter_table("cot_dictionaries", schema=None) as batch_op:
+        batch_op.create_index(batch_op.f("ix_cot_dictionaries_created"), ["created"], unique=False)
+
+
+def decode(payload: bytes, dictionaries: dict) -> bytes:
+    if payload.startswith(ZSTD_MAGIC):
+        import zstandard
+
+        dictionary_id = zstandard.get_frame_parameters(payload).dict_id
+        dictionary = (
+            zstandard.ZstdCompressionDict(dictionaries[dictionary_id]) if dictionary_id else None
+        )
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(payload)
+    elif payload.startswith(TAK_PROTOCOL_MAGIC):
+        from lxml import etree
+
+        from opentakserver.eud_handler.TakProtocol import TakProtocolFramer, proto_to_xml
+        from opentakserver.proto.takmessage_pb2 import TakMessage
+
+        message = TakMessage()
+        message.ParseFromString(TakProtocolFramer().feed(payload)[0])
+        return etree.tostring(proto_to_xml(message.cotEvent))
+    elif payload.startswith(b"\x78"):
+        return zlib.decompress(payload)
+    return payload
+
+
+def downgrade():
+    # Decompress the rows that aren't plain XML before the dictionaries are dropped and the column is converted back
+    # to text
+    connection = op.get_bind()
+    cot_dictionaries = sa.table(
+        "cot_dictionaries", sa.column("id", sa.BigInteger), sa.column("data", sa.LargeBinary)
+    )
+    dictionaries = dict(
+        connection.execute(sa.select(cot_dictionaries.c.id, cot_dictionaries.c.data)).all()
+    )
+
+    cot = sa.table("cot", sa.column("id", sa.Integer), sa.column("xml", sa.LargeBinary))
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(cot.c.id, cot.c.xml)
+            .where(
+                cot.c.id > last_id,
+                sa.func.substr(cot.c.xml, 1, 1) != sa.literal(b"<", sa.LargeBinary),
+            )
+            .order_by(cot.c.id)
+            .limit(1000)
+        ).all()
+        if not rows:
+            break
+
+        for cot_id, xml in rows:
+            connection.execute(
+                sa.update(cot)
+                .where(cot.c.id == cot_id)
+                .values(xml=decode(bytes(xml), dictionaries))
+            )
+        last_id = rows[-1][0]
+
+    with op.batch_alter_table("cot_dictionaries", schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f("ix_cot_dictionaries_created"))
+    op.drop_table("cot_dictionaries")
+
+    with op.batch_alter_table("cot", schema=None) as batch_op:
+        batch_op.alter_column(
+            "xml",
+            existing_type=sa.LargeBinary(),
+            type_=sa.TEXT(),
+            postgresql_using="convert_from(xml, 'UTF8')",
+        )
@@ -0,0 +1,35 @@
+"""Added mission_name and timestamp indexes to the cot and mission_changes tables
+
+Revision ID: b9fc2d692fc2
+Revises: c1b07d78cc4e
+Create Date: 2026-10-18 15:12:44.208115
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b9fc2d692fc2"
+down_revision = "c1b07d78cc4e"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table("cot", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_cot_mission_name_timestamp", ["mission_name", "timestamp"], unique=False
+        )
+
+    with op.batch_alter_table("mission_changes", schema=None) as batch_op:
+        batch_op.create_index(
+            "ix_mission_changes_mission_name_timestamp", ["mission_name", "timestamp"], unique=False
+        )
+
+
+def downgrade():
+    with op.batch_alter_table("mission_changes", schema=None) as batch_op:
+        batch_op.drop_index("ix_mission_changes_mission_name_timestamp")
+
+    with op.batch_alter_table("cot", schema=None) as batch_op:
+        batch_op.drop_index("ix_cot_mission_name_timestamp")
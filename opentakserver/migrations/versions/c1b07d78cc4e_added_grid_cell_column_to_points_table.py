@@ -0,0 +1,51 @@
+"""Added grid_cell column to points table
+
+Revision ID: c1b07d78cc4e
+Revises: e6891780c09f
+Create Date: 2026-10-18 13:41:07.562981
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c1b07d78cc4e"
+down_revision = "e6891780c09f"
+branch_labels = None
+depends_on = None
+
+# Must match opentakserver.geo_index
+CELLS_PER_DEGREE = 10
+GRID_ROWS = 180 * CELLS_PER_DEGREE
+GRID_COLUMNS = 360 * CELLS_PER_DEGREE
+
+
+def upgrade():
+    with op.batch_alter_table("points", schema=None) as batch_op:
+        batch_op.add_column(sa.Column("grid_cell", sa.Integer(), nullable=True))
+        batch_op.create_index(
+            "ix_points_grid_cell_timestamp", ["grid_cell", "timestamp"], unique=False
+        )
+
+    # Fill in the grid cells of the existing points. SQLite doesn't always have FLOOR() but casting a positive
+    # number to an integer truncates it, while PostgreSQL and MySQL round when casting
+    if op.get_bind().dialect.name == "sqlite":
+        floor = "CAST({} AS INTEGER)"
+    else:
+        floor = "FLOOR({})"
+
+    row = floor.format(f"(latitude + 90) * {CELLS_PER_DEGREE}")
+    column = floor.format(f"(longitude + 180) * {CELLS_PER_DEGREE}")
+    op.execute(
+        f"UPDATE points SET grid_cell = "
+        f"(CASE WHEN latitude >= 90 THEN {GRID_ROWS - 1} ELSE {row} END) * {GRID_COLUMNS} + "
+        f"(CASE WHEN longitude >= 180 THEN {GRID_COLUMNS - 1} ELSE {column} END) "
+        f"WHERE latitude BETWEEN -90 AND 90 AND longitude BETWEEN -180 AND 180"
+    )
+
+
+def downgrade():
+    with op.batch_alter_table("points", schema=None) as batch_op:
+        batch_op.drop_index("ix_points_grid_cell_timestamp")
+        batch_op.drop_column("grid_cell")
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app as app
+from sqlalchemy import func, select
+
+from opentakserver.models.GroupMission import GroupMission
+from opentakserver.models.Mission import Mission
+from opentakserver.models.MissionChange import MissionChange
+from opentakserver.models.MissionContentMission import MissionContentMission
+from opentakserver.models.MissionLogEntry import MissionLogEntry
+from opentakserver.models.MissionUID import MissionUID
+
+
+def mission_version_columns() -> list:
+    """Correlated subqueries selected alongside each Mission. Their values change whenever a mission's uids,
+    contents, changes, logs or groups do, so together with the mission's own columns they make up its version
+    """
+    return [
+        select(func.count(MissionUID.uid))
+        .where(MissionUID.mission_name == Mission.name)
+        .scalar_subquery()
+        .label("uid_count"),
+        select(func.count(MissionContentMission.id))
+        .where(MissionContentMission.mission_name == Mission.name)
+        .scalar_subquery()
+        .label("content_count"),
+        select(func.count(MissionChange.id))
+        .where(MissionChange.mission_name == Mission.name)
+        .scalar_subquery()
+        .label("change_count"),
+        select(func.max(MissionChange.id))
+        .where(MissionChange.mission_name == Mission.name)
+        .scalar_subquery()
+        .label("last_change"),
+        select(func.max(MissionUID.timestamp))
+        .where(MissionUID.mission_name == Mission.name)
+        .scalar_subquery()
+        .label("uids_updated"),
+        select(func.count(GroupMission.group_id))
+        .where(GroupMission.mission_name == Mission.name)
+        .scalar_subquery()
+        .label("group_count"),
+        select(func.count(MissionLogEntry.id))
+        .where(MissionLogEntry.mission_name == Mission.name)
+        .scalar_subquery()
+        .label("log_count"),
+    ]
+
+
+def mission_version(mission: Mission, *version_columns) -> str:
+    return hashlib.sha1(
+        json.dumps([mission.name, mission.serialize(), *version_columns], default=str).encode()
+    ).hexdigest()
+
+
+def missions_etag(url_root: str, summary: bool, versions: list[str]) -> str:
+    return hashlib.sha256(json.dumps([url_root, summary, versions]).encode()).hexdigest()
+
+
+class MissionCache:
+    """LRU of the full Marti JSON of missions by their version, so listing missions only serializes the ones that
+    changed. Entries also expire after OTS_MISSION_CACHE_TTL seconds because the owner's details aren't part of
+    the version"""
+
+    def __init__(self):
+        # (mission name, url root) -> (version, JSON, time it was cached)
+        self.missions: OrderedDict[tuple[str, str], tuple[str, dict, float]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name: str, url_root: str, version: str) -> dict | None:
+        with self.lock:
+            entry = self.missions.get((name, url_root))
+            if entry is None:
+                return None
+
+            cached_version, mission_json, cached = entry
+            if cached_version != version or time.monotonic() - cached >= app.config.get(
+                "OTS_MISSION_CACHE_TTL"
+            ):
+                del self.missions[(name, url_root)]
+                return None
+
+            self.missions.move_to_end((name, url_root))
+            return mission_json
+
+    def put(self, name: str, url_root: str, version: str, mission_json: dict):
+        with self.lock:
+            self.missions[(name, url_root)] = (version, mission_json, time.monotonic())
+            while len(self.missions) > app.config.get("OTS_MISSION_CACHE_SIZE"):
+                self.missions.popitem(last=False)
+
+
+mission_cache = MissionCache()
@@ -16,7 +16,7 @@ class Alert(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     uid: Mapped[str] = mapped_column(String(255))
     sender_uid: Mapped[str] = mapped_column(String(255), ForeignKey("euds.uid", ondelete="CASCADE"))
-    start_time: Mapped[datetime] = mapped_column(DateTime)
+    start_time: Mapped[datetime] = mapped_column(DateTime, index=True)
     cancel_time: Mapped[datetime] = mapped_column(DateTime, nullable=True)
     alert_type: Mapped[str] = mapped_column(String(255))
     point_id: Mapped[int] = mapped_column(
@@ -225,16 +225,25 @@ class CasEvac(db.Model):
         event.set("version", "2.0")
         event.set("how", "h-g-i-g-o")
         event.set("uid", self.uid)
-        event.set("time", iso8601_string_from_datetime(self.point.timestamp))
-        event.set("start", iso8601_string_from_datetime(self.point.timestamp))
-        event.set("stale", iso8601_string_from_datetime(self.point.timestamp + timedelta(days=365)))
+        # The point may have been deleted with an old partition of the points table
+        timestamp = self.point.timestamp if self.point else self.timestamp
+        event.set("time", iso8601_string_from_datetime(timestamp))
+        event.set("start", iso8601_string_from_datetime(timestamp))
+        event.set("stale", iso8601_string_from_datetime(timestamp + timedelta(days=365)))
 
         cot_point = ET.SubElement(event, "point")
-        cot_point.set("ce", str(self.point.ce))
-        cot_point.set("hae", str(self.point.hae))
-        cot_point.set("le", str(self.point.le))
-        cot_point.set("lat", str(self.point.latitude))
-        cot_point.set("lon", str(self.point.longitude))
+        if self.point:
+            cot_point.set("ce", str(self.point.ce))
+            cot_point.set("hae", str(self.point.hae))
+            cot_point.set("le", str(self.point.le))
+            cot_point.set("lat", str(self.point.latitude))
+            cot_point.set("lon", str(self.point.longitude))
+        else:
+            cot_point.set("ce", "9999999")
+            cot_point.set("hae", "0")
+            cot_point.set("le", "9999999")
+            cot_point.set("lat", "0")
+            cot_point.set("lon", "0")
 
         detail = ET.SubElement(event, "detail")
 
@@ -246,7 +255,7 @@ class CasEvac(db.Model):
 
         link = ET.SubElement(detail, "link")
         link.set("parent_callsign", current_user.username)
-        link.set("production_time", iso8601_string_from_datetime(self.point.timestamp))
+        link.set("production_time", iso8601_string_from_datetime(timestamp))
         link.set("relation", "p-p")
         link.set("type", "b-r-f-h-c")
         link.set("uid", self.uid)
@@ -1,14 +1,20 @@
 from datetime import datetime
 
-from sqlalchemy import JSON, TEXT, DateTime, ForeignKey, Integer, String
+from sqlalchemy import JSON, DateTime, ForeignKey, Index, Integer, String
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
+from opentakserver.cot_storage import CoTPayload
 from opentakserver.extensions import db
 from opentakserver.functions import iso8601_string_from_datetime
 
 
 class CoT(db.Model):
     __tablename__ = "cot"
+    __table_args__ = (
+        Index("ix_cot_mission_name_timestamp", "mission_name", "timestamp"),
+        Index("ix_cot_uid_timestamp", "uid", "timestamp"),
+        Index("ix_cot_sender_uid_timestamp", "sender_uid", "timestamp"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     how: Mapped[str] = mapped_column(String(255), nullable=True)
@@ -20,10 +26,11 @@ class CoT(db.Model):
         String(255), ForeignKey("euds.uid", ondelete="CASCADE"), nullable=True
     )
     recipients: Mapped[JSON] = mapped_column(JSON, nullable=True)
-    timestamp: Mapped[datetime] = mapped_column(DateTime)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, index=True)
     start: Mapped[datetime] = mapped_column(DateTime)
-    stale: Mapped[datetime] = mapped_column(DateTime)
-    xml: Mapped[str] = mapped_column(TEXT)
+    stale: Mapped[datetime] = mapped_column(DateTime, index=True)
+    # Compressed according to OTS_COT_STORAGE but always read as the XML string
+    xml: Mapped[str] = mapped_column(CoTPayload)
     mission_name: Mapped[str] = mapped_column(
         String(255), ForeignKey("missions.name"), nullable=True
     )
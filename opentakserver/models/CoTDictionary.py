@@ -0,0 +1,23 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import BigInteger, DateTime, LargeBinary
+from sqlalchemy.orm import Mapped, mapped_column
+
+from opentakserver.extensions import db
+
+
+@dataclass
+class CoTDictionary(db.Model):
+    """A zstd dictionary trained on stored CoTs for OTS_COT_STORAGE zstd.
+
+    Kept in the database rather than on disk so every process can read the CoTs compressed with it, and so
+    they stay readable as long as the rows that need it do
+    """
+
+    __tablename__ = "cot_dictionaries"
+
+    # zstd's ID of the dictionary, which is in the header of every frame compressed with it
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=False)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    created: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 
-from sqlalchemy import BigInteger, DateTime, ForeignKey, Integer, String
+from sqlalchemy import BigInteger, DateTime, ForeignKey, Index, Integer, String
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from opentakserver.extensions import db
@@ -14,6 +14,7 @@ from opentakserver.functions import (
 @dataclass
 class EUDStats(db.Model):
     __tablename__ = "eud_stats"
+    __table_args__ = (Index("ix_eud_stats_eud_uid_id", "eud_uid", "id"),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     timestamp: Mapped[DateTime] = mapped_column(DateTime, nullable=True)
@@ -0,0 +1,26 @@
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import JSON, Boolean, DateTime, String
+from sqlalchemy.orm import Mapped, mapped_column
+
+from opentakserver.extensions import db
+
+
+@dataclass
+class MapState(db.Model):
+    """The latest state of everything on the web UI's map, one row per EUD, marker, R&B line and CasEvac.
+
+    Kept up to date by cot_parser and the EUD handlers so /api/map_state doesn't have to query the history tables
+    """
+
+    __tablename__ = "map_state"
+
+    # euds, markers, rb_lines or casevacs
+    kind: Mapped[str] = mapped_column(String(32), primary_key=True)
+    uid: Mapped[str] = mapped_column(String(255), primary_key=True)
+    # Null for EUDs, which are shown until they're deleted
+    stale: Mapped[datetime] = mapped_column(DateTime, nullable=True, index=True)
+    updated: Mapped[datetime] = mapped_column(DateTime, nullable=False, index=True)
+    deleted: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False)
+    data: Mapped[JSON] = mapped_column(JSON, nullable=True)
@@ -1,6 +1,7 @@
 from dataclasses import dataclass
+from datetime import datetime
 
-from sqlalchemy import Boolean, ForeignKey, Integer, String
+from sqlalchemy import Boolean, DateTime, ForeignKey, Integer, String
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from opentakserver.extensions import db
@@ -18,14 +19,16 @@ class Marker(db.Model):
     uid: Mapped[str] = mapped_column(String(255), unique=True)
     affiliation: Mapped[str] = mapped_column(String(255), nullable=True)
     battle_dimension: Mapped[str] = mapped_column(String(255), nullable=True)
-    point_id: Mapped[int] = mapped_column(Integer, ForeignKey("points.id", ondelete="CASCADE"))
+    point_id: Mapped[int] = mapped_column(
+        Integer, ForeignKey("points.id", ondelete="CASCADE"), index=True
+    )
     callsign: Mapped[str] = mapped_column(String(255), nullable=True)
     readiness: Mapped[bool] = mapped_column(Boolean, nullable=True)
     argb: Mapped[int] = mapped_column(Integer, nullable=True)
     color_hex: Mapped[str] = mapped_column(String(255), nullable=True)
     iconset_path: Mapped[str] = mapped_column(String(255), nullable=True)
     parent_callsign: Mapped[str] = mapped_column(String(255), nullable=True)
-    production_time: Mapped[str] = mapped_column(String(255), nullable=True)
+    production_time: Mapped[datetime] = mapped_column(DateTime, nullable=True, index=True)
     relation: Mapped[str] = mapped_column(String(255), nullable=True)
     relation_type: Mapped[str] = mapped_column(String(255), nullable=True)
     location_source: Mapped[str] = mapped_column(String(255), nullable=True)
@@ -38,7 +41,7 @@ class Marker(db.Model):
     )
     remarks: Mapped[str] = mapped_column(String(255), nullable=True)
     cot_id: Mapped[int] = mapped_column(
-        Integer, ForeignKey("cot.id", ondelete="CASCADE"), nullable=True
+        Integer, ForeignKey("cot.id", ondelete="CASCADE"), nullable=True, index=True
     )
     mil_std_2525c: Mapped[str] = mapped_column(String(255), nullable=True)
     point = relationship("Point", cascade="all, delete", back_populates="marker")
@@ -81,7 +84,9 @@ class Marker(db.Model):
             "parent_callsign": self.parent_callsign,
             "relation": self.relation,
             "relation_type": self.relation_type,
-            "production_time": self.production_time,
+            "production_time": (
+                iso8601_string_from_datetime(self.production_time) if self.production_time else None
+            ),
             "location_source": self.location_source,
             "icon": self.icon.to_json() if self.icon else None,
             "point": self.point.to_json() if self.point else None,
@@ -94,7 +94,9 @@ class Mission(db.Model):
             "password": self.password,
         }
 
-    def to_json(self):
+    def to_json(self, counts: dict | None = None):
+        """With counts, a summary that has the number of uids, contents and mission changes from counts instead of
+        the rows themselves"""
         url = request.url_root.replace("http://", "").replace("https://", "").replace("/", "")
         json = {
             "name": self.name,
@@ -115,17 +117,26 @@ class Mission(db.Model):
             "inviteOnly": self.invite_only if self.invite_only is not None else False,
             "expiration": self.expiration if self.expiration is not None else -1,
             "guid": self.guid or "",
-            "uids": [uid.to_json() for uid in self.uids],
-            "contents": [content.to_json() for content in self.contents],
+            "uids": [uid.to_json() for uid in self.uids] if counts is None else [],
+            "contents": (
+                [content.to_json() for content in self.contents] if counts is None else []
+            ),
             "passwordProtected": (
                 self.password_protected if self.password_protected is not None else False
             ),
-            "missionChanges": [mission_change.to_json() for mission_change in self.mission_changes],
+            "missionChanges": (
+                [mission_change.to_json() for mission_change in self.mission_changes]
+                if counts is None
+                else []
+            ),
             "qr_code": f"{url}:{app.config.get('OTS_SSL_STREAMING_PORT')}:ssl,{url}-{app.config.get('OTS_MARTI_HTTPS_PORT')}-ssl-{self.name},{self.name}",
-            "owner": self.owner.to_json() if self.owner else None,
+            "owner": self.owner.to_json() if counts is None and self.owner else None,
             "groups": [],
         }
 
+        if counts is not None:
+            json.update(counts)
+
         for group in self.groups:
             json["groups"].append({"id": group.id, "name": group.name})
 
@@ -140,8 +151,8 @@ class Mission(db.Model):
 
         return json
 
-    def to_marti_json(self):
-        return_value = self.to_json()
+    def to_marti_json(self, counts: dict | None = None):
+        return_value = self.to_json(counts)
 
         return_value["groups"] = []
         for group in self.groups:
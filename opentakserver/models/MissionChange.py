@@ -3,10 +3,10 @@ import uuid
 from dataclasses import dataclass
 from xml.etree.ElementTree import Element, SubElement
 
-from bs4 import BeautifulSoup
-from sqlalchemy import Boolean, DateTime, ForeignKey, Integer, String
+from sqlalchemy import Boolean, DateTime, ForeignKey, Index, Integer, String
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
+from opentakserver.cot_parser.cot_decoder import DecodedCoT
 from opentakserver.extensions import db, logger
 from opentakserver.functions import iso8601_string_from_datetime
 from opentakserver.models.Mission import Mission
@@ -17,6 +17,9 @@ from opentakserver.models.MissionUID import MissionUID
 @dataclass
 class MissionChange(db.Model):
     __tablename__ = "mission_changes"
+    __table_args__ = (
+        Index("ix_mission_changes_mission_name_timestamp", "mission_name", "timestamp"),
+    )
 
     CREATE_MISSION = "CREATE_MISSION"
     DELETE_MISSION = "DELETE_MISSION"
@@ -33,7 +36,7 @@ class MissionChange(db.Model):
     isFederatedChange: Mapped[bool] = mapped_column(Boolean)
     change_type: Mapped[str] = mapped_column(String(255))
     mission_name: Mapped[str] = mapped_column(String(255), ForeignKey("missions.name"))
-    timestamp: Mapped[datetime] = mapped_column(DateTime)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, index=True)
     creator_uid: Mapped[str] = mapped_column(String(255))
     server_time: Mapped[datetime] = mapped_column(DateTime)
     mission_uid: Mapped[str] = mapped_column(
@@ -83,14 +86,14 @@ def generate_mission_change_cot(
     mission: Mission = None,
     mission_change: MissionChange = None,
     content: MissionContent | None = None,
-    cot_event: BeautifulSoup | None = None,
+    cot_event: DecodedCoT | None = None,
     mission_uid: MissionUID = None,
     cot_type: str = "t-x-m-c",
 ) -> Element:
     if content:
         uid = content.uid
     elif cot_event:
-        uid = cot_event.attrs["uid"]
+        uid = cot_event.uid
     else:
         uid = str(uuid.uuid4())
 
@@ -149,24 +152,24 @@ def generate_mission_change_cot(
 
     if cot_event:
         details_tag = SubElement(
-            mission_change_element, "details", {"type": cot_event.attrs["type"]}
+            mission_change_element, "details", {"type": cot_event.type}
         )
 
-        point = cot_event.find("point")
-        color = cot_event.find("color")
-        callsign = cot_event.find("contact")
-        icon = cot_event.find("usericon")
-
-        if color and "argb" in color.attrs:
-            details_tag.set("color", color.attrs["argb"])
-        if color and "value" in color.attrs:
-            details_tag.set("color", color.attrs["value"])
-        if callsign:
-            details_tag.set("callsign", callsign.attrs["callsign"])
-        if icon:
-            details_tag.set("iconsetPath", icon.attrs["iconsetpath"])
-
-        SubElement(details_tag, "location", {"lon": point.attrs["lon"], "lat": point.attrs["lat"]})
+        point = cot_event.point
+        color = cot_event.color
+        callsign = cot_event.contact
+        icon = cot_event.usericon
+
+        if color is not None and "argb" in color:
+            details_tag.set("color", color["argb"])
+        if color is not None and "value" in color:
+            details_tag.set("color", color["value"])
+        if callsign is not None:
+            details_tag.set("callsign", callsign["callsign"])
+        if icon is not None:
+            details_tag.set("iconsetPath", icon["iconsetpath"])
+
+        SubElement(details_tag, "location", {"lon": point["lon"], "lat": point["lat"]})
         # SubElement(mission_change_element, "contentUid").text = cot_event.attrs['uid']
 
     if mission_uid:
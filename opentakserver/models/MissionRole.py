@@ -44,7 +44,7 @@ class MissionRole(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     clientUid: Mapped[str] = mapped_column(String(255))
     username: Mapped[str] = mapped_column(String(255))
-    createTime: Mapped[datetime] = mapped_column(DateTime)
+    createTime: Mapped[datetime] = mapped_column(DateTime, index=True)
     role_type: Mapped[str] = mapped_column(String(255))
     mission_name: Mapped[str] = mapped_column(String(255), ForeignKey("missions.name"), nullable=True)
     mission_guid: Mapped[str] = mapped_column(String(255), nullable=True)
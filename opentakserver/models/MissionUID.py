@@ -14,9 +14,9 @@ class MissionUID(db.Model):
 
     uid: Mapped[str] = mapped_column(String(255), primary_key=True)  # Equals the original CoT's UID
     mission_name: Mapped[str] = mapped_column(
-        String(255), ForeignKey("missions.name"), nullable=True
+        String(255), ForeignKey("missions.name"), nullable=True, index=True
     )
-    timestamp: Mapped[datetime] = mapped_column(DateTime, nullable=True)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, nullable=True, index=True)
     creator_uid: Mapped[str] = mapped_column(String(255), nullable=True)
     cot_type: Mapped[str] = mapped_column(String(255), nullable=True)
     callsign: Mapped[str] = mapped_column(String(255), nullable=True)
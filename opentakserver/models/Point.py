@@ -1,16 +1,21 @@
 import uuid
 from datetime import datetime
 
-from sqlalchemy import DateTime, Float, ForeignKey, Integer, String
+from sqlalchemy import DateTime, Float, ForeignKey, Index, Integer, String
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from opentakserver.extensions import db
 from opentakserver.forms.point_form import PointForm
 from opentakserver.functions import iso8601_string_from_datetime
+from opentakserver.geo_index import default_grid_cell
 
 
 class Point(db.Model):
     __tablename__ = "points"
+    __table_args__ = (
+        Index("ix_points_grid_cell_timestamp", "grid_cell", "timestamp"),
+        Index("ix_points_device_uid_timestamp", "device_uid", "timestamp"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     uid: Mapped[str] = mapped_column(String(255))
@@ -26,12 +31,14 @@ class Point(db.Model):
     speed: Mapped[float] = mapped_column(Float, nullable=True)
     location_source: Mapped[str] = mapped_column(String(255), nullable=True)
     battery: Mapped[float] = mapped_column(Float, nullable=True)
-    timestamp: Mapped[datetime] = mapped_column(DateTime)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, index=True)
     azimuth: Mapped[float] = mapped_column(Float, nullable=True)
     # Camera field of view from TAK ICU and OpenTAK ICU
     fov: Mapped[float] = mapped_column(Float, nullable=True)
+    # Cell of the geo_index grid that the point is in, used for bounding box queries
+    grid_cell: Mapped[int] = mapped_column(Integer, nullable=True, default=default_grid_cell)
     cot_id: Mapped[int] = mapped_column(
-        Integer, ForeignKey("cot.id", ondelete="CASCADE"), nullable=True
+        Integer, ForeignKey("cot.id", ondelete="CASCADE"), nullable=True, index=True
     )
     cot = relationship("CoT", back_populates="point")
 
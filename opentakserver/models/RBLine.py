@@ -20,7 +20,7 @@ class RBLine(db.Model):
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     sender_uid: Mapped[str] = mapped_column(String(255), ForeignKey("euds.uid", ondelete="CASCADE"))
     uid: Mapped[str] = mapped_column(String(255), unique=True)
-    timestamp: Mapped[datetime] = mapped_column(DateTime)
+    timestamp: Mapped[datetime] = mapped_column(DateTime, index=True)
 
     range: Mapped[float] = mapped_column(Float)
     bearing: Mapped[float] = mapped_column(Float)
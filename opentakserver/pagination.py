@@ -0,0 +1,163 @@
+import base64
+import binascii
+import datetime
+import json
+
+from sqlalchemy import and_, inspect, or_
+from sqlalchemy.orm import Query
+
+# Values of these column types are sent as ISO8601 strings in cursors
+TEMPORAL_TYPES = (datetime.datetime, datetime.date, datetime.time)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def sort_keys(model, sort_by: str | None) -> list:
+    """The columns a keyset page is ordered by: the sort column followed by the primary key, which makes the
+    order stable when several rows have the same sort value. Raises KeyError for unknown columns"""
+    mapper = inspect(model)
+    primary_key = [
+        getattr(model, mapper.get_property_by_column(column).key) for column in mapper.primary_key
+    ]
+    if not sort_by:
+        return primary_key
+
+    # Only columns can be sorted on, not relationships or methods
+    sort_column = getattr(model, mapper.columns[sort_by].key)
+    return [sort_column] + [key for key in primary_key if key.key != sort_column.key]
+
+
+def encode_cursor(sort_by: str | None, direction: str, values: list) -> str:
+    cursor = json.dumps(
+        {
+            "s": sort_by,
+            "d": direction,
+            "k": [
+                value.isoformat() if isinstance(value, TEMPORAL_TYPES) else value
+                for value in values
+            ],
+        },
+        separators=(",", ":"),
+    )
+    return base64.urlsafe_b64encode(cursor.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[str | None, str, list]:
+    """Returns the sort column, direction and key values of a cursor from encode_cursor()"""
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        sort_by, direction, values = cursor["s"], cursor["d"], cursor["k"]
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError, KeyError):
+        raise InvalidCursor("Invalid cursor")
+
+    if direction not in ("asc", "desc") or not isinstance(values, list):
+        raise InvalidCursor("Invalid cursor")
+
+    return sort_by, direction, values
+
+
+def key_value(key, value):
+    """Converts a value from a cursor back to the type of its column"""
+    if value is None:
+        return None
+
+    try:
+        python_type = key.type.python_type
+    except NotImplementedError:
+        return value
+
+    try:
+        if python_type in TEMPORAL_TYPES:
+            return python_type.fromisoformat(value)
+        return python_type(value)
+    except (ValueError, TypeError):
+        raise InvalidCursor(f"Invalid cursor value for {key.key}")
+
+
+def nullable(key) -> bool:
+    return any(column.nullable for column in key.property.columns)
+
+
+def order_by(keys: list, descending: bool) -> list:
+    """NULLs sort last in both directions on every database"""
+    clauses = []
+    for key in keys:
+        if nullable(key):
+            clauses.append(key.is_(None))
+        clauses.append(key.desc() if descending else key.asc())
+    return clauses
+
+
+def after(keys: list, values: list, descending: bool):
+    """WHERE clause for the rows that come after values in the order_by() order"""
+    clauses = []
+    for i, (key, value) in enumerate(zip(keys, values)):
+        previous_equal = [
+            previous.is_(None) if previous_value is None else previous == previous_value
+            for previous, previous_value in zip(keys[:i], values[:i])
+        ]
+
+        if value is None:
+            # Only other NULLs come after a NULL, and they're ordered by the next key
+            continue
+
+        beyond = key < value if descending else key > value
+        if nullable(key):
+            beyond = or_(beyond, key.is_(None))
+        clauses.append(and_(*previous_equal, beyond))
+
+    return or_(*clauses)
+
+
+def keyset_page(
+    query: Query, model, sort_by: str | None, direction: str, cursor: str | None, per_page: int
+) -> tuple[list, str | None]:
+    """Fetches per_page rows after cursor, or the first page if there's no cursor. Returns the rows and the cursor
+    of the next page, which is None on the last page.
+
+    Unlike OFFSET, each page costs the same no matter how deep it is as long as the sort column is indexed
+    """
+    if cursor:
+        sort_by, direction, values = decode_cursor(cursor)
+
+    try:
+        keys = sort_keys(model, sort_by)
+    except KeyError:
+        raise InvalidCursor(f"Invalid sort column: {sort_by}")
+
+    descending = direction == "desc"
+
+    if cursor:
+        if len(values) != len(keys):
+            raise InvalidCursor("Invalid cursor")
+        query = query.filter(
+            after(keys, [key_value(key, value) for key, value in zip(keys, values)], descending)
+        )
+
+    # Fetch one extra row to know if there's another page without counting
+    rows = query.order_by(None).order_by(*order_by(keys, descending)).limit(per_page + 1).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = encode_cursor(sort_by, direction, [getattr(last, key.key) for key in keys])
+
+    return rows, next_cursor
+
+
+def count(query: Query, estimate: bool = False) -> int:
+    """Counts the rows matching query. With estimate, PostgreSQL's planner estimate is used instead, which doesn't
+    read the table but may be off by a lot for filtered queries. Other databases always count"""
+    query = query.order_by(None)
+    connection = query.session.connection()
+    if not estimate or connection.dialect.name != "postgresql":
+        return query.count()
+
+    compiled = query.statement.compile(dialect=connection.dialect)
+    plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled}", compiled.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
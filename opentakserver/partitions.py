@@ -0,0 +1,350 @@
+import datetime
+import re
+
+from flask import current_app as app
+from sqlalchemy import Connection, text
+
+from opentakserver.extensions import logger
+
+# The history tables that can be partitioned by their timestamp column on PostgreSQL
+PARTITIONED_TABLES = ("cot", "points")
+
+INTERVALS = {"day": datetime.timedelta(days=1), "week": datetime.timedelta(weeks=1)}
+
+# PostgreSQL can't enforce foreign keys that reference a partitioned table unless they include the partition key,
+# so these are dropped when the tables are partitioned and recreated if they're unpartitioned. Until then
+# delete_references() does what they did when rows are deleted or partitions are dropped.
+# (constraint, table, column, referenced table, ON DELETE, what happens to the referencing rows)
+FOREIGN_KEYS = [
+    ("alert_cot", "alerts", "cot_id", "cot", "CASCADE", "DELETE"),
+    ("alert_point", "alerts", "point_id", "points", "CASCADE", "DELETE"),
+    ("casevac_cot", "casevac", "cot_id", "cot", "CASCADE", "DELETE"),
+    ("casevac_point", "casevac", "point_id", "points", "CASCADE", "DELETE"),
+    # Chat messages can't be saved without their CoT and point
+    ("geochat_cot", "geochat", "cot_id", "cot", None, "DELETE"),
+    ("geochat_point", "geochat", "point_id", "points", None, "DELETE"),
+    ("markers_cot", "markers", "cot_id", "cot", "CASCADE", "DELETE"),
+    ("markers_point", "markers", "point_id", "points", "CASCADE", "DELETE"),
+    ("point_cot", "points", "cot_id", "cot", "CASCADE", "DELETE"),
+    ("rb_line_cot", "rb_lines", "cot_id", "cot", "CASCADE", "DELETE"),
+    ("rb_line_point", "rb_lines", "point_id", "points", "CASCADE", "DELETE"),
+    # Video streams are configured by users, so they're kept without the CoT that last announced them
+    ("video_stream_cot", "video_streams", "cot_id", "cot", None, "SET NULL"),
+]
+
+BOUND_PATTERN = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def partition_start(moment: datetime.datetime, interval: str) -> datetime.datetime:
+    """The start of the partition that moment falls in. Weekly partitions start on Mondays"""
+    start = datetime.datetime(moment.year, moment.month, moment.day)
+    if interval == "week":
+        start -= datetime.timedelta(days=start.weekday())
+    return start
+
+
+def partition_name(table: str, start: datetime.datetime) -> str:
+    return f"{table}_p{start:%Y%m%d}"
+
+
+def is_partitioned(connection: Connection, table: str) -> bool:
+    if connection.dialect.name != "postgresql":
+        return False
+
+    return (
+        connection.execute(
+            text(
+                "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+                "WHERE c.relname = :table AND pg_table_is_visible(c.oid)"
+            ),
+            {"table": table},
+        ).first()
+        is not None
+    )
+
+
+def list_partitions(
+    connection: Connection, table: str
+) -> list[tuple[str, datetime.datetime, datetime.datetime]]:
+    """(name, start, end) of a table's range partitions, oldest first. The default partition isn't included"""
+    rows = connection.execute(
+        text(
+            "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = :table AND pg_table_is_visible(p.oid)"
+        ),
+        {"table": table},
+    ).all()
+
+    partitions = []
+    for name, bound in rows:
+        match = BOUND_PATTERN.search(bound or "")
+        if match:
+            partitions.append(
+                (
+                    name,
+                    datetime.datetime.fromisoformat(match.group(1)),
+                    datetime.datetime.fromisoformat(match.group(2)),
+                )
+            )
+
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_partition(connection: Connection, table: str, start: datetime.datetime, interval: str):
+    """Creates the partition starting at start, moving any of its rows out of the default partition first"""
+    end = start + INTERVALS[interval]
+    name = partition_name(table, start)
+    default = f"{table}_default"
+    bounds = {"start": start, "end": end}
+
+    in_default = connection.execute(
+        text(f'SELECT 1 FROM {default} WHERE "timestamp" >= :start AND "timestamp" < :end LIMIT 1'),
+        bounds,
+    ).first()
+
+    if in_default:
+        connection.execute(text(f"ALTER TABLE {table} DETACH PARTITION {default}"))
+
+    connection.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+            f"FOR VALUES FROM ('{start.isoformat(' ')}') TO ('{end.isoformat(' ')}')"
+        )
+    )
+
+    if in_default:
+        connection.execute(
+            text(
+                f"INSERT INTO {table} SELECT * FROM {default} "
+                f'WHERE "timestamp" >= :start AND "timestamp" < :end'
+            ),
+            bounds,
+        )
+        connection.execute(
+            text(f'DELETE FROM {default} WHERE "timestamp" >= :start AND "timestamp" < :end'),
+            bounds,
+        )
+        connection.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT"))
+
+
+def create_upcoming_partitions(
+    connection: Connection,
+    table: str,
+    interval: str,
+    ahead: int,
+    since: datetime.datetime | None = None,
+) -> int:
+    """Makes sure there are partitions from since, or now, until ahead intervals from now. Returns how many were
+    created"""
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    existing = {name for name, start, end in list_partitions(connection, table)}
+
+    created = 0
+    start = partition_start(since or now, interval)
+    last = partition_start(now + INTERVALS[interval] * ahead, interval)
+    while start <= last:
+        if partition_name(table, start) not in existing:
+            create_partition(connection, table, start, interval)
+            created += 1
+        start += INTERVALS[interval]
+
+    return created
+
+
+def delete_references(connection: Connection, table: str, ids: str, parameters: dict | None = None):
+    """Deletes or nulls out the rows that reference the rows of a partitioned table that the ids subquery selects,
+    like the foreign keys dropped by partition_table() did. Must be called before those rows are deleted or their
+    partition is dropped. Does nothing if the table isn't partitioned because its foreign keys still exist
+    """
+    if not is_partitioned(connection, table):
+        return
+
+    for constraint, foreign_table, column, referenced_table, ondelete, action in FOREIGN_KEYS:
+        if referenced_table != table:
+            continue
+
+        if action == "SET NULL":
+            statement = f"UPDATE {foreign_table} SET {column} = NULL WHERE {column} IN ({ids})"
+        else:
+            # Points that are deleted have their own references
+            delete_references(
+                connection,
+                foreign_table,
+                f"SELECT id FROM {foreign_table} WHERE {column} IN ({ids})",
+                parameters,
+            )
+            statement = f"DELETE FROM {foreign_table} WHERE {column} IN ({ids})"
+
+        count = connection.execute(text(statement), parameters or {}).rowcount
+        if count:
+            logger.info(f"Removed {count} references to {table} from {foreign_table}.{column}")
+
+
+def drop_expired_partitions(connection: Connection, table: str, cutoff: datetime.datetime) -> int:
+    """Drops the partitions whose rows are all older than cutoff, after removing the rows that reference them.
+    Returns how many were dropped"""
+    if cutoff.tzinfo:
+        cutoff = cutoff.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    dropped = 0
+    for name, start, end in list_partitions(connection, table):
+        if end > cutoff:
+            break
+        delete_references(connection, table, f"SELECT id FROM {name}")
+        connection.execute(text(f"DROP TABLE {name}"))
+        logger.info(f"Dropped partition {name} of {table}")
+        dropped += 1
+
+    return dropped
+
+
+def get_index_definitions(connection: Connection, table: str) -> list[str]:
+    """CREATE INDEX statements for a table's indexes, leaving out the ones that back constraints"""
+    definitions = (
+        connection.execute(
+            text(
+                "SELECT indexdef FROM pg_indexes WHERE tablename = :table AND indexname NOT IN "
+                "(SELECT conname FROM pg_constraint WHERE conrelid = CAST(:table AS regclass))"
+            ),
+            {"table": table},
+        )
+        .scalars()
+        .all()
+    )
+    # Indexes of a partitioned table are defined ON ONLY it, but they're recreated on a new table
+    return [definition.replace(" ON ONLY ", " ON ", 1) for definition in definitions]
+
+
+def partition_table(connection: Connection, table: str, interval: str, ahead: int):
+    """Converts a table to one partitioned by range on its timestamp column and copies its rows over.
+
+    This rewrites the whole table and holds an exclusive lock on it while it runs
+    """
+    if interval not in INTERVALS:
+        raise ValueError(
+            f"Invalid partition interval {interval}, must be one of {', '.join(INTERVALS)}"
+        )
+
+    old_table = f"{table}_unpartitioned"
+    foreign_keys = connection.execute(
+        text(
+            "SELECT CAST(conrelid AS regclass), conname FROM pg_constraint "
+            "WHERE contype = 'f' AND confrelid = CAST(:table AS regclass)"
+        ),
+        {"table": table},
+    ).all()
+    for foreign_table, constraint in foreign_keys:
+        connection.execute(text(f'ALTER TABLE {foreign_table} DROP CONSTRAINT "{constraint}"'))
+
+    index_definitions = get_index_definitions(connection, table)
+
+    connection.execute(text(f"ALTER TABLE {table} RENAME TO {old_table}"))
+    connection.execute(
+        text(
+            f"CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS INCLUDING IDENTITY) "
+            f'PARTITION BY RANGE ("timestamp")'
+        )
+    )
+    # The partition key has to be part of the primary key
+    connection.execute(text(f'ALTER TABLE {table} ADD PRIMARY KEY (id, "timestamp")'))
+    connection.execute(text(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT"))
+
+    oldest = connection.execute(text(f'SELECT MIN("timestamp") FROM {old_table}')).scalar()
+    create_upcoming_partitions(connection, table, interval, ahead, oldest)
+
+    # The primary key makes the timestamp NOT NULL. Every row should have one but keep any that don't
+    connection.execute(
+        text(f'UPDATE {old_table} SET "timestamp" = now() WHERE "timestamp" IS NULL')
+    )
+    connection.execute(text(f"INSERT INTO {table} SELECT * FROM {old_table}"))
+    move_sequence(connection, old_table, table)
+    connection.execute(text(f"DROP TABLE {old_table}"))
+
+    for index_definition in index_definitions:
+        if index_definition.startswith("CREATE UNIQUE"):
+            logger.warning(f"Not recreating {index_definition} on the partitioned {table} table")
+            continue
+        connection.execute(text(index_definition))
+
+    logger.info(f"Partitioned the {table} table by {interval}")
+
+
+def unpartition_table(connection: Connection, table: str):
+    """Copies a partitioned table back into a regular table and restores the foreign keys that reference it"""
+    old_table = f"{table}_partitioned"
+
+    index_definitions = get_index_definitions(connection, table)
+
+    connection.execute(text(f"ALTER TABLE {table} RENAME TO {old_table}"))
+    connection.execute(
+        text(f"CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS INCLUDING IDENTITY)")
+    )
+    connection.execute(text(f"ALTER TABLE {table} ADD PRIMARY KEY (id)"))
+    connection.execute(text(f"INSERT INTO {table} SELECT * FROM {old_table}"))
+    move_sequence(connection, old_table, table)
+    connection.execute(text(f"DROP TABLE {old_table}"))
+
+    for index_definition in index_definitions:
+        connection.execute(text(index_definition))
+
+    for constraint, foreign_table, column, referenced_table, ondelete, action in FOREIGN_KEYS:
+        if referenced_table == table:
+            # NOT VALID so rows that still reference deleted rows don't stop the downgrade
+            connection.execute(
+                text(
+                    f"ALTER TABLE {foreign_table} ADD CONSTRAINT {constraint} "
+                    f"FOREIGN KEY ({column}) REFERENCES {table} (id)"
+                    f"{f' ON DELETE {ondelete}' if ondelete else ''} NOT VALID"
+                )
+            )
+
+    logger.info(f"Unpartitioned the {table} table")
+
+
+def move_sequence(connection: Connection, old_table: str, table: str):
+    """Gives a table copied with LIKE the old table's id sequence, or starts its own identity after the copied
+    ids"""
+    sequence = connection.execute(
+        text(f"SELECT pg_get_serial_sequence('{old_table}', 'id')")
+    ).scalar()
+    if (
+        sequence
+        and not connection.execute(text(f"SELECT pg_get_serial_sequence('{table}', 'id')")).scalar()
+    ):
+        connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id"))
+
+    sequence = connection.execute(text(f"SELECT pg_get_serial_sequence('{table}', 'id')")).scalar()
+    if sequence:
+        connection.execute(
+            text(
+                f"SELECT setval('{sequence}', (SELECT COALESCE(MAX(id), 0) + 1 FROM {table}), false)"
+            )
+        )
+
+
+def maintain_partitions(connection: Connection, cutoff: datetime.datetime | None = None):
+    """Creates the next OTS_PARTITIONS_AHEAD partitions of each partitioned table and, with cutoff, drops the ones
+    that only hold rows older than it. Does nothing unless the tables were partitioned"""
+    interval = app.config.get("OTS_PARTITION_INTERVAL")
+
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(connection, table):
+            continue
+
+        if interval in INTERVALS:
+            created = create_upcoming_partitions(
+                connection, table, interval, app.config.get("OTS_PARTITIONS_AHEAD")
+            )
+            if created:
+                logger.info(f"Created {created} partitions of {table}")
+
+        if cutoff is not None:
+            drop_expired_partitions(connection, table, cutoff)
+            # The rows older than cutoff that are left are deleted in batches after this
+            delete_references(
+                connection,
+                table,
+                f'SELECT id FROM {table} WHERE "timestamp" <= :cutoff',
+                {"cutoff": cutoff},
+            )
@@ -0,0 +1,90 @@
+import os
+import tempfile
+import threading
+from typing import BinaryIO
+
+from flask import current_app as app
+
+
+class ProfileCache:
+    """Device profile zips saved on disk by a hash of everything that goes into them.
+
+    The least recently used zips are deleted once there are more than OTS_PROFILE_CACHE_SIZE
+    """
+
+    def __init__(self):
+        # One lock per key so EUDs enrolling at the same time wait for one zip instead of all building their own
+        self.locks: dict[str, threading.Lock] = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def folder() -> str:
+        return os.path.join(app.config.get("OTS_DATA_FOLDER"), "profile_cache")
+
+    def get(self, key: str, build) -> BinaryIO:
+        """Returns the zip for key opened for reading, calling build(path) to write it if it isn't cached.
+
+        The zip is returned already open so evicting it before it's sent doesn't affect the response. Must be called
+        in an app context
+        """
+        path = os.path.join(self.folder(), f"{key}.zip")
+        try:
+            return self.open(path)
+        except FileNotFoundError:
+            pass
+
+        with self.lock:
+            key_lock = self.locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            try:
+                profile = self.open(path)
+            except FileNotFoundError:
+                os.makedirs(self.folder(), exist_ok=True)
+                with tempfile.NamedTemporaryFile(
+                    dir=self.folder(), suffix=".tmp", delete=False
+                ) as f:
+                    temp_path = f.name
+
+                try:
+                    build(temp_path)
+                except BaseException:
+                    os.remove(temp_path)
+                    raise
+
+                os.replace(temp_path, path)
+                profile = open(path, "rb")
+                self.evict()
+
+        with self.lock:
+            self.locks.pop(key, None)
+
+        return profile
+
+    @staticmethod
+    def open(path: str) -> BinaryIO:
+        profile = open(path, "rb")
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted after it was opened, the open file can still be sent
+            pass
+        return profile
+
+    @staticmethod
+    def key(profile: BinaryIO) -> str:
+        """The key of a zip returned by get(), which is also the hash of everything in it"""
+        return os.path.splitext(os.path.basename(profile.name))[0]
+
+    def evict(self):
+        zips = [entry for entry in os.scandir(self.folder()) if entry.name.endswith(".zip")]
+        zips.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in zips[app.config.get("OTS_PROFILE_CACHE_SIZE") :]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                # Already removed, or still open on Windows
+                pass
+
+
+profile_cache = ProfileCache()
@@ -0,0 +1,146 @@
+import datetime
+import json
+import time
+from xml.etree.ElementTree import tostring
+
+import pika
+from flask import current_app as app
+from sqlalchemy import ColumnElement, delete, inspect, select
+
+from opentakserver.extensions import db, logger
+from opentakserver.functions import generate_delete_cot
+from opentakserver.map_state import delete_map_state
+from opentakserver.models.CoT import CoT
+from opentakserver.models.Group import Group
+
+
+class DeleteCoTPublisher:
+    """Sends delete CoTs for expired markers, alerts and R&B lines to every group and the firehose.
+
+    The group names are read once per run and each delete CoT is serialized once no matter how many groups it goes
+    to
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.routing_keys = [
+            f"{name}.{Group.OUT}" for name in db.session.execute(select(Group.name)).scalars()
+        ]
+        self.properties = pika.BasicProperties(expiration=app.config.get("OTS_RABBITMQ_TTL"))
+        self.published = 0
+
+    def publish(self, items: list[tuple[str, str | None]]):
+        """Publishes a delete CoT for each (uid, type) in items"""
+        for uid, cot_type in items:
+            body = json.dumps(
+                {
+                    "cot": tostring(generate_delete_cot(uid, cot_type)).decode("utf-8"),
+                    "uid": app.config["OTS_NODE_ID"],
+                }
+            )
+            for routing_key in self.routing_keys:
+                self.channel.basic_publish(
+                    exchange="groups",
+                    routing_key=routing_key,
+                    body=body,
+                    properties=self.properties,
+                )
+            self.channel.basic_publish(
+                exchange="firehose", routing_key="", body=body, properties=self.properties
+            )
+            self.published += 1
+
+
+class RetentionRun:
+    """Deletes expired rows in batches of OTS_DELETE_OLD_DATA_BATCH_SIZE, committing after each batch so no single
+    transaction holds locks on millions of rows. Must be used in an app context"""
+
+    def __init__(self, publisher: DeleteCoTPublisher | None = None):
+        self.publisher = publisher
+        self.batch_size = app.config.get("OTS_DELETE_OLD_DATA_BATCH_SIZE")
+        self.started = time.monotonic()
+        self.deleted: dict[str, int] = {}
+
+    def delete(self, model, *criteria: ColumnElement[bool]) -> int:
+        """Runs DELETE ... WHERE pk IN (SELECT pk ... LIMIT batch_size) until no rows match criteria.
+
+        The subquery is wrapped in a derived table because MySQL doesn't allow LIMIT directly in an IN subquery
+        """
+        primary_key = inspect(model).primary_key[0]
+        table = model.__tablename__
+        deleted = 0
+        started = time.monotonic()
+
+        while True:
+            batch = select(primary_key).where(*criteria).limit(self.batch_size).subquery()
+            count = db.session.execute(
+                delete(model)
+                .where(primary_key.in_(select(batch.c[primary_key.name])))
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            db.session.commit()
+
+            deleted += count
+            logger.debug(f"Deleted {deleted} rows from {table}")
+            if count < self.batch_size:
+                break
+
+        self.report(table, deleted, started)
+        return deleted
+
+    def delete_with_cots(self, model, map_state_kind: str | None, *criteria: ColumnElement[bool]):
+        """Like delete() but also sends delete CoTs for the rows and removes them from the map state"""
+        primary_key = inspect(model).primary_key[0]
+        table = model.__tablename__
+        deleted = 0
+        started = time.monotonic()
+
+        while True:
+            rows = db.session.execute(
+                select(primary_key, model.uid, CoT.type)
+                .outerjoin(CoT, CoT.id == model.cot_id)
+                .where(*criteria)
+                .order_by(primary_key)
+                .limit(self.batch_size)
+            ).all()
+            if not rows:
+                break
+
+            if self.publisher:
+                self.publisher.publish([(uid, cot_type) for _, uid, cot_type in rows])
+
+            if map_state_kind:
+                delete_map_state(map_state_kind, [uid for _, uid, _ in rows])
+
+            db.session.execute(
+                delete(model)
+                .where(primary_key.in_([row[0] for row in rows]))
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+
+            deleted += len(rows)
+            logger.debug(f"Deleted {deleted} rows from {table}")
+            if len(rows) < self.batch_size:
+                break
+
+        self.report(table, deleted, started)
+        return deleted
+
+    def report(self, table: str, deleted: int, started: float):
+        self.deleted[table] = self.deleted.get(table, 0) + deleted
+        if deleted:
+            elapsed = time.monotonic() - started
+            logger.info(
+                f"Deleted {deleted} rows from {table} in {elapsed:.2f}s "
+                f"({deleted / max(elapsed, 0.001):.0f} rows/s)"
+            )
+
+    def summary(self, cutoff: datetime.datetime) -> str:
+        total = sum(self.deleted.values())
+        elapsed = time.monotonic() - self.started
+        published = self.publisher.published if self.publisher else 0
+        return (
+            f"Deleted {total} rows older than {cutoff.isoformat()} in {elapsed:.2f}s "
+            f"({total / max(elapsed, 0.001):.0f} rows/s) and sent {published} delete CoTs"
+        )
@@ -0,0 +1,112 @@
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from flask import current_app as app
+from werkzeug.http import parse_content_range_header
+
+SHA256_PATTERN = re.compile(r"^[0-9a-fA-F]{64}$")
+
+
+class RangeError(ValueError):
+    """A chunk of a ranged upload that doesn't continue where the previous chunk ended"""
+
+    def __init__(self, message: str, received: int):
+        super().__init__(message)
+        self.received = received
+
+
+def copy_stream(source, destination, *hashes) -> int:
+    """Copies source to destination in chunks, updating each hash along the way. Returns the number of bytes copied"""
+    chunk_size = app.config.get("OTS_UPLOAD_CHUNK_SIZE")
+    size = 0
+    while chunk := source.read(chunk_size):
+        destination.write(chunk)
+        for file_hash in hashes:
+            file_hash.update(chunk)
+        size += len(chunk)
+    return size
+
+
+def hash_stream(stream, algorithm: str = "sha256") -> str:
+    file_hash = hashlib.new(algorithm)
+    chunk_size = app.config.get("OTS_UPLOAD_CHUNK_SIZE")
+    while chunk := stream.read(chunk_size):
+        file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def hash_file(path: str, algorithm: str = "sha256") -> str:
+    with open(path, "rb") as f:
+        return hash_stream(f, algorithm)
+
+
+def write_temp_file(stream, directory: str, algorithm: str = "sha256") -> tuple[str, str, int]:
+    """Writes a stream to a temporary file in directory while hashing it.
+
+    Returns the path of the temporary file, its hash and its size. The caller has to rename or remove it
+    """
+    os.makedirs(directory, exist_ok=True)
+    file_hash = hashlib.new(algorithm)
+    with tempfile.NamedTemporaryFile(dir=directory, suffix=".tmp", delete=False) as f:
+        try:
+            size = copy_stream(stream, f, file_hash)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+
+    return f.name, file_hash.hexdigest(), size
+
+
+def partial_upload_path(upload_id: str) -> str:
+    return os.path.join(app.config.get("UPLOAD_FOLDER"), "partial", f"{upload_id}.part")
+
+
+def receive_range(upload_id: str, stream, content_range: str) -> tuple[str | None, int]:
+    """Appends one chunk of an upload that's split across requests with Content-Range headers.
+
+    Returns the path of the complete file once the last chunk is received, otherwise None, along with the number
+    of bytes received so far. A Content-Range of "bytes */<length>" only reports the progress so a client can
+    resume an interrupted upload. Raises RangeError when a chunk doesn't start where the last one ended
+    """
+    path = partial_upload_path(upload_id)
+    received = os.path.getsize(path) if os.path.exists(path) else 0
+
+    parsed = parse_content_range_header(content_range)
+    if parsed is None or parsed.units != "bytes" or parsed.length is None:
+        raise RangeError(f"Invalid Content-Range: {content_range}", received)
+
+    if parsed.start is not None:
+        if parsed.start != received:
+            raise RangeError(f"Expected a chunk starting at byte {received}", received)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as f:
+            received += copy_stream(stream, f)
+
+    if received >= parsed.length:
+        return path, received
+
+    return None, received
+
+
+def range_headers(received: int) -> dict:
+    """The Range header telling a client which bytes of a ranged upload were received"""
+    if not received:
+        return {}
+    return {"Range": f"bytes=0-{received - 1}"}
+
+
+def delete_stale_partial_uploads():
+    """Removes partial uploads that haven't received a chunk in OTS_PARTIAL_UPLOAD_EXPIRATION_HOURS"""
+    folder = os.path.join(app.config.get("UPLOAD_FOLDER"), "partial")
+    if not os.path.exists(folder):
+        return
+
+    cutoff = time.time() - app.config.get("OTS_PARTIAL_UPLOAD_EXPIRATION_HOURS") * 3600
+    for entry in os.scandir(folder):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
@@ -0,0 +1,104 @@
+"""Compares decode_cot() with the BeautifulSoup parsing that cot_parser used to do for every message.
+
+Run with: python -m tests.benchmark_cot_decoder
+"""
+
+import timeit
+
+from bs4 import BeautifulSoup
+
+from opentakserver.cot_parser.cot_decoder import decode_cot
+
+PLI = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<event version="2.0" uid="ANDROID-0123456789abcdef" type="a-f-G-U-C" how="m-g" '
+    'time="2024-05-01T12:00:00.123Z" start="2024-05-01T12:00:00.123Z" stale="2024-05-01T12:06:00.123Z">'
+    '<point lat="40.7128" lon="-74.006" hae="10.5" ce="4.9" le="9999999.0"/>'
+    '<detail><takv os="34" version="5.1.0.8 (17eb3e0d).1715616000-CIV" device="GOOGLE PIXEL 8" platform="ATAK-CIV"/>'
+    '<contact endpoint="*:-1:stcp" phone="5555555555" callsign="ALPHA"/>'
+    '<uid Droid="ALPHA"/><precisionlocation altsrc="GPS" geopointsrc="GPS"/>'
+    '<__group role="Team Member" name="Cyan"/><status battery="88"/>'
+    '<track course="142.5" speed="1.2"/></detail></event>'
+)
+
+MARKER = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<event version="2.0" uid="b1f5d2c4-5c3e-4d1f-9c9b-1a2b3c4d5e6f" type="a-h-G" how="h-g-i-g-o" '
+    'time="2024-05-01T12:00:00.123Z" start="2024-05-01T12:00:00.123Z" stale="2025-05-01T12:00:00.123Z">'
+    '<point lat="40.72" lon="-74.01" hae="9999999.0" ce="9999999.0" le="9999999.0"/>'
+    '<detail><status readiness="true"/><archive/>'
+    '<link uid="ANDROID-0123456789abcdef" production_time="2024-05-01T12:00:00.123Z" '
+    'type="a-f-G-U-C" parent_callsign="ALPHA" relation="p-p"/>'
+    '<contact callsign="H.1"/><remarks/><color argb="-65536"/>'
+    '<usericon iconsetpath="COT_MAPPING_2525B/a-h/a-h-G"/>'
+    '<precisionlocation altsrc="DTED0"/></detail></event>'
+)
+
+GEOCHAT = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<event version="2.0" uid="GeoChat.ANDROID-0123456789abcdef.All Chat Rooms.7d0e4c2a" type="b-t-f" '
+    'how="h-g-i-g-o" time="2024-05-01T12:00:00.123Z" start="2024-05-01T12:00:00.123Z" '
+    'stale="2024-05-02T12:00:00.123Z">'
+    '<point lat="40.7128" lon="-74.006" hae="10.5" ce="4.9" le="9999999.0"/>'
+    '<detail><__chat parent="RootContactGroup" groupOwner="false" messageId="7d0e4c2a" '
+    'chatroom="All Chat Rooms" id="All Chat Rooms" senderCallsign="ALPHA">'
+    '<chatgrp uid0="ANDROID-0123456789abcdef" uid1="All Chat Rooms" id="All Chat Rooms"/></__chat>'
+    '<link uid="ANDROID-0123456789abcdef" type="a-f-G-U-C" relation="p-p"/>'
+    '<remarks source="BAO.F.ATAK.ANDROID-0123456789abcdef" to="All Chat Rooms" '
+    'time="2024-05-01T12:00:00.123Z">Hello everyone</remarks></detail></event>'
+)
+
+MESSAGES = {"PLI": PLI, "Marker": MARKER, "GeoChat": GEOCHAT}
+
+# The lookups the parse_* functions, generate_mission_change() and route_cot() made with BeautifulSoup
+FIND_TAGS = [
+    "dest",
+    "point",
+    "track",
+    "sensor",
+    "precisionlocation",
+    "status",
+    "usericon",
+    "color",
+    "contact",
+    "takv",
+    "__video",
+    "__chat",
+    "emergency",
+    "_medevac_",
+    "detail",
+    "link",
+    "stats",
+    "usericon",
+    "color",
+    "contact",
+    "takv",
+]
+
+
+def beautifulsoup(xml: str):
+    soup = BeautifulSoup(xml, "xml")
+    event = soup.find("event")
+    for tag in FIND_TAGS:
+        event.find(tag)
+    detail = event.find("detail")
+    if detail:
+        for tag in detail.find_all():
+            tag.attrs
+    event.find_all("dest")
+    event.find_all("dest")
+    str(soup)
+
+
+def main(number: int = 2000):
+    for name, xml in MESSAGES.items():
+        old = timeit.timeit(lambda: beautifulsoup(xml), number=number)
+        new = timeit.timeit(lambda: decode_cot(xml), number=number)
+        print(
+            f"{name:8} BeautifulSoup: {old / number * 1e6:8.1f} us  decode_cot: {new / number * 1e6:7.1f} us  "
+            f"speedup: {old / new:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,77 @@
+import asyncio
 import base64
+import contextlib
+import datetime
+import hashlib
+import io
+import ipaddress
+import json
+import logging
+import os
+import pkgutil
+import re
+import shutil
+import ssl
+import time
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import flask_babel
+import flask_wtf
+import pytest
+import sqlalchemy
+import zstandard
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+from flask import Flask, request
+from flask_migrate import Migrate, downgrade, upgrade
+from flask_security.models import fsqla_v3 as fsqla
+from lxml import etree
+from sqlalchemy import delete, exc, func, insert, inspect, select, text, true, update
+
+import opentakserver
+from opentakserver import key_cache
+from opentakserver.blob_store import FileSystemBlobStore
+from opentakserver.certificate_authority import CertificateAuthority
+from opentakserver.cot_parser.cot_decoder import decode_cot
+from opentakserver.cot_parser.pli_filter import PLIFilter, distance
+from opentakserver.cot_parser.worker_pool import message_uid, shard_index
+from opentakserver.cot_storage import CODECS, ZSTD_MAGIC, CoTStorage
+from opentakserver.defaultconfig import DefaultConfig
+from opentakserver.eud_handler import TakProtocol
+from opentakserver.eud_handler.AsyncEudHandler import AsyncEudHandler
+from opentakserver.eud_handler.AsyncEudServer import AsyncEudServer
+from opentakserver.eud_handler.CoTFramer import CoTFramer, FrameTooLarge
+from opentakserver.eud_handler.EudHandler import EudHandler
+from opentakserver.eud_handler.RabbitMQGateway import RabbitMQGateway
+from opentakserver.extensions import db, logger
+from opentakserver.functions import iso8601_string_from_datetime
+from opentakserver.geo_index import GRID_COLUMNS, bbox_filter, grid_cell, parse_bbox
+from opentakserver.key_cache import CachedFile, VerifiedCertificates
+from opentakserver.kml_export import kmz, split_tracks, track_kml
+from opentakserver.map_state import get_map_state, save_map_state
+from opentakserver.mission_cache import (
+    MissionCache,
+    mission_version,
+    mission_version_columns,
+    missions_etag,
+)
+from opentakserver.models.CoTDictionary import CoTDictionary
+from opentakserver.pagination import InvalidCursor, decode_cursor, encode_cursor, keyset_page
+from opentakserver.partitions import (
+    BOUND_PATTERN,
+    FOREIGN_KEYS,
+    is_partitioned,
+    list_partitions,
+    maintain_partitions,
+    partition_name,
+    partition_start,
+)
+from opentakserver.uploads import RangeError, hash_file, receive_range
 
 
 def test_marti_api_clientendpoints(client):
@@ -22,3 +95,2059 @@ def test_points(auth):
 def test_me(auth):
     response = auth.get("/api/me")
     assert response.json["username"] == "TestUser"
+
+
+def test_map_state(auth):
+    response = auth.get("/api/map_state")
+    assert response.status_code == 200
+    assert "timestamp" in response.json
+
+    response = auth.get("/api/map_state?since={}".format(response.json["timestamp"]))
+    assert response.status_code == 200
+    assert "deleted" in response.json
+
+    response = auth.get("/api/map_state?since=yesterday")
+    assert response.status_code == 400
+
+
+def test_cot_framer_split_messages():
+    declaration = b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    stream = (
+        declaration
+        + b'<event uid="ANDROID-1"><detail><contact callsign="\xc3\xa9"/></detail></event>'
+        + declaration
+        + b'<auth><cot username="TestUser" password="TestPass" uid="ANDROID-1"/></auth>'
+    )
+
+    framer = CoTFramer()
+    frames = []
+    for i in range(len(stream)):
+        frames += framer.feed(stream[i : i + 1])
+
+    assert [frame.tag for frame in frames] == ["event", "auth"]
+    assert frames[0].find(".//contact").get("callsign") == "\u00e9"
+
+
+def test_cot_framer_max_frame_size():
+    framer = CoTFramer(max_frame_size=100)
+    with pytest.raises(FrameTooLarge):
+        framer.feed(b"<event>" + b"x" * 200)
+
+    with pytest.raises(etree.XMLSyntaxError):
+        framer.feed(b"</event><event></bad>")
+
+    assert framer.feed(b'</event><event uid="ANDROID-1"/>')[0].get("uid") == "ANDROID-1"
+
+    # Messages completed before the error are still delivered
+    with pytest.raises(etree.XMLSyntaxError) as error:
+        framer.feed(b'<event uid="ANDROID-2"/><event uid="ANDROID-3"/></bad>')
+    assert [frame.get("uid") for frame in error.value.frames] == ["ANDROID-2", "ANDROID-3"]
+
+    with pytest.raises(FrameTooLarge) as error:
+        framer.feed(b'<event uid="ANDROID-4"/><?xml ' + b"x" * 200)
+    assert [frame.get("uid") for frame in error.value.frames] == ["ANDROID-4"]
+    assert framer.feed(b'<event uid="ANDROID-5"/>')[0].get("uid") == "ANDROID-5"
+
+    framer = TakProtocol.TakProtocolFramer(max_frame_size=100)
+    with pytest.raises(FrameTooLarge) as error:
+        framer.feed(TakProtocol.frame(b"first") + TakProtocol.frame(b"x" * 200))
+    assert error.value.frames == [b"first"]
+
+    framer = TakProtocol.TakProtocolFramer()
+    with pytest.raises(TakProtocol.TakProtocolError) as error:
+        framer.feed(TakProtocol.frame(b"first") + b"<event/>")
+    assert error.value.frames == [b"first"]
+
+
+class FakeLoop:
+    def __init__(self):
+        self.later = []
+
+    def call_soon_threadsafe(self, callback):
+        callback()
+
+    def call_later(self, delay, callback):
+        self.later.append(callback)
+
+    def run_later(self):
+        later, self.later = self.later, []
+        for callback in later:
+            callback()
+
+
+class FakeChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_open = True
+        self.calls = []
+        self.close_callbacks = []
+
+    def add_on_close_callback(self, callback):
+        self.close_callbacks.append(callback)
+
+    def close_by_broker(self):
+        self.is_open = False
+        for callback in self.close_callbacks:
+            callback(self, "NOT_FOUND")
+
+    def basic_consume(self, queue, **kwargs):
+        self.calls.append(("basic_consume", queue))
+        return f"ctag{len(self.calls)}"
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.calls.append(("basic_publish", exchange, body))
+
+    def __getattr__(self, method):
+        return lambda *args, **kwargs: self.calls.append((method, *args, *kwargs.values()))
+
+
+class FakeConnection:
+    is_open, is_closing, is_closed = True, False, False
+
+    def channel(self, on_open_callback):
+        on_open_callback(FakeChannel(self))
+
+
+def test_rabbitmq_gateway_reopens_channels():
+    app = Flask(__name__)
+    app.config.update(
+        OTS_EUD_PUBLISH_BATCH_SIZE=1,
+        OTS_EUD_PUBLISH_BATCH_MS=10,
+        OTS_EUD_PUBLISH_MAX_UNCONFIRMED=10,
+        OTS_EUD_PUBLISH_BUFFER=10,
+    )
+    gateway = RabbitMQGateway(app, app.logger)
+    gateway.loop = FakeLoop()
+    gateway.rabbit_connection = FakeConnection()
+    gateway.on_connection_open(gateway.rabbit_connection)
+
+    class Handler:
+        callsign, uid = "ALPHA", "ANDROID-1"
+
+        def on_channel_open(self, channel):
+            self.channel = channel
+
+    handler = Handler()
+    gateway.open_channel(handler)
+    channel = handler.channel
+    messages = []
+    channel.queue_declare(queue="ANDROID-1")
+    channel.queue_bind(queue="ANDROID-1", exchange="groups", routing_key="Cyan.OUT")
+    channel.basic_consume(
+        queue="ANDROID-1", on_message_callback=lambda *args: messages.append(args)
+    )
+
+    # A queue operation failed, so RabbitMQ closed the consumer channel
+    gateway.consume_channel.close_by_broker()
+    assert gateway.consume_channel is None and channel.is_open
+
+    channel.queue_bind(queue="ALPHA", exchange="dms", routing_key="ALPHA")
+    channel.queue_unbind(queue="ANDROID-1", exchange="groups", routing_key="Cyan.OUT")
+    gateway.loop.run_later()
+
+    assert gateway.consume_channel.calls == [
+        ("queue_declare", "ANDROID-1"),
+        ("queue_unbind", "ANDROID-1", "groups", "Cyan.OUT"),
+        ("queue_bind", "ANDROID-1", "dms", "ALPHA"),
+        ("basic_consume", "ANDROID-1"),
+    ]
+    gateway.on_message(None, type("Deliver", (), {"consumer_tag": "ctag4"}), None, b"cot")
+    assert len(messages) == 1
+
+    # A message to a missing exchange is published once more on the new channel, then dropped
+    channel.basic_publish("missing", "", b"cot")
+    for attempt in range(2):
+        assert gateway.publish_channel.calls[-1] == ("basic_publish", "missing", b"cot")
+        gateway.publish_channel.close_by_broker()
+        gateway.loop.run_later()
+    assert ("basic_publish", "missing", b"cot") not in gateway.publish_channel.calls
+    assert not gateway.unconfirmed and not gateway.outgoing
+
+
+def test_rabbitmq_gateway_drops_oldest():
+    app = Flask(__name__)
+    app.config.update(
+        OTS_EUD_PUBLISH_BATCH_SIZE=100,
+        OTS_EUD_PUBLISH_BATCH_MS=10,
+        OTS_EUD_PUBLISH_MAX_UNCONFIRMED=3,
+        OTS_EUD_PUBLISH_BUFFER=3,
+    )
+    gateway = RabbitMQGateway(app, app.logger)
+    gateway.loop = FakeLoop()
+    gateway.rabbit_connection = FakeConnection()
+    gateway.on_connection_open(gateway.rabbit_connection)
+
+    def bodies():
+        return [message[2] for message in gateway.outgoing]
+
+    for i in range(3):
+        gateway.publish("cot", "", i)
+    gateway.flush()
+    assert len(gateway.unconfirmed) == 3
+
+    # The unconfirmed messages are older than the ones published since, so they're the ones dropped
+    for i in range(3, 5):
+        gateway.publish("cot", "", i)
+    gateway.publish_channel.close_by_broker()
+    assert bodies() == [2, 3, 4] and gateway.dropped == 2
+
+    gateway.publish("cot", "", 5)
+    assert bodies() == [3, 4, 5] and gateway.dropped == 3
+
+    # The same when the connection closes
+    gateway.loop.run_later()
+    gateway.flush()
+    gateway.publish("cot", "", 6)
+    gateway.on_connection_close(gateway.rabbit_connection, "closed")
+    assert bodies() == [4, 5, 6] and gateway.dropped == 4
+
+
+def self_signed_certificate(folder) -> tuple[str, str]:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "opentakserver")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    cert_path, key_path = os.path.join(folder, "server.pem"), os.path.join(folder, "server.key")
+    with open(cert_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    return cert_path, key_path
+
+
+def test_async_eud_server(plan_app, tmp_path):
+    from flask_security import Security, SQLAlchemyUserDatastore, hash_password
+
+    from opentakserver.models.EUD import EUD
+    from opentakserver.models.role import Role
+    from opentakserver.models.user import User
+
+    for key in dir(DefaultConfig):
+        if key.isupper() and not key.startswith("SQLALCHEMY"):
+            plan_app.config.setdefault(key, getattr(DefaultConfig, key))
+    plan_app.config.update(OTS_EUD_PUBLISH_BATCH_SIZE=1, OTS_EUD_ASYNC_WRITE_BUFFER_LIMIT=64 * 1024)
+    flask_wtf.CSRFProtect(plan_app)
+    plan_app.security = Security(plan_app, SQLAlchemyUserDatastore(db, User, Role))
+    with plan_app.test_request_context():
+        plan_app.security.datastore.create_user(
+            username="TestUser", password=hash_password("TestPass"), active=True
+        )
+    db.session.commit()
+
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(*self_signed_certificate(tmp_path))
+    client_context = ssl.create_default_context()
+    client_context.check_hostname = False
+    client_context.verify_mode = ssl.CERT_NONE
+
+    handlers = []
+
+    class Handler(AsyncEudHandler):
+        def __init__(self, *args):
+            super().__init__(*args)
+            handlers.append(self)
+
+    server = AsyncEudServer(("127.0.0.1", 0), Handler, logger, plan_app, server_context)
+    server.server_bind()
+    server.executor = ThreadPoolExecutor(max_workers=1)
+    gateway = server.gateway
+
+    def connect(loop):
+        gateway.loop = loop
+        gateway.rabbit_connection = FakeConnection()
+        gateway.on_connection_open(gateway.rabbit_connection)
+
+    gateway.connect = connect
+
+    def published(exchange: str) -> list[dict]:
+        return [
+            json.loads(call[2])
+            for call in gateway.publish_channel.calls
+            if call[:2] == ("basic_publish", exchange)
+        ]
+
+    async def receive(reader, framer) -> list:
+        frames = []
+        while not frames:
+            data = await asyncio.wait_for(reader.read(65536), 5)
+            if not data:
+                return None
+            frames += framer.feed(data)
+        return frames
+
+    async def connect_client():
+        reader, writer = await asyncio.open_connection(*server.server_address, ssl=client_context)
+        framer = CoTFramer()
+        # The server advertises TAK protocol as soon as the EUD connects
+        assert (await receive(reader, framer))[0].get("type") == "t-x-takp-v"
+        return reader, writer, framer
+
+    auth = '<auth><cot username="TestUser" password="{}" uid="ANDROID-1"/></auth>'
+    ping = (
+        '<event version="2.0" uid="ANDROID-1-ping" type="t-x-c-t" how="h-g-i-g-o" '
+        'time="2026-10-18T00:00:00Z" start="2026-10-18T00:00:00Z" stale="2026-10-18T00:00:10Z">'
+        '<point lat="0" lon="0" hae="0" ce="9999999" le="9999999"/></event>'
+    )
+    device_info = (
+        '<event version="2.0" uid="ANDROID-1" type="a-f-G-U-C" how="m-g" time="2026-10-18T00:00:00Z" '
+        'start="2026-10-18T00:00:00Z" stale="2026-10-18T00:02:00Z"><point lat="1" lon="2" hae="0" '
+        'ce="9999999" le="9999999"/><detail><contact callsign="ALPHA"/>'
+        '<takv device="Pixel" os="34" platform="ATAK-CIV" version="5.3"/>'
+        '<__group name="Cyan" role="Team Member"/></detail></event>'
+    )
+
+    async def run():
+        serving = asyncio.create_task(server.serve())
+        await asyncio.sleep(0)
+
+        # A wrong password is disconnected
+        reader, writer, framer = await connect_client()
+        writer.write(auth.format("wrong").encode())
+        assert await receive(reader, framer) is None
+        assert not handlers[0].is_authenticated
+        writer.close()
+
+        reader, writer, framer = await connect_client()
+        writer.write(auth.format("TestPass").encode() + ping.encode())
+        pong = (await receive(reader, framer))[0]
+        assert pong.get("uid") == "ANDROID-1-ping" and pong.get("type") == "t-x-c-t"
+        handler = handlers[1]
+        assert handler.is_authenticated and handler.user.username == "TestUser"
+
+        # The first connection's disconnection was published too
+        assert [message["uid"] for message in published("cot_parser")] == [None]
+        writer.write(device_info.encode())
+        while len(published("cot_parser")) < 2:
+            await asyncio.sleep(0.01)
+        assert handler.uid == "ANDROID-1" and handler.callsign == "ALPHA"
+        assert published("cot_parser")[1]["uid"] == "ANDROID-1"
+        assert ("queue_bind", "ANDROID-1", "dms", "ALPHA") in gateway.consume_channel.calls
+
+        # The EUD stops reading, so the messages for it pile up until it's disconnected
+        on_message = next(iter(gateway.consumers.values()))
+        cot = json.dumps({"uid": "ANDROID-2", "cot": "<event/>" + " " * 65536})
+        for i in range(1000):
+            if handler.closed:
+                break
+            on_message(None, None, None, cot)
+            await asyncio.sleep(0)
+        assert handler.closed and handler.shutdown
+        while not any(message.get("disconnected") for message in published("cot_parser")):
+            await asyncio.sleep(0.01)
+        assert not gateway.channels
+
+        writer.close()
+        serving.cancel()
+
+    try:
+        asyncio.run(run())
+    finally:
+        server.executor.shutdown()
+        server.socket.close()
+
+    eud = db.session.execute(select(EUD).where(EUD.uid == "ANDROID-1")).scalar_one()
+    assert (eud.callsign, eud.device, eud.platform) == ("ALPHA", "Pixel", "ATAK-CIV")
+    assert eud.user_id == handlers[1].user.id
+
+
+def test_tak_protocol_round_trip():
+    event = etree.fromstring(
+        b'<event version="2.0" uid="ANDROID-1" type="a-f-G-U-C" how="m-g" time="2024-05-01T12:00:00.123Z" '
+        b'start="2024-05-01T12:00:00.123Z" stale="2024-05-01T12:06:00.123Z">'
+        b'<point lat="40.1" lon="-73.2" hae="10.5" ce="9999999.0" le="9999999.0"/>'
+        b'<detail><contact endpoint="*:-1:stcp" callsign="ALPHA"/><uid Droid="ALPHA"/>'
+        b'<status battery="88" readiness="true"/></detail></event>'
+    )
+
+    message = TakProtocol.xml_to_proto(event)
+    assert message.cotEvent.detail.contact.callsign == "ALPHA"
+    assert not message.cotEvent.detail.HasField("status")
+    assert "readiness" in message.cotEvent.detail.xmlDetail
+
+    payload = message.SerializeToString()
+    stream = TakProtocol.frame(payload) * 2
+    framer = TakProtocol.TakProtocolFramer()
+    frames = framer.feed(stream[:5]) + framer.feed(stream[5:])
+    assert frames == [payload, payload]
+
+    xml = TakProtocol.proto_to_xml(message.cotEvent)
+    assert xml.get("start") == "2024-05-01T12:00:00.123Z"
+    assert TakProtocol.xml_to_proto(xml) == message
+
+
+def test_eud_handler_drops_unconvertible_messages():
+    class Socket:
+        sent = []
+
+        def send(self, data):
+            self.sent.append(data)
+
+    handler = EudHandler.__new__(EudHandler)
+    handler.uid, handler.callsign, handler.tak_protocol_version = "ANDROID-1", "ALPHA", 1
+    handler.logger, handler.request = logging.getLogger(), Socket()
+    handler.close_connection = lambda: pytest.fail("Closed the connection")
+
+    bad = '<event uid="marker-1" type="a-h-G" time="yesterday"/>'
+    good = '<event uid="marker-1" type="a-h-G" time="2024-05-01T12:00:00Z"/>'
+    for cot in (bad, good):
+        handler.on_message(None, None, None, json.dumps({"uid": "ANDROID-2", "cot": cot}))
+
+    assert len(handler.request.sent) == 1
+    assert TakProtocol.TakProtocolFramer().feed(handler.request.sent[0])
+
+
+def test_decode_cot():
+    cot = decode_cot(
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<event version="2.0" uid="marker-1" type="a-h-G" how="h-g-i-g-o" time="2024-05-01T12:00:00Z" '
+        'start="2024-05-01T12:00:00Z" stale="2024-05-02T12:00:00Z">'
+        '<point lat="40.1" lon="-73.2" hae="0" ce="9999999" le="9999999"/>'
+        '<detail><status readiness="true"/><contact callsign="H.1"/><color argb="-65536"/>'
+        '<remarks>Hostile <b>armor</b></remarks><marti><dest callsign="ALPHA"/><dest uid="ANDROID-2"/></marti>'
+        "</detail></event>"
+    )
+
+    assert cot.uid == "marker-1"
+    assert cot.start.year == 2024
+    assert cot.point["lat"] == "40.1"
+    assert cot.contact == {"callsign": "H.1"}
+    assert cot.readiness == "true" and cot.argb == "-65536"
+    assert cot.remarks_text == "Hostile armor"
+    assert cot.destinations == [{"callsign": "ALPHA"}, {"uid": "ANDROID-2"}]
+    assert cot.takv is None and cot.has_detail
+
+    assert decode_cot("<auth/>") is None
+
+
+def test_cot_parser_sharding():
+    uids = [f"ANDROID-{i}" for i in range(1000)]
+    four_shards = [shard_index(uid, 4) for uid in uids]
+    five_shards = [shard_index(uid, 5) for uid in uids]
+
+    assert set(four_shards) == {0, 1, 2, 3}
+    assert four_shards == [shard_index(uid, 4) for uid in uids]
+    # Adding a shard only moves UIDs to the new shard
+    assert all(new in (old, 4) for old, new in zip(four_shards, five_shards))
+
+    assert (
+        message_uid({"cot": '<event version="2.0" uid="marker-1"><detail/></event>'}) == "marker-1"
+    )
+    assert message_uid({"uid": "ANDROID-1", "disconnected": True}) == "ANDROID-1"
+
+
+def test_geo_index():
+    assert grid_cell(-90, -180) == 0
+    assert grid_cell(90, 180) == grid_cell(89.99, 179.99)
+    assert grid_cell(0.05, 0.05) == grid_cell(0.01, 0.09)
+    assert grid_cell(0.15, 0.05) == grid_cell(0.05, 0.05) + GRID_COLUMNS
+    assert grid_cell(91, 0) is None
+    assert grid_cell(None, 0) is None
+
+    assert parse_bbox({}) is None
+    bbox = parse_bbox({"left": "170", "bottom": "-5", "right": "-170", "top": "5"})
+    assert bbox == (170, -5, -170, 5)
+    with pytest.raises(ValueError):
+        parse_bbox({"left": "1", "bottom": "1"})
+    with pytest.raises(ValueError):
+        parse_bbox({"left": "0", "bottom": "10", "right": "1", "top": "5"})
+
+
+def test_geo_index_query(plan_app):
+    from opentakserver.models.EUD import EUD
+    from opentakserver.models.Point import Point
+
+    locations = {
+        "inside": (10.2, 10.2),
+        "edge cell": (10.2, 10.55),
+        "north": (10.6, 10.2),
+        "band": (15, 100),
+        "east": (0.2, 175),
+        "west": (0.2, -175),
+        "null island": (0.2, 0.1),
+        "outside east": (0.2, 169),
+    }
+    db.session.execute(insert(EUD).values(uid="ANDROID-1"))
+    db.session.execute(
+        insert(Point),
+        [
+            {
+                "uid": uid,
+                "device_uid": "ANDROID-1",
+                "latitude": latitude,
+                "longitude": longitude,
+                "timestamp": datetime.datetime(2026, 10, 18),
+            }
+            for uid, (latitude, longitude) in locations.items()
+        ],
+    )
+    db.session.commit()
+
+    def query(*bbox) -> list[str]:
+        return sorted(db.session.scalars(select(Point.uid).where(bbox_filter(Point, *bbox))))
+
+    # One grid cell range per row. The edge cell's point is in a matching cell, but east of the box
+    def ranges(*bbox) -> int:
+        return str(bbox_filter(Point, *bbox).clauses[0]).count("BETWEEN")
+
+    assert ranges(10, 10, 10.5, 10.5) == 6
+    assert query(10, 10, 10.5, 10.5) == ["inside"]
+
+    # Boxes spanning more than MAX_GRID_RANGES rows match whole latitude bands
+    assert ranges(0, 0, 20, 20) == 1
+    assert query(0, 0, 20, 20) == ["edge cell", "inside", "north", "null island"]
+    assert query(90, 14, 110, 16) == ["band"]
+
+    # Crossing the antimeridian splits every row in two
+    assert ranges(170, 0, -170, 0.5) == 12
+    assert ranges(170, -80, -170, 80) == 1
+    assert query(170, 0, -170, 0.5) == ["east", "west"]
+    assert query(170, -80, -170, 80) == ["east", "west"]
+
+
+def test_uploads(tmp_path):
+    app = Flask(__name__)
+    app.config.update(UPLOAD_FOLDER=str(tmp_path), OTS_UPLOAD_CHUNK_SIZE=64)
+    data = bytes(range(256)) * 10
+    data_hash = hashlib.sha256(data).hexdigest()
+
+    with app.app_context():
+        store = FileSystemBlobStore(str(tmp_path / "blobs"), str(tmp_path))
+        assert store.store(io.BytesIO(data)) == (data_hash, len(data))
+        assert store.path(data_hash) == str(
+            tmp_path / "blobs" / data_hash[:2] / data_hash[2:4] / data_hash
+        )
+        with open(store.find(data_hash), "rb") as f:
+            assert f.read() == data
+        # Already uploaded, so the stream isn't read
+        assert store.store(io.BytesIO(b""), data_hash.upper()) == (data_hash, len(data))
+        with pytest.raises(ValueError):
+            store.store(io.BytesIO(data), "../../etc/passwd")
+        with pytest.raises(ValueError):
+            store.store(io.BytesIO(b"other"), "0" * 64)
+
+        # Files saved before the blob store are still found
+        (tmp_path / f"{'1' * 64}.zip").write_bytes(b"old")
+        assert store.find("1" * 64) == str(tmp_path / f"{'1' * 64}.zip")
+        store.delete("1" * 64)
+        assert store.find("1" * 64) is None
+
+        assert receive_range("upload", io.BytesIO(data[:1000]), "bytes 0-999/2560") == (None, 1000)
+        with pytest.raises(RangeError):
+            receive_range("upload", io.BytesIO(data[1500:]), "bytes 1500-2559/2560")
+        assert receive_range("upload", io.BytesIO(), "bytes */2560") == (None, 1000)
+        path, received = receive_range("upload", io.BytesIO(data[1000:]), "bytes 1000-2559/2560")
+        assert received == len(data)
+        assert hash_file(path) == data_hash
+
+
+def test_cached_file(tmp_path, monkeypatch):
+    path = tmp_path / "value.txt"
+    path.write_bytes(b"first")
+    loads = []
+    cached_file = CachedFile(lambda data: loads.append(data) or data)
+
+    assert cached_file.get(str(path)) == b"first"
+    path.write_bytes(b"second")
+    os.utime(path, ns=(0, 1_000_000_000))
+    # Files aren't checked again until RECHECK_INTERVAL has passed
+    assert cached_file.get(str(path)) == b"first"
+
+    monkeypatch.setattr(key_cache, "RECHECK_INTERVAL", 0)
+    assert cached_file.get(str(path)) == b"second"
+    assert cached_file.get(str(path)) == b"second"
+    assert loads == [b"first", b"second"]
+
+    cached_file.invalidate(str(path))
+    assert cached_file.get(str(path)) == b"second"
+    assert len(loads) == 3
+
+
+@pytest.fixture
+def ca_app(tmp_path):
+    """A bare app with the CA settings and a CA folder in tmp_path"""
+    app = Flask(__name__)
+    app.config.update(
+        OTS_CA_FOLDER=str(tmp_path / "ca"),
+        OTS_CA_NAME="OpenTAKServer-CA",
+        OTS_CA_SUBJECT="/C=WW/ST=XX/L=YY/O=ZZ/OU=OpenTAKServer",
+        OTS_CA_PASSWORD="atakatak",
+        OTS_CA_EXPIRATION_TIME=30,
+        OTS_CA_KEYGEN_PROCESSES=1,
+        OTS_VERIFIED_CERT_CACHE_SIZE=10,
+        OTS_MARTI_HTTPS_PORT=8443,
+        OTS_SSL_STREAMING_PORT=8089,
+    )
+    with app.app_context():
+        yield app
+
+
+def test_certificate_authority(ca_app):
+    ca = CertificateAuthority(logging.getLogger(), ca_app)
+    ca.create_ca()
+    ca_cert, _ = ca.load_ca()
+    assert ca_cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca
+
+    server_cert = x509.load_pem_x509_certificates(
+        open(ca.path("certs", "opentakserver", "opentakserver.pem"), "rb").read()
+    )
+    assert server_cert[1] == ca_cert
+    server_cert = server_cert[0]
+    server_cert.verify_directly_issued_by(ca_cert)
+    assert server_cert.extensions.get_extension_for_class(x509.ExtendedKeyUsage).value == (
+        x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH, ExtendedKeyUsageOID.SERVER_AUTH])
+    )
+    assert server_cert.extensions.get_extension_for_class(
+        x509.SubjectAlternativeName
+    ).value.get_values_for_type(x509.DNSName) == ["opentakserver"]
+
+    ca.sign_csr(csr("10.0.0.1"), "10.0.0.1", server=True)
+    ip_cert = x509.load_pem_x509_certificate(
+        open(ca.path("certs", "10.0.0.1", "10.0.0.1.pem"), "rb").read()
+    )
+    assert ip_cert.extensions.get_extension_for_class(
+        x509.SubjectAlternativeName
+    ).value.get_values_for_type(x509.IPAddress) == [ipaddress.ip_address("10.0.0.1")]
+
+    with ca_app.test_request_context(base_url="https://ots.example.com"):
+        assert ca.issue_certificates(["user1"]) == {
+            "user1": ["user1_CONFIG.zip", "user1_CONFIG_iTAK.zip"]
+        }
+
+    key, user_cert, additional = pkcs12.load_key_and_certificates(
+        open(ca.path("certs", "user1", "user1.p12"), "rb").read(), b"atakatak"
+    )
+    assert key.public_key() == user_cert.public_key() and not additional
+    user_cert.verify_directly_issued_by(ca_cert)
+    assert user_cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value == "user1"
+    assert user_cert.subject.get_attributes_for_oid(NameOID.ORGANIZATION_NAME)[0].value == "ZZ"
+    assert user_cert.extensions.get_extension_for_class(x509.ExtendedKeyUsage).value == (
+        x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH])
+    )
+    with pytest.raises(x509.ExtensionNotFound):
+        user_cert.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+    with pytest.raises(ValueError):
+        pkcs12.load_key_and_certificates(
+            open(ca.path("certs", "user1", "user1.p12"), "rb").read(), b"wrong"
+        )
+
+    truststore = pkcs12.load_pkcs12(open(ca.path("truststore-root.p12"), "rb").read(), b"atakatak")
+    assert [cert.certificate for cert in truststore.additional_certs] == [ca_cert]
+
+    crl = x509.load_pem_x509_crl(open(ca.path("ca.crl"), "rb").read())
+    assert crl.is_signature_valid(ca_cert.public_key()) and len(crl) == 0
+
+    ca.revoke_certificate("user1")
+    crl = x509.load_pem_x509_crl(open(ca.path("ca.crl"), "rb").read())
+    assert crl.is_signature_valid(ca_cert.public_key())
+    assert [revoked.serial_number for revoked in crl] == [user_cert.serial_number]
+    assert crl.get_revoked_certificate_by_serial_number(server_cert.serial_number) is None
+
+
+def csr(common_name: str) -> bytes:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    request = (
+        x509.CertificateSigningRequestBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)]))
+        .sign(key, hashes.SHA256())
+    )
+    return request.public_bytes(serialization.Encoding.PEM)
+
+
+def test_verified_certificates(ca_app, tmp_path, monkeypatch):
+    monkeypatch.setattr(key_cache, "RECHECK_INTERVAL", 0)
+    for folder in ("other_ca", "ca"):
+        ca_app.config["OTS_CA_FOLDER"] = str(tmp_path / folder)
+        CertificateAuthority(logging.getLogger(), ca_app).create_ca()
+
+    pem = (tmp_path / "ca" / "certs" / "opentakserver" / "opentakserver.pem").read_text()
+    other_pem = (
+        tmp_path / "other_ca" / "certs" / "opentakserver" / "opentakserver.pem"
+    ).read_text()
+
+    cache = VerifiedCertificates()
+    certificate = cache.verify(pem)
+    assert certificate.get_subject().CN == "opentakserver"
+    assert cache.verify(pem) is certificate
+    assert cache.verify(other_pem) is None
+
+    # Certificates verified with the old CA have to be verified again with the new one
+    shutil.copy(tmp_path / "other_ca" / "ca.pem", tmp_path / "ca" / "ca.pem")
+    os.utime(tmp_path / "ca" / "ca.pem", ns=(0, 1_000_000_000))
+    assert cache.verify(pem) is None
+    assert cache.verify(other_pem) is not None
+    assert len(cache.certificates) == 1
+
+
+def test_profile_cache(plan_app, tmp_path):
+    from opentakserver.blueprints.marti_api.device_profile_marti_api import create_profile_zip
+    from opentakserver.models.Packages import Packages
+
+    plan_app.config.update(
+        OTS_DATA_FOLDER=str(tmp_path),
+        OTS_CA_FOLDER=str(tmp_path / "ca"),
+        OTS_CA_PASSWORD="atakatak",
+        OTS_MARTI_HTTPS_PORT=8443,
+        OTS_ENABLE_CHANNELS=True,
+        OTS_ENABLE_LDAP=False,
+        OTS_PROFILE_CACHE_SIZE=1,
+    )
+    os.makedirs(tmp_path / "ca")
+    (tmp_path / "ca" / "truststore-root.p12").write_bytes(b"truststore")
+    os.makedirs(tmp_path / "packages")
+    plugin = tmp_path / "packages" / "plugin.apk"
+    plugin.write_bytes(b"first")
+    db.session.add(
+        Packages(
+            platform="Android",
+            plugin_type="plugin",
+            package_name="com.example.plugin",
+            name="Plugin",
+            file_name="plugin.apk",
+            version="1",
+            file_size=5,
+            install_on_connection=True,
+            publish_time=datetime.datetime.now(datetime.timezone.utc),
+        )
+    )
+    db.session.commit()
+
+    with plan_app.test_request_context(base_url="https://ots.example.com"):
+        with create_profile_zip(False) as first, create_profile_zip(False) as hit:
+            assert hit.name == first.name
+            plugin_entry = zipfile.ZipFile(first).read(
+                "5c2bfcae3d98c9f4d262172df99ebac5/plugin.apk"
+            )
+            assert plugin_entry == b"first"
+
+        # A plugin that changed gets a new zip
+        plugin.write_bytes(b"second")
+        os.utime(plugin, ns=(0, 1_000_000_000))
+        with create_profile_zip(False) as changed:
+            assert changed.name != first.name
+            plugin_entry = zipfile.ZipFile(changed).read(
+                "5c2bfcae3d98c9f4d262172df99ebac5/plugin.apk"
+            )
+            assert plugin_entry == b"second"
+
+        # Only OTS_PROFILE_CACHE_SIZE zips are kept. One that's evicted while it's open can still be read
+        assert not os.path.exists(first.name)
+        with create_profile_zip(False, clientUid="ANDROID-1") as evicted:
+            plugin.write_bytes(b"third")
+            os.utime(plugin, ns=(0, 2_000_000_000))
+            with create_profile_zip(False) as last:
+                pass
+            assert not os.path.exists(evicted.name)
+            assert zipfile.ZipFile(evicted).testzip() is None
+
+        assert os.listdir(tmp_path / "profile_cache") == [os.path.basename(last.name)]
+
+
+def test_product_infz(plan_app, tmp_path):
+    from opentakserver.blueprints.ots_api.package_api import (
+        create_product_infz,
+        send_product_infz,
+    )
+    from opentakserver.models.Packages import Packages
+
+    plan_app.config["OTS_DATA_FOLDER"] = str(tmp_path)
+    for package_name, atak_version in [("com.example.b", "5.2"), ("com.example.a", None)]:
+        db.session.add(
+            Packages(
+                platform="Android",
+                plugin_type="plugin",
+                package_name=package_name,
+                name=package_name,
+                file_name=f"{package_name}.apk",
+                version="1",
+                file_size=5,
+                icon=b"icon",
+                icon_filename=f"{package_name}.png",
+                publish_time=datetime.datetime.now(datetime.timezone.utc),
+                atak_version=atak_version,
+            )
+        )
+    db.session.commit()
+
+    create_product_infz("5.2")
+    index, versioned = (
+        tmp_path / "packages" / "product.infz",
+        tmp_path / "packages" / "5.2" / "product.infz",
+    )
+    with zipfile.ZipFile(index) as zipf:
+        assert sorted(zipf.namelist()) == ["com.example.a.png", "com.example.b.png", "product.inf"]
+        rows = zipf.read("product.inf").decode().splitlines()
+        assert [row.split(",")[2] for row in rows] == ["com.example.a", "com.example.b"]
+    with zipfile.ZipFile(versioned) as zipf:
+        assert sorted(zipf.namelist()) == ["com.example.b.png", "product.inf"]
+
+    # Rebuilding an unchanged index leaves the file alone so it keeps its ETag and Last-Modified time
+    os.utime(index, ns=(0, 1_000_000_000))
+    before = index.stat()
+    create_product_infz(None)
+    assert (index.stat().st_ino, index.stat().st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+
+    def get(etag=None, atak_version=None):
+        headers = {"If-None-Match": f'"{etag}"'} if etag else {}
+        with plan_app.test_request_context(headers=headers):
+            response = send_product_infz(atak_version)
+            if isinstance(response, tuple):
+                return response[1], None
+            response.close()
+            return response.status_code, response.get_etag()[0]
+
+    etag = hashlib.sha256(index.read_bytes()).hexdigest()
+    assert get() == (200, etag)
+    assert get(etag) == (304, etag)
+    assert get(atak_version="5.3") == (404, None)
+
+    # A changed package gets a new index and a client with the old one downloads it again
+    db.session.execute(update(Packages).values(version="2"))
+    db.session.commit()
+    create_product_infz(None)
+    assert index.stat().st_mtime_ns != before.st_mtime_ns
+    status, new_etag = get(etag)
+    assert status == 200 and new_etag == hashlib.sha256(index.read_bytes()).hexdigest() != etag
+    assert not [name for name in os.listdir(tmp_path / "packages") if name.endswith(".tmp")]
+
+
+def test_mission_cache(plan_app):
+    from opentakserver.models.Mission import Mission
+    from opentakserver.models.MissionContent import MissionContent
+    from opentakserver.models.MissionContentMission import MissionContentMission
+    from opentakserver.models.MissionLogEntry import MissionLogEntry
+    from opentakserver.models.MissionUID import MissionUID
+
+    plan_app.config.update(OTS_MISSION_CACHE_TTL=60, OTS_MISSION_CACHE_SIZE=1)
+    db.session.add(Mission(name="mission", tool="public"))
+    db.session.commit()
+
+    def etag():
+        versions = [
+            mission_version(mission, *version_columns)
+            for mission, *version_columns in db.session.execute(
+                select(Mission).add_columns(*mission_version_columns())
+            )
+        ]
+        return versions[0], missions_etag("https://ots.example.com/", False, versions)
+
+    version, first = etag()
+    assert etag() == (version, first)
+    cache = MissionCache()
+    cache.put("mission", "https://ots.example.com/", version, {"name": "mission"})
+    assert cache.get("mission", "https://ots.example.com/", version) == {"name": "mission"}
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    content = MissionContent(hash="abc", uid="content", submission_time=now)
+    db.session.add(content)
+    db.session.commit()
+    assert etag()[1] == first
+
+    etags = [first]
+    for change in [
+        MissionUID(uid="marker", mission_name="mission", timestamp=now),
+        MissionContentMission(mission_name="mission", mission_content_id=content.id),
+        MissionLogEntry(
+            mission_name="mission", content="log", creator_uid="ANDROID-1", entry_uid="entry"
+        ),
+    ]:
+        db.session.add(change)
+        db.session.commit()
+        etags.append(etag()[1])
+    assert len(set(etags)) == 4
+
+    # A client that has the old list gets all of it again while one that has the latest gets a 304
+    with plan_app.test_request_context(headers={"If-None-Match": f'"{etags[-1]}"'}):
+        assert request.if_none_match.contains(etags[-1])
+        assert not request.if_none_match.contains(first)
+
+    # The cached JSON of the old version isn't used any more
+    assert cache.get("mission", "https://ots.example.com/", etag()[0]) is None
+    assert cache.get("mission", "https://ots.example.com/", version) is None
+
+
+def test_mission_changes(plan_app, monkeypatch):
+    from opentakserver.blueprints.marti_api.mission_marti_api import mission_changes
+    from opentakserver.models.Mission import Mission
+    from opentakserver.models.MissionChange import MissionChange
+    from opentakserver.models.MissionContent import MissionContent
+    from opentakserver.models.MissionUID import MissionUID
+
+    # The blueprint's package exports the Blueprint under the module's name
+    monkeypatch.setitem(mission_changes.__globals__, "check_permission", lambda mission_name: True)
+    plan_app.config["OTS_NODE_ID"] = "node"
+    flask_babel.Babel(plan_app)
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    db.session.add_all([Mission(name="mission", tool="public"), Mission(name="other")])
+    db.session.add(MissionContent(hash="abc", uid="content", submission_time=now))
+    db.session.add(MissionUID(uid="marker", mission_name="mission", timestamp=now))
+    db.session.commit()
+
+    changes = [
+        ("CREATE_MISSION", None, None, 180),
+        ("ADD_CONTENT", "content", None, 120),
+        ("ADD_CONTENT", None, "marker", 120),
+        ("REMOVE_CONTENT", "content", None, 60),
+        ("CHANGE", None, None, 30),
+        ("ADD_CONTENT", None, "marker", 10),
+    ]
+    for change_type, content_uid, mission_uid, minutes_ago in changes:
+        timestamp = now - datetime.timedelta(minutes=minutes_ago)
+        db.session.add(
+            MissionChange(
+                isFederatedChange=False,
+                change_type=change_type,
+                mission_name="mission",
+                timestamp=timestamp,
+                creator_uid="ANDROID-1",
+                server_time=timestamp,
+                content_uid=content_uid,
+                mission_uid=mission_uid,
+            )
+        )
+    # A newer change to the same content in another mission doesn't squash this mission's
+    db.session.add(
+        MissionChange(
+            isFederatedChange=False,
+            change_type="ADD_CONTENT",
+            mission_name="other",
+            timestamp=now,
+            creator_uid="ANDROID-1",
+            server_time=now,
+            content_uid="content",
+        )
+    )
+    db.session.commit()
+
+    def get(**args):
+        with plan_app.test_request_context(query_string=args):
+            response = mission_changes("mission")
+            if isinstance(response, tuple):
+                return response[1], response[0].json
+            return response.status_code, json.loads(response.get_data())
+
+    status, body = get()
+    assert status == 200
+    assert body["version"] == "3" and body["type"] == "MissionChange" and body["nodeId"] == "node"
+    assert [change["type"] for change in body["data"]] == [change[0] for change in changes]
+    assert body["data"][1]["contentUid"] == "content"
+    assert body["data"][1]["contentResource"]["hash"] == "abc"
+    assert body["data"][2]["details"]["location"] == {"lat": None, "lon": None}
+
+    # Only the latest change to each piece of content or CoT, and every change to the mission
+    _, body = get(squashed="true")
+    assert [
+        (change["type"], change["contentUid"], change["missionGuid"]) for change in body["data"]
+    ] == [
+        ("CREATE_MISSION", None, None),
+        ("REMOVE_CONTENT", "content", None),
+        ("CHANGE", None, None),
+        ("ADD_CONTENT", None, "marker"),
+    ]
+
+    _, body = get(secago=90 * 60)
+    assert [change["type"] for change in body["data"]] == [
+        "REMOVE_CONTENT",
+        "CHANGE",
+        "ADD_CONTENT",
+    ]
+    _, body = get(
+        start=iso8601_string_from_datetime(now - datetime.timedelta(minutes=150)),
+        end=iso8601_string_from_datetime(now - datetime.timedelta(minutes=45)),
+    )
+    assert [change["type"] for change in body["data"]] == ["ADD_CONTENT"] * 2 + ["REMOVE_CONTENT"]
+    _, body = get(squashed="true", secago=20 * 60)
+    assert [change["type"] for change in body["data"]] == ["ADD_CONTENT"]
+
+    for args in [{"secago": "yesterday"}, {"start": "2024-05-01"}, {"end": "tomorrow"}]:
+        status, body = get(**args)
+        assert status == 400 and body["error"] == "Invalid secago, start or end time"
+
+
+def test_kml_export():
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    # A straight line with an hour long gap in the middle
+    points = [(start + datetime.timedelta(seconds=i), 0.00001 * i, 0.0) for i in range(100)]
+    points += [
+        (start + datetime.timedelta(hours=1, seconds=i), 0.001 + 0.00001 * i, 0.0)
+        for i in range(100)
+    ]
+
+    assert len(list(split_tracks(points))) == 200
+    tracks = list(split_tracks(points, datetime.timedelta(minutes=5), 1))
+    assert [point[:3] for point in tracks] == [points[0], points[99], points[100], points[199]]
+    assert [point[3] for point in tracks] == [True, False, True, False]
+
+    kml = "".join(track_kml("Track <1>", "Callsign", "files/team_cyan.png", tracks))
+    root = etree.fromstring(kml.encode())
+    gx = "{http://www.google.com/kml/ext/2.2}"
+    assert [len(track.findall(f"{gx}coord")) for track in root.iter(f"{gx}Track")] == [2, 2]
+
+    kmz_file = zipfile.ZipFile(io.BytesIO(b"".join(kmz([kml], {}))))
+    assert kmz_file.read("doc.kml").decode() == kml
+
+
+def test_partitions():
+    moment = datetime.datetime(2026, 10, 18, 17, 30)  # A Sunday
+    assert partition_start(moment, "day") == datetime.datetime(2026, 10, 18)
+    assert partition_start(moment, "week") == datetime.datetime(2026, 10, 12)
+    assert partition_name("cot", partition_start(moment, "week")) == "cot_p20261012"
+
+    bound = "FOR VALUES FROM ('2026-10-12 00:00:00') TO ('2026-10-19 00:00:00')"
+    assert BOUND_PATTERN.search(bound).groups() == ("2026-10-12 00:00:00", "2026-10-19 00:00:00")
+    assert BOUND_PATTERN.search("DEFAULT") is None
+
+
+# Set OTS_TEST_POSTGRESQL_URI to a throwaway database to also run these tests and the migrations on PostgreSQL
+PLAN_DATABASES = ["sqlite://"]
+if os.getenv("OTS_TEST_POSTGRESQL_URI"):
+    PLAN_DATABASES.append(os.getenv("OTS_TEST_POSTGRESQL_URI"))
+
+
+@contextlib.contextmanager
+def models_app(uri: str):
+    """A bare app with every table created from the models, without the rest of create_app()"""
+    import opentakserver.models
+
+    for module in pkgutil.iter_modules(opentakserver.models.__path__):
+        if module.name not in ("user", "role"):
+            __import__(f"opentakserver.models.{module.name}")
+    try:
+        fsqla.FsModels.set_db_info(db)
+    except exc.InvalidRequestError:
+        pass
+    import opentakserver.models.role
+    import opentakserver.models.user
+
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = uri
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.rollback()
+        db.drop_all()
+
+
+@pytest.fixture(params=PLAN_DATABASES, ids=lambda uri: uri.split(":")[0])
+def plan_app(request):
+    with models_app(request.param) as app:
+        yield app
+
+
+MIGRATIONS = os.path.join(os.path.dirname(opentakserver.__file__), "migrations")
+
+
+@contextlib.contextmanager
+def migrations_app():
+    """A bare app with an empty PostgreSQL database for running the migrations, which don't all run on SQLite"""
+    if not os.getenv("OTS_TEST_POSTGRESQL_URI"):
+        pytest.skip("OTS_TEST_POSTGRESQL_URI isn't set")
+
+    app = Flask(__name__)
+    app.config.from_object(DefaultConfig)
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.getenv("OTS_TEST_POSTGRESQL_URI")
+    db.init_app(app)
+    Migrate(app, db)
+    with app.app_context():
+        db.session.execute(text("DROP SCHEMA public CASCADE; CREATE SCHEMA public"))
+        db.session.commit()
+        yield app
+        db.session.rollback()
+        db.session.execute(text("DROP SCHEMA public CASCADE; CREATE SCHEMA public"))
+        db.session.commit()
+
+
+@pytest.fixture
+def migrated_app():
+    with migrations_app() as app:
+        yield app
+
+
+@pytest.fixture(params=["sqlite", "migrations"])
+def indexed_app(request):
+    """SQLite with the indexes declared on the models, and PostgreSQL with the ones the migrations create"""
+    if request.param == "sqlite":
+        with models_app("sqlite://") as app:
+            yield app
+    else:
+        with migrations_app() as app:
+            migrate("head")
+            yield app
+
+
+def migrate(revision: str):
+    # The migrations run on their own connection, which would wait for the session's locks
+    db.session.commit()
+    if revision.startswith("-"):
+        downgrade(directory=MIGRATIONS, revision=revision[1:])
+    else:
+        upgrade(directory=MIGRATIONS, revision=revision)
+    # Alembic's logging config disables the other loggers
+    logger.disabled = False
+
+
+def insert_rows(table: str, *rows: dict) -> list:
+    """Inserts rows into a table as it is at the current revision and returns their primary keys"""
+    reflected = sqlalchemy.Table(
+        table, sqlalchemy.MetaData(), autoload_with=db.session.connection()
+    )
+    return [
+        db.session.execute(insert(reflected).values(**row)).inserted_primary_key[0] for row in rows
+    ]
+
+
+def test_partition_migration(migrated_app):
+    migrated_app.config.update(OTS_PARTITION_INTERVAL="day", OTS_PARTITIONS_AHEAD=2)
+    migrate("7d3f0c5a9e21")
+
+    now = datetime.datetime.now().replace(microsecond=0)
+    old, new = now - datetime.timedelta(days=10), now - datetime.timedelta(hours=1)
+    insert_rows("euds", {"uid": "ANDROID-1"})
+    cot_ids = insert_rows(
+        "cot",
+        *(
+            {
+                "how": "h-g-i-g-o",
+                "type": "a-h-G",
+                "sender_uid": "ANDROID-1",
+                "xml": "<event/>",
+                "timestamp": timestamp,
+                "start": timestamp,
+                "stale": timestamp,
+            }
+            for timestamp in (old, new)
+        ),
+    )
+    point_ids = insert_rows(
+        "points",
+        *(
+            {
+                "uid": f"point-{cot_id}",
+                "device_uid": "ANDROID-1",
+                "cot_id": cot_id,
+                "timestamp": timestamp,
+            }
+            for cot_id, timestamp in zip(cot_ids, (old, new))
+        ),
+    )
+    for i, (cot_id, point_id, timestamp) in enumerate(zip(cot_ids, point_ids, (old, new))):
+        insert_rows(
+            "alerts",
+            {
+                "uid": f"alert-{i}",
+                "sender_uid": "ANDROID-1",
+                "start_time": timestamp,
+                "alert_type": "911",
+                "cot_id": cot_id,
+                "point_id": point_id,
+            },
+        )
+        insert_rows(
+            "casevac",
+            {
+                "uid": f"casevac-{i}",
+                "sender_uid": "ANDROID-1",
+                "timestamp": timestamp,
+                "title": "MEDEVAC",
+                "cot_id": cot_id,
+                "point_id": point_id,
+            },
+        )
+        insert_rows("markers", {"uid": f"marker-{i}", "cot_id": cot_id, "point_id": point_id})
+        insert_rows(
+            "video_streams",
+            {
+                "path": f"stream-{i}",
+                "protocol": "rtsp",
+                "port": 8554,
+                "network_timeout": 10000,
+                "ready": False,
+                "mediamtx_settings": "",
+                "cot_id": cot_id,
+            },
+        )
+    db.session.commit()
+
+    migrate("head")
+    connection = db.session.connection()
+    assert is_partitioned(connection, "cot") and is_partitioned(connection, "points")
+    assert partition_name("cot", partition_start(old, "day")) in [
+        name for name, start, end in list_partitions(connection, "cot")
+    ]
+    assert db.session.execute(text("SELECT COUNT(*) FROM points")).scalar() == 2
+    db.session.commit()
+
+    # The partitions holding the old rows are dropped along with the rows that referenced them
+    maintain_partitions(db.session.connection(), now - datetime.timedelta(days=5))
+    db.session.commit()
+    for table in ("cot", "points", "alerts", "casevac", "markers"):
+        assert db.session.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar() == 1, table
+    assert db.session.execute(
+        text("SELECT cot_id FROM video_streams ORDER BY path")
+    ).scalars().all() == [
+        None,
+        cot_ids[1],
+    ]
+
+    migrate("-7d3f0c5a9e21")
+    connection = db.session.connection()
+    assert not is_partitioned(connection, "cot") and not is_partitioned(connection, "points")
+    foreign_keys = set(
+        connection.execute(
+            text(
+                "SELECT conname FROM pg_constraint WHERE contype = 'f' "
+                "AND confrelid IN (CAST('cot' AS regclass), CAST('points' AS regclass))"
+            )
+        ).scalars()
+    )
+    assert foreign_keys == {constraint for constraint, *rest in FOREIGN_KEYS}
+
+    # The restored foreign keys are enforced and cascade again
+    with pytest.raises(exc.IntegrityError), db.session.begin_nested():
+        db.session.execute(text("DELETE FROM cot"))
+    db.session.execute(text("DELETE FROM video_streams"))
+    db.session.execute(text("DELETE FROM cot"))
+    for table in ("points", "alerts", "casevac", "markers"):
+        assert db.session.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar() == 0, table
+    db.session.commit()
+
+
+class FanoutChannel:
+    """Delivers what's published to an exchange to every queue bound to it, like RabbitMQ"""
+
+    def __init__(self):
+        self.bindings = {}
+        self.consumers = {}
+
+    def exchange_declare(self, exchange, **kwargs):
+        pass
+
+    def queue_declare(self, queue, **kwargs):
+        queue = queue or f"amq.gen-{len(self.consumers)}"
+        return type("Frame", (), {"method": type("Method", (), {"queue": queue})})
+
+    def queue_bind(self, exchange, queue, routing_key=None):
+        self.bindings.setdefault(exchange, []).append(queue)
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        self.consumers[queue] = on_message_callback
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        for queue in self.bindings.get(exchange, []):
+            self.consumers[queue](self, None, properties, body)
+
+
+def test_group_cache(plan_app):
+    from opentakserver.group_cache import GroupCache, group_cache, notify_group_change
+    from opentakserver.models.Group import Group
+    from opentakserver.models.GroupUser import GroupUser
+
+    user_ids = insert_rows(
+        "user",
+        *(
+            {"username": f"user-{i}", "active": True, "fs_uniquifier": f"user-{i}"}
+            for i in range(2)
+        ),
+    )
+    now = datetime.datetime.now()
+    cyan, red = insert_rows(
+        "groups",
+        *(
+            {"name": name, "type": "SYSTEM", "bitpos": i, "created": now}
+            for i, name in enumerate(["Cyan", "Red"])
+        ),
+    )
+    insert_rows(
+        "groups_users",
+        {"user_id": user_ids[0], "group_id": cyan, "direction": Group.IN, "enabled": True},
+        {"user_id": user_ids[0], "group_id": cyan, "direction": Group.OUT, "enabled": True},
+        {"user_id": user_ids[0], "group_id": red, "direction": Group.OUT, "enabled": False},
+        {"user_id": user_ids[1], "group_id": red, "direction": Group.OUT, "enabled": True},
+    )
+    db.session.commit()
+
+    queries = []
+
+    @sqlalchemy.event.listens_for(db.engine, "before_cursor_execute")
+    def count_query(connection, cursor, statement, *args):
+        queries.append(statement)
+
+    # The groups of another process, which hears about changes from the group_changes exchange
+    channel = FanoutChannel()
+    other_process = GroupCache()
+    other_process.subscribe(channel)
+    group_cache.invalidate()
+
+    for cache in (group_cache, other_process):
+        assert cache.group_names(user_ids[0], Group.OUT) == ["Cyan"]
+        assert cache.group_names(user_ids[0], Group.IN) == ["Cyan"]
+        assert cache.group_names(user_ids[1], Group.OUT) == ["Red"]
+    assert len(queries) == 4
+
+    # Cached until the change is published
+    db.session.execute(update(GroupUser).where(GroupUser.group_id == red).values(enabled=True))
+    db.session.commit()
+    queries.clear()
+    assert group_cache.group_names(user_ids[0], Group.OUT) == ["Cyan"] and not queries
+
+    notify_group_change(user_ids[0], channel)
+    for cache in (group_cache, other_process):
+        assert sorted(cache.group_names(user_ids[0], Group.OUT)) == ["Cyan", "Red"]
+        # Only that user's groups are loaded again
+        assert cache.group_names(user_ids[1], Group.OUT) == ["Red"]
+    assert len(queries) == 2
+
+    # Every user's groups when more than one user changed, or when a change can't be parsed
+    notify_group_change(None, channel)
+    assert not group_cache.groups and not other_process.groups
+    other_process.group_names(user_ids[1], Group.OUT)
+    channel.basic_publish("group_changes", "", b"not json")
+    assert not other_process.groups
+    sqlalchemy.event.remove(db.engine, "before_cursor_execute", count_query)
+    group_cache.invalidate()
+
+
+def test_map_state_delta(plan_app, monkeypatch):
+    from opentakserver import map_state
+    from opentakserver.map_state import delete_map_state
+    from opentakserver.models.MapState import MapState
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    save_map_state("euds", "ANDROID-1", {"callsign": "ALPHA"})
+    save_map_state("euds", "ANDROID-2", {"callsign": "BRAVO"})
+    save_map_state("markers", "marker-1", {"uid": "marker-1"}, now + datetime.timedelta(hours=1))
+    save_map_state("markers", "marker-2", {"uid": "marker-2"}, now - datetime.timedelta(hours=1))
+    # Saving an item again replaces it
+    save_map_state("euds", "ANDROID-1", {"callsign": "ALPHA-1"})
+    db.session.commit()
+
+    state = get_map_state()
+    assert sorted(eud["callsign"] for eud in state["euds"]) == ["ALPHA-1", "BRAVO"]
+    # Stale items aren't on the map
+    assert state["markers"] == [{"uid": "marker-1"}] and "deleted" not in state
+
+    db.session.execute(update(MapState).values(updated=now - datetime.timedelta(hours=1)))
+    db.session.commit()
+    since = now - datetime.timedelta(minutes=1)
+    assert get_map_state(since)["euds"] == []
+
+    # Only what changed since is returned, along with the UIDs of deleted items
+    save_map_state("euds", "ANDROID-2", {"callsign": "BRAVO-1"})
+    delete_map_state("markers", ["marker-1"])
+    db.session.commit()
+    state = get_map_state(since)
+    assert state["euds"] == [{"callsign": "BRAVO-1"}] and state["markers"] == []
+    assert state["deleted"] == {"euds": [], "markers": ["marker-1"], "rb_lines": [], "casevacs": []}
+    assert get_map_state()["markers"] == []
+
+    # Databases without an upsert update the row, or insert it if there isn't one
+    monkeypatch.setattr(map_state, "upsert", lambda values: None)
+    save_map_state("euds", "ANDROID-2", {"callsign": "BRAVO-2"})
+    save_map_state("euds", "ANDROID-3", {"callsign": "CHARLIE"})
+    db.session.commit()
+    assert sorted(eud["callsign"] for eud in get_map_state()["euds"]) == [
+        "ALPHA-1",
+        "BRAVO-2",
+        "CHARLIE",
+    ]
+
+    # Deleting every item of a kind
+    delete_map_state("euds")
+    db.session.commit()
+    assert get_map_state()["euds"] == []
+    assert sorted(get_map_state(since)["deleted"]["euds"]) == [
+        "ANDROID-1",
+        "ANDROID-2",
+        "ANDROID-3",
+    ]
+    assert db.session.execute(select(func.count()).select_from(MapState)).scalar() == 5
+
+
+def test_retention(plan_app):
+    from opentakserver.models.CoT import CoT
+    from opentakserver.models.MapState import MapState
+    from opentakserver.models.Marker import Marker
+    from opentakserver.retention import DeleteCoTPublisher, RetentionRun
+
+    plan_app.config.update(
+        OTS_DELETE_OLD_DATA_BATCH_SIZE=2, OTS_RABBITMQ_TTL="1000", OTS_NODE_ID="node"
+    )
+    cutoff = datetime.datetime(2026, 10, 18)
+    old, new = cutoff - datetime.timedelta(days=1), cutoff + datetime.timedelta(hours=1)
+    insert_rows("groups", {"name": "Cyan", "type": "SYSTEM", "bitpos": 0, "created": cutoff})
+    insert_rows("euds", {"uid": "ANDROID-1"})
+    cot_ids = insert_rows(
+        "cot",
+        *(
+            {
+                "how": "m-g",
+                "type": "a-h-G",
+                "sender_uid": "ANDROID-1",
+                "xml": b"<event/>",
+                "timestamp": timestamp,
+                "start": timestamp,
+                "stale": timestamp,
+            }
+            for timestamp in [old] * 5 + [new] * 2
+        ),
+    )
+    # Three expired markers and one that isn't
+    for i, cot_id in enumerate(cot_ids[3:]):
+        point_id = insert_rows(
+            "points", {"uid": f"point-{i}", "device_uid": "ANDROID-1", "timestamp": old}
+        )[0]
+        insert_rows(
+            "markers",
+            {
+                "uid": f"marker-{i}",
+                "cot_id": cot_id,
+                "point_id": point_id,
+                "production_time": old if i < 3 else new,
+            },
+        )
+        save_map_state("markers", f"marker-{i}", {"uid": f"marker-{i}"})
+    db.session.commit()
+
+    commits = []
+
+    @sqlalchemy.event.listens_for(db.engine, "commit")
+    def count_commit(connection):
+        commits.append(connection)
+
+    channel = FakeChannel(None)
+    retention = RetentionRun(DeleteCoTPublisher(channel))
+    assert retention.delete_with_cots(Marker, "markers", Marker.production_time <= cutoff) == 3
+    assert len(commits) == 2
+    assert db.session.execute(select(Marker.uid)).scalars().all() == ["marker-3"]
+    # A delete CoT for each marker went to every group and the firehose
+    assert [call[1] for call in channel.calls] == ["groups", "firehose"] * 3
+    delete_cot = etree.fromstring(json.loads(channel.calls[0][2])["cot"])
+    assert delete_cot.find(".//link").get("uid") == "marker-0"
+    assert delete_cot.find(".//link").get("type") == "a-h-G"
+    assert db.session.execute(
+        select(MapState.uid).where(MapState.deleted.is_(True)).order_by(MapState.uid)
+    ).scalars().all() == ["marker-0", "marker-1", "marker-2"]
+
+    commits.clear()
+    assert retention.delete(CoT, CoT.timestamp <= cutoff) == 5
+    assert len(commits) == 3
+    assert db.session.execute(select(CoT.id)).scalars().all() == cot_ids[5:]
+    assert retention.delete(CoT, CoT.timestamp <= cutoff) == 0
+
+    assert retention.deleted == {"markers": 3, "cot": 5}
+    assert retention.summary(cutoff).startswith("Deleted 8 rows older than 2026-10-18T00:00:00")
+    assert retention.summary(cutoff).endswith("and sent 3 delete CoTs")
+    sqlalchemy.event.remove(db.engine, "commit", count_commit)
+
+
+def test_production_time_migration(migrated_app):
+    migrate("b9fc2d692fc2")
+    production_times = [
+        "2026-10-18T12:00:00.500Z",
+        "2026-10-18T12:00:00Z",
+        "2026-10-18T14:00:00+02:00",
+        "not a time",
+        None,
+    ]
+    insert_rows("euds", {"uid": "ANDROID-1"})
+    point_id = insert_rows(
+        "points",
+        {"uid": "point", "device_uid": "ANDROID-1", "timestamp": datetime.datetime(2026, 10, 18)},
+    )[0]
+    insert_rows(
+        "markers",
+        *(
+            {"uid": f"marker-{i}", "point_id": point_id, "production_time": production_time}
+            for i, production_time in enumerate(production_times)
+        ),
+    )
+
+    migrate("7d3f0c5a9e21")
+    assert db.session.execute(
+        text("SELECT production_time FROM markers ORDER BY id")
+    ).scalars().all() == [
+        datetime.datetime(2026, 10, 18, 12, 0, 0, 500000),
+        datetime.datetime(2026, 10, 18, 12),
+        datetime.datetime(2026, 10, 18, 12),
+        None,
+        None,
+    ]
+
+    migrate("-b9fc2d692fc2")
+    assert db.session.execute(
+        text("SELECT production_time FROM markers ORDER BY id")
+    ).scalars().all() == [
+        "2026-10-18T12:00:00.500000Z",
+        "2026-10-18T12:00:00.000000Z",
+        "2026-10-18T12:00:00.000000Z",
+        None,
+        None,
+    ]
+
+
+def explain(statement) -> str:
+    connection = db.session.connection()
+    compiled = statement.compile(dialect=connection.dialect)
+    if connection.dialect.name == "sqlite":
+        parameters = tuple(compiled.params[name] for name in compiled.positiontup)
+        rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", parameters).all()
+        return "\n".join(row[-1] for row in rows)
+
+    rows = connection.exec_driver_sql(f"EXPLAIN {compiled}", compiled.params).all()
+    return "\n".join(row[0] for row in rows)
+
+
+def test_query_plans(indexed_app):
+    """The hot lookups have to be served by the indexes the models declare and the migrations create rather than
+    reading the whole table"""
+    from opentakserver.models.CoT import CoT
+    from opentakserver.models.EUD import EUD
+    from opentakserver.models.EUDStats import EUDStats
+    from opentakserver.models.Group import Group
+    from opentakserver.models.GroupUser import GroupUser
+    from opentakserver.models.Icon import Icon
+    from opentakserver.models.MapState import MapState
+    from opentakserver.models.Marker import Marker
+    from opentakserver.models.MissionChange import MissionChange
+    from opentakserver.models.MissionContentMission import MissionContentMission
+    from opentakserver.models.MissionUID import MissionUID
+    from opentakserver.models.Point import Point
+
+    now = datetime.datetime(2026, 10, 18)
+    db.session.execute(insert(EUD), [{"uid": f"ANDROID-{i}"} for i in range(10)])
+    db.session.execute(
+        insert(CoT),
+        [
+            {
+                "how": "m-g",
+                "type": "a-f-G-U-C",
+                "sender_uid": f"ANDROID-{i % 10}",
+                "uid": f"ANDROID-{i % 10}",
+                "xml": b"<event/>",
+                "timestamp": now + datetime.timedelta(seconds=i),
+                "start": now,
+                "stale": now + datetime.timedelta(seconds=i),
+            }
+            for i in range(200)
+        ],
+    )
+    db.session.execute(
+        insert(Point),
+        [
+            {
+                "uid": f"point-{i}",
+                "device_uid": f"ANDROID-{i % 10}",
+                "latitude": 0.0,
+                "longitude": 0.0,
+                "timestamp": now + datetime.timedelta(seconds=i),
+            }
+            for i in range(200)
+        ],
+    )
+    insert_rows("missions", *({"name": f"mission-{i}", "expiration": -1} for i in range(10)))
+    db.session.execute(
+        insert(MissionChange),
+        [
+            {
+                "isFederatedChange": False,
+                "change_type": MissionChange.CHANGE,
+                "mission_name": f"mission-{i % 10}",
+                "timestamp": now + datetime.timedelta(seconds=i),
+                "creator_uid": "ANDROID-1",
+                "server_time": now,
+            }
+            for i in range(200)
+        ],
+    )
+    user_ids = insert_rows(
+        "user",
+        *(
+            {"username": f"user-{i}", "active": True, "fs_uniquifier": f"user-{i}"}
+            for i in range(10)
+        ),
+    )
+    group_ids = insert_rows(
+        "groups",
+        *({"name": f"group-{i}", "type": "SYSTEM", "bitpos": i, "created": now} for i in range(20)),
+    )
+    db.session.execute(
+        insert(GroupUser),
+        [
+            {"user_id": user_id, "group_id": group_id, "direction": direction, "enabled": enabled}
+            for user_id in user_ids
+            for group_id in group_ids
+            for direction, enabled in ((Group.IN, True), (Group.OUT, group_id % 2 == 0))
+        ],
+    )
+    # SQLite plans without statistics, like it does until something runs ANALYZE
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(text("ANALYZE"))
+        # Small tables are cheaper to scan, so make the planner use any index that fits
+        db.session.execute(text("SET enable_seqscan = off"))
+        full_scan = re.compile(r"Seq Scan on (\w+)")
+        index_scan = r"(Index (Only )?Scan (Backward )?using|Bitmap Index Scan on) {index} "
+    else:
+        full_scan = re.compile(r"^SCAN (\w+)(?: AS \w+)?$", re.MULTILINE)
+        index_scan = r"USING (COVERING )?INDEX {index}\b"
+
+    # Query -> the index that has to serve it
+    queries = {
+        # map_state.get_map_state
+        "map state": (
+            select(MapState.kind, MapState.uid, MapState.data).where(MapState.updated >= now),
+            "ix_map_state_updated",
+        ),
+        "unexpired cots": (select(CoT.id).where(CoT.stale >= now), "ix_cot_stale"),
+        # CoT history and mission CoTs
+        "cots by uid": (
+            select(CoT).where(CoT.uid == "ANDROID-1").order_by(CoT.timestamp),
+            "ix_cot_uid_timestamp",
+        ),
+        "cots by sender": (
+            select(CoT.id).where(CoT.sender_uid == "ANDROID-1").order_by(CoT.timestamp),
+            "ix_cot_sender_uid_timestamp",
+        ),
+        "mission cots": (
+            select(CoT.xml).where(CoT.mission_name == "mission").order_by(CoT.timestamp, CoT.id),
+            "ix_cot_mission_name_timestamp",
+        ),
+        # Track exports
+        "eud track": (
+            select(Point.timestamp, Point.latitude, Point.longitude)
+            .where(Point.device_uid == "ANDROID-1")
+            .order_by(Point.timestamp),
+            "ix_points_device_uid_timestamp",
+        ),
+        "eud stats": (
+            select(EUDStats)
+            .where(EUDStats.eud_uid == "ANDROID-1")
+            .order_by(EUDStats.id.desc())
+            .limit(50),
+            "ix_eud_stats_eud_uid_id",
+        ),
+        # group_cache
+        "user groups": (
+            select(Group.name, GroupUser.direction)
+            .join(GroupUser.group)
+            .where(GroupUser.user_id == 1, GroupUser.enabled == true()),
+            "ix_groups_users_user_id_direction_enabled",
+        ),
+        "mission uids": (
+            select(MissionUID).where(MissionUID.mission_name == "mission"),
+            "ix_mission_uids_mission_name",
+        ),
+        "mission contents": (
+            select(MissionContentMission).where(MissionContentMission.mission_name == "mission"),
+            "ix_mission_content_mission_mission_name",
+        ),
+        "mission changes": (
+            select(MissionChange)
+            .where(MissionChange.mission_name == "mission")
+            .order_by(MissionChange.timestamp),
+            "ix_mission_changes_mission_name_timestamp",
+        ),
+        "icon by filename": (select(Icon).where(Icon.filename == "icon.png"), "ix_icons_filename"),
+        # Cascading deletes
+        "markers of a point": (
+            select(Marker.uid).where(Marker.point_id == 1),
+            "ix_markers_point_id",
+        ),
+        "markers of a cot": (select(Marker.uid).where(Marker.cot_id == 1), "ix_markers_cot_id"),
+        "points of a cot": (select(Point.uid).where(Point.cot_id == 1), "ix_points_cot_id"),
+    }
+    # retention.RetentionRun.delete
+    for column in (CoT.timestamp, Point.timestamp, Marker.production_time):
+        table = column.class_.__tablename__
+        queries[f"expired {table}"] = (
+            select(column.class_.id).where(column <= now).limit(5000),
+            f"ix_{table}_{column.key}",
+        )
+
+    for name, (query, index) in queries.items():
+        plan = explain(query)
+        assert not full_scan.search(plan), f"{name} reads the whole table:\n{plan}"
+        assert re.search(
+            index_scan.format(index=index), plan
+        ), f"{name} doesn't use {index}:\n{plan}"
+
+
+def test_cot_parser_batch(plan_app):
+    from opentakserver.cot_parser.cot_parser import CoTController
+    from opentakserver.defaultconfig import DefaultConfig
+    from opentakserver.models.Chatrooms import Chatroom
+    from opentakserver.models.CoT import CoT
+    from opentakserver.models.EUD import EUD
+    from opentakserver.models.GeoChat import GeoChat
+    from opentakserver.models.Marker import Marker
+
+    for key in dir(DefaultConfig):
+        if key.startswith("OTS_"):
+            plan_app.config.setdefault(key, getattr(DefaultConfig, key))
+    db.session.execute(insert(EUD).values(uid="ANDROID-1", callsign="ALPHA"))
+    db.session.commit()
+
+    commits = []
+    sent = []
+
+    @sqlalchemy.event.listens_for(db.engine, "commit")
+    def count_commit(connection):
+        commits.append(connection)
+
+    class SocketIO:
+        def emit(self, event, data, namespace=None):
+            sent.append((event, len(commits)))
+
+    class Channel:
+        def basic_publish(self, exchange, routing_key, body, properties=None):
+            sent.append((exchange, len(commits)))
+
+    def event(uid, cot_type, detail="", lat=40.1):
+        return (
+            f'<event version="2.0" uid="{uid}" type="{cot_type}" how="h-g-i-g-o" time="2024-05-01T12:00:00Z" '
+            f'start="2024-05-01T12:00:00Z" stale="2024-05-02T12:00:00Z"><point lat="{lat}" lon="-73.2" hae="0" '
+            f'ce="9999999" le="9999999"/><detail>{detail}</detail></event>'
+        )
+
+    def chat(uid):
+        return event(
+            uid,
+            "b-t-f",
+            '<__chat id="All Chat Rooms" chatroom="All Chat Rooms"><chatgrp uid0="ANDROID-1" '
+            'uid1="All Chat Rooms" id="All Chat Rooms"/></__chat>'
+            '<remarks time="2024-05-01T12:00:00Z">Hello</remarks>',
+        )
+
+    controller = CoTController(plan_app.app_context(), plan_app.logger, db, SocketIO())
+    controller.rabbit_channel = Channel()
+
+    def handle(*cots):
+        batch = [
+            controller.decode_message(tag, {"uid": "ANDROID-1", "cot": cot})
+            for tag, cot in enumerate(cots)
+        ]
+        controller.handle_batch(batch)
+        return batch
+
+    # Upserts of the same marker and chat room in one batch don't roll it back
+    batch = handle(
+        event("ANDROID-1", "a-f-G-U-C", '<takv platform="ATAK-CIV"/>'),
+        event("marker-1", "a-h-G", '<contact callsign="H.1"/>'),
+        event("marker-1", "a-h-G", '<contact callsign="H.2"/>', lat=40.2),
+        chat("chat-1"),
+        chat("chat-2"),
+    )
+    assert not any(message.failed for message in batch)
+    assert len(commits) == 1
+    assert ("marker", 1) in sent and all(commits_before == 1 for _, commits_before in sent)
+
+    # One bad message in a batch only fails itself, and the others are saved once
+    batch = handle(
+        event("marker-2", "a-h-G"),
+        event("casevac-1", "b-r-f-h-c", '<_medevac_ no_such_column="1"/>'),
+    )
+    assert [message.failed for message in batch] == [False, True]
+
+    sqlalchemy.event.remove(db.engine, "commit", count_commit)
+    db.session.expire_all()
+    assert db.session.scalar(select(func.count()).select_from(CoT)) == 6
+    assert db.session.scalar(select(Marker.callsign).filter_by(uid="marker-1")) == "H.2"
+    assert db.session.scalar(select(func.count()).select_from(Marker)) == 2
+    assert db.session.scalar(select(func.count()).select_from(GeoChat)) == 2
+    assert db.session.scalar(select(func.count()).select_from(Chatroom)) == 1
+
+
+def test_cot_parser_pli_coalescing(plan_app, monkeypatch):
+    from opentakserver.cot_parser.cot_parser import CoTController
+    from opentakserver.defaultconfig import DefaultConfig
+    from opentakserver.models.EUD import EUD
+    from opentakserver.models.Point import Point
+
+    for key in dir(DefaultConfig):
+        if key.startswith("OTS_"):
+            plan_app.config.setdefault(key, getattr(DefaultConfig, key))
+    plan_app.config.update(OTS_PLI_COALESCING=True, OTS_PLI_GROUP_INTERVAL=5)
+    db.session.execute(insert(EUD).values(uid="ANDROID-1", callsign="ALPHA"))
+    save_map_state(
+        "euds", "ANDROID-1", {"uid": "ANDROID-1", "callsign": "ALPHA", "last_point": None}
+    )
+    db.session.commit()
+
+    clock = [1000.0]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    published = []
+    timers = []
+
+    class SocketIO:
+        def emit(self, event, data, namespace=None):
+            pass
+
+    class Channel:
+        def basic_publish(self, exchange, routing_key, body, properties=None):
+            published.append(
+                (routing_key, re.search(r'lat="([\d.]+)"', json.loads(body)["cot"])[1])
+            )
+
+        def basic_ack(self, delivery_tag, multiple=False):
+            pass
+
+    class Connection:
+        def call_later(self, delay, callback):
+            timers.append((delay, callback))
+            return len(timers)
+
+        def remove_timeout(self, timer):
+            pass
+
+    controller = CoTController(plan_app.app_context(), plan_app.logger, db, SocketIO())
+    controller.rabbit_channel = Channel()
+    controller.rabbit_connection = Connection()
+
+    def pli(lat, seconds):
+        clock[0] = 1000 + seconds
+        controller.batch = [
+            controller.decode_message(
+                0,
+                {
+                    "uid": "ANDROID-1",
+                    "cot": f'<event version="2.0" uid="ANDROID-1" type="a-f-G-U-C" how="m-g" '
+                    f'time="2024-05-01T12:00:{seconds:02d}Z" start="2024-05-01T12:00:00Z" '
+                    f'stale="2024-05-02T12:00:00Z"><point lat="{lat}" lon="-73.2" hae="0" ce="10" '
+                    f'le="10"/><detail><takv platform="ATAK-CIV"/></detail></event>',
+                },
+            )
+        ]
+        controller.flush()
+
+    pli("40.1", 0)
+    # Moved, but the group already got a PLI in the last 5 seconds
+    pli("40.11", 1)
+    last_point = get_map_state()["euds"][0]["last_point"]
+    assert (last_point["latitude"], last_point["callsign"]) == (40.11, "ALPHA")
+    # Inside the dead-bands, it isn't stored in the history but is the EUD's newest position
+    pli("40.11001", 2)
+    assert published == [("__ANON__.OUT", "40.1")]
+    db.session.expire_all()
+    assert db.session.execute(select(Point.latitude, Point.timestamp).order_by(Point.id)).all() == [
+        (40.1, datetime.datetime(2024, 5, 1, 12, 0, 0)),
+        (40.11, datetime.datetime(2024, 5, 1, 12, 0, 1)),
+    ]
+    last_point = get_map_state()["euds"][0]["last_point"]
+    assert (last_point["latitude"], last_point["timestamp"]) == (
+        40.11001,
+        "2024-05-01T12:00:02.0000Z",
+    )
+
+    # The group gets the newest PLI once its interval passes, even though the EUD stopped reporting
+    delay, callback = timers[-1]
+    assert delay == 4
+    clock[0] += delay
+    callback()
+    assert published == [("__ANON__.OUT", "40.1"), ("__ANON__.OUT", "40.11001")]
+    assert controller.pli_filter.next_due() is None
+
+
+def test_keyset_pagination(plan_app):
+    from opentakserver.models.CoT import CoT
+
+    now = datetime.datetime(2026, 10, 18)
+    db.session.execute(
+        insert(CoT),
+        [
+            {
+                "how": "m-g",
+                "type": "a-f-G-U-C",
+                # Repeated and missing sort values
+                "sender_callsign": f"callsign-{i % 7}" if i % 5 else None,
+                "uid": f"ANDROID-{i}",
+                "xml": "<event/>",
+                "timestamp": now + datetime.timedelta(seconds=i % 3),
+                "start": now,
+                "stale": now,
+            }
+            for i in range(50)
+        ],
+    )
+
+    for sort_by in (None, "sender_callsign", "timestamp"):
+        for direction in ("asc", "desc"):
+            # Ties are broken by id in the same direction and NULLs come last
+            expected = sorted(
+                db.session.query(CoT).all(), key=lambda cot: cot.id, reverse=direction == "desc"
+            )
+            if sort_by:
+                expected = sorted(
+                    [cot for cot in expected if getattr(cot, sort_by) is not None],
+                    key=lambda cot: getattr(cot, sort_by),
+                    reverse=direction == "desc",
+                ) + [cot for cot in expected if getattr(cot, sort_by) is None]
+
+            rows, cursor = keyset_page(db.session.query(CoT), CoT, sort_by, direction, None, 8)
+            while cursor:
+                page, cursor = keyset_page(db.session.query(CoT), CoT, None, "asc", cursor, 8)
+                rows += page
+            assert [cot.id for cot in rows] == [cot.id for cot in expected], (sort_by, direction)
+
+    cursor = encode_cursor("timestamp", "desc", [now, 1])
+    assert decode_cursor(cursor) == ("timestamp", "desc", [now.isoformat(), 1])
+    with pytest.raises(InvalidCursor):
+        decode_cursor("not a cursor")
+    with pytest.raises(InvalidCursor):
+        keyset_page(db.session.query(CoT), CoT, "to_json", "asc", None, 8)
+
+
+def cot_events(count: int) -> list[str]:
+    return [
+        f'<event version="2.0" uid="ANDROID-{i % 20}" type="a-f-G-U-C" how="m-g" '
+        f'time="2026-10-18T00:00:{i % 60:02d}.000Z" start="2026-10-18T00:00:{i % 60:02d}.000Z" '
+        f'stale="2026-10-18T00:02:{i % 60:02d}.000Z"><point lat="38.{i}" lon="-77.{i}" hae="10.0" '
+        f'ce="9.9" le="9999999.0"/><detail><contact callsign="CALLSIGN-{i % 20}"/>'
+        f'<__group name="Cyan" role="Team Member"/><status battery="{i % 100}"/></detail></event>'
+        for i in range(count)
+    ]
+
+
+def test_cot_storage(plan_app):
+    storage = CoTStorage()
+    storage.dictionary_size = 4096
+    events = cot_events(500)
+
+    for codec in CODECS:
+        payload = storage.encode(events[0], codec)
+        decoded = storage.decode(payload)
+        if codec == "protobuf":
+            # Protobuf keeps the contents of the event but not how the XML was written
+            assert etree.fromstring(decoded).find("detail/contact").get("callsign") == "CALLSIGN-0"
+        else:
+            assert decoded == events[0]
+
+    # Rows stored before the column was binary and unknown formats are read as plain XML
+    assert storage.decode(events[0]) == events[0]
+    assert storage.decode(None) is None
+
+    without_dictionary = storage.encode(events[1], "zstd")
+    dictionary_id = storage.train_dictionary(events)
+    with_dictionary = storage.encode(events[1], "zstd")
+    assert with_dictionary.startswith(ZSTD_MAGIC) and len(with_dictionary) < len(without_dictionary)
+
+    # Another process finds the dictionary in the database by the ID in the frame and compresses with it too
+    other = CoTStorage()
+    assert other.decode(with_dictionary) == events[1]
+    other.load_dictionaries()
+    assert other.dictionary.dict_id() == dictionary_id
+    assert db.session.get(CoTDictionary, dictionary_id).data == other.dictionary.as_bytes()
+
+    # CoTs compressed with a dictionary that's gone can't be read
+    db.session.execute(delete(CoTDictionary))
+    db.session.commit()
+    with pytest.raises(ValueError):
+        CoTStorage().decode(with_dictionary)
+
+
+def test_cot_dictionary_migration(migrated_app):
+    migrate("head")
+
+    events = cot_events(500)
+    dictionary = zstandard.train_dictionary(4096, [event.encode() for event in events])
+    insert_rows(
+        "cot_dictionaries",
+        {
+            "id": dictionary.dict_id(),
+            "data": dictionary.as_bytes(),
+            "created": datetime.datetime.now(),
+        },
+    )
+    insert_rows("euds", {"uid": "ANDROID-1"})
+    cot = {
+        "how": "m-g",
+        "type": "a-f-G-U-C",
+        "sender_uid": "ANDROID-1",
+        "timestamp": datetime.datetime(2026, 10, 18),
+        "start": datetime.datetime(2026, 10, 18),
+        "stale": datetime.datetime(2026, 10, 18),
+    }
+    insert_rows(
+        "cot",
+        {**cot, "xml": zstandard.ZstdCompressor(dict_data=dictionary).compress(events[1].encode())},
+        {**cot, "xml": zlib.compress(events[2].encode())},
+        {**cot, "xml": events[3].encode()},
+    )
+
+    # Downgrading decompresses the CoTs with the dictionaries in the table before dropping it
+    migrate("-5c2d9e8a7b14")
+    assert not inspect(db.engine).has_table("cot_dictionaries")
+    assert db.session.execute(text("SELECT xml FROM cot ORDER BY id")).scalars().all() == [
+        events[1],
+        events[2],
+        events[3],
+    ]
+
+
+def test_pli_filter():
+    def pli(lat, lon, course=0.0, uid="ANDROID-1", dest=""):
+        return decode_cot(
+            f'<event version="2.0" uid="{uid}" type="a-f-G-U-C" how="m-g" time="2026-10-18T00:00:00Z" '
+            f'start="2026-10-18T00:00:00Z" stale="2026-10-18T00:02:00Z"><point lat="{lat}" lon="{lon}" '
+            f'hae="0" ce="9999999" le="9999999"/><detail><track course="{course}" speed="1"/>{dest}'
+            f"</detail></event>"
+        )
+
+    assert 110 < distance(0, 0, 0.001, 0) < 112
+    assert PLIFilter.is_pli(pli(0, 0), "ANDROID-1")
+    assert not PLIFilter.is_pli(pli(0, 0, uid="marker"), "ANDROID-1")
+    assert not PLIFilter.is_pli(pli(0, 0, dest='<marti><dest callsign="a"/></marti>'), "ANDROID-1")
+
+    pli_filter = PLIFilter(5, 15, 30, 2, {"Slow": 10})
+    assert pli_filter.store(pli(0, 0), now=0)
+    # Inside every dead-band
+    assert not pli_filter.store(pli(0.00001, 0), now=1)
+    assert not pli_filter.store(pli(0, 0, course=350), now=2)
+    # Moved, turned or the time dead-band passed. Dead-bands are measured from the last stored PLI
+    assert pli_filter.store(pli(0.0001, 0), now=3)
+    assert pli_filter.store(pli(0.0001, 0, course=90), now=4)
+    assert not pli_filter.store(pli(0.0001, 0, course=90), now=33)
+    assert pli_filter.store(pli(0.0001, 0, course=90), now=34)
+
+    assert pli_filter.forward("ANDROID-1", "Cyan", True, now=0)
+    assert not pli_filter.forward("ANDROID-1", "Cyan", True, now=1)
+    assert pli_filter.forward("ANDROID-1", "Cyan", True, now=2)
+    assert pli_filter.forward("ANDROID-1", "Slow", True, now=2)
+    assert not pli_filter.forward("ANDROID-1", "Slow", True, now=11)
+    # PLIs inside the dead-bands only go out once per time dead-band
+    assert not pli_filter.forward("ANDROID-1", "Cyan", False, now=31)
+    assert pli_filter.forward("ANDROID-1", "Cyan", False, now=32)
+
+    # The newest PLI a group didn't get is sent once its interval passes
+    assert pli_filter.forward("ANDROID-1", "Slow", True, "first", now=13)
+    assert not pli_filter.forward("ANDROID-1", "Slow", True, "second", now=14)
+    assert not pli_filter.forward("ANDROID-1", "Slow", False, "third", now=15)
+    assert pli_filter.next_due() == 23
+    assert pli_filter.due(now=22) == []
+    assert pli_filter.due(now=23) == [("Slow", "third")]
+    assert pli_filter.next_due() is None
+    assert not pli_filter.forward("ANDROID-1", "Slow", True, "fourth", now=24)
+    # Unless a newer PLI got through first
+    assert pli_filter.forward("ANDROID-1", "Slow", True, "fifth", now=33)
+    assert pli_filter.due(now=40) == []
+
+    assert pli_filter.counters == {
+        "stored": 4,
+        "suppressed": 3,
+        "forwarded": 6,
+        "rate_limited": 6,
+        "delayed": 1,
+    }